@@ -1,3 +1,4 @@
+import click
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
@@ -18,7 +19,7 @@ cors = CORS()
 jwt = JWTManager()
 
 # Import Redis Manager
-from .redis_config import redis_manager
+from .redis_config import redis_manager, register_cache_invalidation
 
 def create_app():
     app = Flask(__name__)
@@ -42,8 +43,22 @@ def create_app():
             "keepalives_idle": 600,
             "keepalives_interval": 30,
             "keepalives_count": 3,
+            # Fail lock waits instead of hanging a worker; the retry policy re-runs the operation
+            "options": f"-c lock_timeout={os.getenv('DB_LOCK_TIMEOUT_MS', '5000')}",
         },
     }
+    app.config["DB_LOCK_RETRIES"] = int(os.getenv("DB_LOCK_RETRIES", 3))
+    app.config["DB_LOCK_RETRY_BACKOFF"] = float(os.getenv("DB_LOCK_RETRY_BACKOFF", 0.05))
+    # Embed the permission bitmask in access tokens; permission changes then apply at next login
+    app.config["JWT_PERMISSION_CLAIMS"] = os.getenv("JWT_PERMISSION_CLAIMS", "false").lower() in ("1", "true", "yes")
+    # Per-request query counts/DB time (Server-Timing, logs, /sql/stats) and the
+    # repeated-statement (N+1) warning threshold
+    app.config["SQL_INSTRUMENTATION"] = os.getenv("SQL_INSTRUMENTATION", "true").lower() in ("1", "true", "yes")
+    app.config["SQL_REPEAT_WARN_THRESHOLD"] = int(os.getenv("SQL_REPEAT_WARN_THRESHOLD", 10))
+    # Background jobs: how long finished jobs (and results) stay readable at
+    # /jobs/<id>, and default retries for failing tasks
+    app.config["JOB_RESULT_TTL"] = int(os.getenv("JOB_RESULT_TTL", 86400))
+    app.config["JOB_MAX_RETRIES"] = int(os.getenv("JOB_MAX_RETRIES", 3))
 
     # Initialize extensions
     db.init_app(app)
@@ -65,6 +80,47 @@ def create_app():
     # Initialize Redis
     redis_manager.init_app(app)
 
+    # Session hooks: cache invalidation, the per-(item, location) stock summary,
+    # cached employee permission sets, cached reference rows, the stock
+    # change log used for delta sync and live change events; request, pool,
+    # Redis and operation metrics for /metrics
+    from .stock_summary import register_stock_summary, rebuild_stock_summary
+    from .permissions import register_permission_invalidation
+    from .reference_cache import register_reference_invalidation
+    from .stock_changes import register_stock_changes, prune_stock_changes
+    from .events.event import register_change_events
+    from .instrumentation import init_instrumentation
+    from .metrics import init_metrics
+    with app.app_context():
+        register_cache_invalidation(db.session)
+        register_stock_summary(db.session)
+        register_permission_invalidation(db.session)
+        register_reference_invalidation(db.session)
+        register_stock_changes(db.session)
+        register_change_events(db.session)
+        init_instrumentation(app, db.engine)
+        init_metrics(app, db.engine, db.session, redis_manager.redis_client)
+
+    @app.cli.command("rebuild-stock-summary")
+    def rebuild_stock_summary_command():
+        """Rebuild the stock_summary table from item locations and price layers"""
+        count = rebuild_stock_summary()
+        print(f"Rebuilt stock summary: {count} rows")
+
+    @app.cli.command("prune-stock-changes")
+    @click.option("--days", default=30, show_default=True, help="Keep changes newer than this many days")
+    def prune_stock_changes_command(days):
+        """Delete old stock change log entries (clients older than that reload in full)"""
+        count = prune_stock_changes(days)
+        print(f"Pruned stock changes: {count} rows")
+
+    @app.cli.command("jobs-worker")
+    @click.option("--burst", is_flag=True, help="Exit once the queue is empty")
+    def jobs_worker_command(burst):
+        """Run background jobs (imports, purchase recalculations) from the Redis queue"""
+        from .jobs.job import run_worker
+        run_worker(app, burst=burst)
+
     # Initialize Flask-RestX API
     api = Api(
         app,
@@ -82,6 +138,8 @@ def create_app():
     from .warehouses.warehouse import item_location_ns, warehouse_ns
     from .auth import auth_ns
     from .reports.report import reports_ns
+    from .events.event import events_ns
+    from .jobs.job import jobs_ns
 
     main_ns = Namespace("", description="Main API endpoints")
 
@@ -109,7 +167,9 @@ def create_app():
                     "mechanisms": "/mechanisms/",
                     "suppliers": "/suppliers/",
                     "reports": "/reports/",
+                    "jobs": "/jobs/<job_id>",
                     "cache": "/cache/",
+                    "metrics": "/metrics",
                 },
             }
 
@@ -125,7 +185,8 @@ def create_app():
     @main_ns.route("/cache/status")
     class CacheStatus(Resource):
         def get(self):
-            """Get cache status"""
+            """Get cache status, with per-endpoint hit rates and stored entry sizes"""
+            from .redis_config import get_cache_stats, cache_codec_info
             if redis_manager.redis_client:
                 try:
                     info = redis_manager.redis_client.info()
@@ -134,12 +195,35 @@ def create_app():
                         "redis_version": info.get('redis_version'),
                         "used_memory": info.get('used_memory_human'),
                         "connected_clients": info.get('connected_clients'),
-                        "total_commands_processed": info.get('total_commands_processed')
+                        "total_commands_processed": info.get('total_commands_processed'),
+                        "codec": cache_codec_info(),
+                        "endpoints": get_cache_stats()
                     }, 200
                 except Exception as e:
                     return {"status": "error", "message": str(e)}, 500
             else:
-                return {"status": "disconnected", "message": "Redis not available"}, 200
+                return {
+                    "status": "disconnected",
+                    "message": "Redis not available",
+                    "codec": cache_codec_info(),
+                    "endpoints": get_cache_stats()
+                }, 200
+
+    @main_ns.route("/sql/stats")
+    class SqlStats(Resource):
+        def get(self):
+            """Per-endpoint query counts and DB time, heaviest first"""
+            from .instrumentation import get_sql_stats
+            return {
+                "repeat_warn_threshold": app.config["SQL_REPEAT_WARN_THRESHOLD"],
+                "endpoints": get_sql_stats()
+            }, 200
+
+        def delete(self):
+            """Reset the per-endpoint SQL statistics"""
+            from .instrumentation import reset_sql_stats
+            reset_sql_stats()
+            return {"message": "SQL statistics reset"}, 200
 
     api.add_namespace(warehouse_ns)
     api.add_namespace(invoice_ns)
@@ -150,6 +234,8 @@ def create_app():
     api.add_namespace(item_location_ns)
     api.add_namespace(supplier_ns)
     api.add_namespace(reports_ns)
+    api.add_namespace(events_ns)
+    api.add_namespace(jobs_ns)
     api.add_namespace(main_ns)
 
     return app
\ No newline at end of file
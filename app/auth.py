@@ -5,6 +5,8 @@ from sqlalchemy import desc
 from . import db
 from .models import Employee
 from .utils import parse_bool
+from .permissions import permission_claims
+from .pagination import add_cursor_arguments, count_rows, keyset_page, page_count
 from pprint import pp
 
 # Create namespace
@@ -26,6 +28,7 @@ pagination_parser.add_argument('all',
                                required=False,
                                default=True,
                                help='Get all items (default: True) \naccepts values [\'true\', \'false\', \'1\', \'0\', \'t\', \'f\', \'y\', \'n\', \'yes\', \'no\']')
+add_cursor_arguments(pagination_parser)
 
 # Create Invoice Permissions
 create_invoice_model = auth_ns.model('CreateInvoicePermissions', {
@@ -189,7 +192,8 @@ pagination_model = auth_ns.model('UsersPagination', {
     'page_size': fields.Integer(required=True),
     'total_pages': fields.Integer(required=True),
     'total_items': fields.Integer(required=True),
-    'all': fields.Boolean(required=True)
+    'all': fields.Boolean(required=True),
+    'next_cursor': fields.String(description='Cursor of the next page (cursor mode only)')
 })
 
 change_password_model = auth_ns.model('ChangePassword', {
@@ -349,7 +353,10 @@ class Login(Resource):
         if not employee or not check_password_hash(employee.password_hash, data['password']):
             auth_ns.abort(401, "Invalid credentials")
 
-        access_token = create_access_token(identity=str(employee.id))
+        access_token = create_access_token(
+            identity=str(employee.id),
+            additional_claims=permission_claims(employee)
+        )
         return {"access_token": access_token}, 200
 
 @auth_ns.route('/user/<int:user_id>/change-password')
@@ -513,19 +520,23 @@ class Users(Resource):
         # Add DESC ordering by id
         query = Employee.query.order_by(desc(Employee.id))
         
-        if not all_results:
+        next_cursor = None
+        if args['cursor'] is not None:
+            employees, next_cursor = keyset_page(query, Employee.id, args['cursor'], page_size)
+        elif not all_results:
             employees = query.limit(page_size).offset(offset).all()
         else:
             employees = query.all()
 
-        total_count = Employee.query.count()
+        total_count = count_rows(query, args['count'], Employee)
         return {
             'users': employees,
-            'page': page,
+            'page': page if args['cursor'] is None else None,
             'page_size': page_size,
-            'total_pages': (total_count + page_size - 1) // page_size,
+            'total_pages': page_count(total_count, page_size),
             'total_items': total_count,
-            'all': all_results
+            'all': all_results if args['cursor'] is None else False,
+            'next_cursor': next_cursor
         }, 200
 
 @auth_ns.route('/user')
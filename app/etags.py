@@ -0,0 +1,62 @@
+import hashlib
+from functools import wraps
+
+from flask import request, Response
+from flask_jwt_extended import verify_jwt_in_request
+
+from .redis_config import request_cache_key, resolve_tags, tag_versions
+
+ETAG_CACHE_CONTROL = "private, no-cache"
+
+
+def compute_etag(tags, scope=None, view_kwargs=None):
+    """
+    Strong ETag of the current request from the version stamps of ``tags``
+    (one Redis MGET), or None when versions are unavailable.
+    """
+    versions = tag_versions(tags)
+    if versions is None:
+        return None
+    key = request_cache_key("etag", scope, view_kwargs)
+    return hashlib.sha1(f"{key}|{'|'.join(versions)}".encode()).hexdigest()
+
+
+def _with_etag(result, etag):
+    headers = {"ETag": f'"{etag}"', "Cache-Control": ETAG_CACHE_CONTROL}
+    if isinstance(result, Response):
+        if result.status_code < 300:
+            result.headers.update(headers)
+        return result
+    if not isinstance(result, tuple):
+        return result, 200, headers
+    data = result[0]
+    status_code = result[1] if len(result) > 1 else 200
+    extra = result[2] if len(result) > 2 else None
+    if not isinstance(status_code, int) or status_code >= 300:
+        return result
+    return data, status_code, {**dict(extra or {}), **headers}
+
+
+def conditional_get(tags=(), scope=None):
+    """
+    Answer ``If-None-Match`` with 304 before the view runs any query.
+
+    The ETag combines the route, query args and optional ``scope`` with the
+    version stamps of ``tags`` (format strings filled from the view kwargs, as
+    in ``cache_result``); a commit touching a tagged table or row changes it.
+    Use it as the outermost decorator, above ``marshal_with``. Without Redis
+    the view runs normally and no ETag is sent.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            verify_jwt_in_request()
+            etag = compute_etag(resolve_tags(tags, kwargs), scope() if scope else None, kwargs)
+            if etag is None:
+                return func(*args, **kwargs)
+            if request.if_none_match.contains_weak(etag):
+                return Response(status=304, headers={"ETag": f'"{etag}"', "Cache-Control": ETAG_CACHE_CONTROL})
+            return _with_etag(func(*args, **kwargs), etag)
+
+        return wrapper
+    return decorator
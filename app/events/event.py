@@ -0,0 +1,238 @@
+import json
+import os
+import queue
+import threading
+import time
+
+from flask import Response, stream_with_context
+from flask_restx import Namespace, Resource
+from flask_jwt_extended import jwt_required
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import attributes
+
+from .. import db
+from ..models import Invoice, ItemLocations, RentalWarehouseLocations
+from ..permissions import allowed_invoice_types, current_permissions
+from ..redis_config import redis_manager
+
+events_ns = Namespace('events', description='Live change events (Server-Sent Events)')
+
+stream_parser = events_ns.parser()
+stream_parser.add_argument('types',
+                           type=str,
+                           required=False,
+                           help='Comma-separated event type prefixes to receive, e.g. "invoice,stock" (default: all)')
+stream_parser.add_argument('jwt',
+                           type=str,
+                           required=False,
+                           help='Access token, for EventSource clients that cannot send headers')
+
+EVENTS_CHANNEL = "warehouse_app:events"
+PENDING_EVENTS_KEY = 'pending_change_events'
+# Events buffered per connection before it is told to resync
+SUBSCRIBER_QUEUE_SIZE = 1000
+# Seconds between keep-alive comments, and before a stream is closed so the
+# worker is freed (EventSource reconnects on its own)
+SSE_KEEPALIVE = 15
+SSE_MAX_DURATION = 300
+SSE_RETRY_MS = 3000
+
+
+# ---- Collecting events: after flush, published after commit ----
+
+def _invoice_events(session):
+    events = []
+    for obj in session.new:
+        if isinstance(obj, Invoice):
+            events.append((obj, {'type': 'invoice.created', 'id': obj.id, 'invoice_type': obj.type, 'status': obj.status}))
+    for obj in session.dirty:
+        if isinstance(obj, Invoice) and session.is_modified(obj):
+            history = attributes.get_history(obj, 'status')
+            kind = 'invoice.status_changed' if history.added else 'invoice.updated'
+            events.append((obj, {'type': kind, 'id': obj.id, 'invoice_type': obj.type, 'status': obj.status}))
+    for obj in session.deleted:
+        if isinstance(obj, Invoice):
+            events.append((obj, {'type': 'invoice.deleted', 'id': obj.id, 'invoice_type': obj.type}))
+    return events
+
+
+def _stock_events(session):
+    events = []
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if not isinstance(obj, (ItemLocations, RentalWarehouseLocations)):
+            continue
+        if obj in session.dirty and not session.is_modified(obj):
+            continue
+        payload = {
+            'type': 'rental_stock.changed' if isinstance(obj, RentalWarehouseLocations) else 'stock.changed',
+            'item_id': obj.item_id,
+            'location': obj.location,
+            'quantity': None if obj in session.deleted else obj.quantity,
+        }
+        events.append((obj, payload))
+    return events
+
+
+def _collect_events(session, flush_context):
+    events = _invoice_events(session) + _stock_events(session)
+    if events:
+        session.info.setdefault(PENDING_EVENTS_KEY, []).extend(events)
+
+
+def _publish_on_commit(session):
+    pending = session.info.pop(PENDING_EVENTS_KEY, None)
+    if not pending:
+        return
+    # Rows added inside a savepoint that was rolled back are transient again
+    events = [payload for obj, payload in pending if obj is None or not inspect(obj).transient]
+    if events:
+        publish_events(events)
+
+
+def queue_events(session, payloads):
+    """Queue events for rows written with raw SQL; published on commit like flushed ones"""
+    session.info.setdefault(PENDING_EVENTS_KEY, []).extend((None, payload) for payload in payloads)
+
+
+def _discard_on_rollback(session):
+    session.info.pop(PENDING_EVENTS_KEY, None)
+
+
+def register_change_events(session):
+    if event.contains(session, 'after_flush', _collect_events):
+        return
+    event.listen(session, 'after_flush', _collect_events)
+    event.listen(session, 'after_commit', _publish_on_commit)
+    event.listen(session, 'after_rollback', _discard_on_rollback)
+
+
+def publish_events(events):
+    """Fan events out to every worker (Redis pub/sub), or to this worker's streams without Redis"""
+    message = json.dumps({'events': events}, ensure_ascii=False, default=str)
+    if redis_manager.redis_client:
+        try:
+            redis_manager.redis_client.publish(EVENTS_CHANNEL, message)
+            return
+        except Exception as e:
+            pass
+    broker.dispatch(message)
+
+
+# ---- Per-worker broker: one Redis subscription shared by every open stream ----
+
+class EventBroker:
+    def __init__(self):
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def _ensure_listener(self):
+        client = redis_manager.redis_client
+        if not client or self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        try:
+            pubsub = client.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(**{EVENTS_CHANNEL: lambda raw: self.dispatch(raw['data'])})
+            pubsub.run_in_thread(sleep_time=1.0, daemon=True)
+        except Exception as e:
+            self._pid = None
+
+    def subscribe(self):
+        self._ensure_listener()
+        subscriber = queue.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        with self._lock:
+            self._subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def dispatch(self, message):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait(message)
+            except queue.Full:
+                # A stalled client: drop its backlog and tell it to reload
+                try:
+                    while True:
+                        subscriber.get_nowait()
+                except queue.Empty:
+                    pass
+                subscriber.put_nowait(None)
+
+
+broker = EventBroker()
+
+
+def _format_event(payload):
+    return f"event: {payload['type']}\ndata: {json.dumps(payload, ensure_ascii=False, default=str)}\n\n"
+
+
+def _visible(payload, prefixes, invoice_types):
+    if payload['type'] == 'resync':
+        return True
+    if prefixes and not any(payload['type'].startswith(prefix) for prefix in prefixes):
+        return False
+    if payload['type'].startswith('invoice.'):
+        return payload.get('invoice_type') in invoice_types
+    return True
+
+
+def event_stream(prefixes, invoice_types):
+    subscriber = broker.subscribe()
+    started = time.monotonic()
+    try:
+        yield f"retry: {SSE_RETRY_MS}\n\n"
+        while time.monotonic() - started < SSE_MAX_DURATION:
+            try:
+                message = subscriber.get(timeout=SSE_KEEPALIVE)
+            except queue.Empty:
+                yield ": keep-alive\n\n"
+                continue
+            if message is None:
+                yield _format_event({'type': 'resync'})
+                continue
+            for payload in json.loads(message)['events']:
+                if _visible(payload, prefixes, invoice_types):
+                    yield _format_event(payload)
+    finally:
+        broker.unsubscribe(subscriber)
+
+
+@events_ns.route('/stream')
+class EventStream(Resource):
+    @events_ns.expect(stream_parser)
+    @jwt_required(locations=['headers', 'query_string'])
+    def get(self):
+        """
+        Stream change events as text/event-stream.
+
+        Events: invoice.created, invoice.status_changed, invoice.updated,
+        invoice.deleted (only invoice types the caller may view),
+        stock.changed and rental_stock.changed (item_id, location, quantity;
+        quantity is null when the location was removed), and resync when the
+        client fell behind or a bulk import changed too much to list, and has
+        to reload (sent whatever the types filter). They are hints: fetch
+        the affected rows for full data. Streams close after a few minutes and
+        EventSource reconnects; run the API on threaded or gevent workers so
+        open streams do not hold every worker.
+        """
+        args = stream_parser.parse_args()
+        prefixes = [prefix.strip() for prefix in (args.get('types') or '').split(',') if prefix.strip()]
+        invoice_types = set(allowed_invoice_types(current_permissions()))
+        # The stream never touches the database: give the connection the
+        # permission lookup may have checked out back to the pool now, not
+        # when the stream ends (up to SSE_MAX_DURATION later)
+        db.session.remove()
+        return Response(
+            stream_with_context(event_stream(prefixes, invoice_types)),
+            mimetype="text/event-stream",
+            headers={
+                "Cache-Control": "no-cache",
+                "X-Accel-Buffering": "no",
+            },
+        )
@@ -0,0 +1,188 @@
+from datetime import datetime
+from sqlalchemy import tuple_
+
+from .models import Prices, InvoicePriceDetail
+from . import db
+from .serializers import chunked, index_by
+
+# Number of open price layers fetched per round trip while consuming
+FIFO_BATCH_SIZE = 20
+
+
+def _layer_key(layer):
+    return (layer.invoice_id, layer.location, layer.supplier_id)
+
+
+def open_layers(item_id, location=None, batch_size=FIFO_BATCH_SIZE):
+    """
+    Yield the open (quantity > 0) price layers of an item, oldest first.
+
+    Layers are read in keyset pages of ``batch_size`` rows so a caller that stops
+    early never loads the rest of the item's history. Exhausted layers are kept in
+    the table for price detail references and are never read here.
+    """
+    last_key = None
+    while True:
+        query = Prices.query.filter(Prices.item_id == item_id, Prices.quantity > 0)
+        if location is not None:
+            query = query.filter(Prices.location == location)
+        if last_key is not None:
+            query = query.filter(tuple_(Prices.invoice_id, Prices.location, Prices.supplier_id) > last_key)
+
+        page = query.order_by(
+            Prices.invoice_id.asc(), Prices.location.asc(), Prices.supplier_id.asc()
+        ).limit(batch_size).all()
+
+        for layer in page:
+            yield layer
+
+        if len(page) < batch_size:
+            return
+        last_key = _layer_key(page[-1])
+
+
+def latest_layer(item_id, location=None):
+    """Most recent price layer of an item, open or exhausted"""
+    query = Prices.query.filter(Prices.item_id == item_id)
+    if location is not None:
+        query = query.filter(Prices.location == location)
+    return query.order_by(Prices.invoice_id.desc()).first()
+
+
+def has_open_layers(item_id, location=None):
+    """True when the item still has an open price layer (at ``location`` if given)"""
+    return next(open_layers(item_id, location, batch_size=1), None) is not None
+
+
+def _price_slice(layer, quantity, precision):
+    unit_price = layer.unit_price
+    subtotal = quantity * unit_price
+    if precision is not None:
+        unit_price = round(unit_price, precision)
+        subtotal = round(subtotal, precision)
+    return {
+        'quantity': quantity,
+        'unit_price': unit_price,
+        'subtotal': subtotal,
+        'source_invoice_id': layer.invoice_id,
+        'source_item_id': layer.item_id,
+        'source_location': layer.location,
+        'source_supplier_id': layer.supplier_id,
+    }
+
+
+def consume(item_id, quantity, location=None, invoice_id=None, precision=None, fill_from_latest=False):
+    """
+    Take ``quantity`` units of an item from its oldest open price layers.
+
+    Args:
+        item_id: The warehouse item ID
+        quantity: Units to consume
+        location: Restrict consumption to one location (None = all locations)
+        invoice_id: When given, an InvoicePriceDetail row is written per slice
+        precision: Round unit prices and subtotals to this many decimals
+        fill_from_latest: Price any quantity left once the open layers run out at
+            the most recent layer's price instead of reporting it as remaining
+
+    Returns:
+        dict with total, remaining (units that could not be priced), breakdown
+        (one dict per layer slice) and details (the InvoicePriceDetail rows)
+    """
+    breakdown = []
+    remaining = quantity
+
+    if remaining > 0:
+        for layer in open_layers(item_id, location):
+            taken = min(remaining, layer.quantity)
+            layer.quantity -= taken
+            remaining -= taken
+            breakdown.append(_price_slice(layer, taken, precision))
+            if remaining <= 0:
+                break
+
+    if remaining > 0 and fill_from_latest:
+        layer = latest_layer(item_id, location)
+        if layer:
+            breakdown.append(_price_slice(layer, remaining, precision))
+            remaining = 0
+
+    total = sum(entry['subtotal'] for entry in breakdown)
+    if precision is not None:
+        total = round(total, precision)
+
+    details = []
+    if invoice_id is not None and breakdown:
+        details = [
+            InvoicePriceDetail(
+                invoice_id=invoice_id,
+                item_id=item_id,
+                source_price_invoice_id=entry['source_invoice_id'],
+                source_price_item_id=entry['source_item_id'],
+                source_price_location=entry['source_location'],
+                source_price_supplier_id=entry['source_supplier_id'],
+                quantity=entry['quantity'],
+                unit_price=entry['unit_price'],
+                subtotal=entry['subtotal']
+            )
+            for entry in breakdown
+        ]
+        db.session.add_all(details)
+
+    return {
+        'total': total,
+        'remaining': remaining,
+        'breakdown': breakdown,
+        'details': details,
+    }
+
+
+def restore(details, proportion=1):
+    """
+    Return the quantities recorded in price details to their source layers.
+
+    ``proportion`` restores only that share of each detail (partial returns).
+    Layers are loaded in batched IN queries on the full primary key; a layer that
+    no longer exists is recreated with the detail's unit price.
+    """
+    restorations = {}
+    for detail in details:
+        quantity = detail.quantity if proportion == 1 else int(detail.quantity * proportion)
+        if quantity <= 0:
+            continue
+        key = (
+            detail.source_price_invoice_id,
+            detail.source_price_item_id,
+            detail.source_price_location,
+            detail.source_price_supplier_id or 0,
+        )
+        if key in restorations:
+            restorations[key]['quantity'] += quantity
+        else:
+            restorations[key] = {'quantity': quantity, 'unit_price': detail.unit_price}
+
+    if not restorations:
+        return
+
+    columns = tuple_(Prices.invoice_id, Prices.item_id, Prices.location, Prices.supplier_id)
+    layers = {}
+    for batch in chunked(restorations.keys()):
+        layers.update(index_by(
+            Prices.query.filter(columns.in_(batch)).all(),
+            lambda row: (row.invoice_id, row.item_id, row.location, row.supplier_id)
+        ))
+
+    for key, restoration in restorations.items():
+        layer = layers.get(key)
+        if layer:
+            layer.quantity += restoration['quantity']
+        else:
+            invoice_id, item_id, location, supplier_id = key
+            db.session.add(Prices(
+                invoice_id=invoice_id,
+                item_id=item_id,
+                location=location,
+                supplier_id=supplier_id,
+                quantity=restoration['quantity'],
+                unit_price=restoration['unit_price'],
+                created_at=datetime.now()
+            ))
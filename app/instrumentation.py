@@ -0,0 +1,193 @@
+import hashlib
+import json
+import re
+import time
+from collections import Counter, defaultdict
+
+from flask import current_app, g, has_app_context, request
+from sqlalchemy import event
+
+from .redis_config import redis_manager
+
+SQL_STATS_KEY = "warehouse_app:sql_stats"
+SQL_STATS_FIELDS = ('requests', 'queries', 'db_ms', 'max_queries', 'repeated')
+REQUEST_STATS_KEY = 'sql_request_stats'
+
+_local_sql_stats = defaultdict(float)
+
+# Literals and expanded IN lists are folded so one statement shape gets one fingerprint
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_LITERAL = re.compile(r"\b\d+(?:\.\d+)?\b")
+_PLACEHOLDER = re.compile(r"%\([^)]*\)s|\?|(?<!:):(?!:)\w+|\$\d+")
+_VALUE_LIST = re.compile(r"\((?:\s*\?\s*,)+\s*\?\s*\)")
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_statement(statement):
+    statement = _STRING_LITERAL.sub('?', statement)
+    statement = _PLACEHOLDER.sub('?', statement)
+    statement = _NUMBER_LITERAL.sub('?', statement)
+    statement = _VALUE_LIST.sub('(?)', statement)
+    return _WHITESPACE.sub(' ', statement).strip()
+
+
+def fingerprint(statement):
+    """Short hash of a statement's shape (literals, bound values and IN list lengths ignored)"""
+    return hashlib.md5(normalize_statement(statement).encode()).hexdigest()[:12]
+
+
+def _request_stats():
+    if not has_app_context():
+        return None
+    return g.get(REQUEST_STATS_KEY)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _request_stats() is not None:
+        conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = _request_stats()
+    started = conn.info.get('query_started')
+    if stats is None or not started:
+        return
+    elapsed = time.perf_counter() - started.pop()
+    key = fingerprint(statement)
+    stats['queries'] += 1
+    stats['db_time'] += elapsed
+    stats['shapes'][key] += 1
+    stats['samples'].setdefault(key, statement)
+
+
+def _handle_error(exception_context):
+    # The failed statement never reaches after_cursor_execute
+    started = exception_context.connection.info.get('query_started') if exception_context.connection else None
+    if started:
+        started.pop()
+
+
+def _start_request():
+    setattr(g, REQUEST_STATS_KEY, {
+        'started': time.perf_counter(),
+        'queries': 0,
+        'db_time': 0.0,
+        'shapes': Counter(),
+        'samples': {},
+    })
+
+
+def _finish_request(response):
+    stats = g.pop(REQUEST_STATS_KEY, None)
+    if stats is None:
+        return response
+
+    total_ms = (time.perf_counter() - stats['started']) * 1000
+    db_ms = stats['db_time'] * 1000
+    threshold = current_app.config.get("SQL_REPEAT_WARN_THRESHOLD", 10)
+    repeated = [(key, count) for key, count in stats['shapes'].most_common() if count > threshold]
+
+    response.headers.add(
+        'Server-Timing',
+        f'db;dur={db_ms:.1f};desc="{stats["queries"]} queries", app;dur={total_ms - db_ms:.1f}'
+    )
+
+    endpoint = request.endpoint or request.path
+    current_app.logger.info(json.dumps({
+        'event': 'request_sql',
+        'method': request.method,
+        'path': request.path,
+        'endpoint': endpoint,
+        'status': response.status_code,
+        'queries': stats['queries'],
+        'db_ms': round(db_ms, 1),
+        'total_ms': round(total_ms, 1),
+        'distinct_statements': len(stats['shapes']),
+    }, ensure_ascii=False))
+    for key, count in repeated:
+        current_app.logger.warning(json.dumps({
+            'event': 'repeated_statement',
+            'endpoint': endpoint,
+            'fingerprint': key,
+            'count': count,
+            'threshold': threshold,
+            'statement': normalize_statement(stats['samples'][key])[:500],
+        }, ensure_ascii=False))
+
+    record_sql_stats(f"{request.method} {endpoint}", stats['queries'], db_ms, bool(repeated))
+    return response
+
+
+# ---- Per-endpoint aggregates (shared across workers through Redis when available) ----
+
+def record_sql_stats(endpoint, queries, db_ms, repeated):
+    if redis_manager.redis_client:
+        try:
+            pipe = redis_manager.redis_client.pipeline()
+            pipe.hincrby(SQL_STATS_KEY, f"{endpoint}|requests", 1)
+            pipe.hincrby(SQL_STATS_KEY, f"{endpoint}|queries", queries)
+            pipe.hincrbyfloat(SQL_STATS_KEY, f"{endpoint}|db_ms", db_ms)
+            if repeated:
+                pipe.hincrby(SQL_STATS_KEY, f"{endpoint}|repeated", 1)
+            pipe.hget(SQL_STATS_KEY, f"{endpoint}|max_queries")
+            current_max = pipe.execute()[-1]
+            if current_max is None or int(current_max) < queries:
+                redis_manager.redis_client.hset(SQL_STATS_KEY, f"{endpoint}|max_queries", queries)
+            return
+        except Exception as e:
+            pass
+    _local_sql_stats[f"{endpoint}|requests"] += 1
+    _local_sql_stats[f"{endpoint}|queries"] += queries
+    _local_sql_stats[f"{endpoint}|db_ms"] += db_ms
+    _local_sql_stats[f"{endpoint}|repeated"] += int(repeated)
+    _local_sql_stats[f"{endpoint}|max_queries"] = max(_local_sql_stats[f"{endpoint}|max_queries"], queries)
+
+
+def get_sql_stats():
+    """Per-endpoint request count, queries per request, DB time and repeated-statement requests"""
+    raw = dict(_local_sql_stats)
+    if redis_manager.redis_client:
+        try:
+            raw = {field: float(value) for field, value in redis_manager.redis_client.hgetall(SQL_STATS_KEY).items()}
+        except Exception as e:
+            pass
+
+    endpoints = defaultdict(lambda: dict.fromkeys(SQL_STATS_FIELDS, 0))
+    for field, value in raw.items():
+        endpoint, _, stat = field.rpartition('|')
+        endpoints[endpoint][stat] = value
+
+    table = []
+    for endpoint, values in endpoints.items():
+        requests = values['requests'] or 1
+        table.append({
+            'endpoint': endpoint,
+            'requests': int(values['requests']),
+            'avg_queries': round(values['queries'] / requests, 1),
+            'max_queries': int(values['max_queries']),
+            'avg_db_ms': round(values['db_ms'] / requests, 1),
+            'total_db_ms': round(values['db_ms'], 1),
+            'repeated_statement_requests': int(values['repeated']),
+        })
+    return sorted(table, key=lambda row: row['total_db_ms'], reverse=True)
+
+
+def reset_sql_stats():
+    _local_sql_stats.clear()
+    if redis_manager.redis_client:
+        try:
+            redis_manager.redis_client.delete(SQL_STATS_KEY)
+        except Exception as e:
+            pass
+
+
+def init_instrumentation(app, engine):
+    """Count queries and DB time per request; see SQL_INSTRUMENTATION / SQL_REPEAT_WARN_THRESHOLD"""
+    if not app.config.get("SQL_INSTRUMENTATION", True):
+        return
+    if not event.contains(engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+        event.listen(engine, 'handle_error', _handle_error)
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
@@ -0,0 +1,404 @@
+import json
+import os
+import signal
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from flask import current_app, request
+from flask_restx import Namespace, Resource
+from flask_jwt_extended import jwt_required, get_jwt_identity
+
+from .. import db
+from ..redis_config import redis_manager
+from ..utils import parse_bool
+
+jobs_ns = Namespace('jobs', description='Background jobs (imports, recalculations)')
+
+# Durable job state lives outside the "warehouse_app:" cache namespace, which
+# clear_all_cache() and /cache/clear wipe
+JOB_KEY_PREFIX = "warehouse_jobs:job:"
+JOB_QUEUE_KEY = "warehouse_jobs:queue"
+# Retries waiting for their backoff: sorted set of job ids by due time
+JOB_DELAYED_KEY = "warehouse_jobs:delayed"
+# Jobs a worker has taken, kept until they finish so a dead worker's job is re-queued
+JOB_PROCESSING_PREFIX = "warehouse_jobs:processing:"
+WORKER_KEY_PREFIX = "warehouse_jobs:worker:"
+WORKER_HEARTBEAT_TTL = 30
+# A worker refreshes its heartbeat this often, also while a job runs
+WORKER_HEARTBEAT_INTERVAL = 10
+WORKER_POLL_TIMEOUT = 1
+# Finished jobs (and their results) are kept this long; JOB_RESULT_TTL and
+# JOB_MAX_RETRIES in the app config override the defaults
+JOB_RESULT_TTL = 86400
+JOB_MAX_RETRIES = 3
+JOB_RETRY_BACKOFF = 5
+# Threads running jobs in-process when Redis is not available
+LOCAL_JOB_WORKERS = 2
+
+QUEUED, RUNNING, RETRYING, SUCCEEDED, FAILED = 'queued', 'running', 'retrying', 'succeeded', 'failed'
+FINISHED = (SUCCEEDED, FAILED)
+JSON_FIELDS = ('payload', 'result')
+PUBLIC_FIELDS = (
+    'id', 'task', 'status', 'progress', 'message', 'attempts', 'max_retries',
+    'created_at', 'started_at', 'finished_at', 'result', 'error',
+)
+
+# task name -> (function(payload, job), max retries or None for JOB_MAX_RETRIES)
+TASKS = {}
+
+# Without Redis, job state lives in this process only: behind several API
+# processes (gunicorn workers), /jobs/<id> answers 404 from the others.
+# Multi-process deployments need Redis and a ``flask jobs-worker``.
+_local_jobs = {}
+_local_lock = threading.Lock()
+_local_executor = {'pid': None, 'executor': None}
+
+
+class JobFailed(Exception):
+    """A job failure that retrying cannot fix (bad input, business rule)"""
+
+    def __init__(self, message, result=None):
+        super().__init__(message)
+        self.result = result
+
+
+def job_task(name, max_retries=None):
+    """Register ``func(payload, job)`` as a background task; its return value is the job result"""
+    def decorator(func):
+        TASKS[name] = (func, max_retries)
+        return func
+    return decorator
+
+
+def job_response(body, status_code):
+    """
+    Turn an endpoint-style (body, status) pair into a task result: a 4xx
+    fails the job, a 5xx (database error, lock timeout) is retried.
+    """
+    if status_code >= 400:
+        message = body.get('message') or f"Failed with status {status_code}"
+        if status_code >= 500:
+            raise RuntimeError(message)
+        raise JobFailed(message, result=body)
+    return body
+
+
+def wants_async():
+    """True when the request asked for a background job (?async=true)"""
+    value = request.args.get('async')
+    return value is not None and parse_bool(value)
+
+
+def job_accepted(job_id):
+    return {'job_id': job_id, 'status': QUEUED, 'status_url': f"/jobs/{job_id}"}, 202
+
+
+# ---- Job records: a Redis hash per job, or a dict without Redis ----
+
+def _now():
+    return datetime.now().isoformat(timespec='seconds')
+
+
+def _result_ttl():
+    return current_app.config.get("JOB_RESULT_TTL", JOB_RESULT_TTL)
+
+
+def _max_retries(task):
+    max_retries = TASKS[task][1]
+    return current_app.config.get("JOB_MAX_RETRIES", JOB_MAX_RETRIES) if max_retries is None else max_retries
+
+
+def _encode(fields):
+    return {
+        key: json.dumps(value, ensure_ascii=False, default=str) if key in JSON_FIELDS else ('' if value is None else value)
+        for key, value in fields.items()
+    }
+
+
+def _decode(record):
+    job = {}
+    for key, value in record.items():
+        if key in JSON_FIELDS:
+            job[key] = json.loads(value) if value else None
+        elif key in ('progress', 'attempts', 'max_retries'):
+            job[key] = int(float(value or 0))
+        else:
+            job[key] = value if value != '' else None
+    return job
+
+
+def _is_local(job_id):
+    # Jobs queued while Redis was unavailable stay in-process for their whole life
+    return job_id in _local_jobs or not redis_manager.redis_client
+
+
+def _save(job_id, **fields):
+    if not _is_local(job_id):
+        redis_manager.redis_client.hset(f"{JOB_KEY_PREFIX}{job_id}", mapping=_encode(fields))
+        return
+    with _local_lock:
+        _local_jobs.setdefault(job_id, {}).update(fields)
+
+
+def get_job(job_id, include_payload=False):
+    """Job record as a dict (see PUBLIC_FIELDS), or None when unknown or expired"""
+    with _local_lock:
+        job = dict(_local_jobs[job_id]) if job_id in _local_jobs else None
+    if job is None and redis_manager.redis_client:
+        try:
+            record = redis_manager.redis_client.hgetall(f"{JOB_KEY_PREFIX}{job_id}")
+        except Exception as e:
+            return None
+        job = _decode(record) if record else None
+    if job is not None and not include_payload:
+        job.pop('payload', None)
+    return job
+
+
+class JobContext:
+    """Handed to a running task so it can report progress"""
+
+    def __init__(self, job_id):
+        self.id = job_id
+
+    def progress(self, percent, message=None):
+        fields = {'progress': max(0, min(100, int(percent)))}
+        if message is not None:
+            fields['message'] = message
+        try:
+            _save(self.id, **fields)
+        except Exception as e:
+            pass
+
+
+def enqueue(task, payload, employee_id=None):
+    """
+    Queue ``task`` with a JSON-serializable payload and return the job id.
+
+    With Redis the job waits for a worker (``flask jobs-worker``); without it
+    the job runs on a thread of this process and only this process can report
+    its status (fine for a single-process server, see _local_jobs).
+    """
+    if task not in TASKS:
+        raise ValueError(f"Unknown job task: {task}")
+    job_id = uuid.uuid4().hex
+    record = {
+        'id': job_id,
+        'task': task,
+        'status': QUEUED,
+        'progress': 0,
+        'message': None,
+        'attempts': 0,
+        'max_retries': _max_retries(task),
+        'employee_id': employee_id,
+        'worker': None,
+        'created_at': _now(),
+        'started_at': None,
+        'finished_at': None,
+        'payload': payload,
+        'result': None,
+        'error': None,
+    }
+    client = redis_manager.redis_client
+    if client:
+        try:
+            pipe = client.pipeline()
+            pipe.hset(f"{JOB_KEY_PREFIX}{job_id}", mapping=_encode(record))
+            pipe.lpush(JOB_QUEUE_KEY, job_id)
+            pipe.execute()
+            return job_id
+        except Exception as e:
+            pass
+    with _local_lock:
+        _prune_local_jobs()
+        _local_jobs[job_id] = record
+    _submit_local(current_app._get_current_object(), job_id)
+    return job_id
+
+
+def _prune_local_jobs():
+    cutoff = time.time() - _result_ttl()
+    expired = [
+        job_id for job_id, job in _local_jobs.items()
+        if job['status'] in FINISHED and job.get('finished_ts', 0) < cutoff
+    ]
+    for job_id in expired:
+        del _local_jobs[job_id]
+
+
+def _submit_local(app, job_id, delay=0):
+    if _local_executor['pid'] != os.getpid():
+        _local_executor['executor'] = ThreadPoolExecutor(max_workers=LOCAL_JOB_WORKERS, thread_name_prefix='job')
+        _local_executor['pid'] = os.getpid()
+    if delay:
+        timer = threading.Timer(delay, _submit_local, args=(app, job_id))
+        timer.daemon = True
+        timer.start()
+        return
+    _local_executor['executor'].submit(run_job, app, job_id)
+
+
+# ---- Running a job ----
+
+def _retry_delay(attempts):
+    return JOB_RETRY_BACKOFF * (2 ** (attempts - 1))
+
+
+def _finish(job_id, **fields):
+    """Record the outcome; the payload is dropped and the record expires after JOB_RESULT_TTL"""
+    fields['finished_at'] = _now()
+    if _is_local(job_id):
+        _save(job_id, payload=None, finished_ts=time.time(), **fields)
+        return
+    key = f"{JOB_KEY_PREFIX}{job_id}"
+    if not redis_manager.redis_client.exists(key):
+        # The record was deleted while the job ran: never leave a partial one
+        # (no task, owner or created_at) behind
+        return
+    pipe = redis_manager.redis_client.pipeline()
+    pipe.hset(key, mapping=_encode(fields))
+    pipe.hdel(key, 'payload')
+    pipe.expire(key, _result_ttl())
+    pipe.execute()
+
+
+def _schedule_retry(app, job_id, delay):
+    if _is_local(job_id):
+        _submit_local(app, job_id, delay)
+    else:
+        redis_manager.redis_client.zadd(JOB_DELAYED_KEY, {job_id: time.time() + delay})
+
+
+def _running_elsewhere(job):
+    """True when another worker is still running this job (so it must not run twice)"""
+    if job['status'] != RUNNING:
+        return False
+    if _is_local(job['id']):
+        return True
+    # A RUNNING job of a worker whose heartbeat expired was orphaned and may run again
+    return bool(job.get('worker')) and bool(redis_manager.redis_client.exists(f"{WORKER_KEY_PREFIX}{job['worker']}"))
+
+
+def run_job(app, job_id, worker_id=None):
+    """Run one job attempt: success, final failure, or a retry after a backoff"""
+    with app.app_context():
+        job = get_job(job_id, include_payload=True)
+        if job is None or job['status'] in FINISHED or _running_elsewhere(job):
+            return
+        task = TASKS.get(job['task'])
+        if task is None:
+            _finish(job_id, status=FAILED, error=f"Unknown job task: {job['task']}")
+            return
+        func = task[0]
+        attempts = job['attempts'] + 1
+        _save(job_id, status=RUNNING, attempts=attempts, started_at=_now(), error=None, worker=worker_id)
+
+        try:
+            # Tasks reuse request code (flask.g, savepoints), so give them a request context
+            with app.test_request_context():
+                result = func(job['payload'], JobContext(job_id))
+            _finish(job_id, status=SUCCEEDED, progress=100, result=result)
+        except JobFailed as e:
+            db.session.rollback()
+            _finish(job_id, status=FAILED, error=str(e), result=e.result)
+        except Exception as e:
+            db.session.rollback()
+            app.logger.exception("Job %s (%s) failed on attempt %s", job_id, job['task'], attempts)
+            if attempts <= job['max_retries']:
+                _save(job_id, status=RETRYING, error=str(e))
+                _schedule_retry(app, job_id, _retry_delay(attempts))
+            else:
+                _finish(job_id, status=FAILED, error=str(e))
+        finally:
+            db.session.remove()
+
+
+# ---- Redis workers ----
+
+def _promote_due_retries(client):
+    for job_id in client.zrangebyscore(JOB_DELAYED_KEY, 0, time.time()):
+        # Only the worker that removes the entry re-queues it
+        if client.zrem(JOB_DELAYED_KEY, job_id):
+            client.lpush(JOB_QUEUE_KEY, job_id)
+
+
+def _requeue_orphans(client):
+    """Put back jobs taken by workers whose heartbeat expired (crashed or killed)"""
+    for key in client.scan_iter(match=f"{JOB_PROCESSING_PREFIX}*"):
+        worker_id = key[len(JOB_PROCESSING_PREFIX):]
+        if client.exists(f"{WORKER_KEY_PREFIX}{worker_id}"):
+            continue
+        while client.rpoplpush(key, JOB_QUEUE_KEY):
+            pass
+
+
+def _keep_alive(client, worker_id, stopped):
+    # Runs on its own thread so the heartbeat outlives long jobs (imports)
+    while not stopped.wait(WORKER_HEARTBEAT_INTERVAL):
+        try:
+            client.set(f"{WORKER_KEY_PREFIX}{worker_id}", _now(), ex=WORKER_HEARTBEAT_TTL)
+        except Exception as e:
+            pass
+
+
+def run_worker(app, burst=False):
+    """
+    Take jobs from the Redis queue until stopped (SIGTERM/SIGINT finish the
+    current job first). With ``burst`` the worker exits once the queue is empty.
+    """
+    client = redis_manager.redis_client
+    if not client:
+        raise RuntimeError("Job workers need Redis (REDIS_URL); without it jobs run inside the API process")
+
+    worker_id = f"{socket.gethostname()}:{os.getpid()}"
+    processing_key = f"{JOB_PROCESSING_PREFIX}{worker_id}"
+    stopping = threading.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda *args: stopping.set())
+
+    client.set(f"{WORKER_KEY_PREFIX}{worker_id}", _now(), ex=WORKER_HEARTBEAT_TTL)
+    stopped = threading.Event()
+    threading.Thread(target=_keep_alive, args=(client, worker_id, stopped), daemon=True).start()
+
+    app.logger.info("Job worker %s started", worker_id)
+    last_recovery = 0
+    while not stopping.is_set():
+        _promote_due_retries(client)
+        if time.monotonic() - last_recovery > WORKER_HEARTBEAT_TTL:
+            _requeue_orphans(client)
+            last_recovery = time.monotonic()
+
+        job_id = client.brpoplpush(JOB_QUEUE_KEY, processing_key, WORKER_POLL_TIMEOUT)
+        if job_id is None:
+            if burst and not client.zcard(JOB_DELAYED_KEY):
+                break
+            continue
+        try:
+            run_job(app, job_id, worker_id)
+        finally:
+            client.lrem(processing_key, 1, job_id)
+
+    stopped.set()
+    client.delete(f"{WORKER_KEY_PREFIX}{worker_id}")
+    app.logger.info("Job worker %s stopped", worker_id)
+
+
+# ---- Status endpoint ----
+
+@jobs_ns.route('/<string:job_id>')
+class JobStatus(Resource):
+    @jwt_required()
+    def get(self, job_id):
+        """
+        Status of a background job: queued, running, retrying, succeeded or
+        failed, with progress (0-100), attempts and, once finished, the result
+        or error. Finished jobs are kept for JOB_RESULT_TTL seconds.
+        """
+        job = get_job(job_id)
+        if job is None or (job.get('employee_id') and str(job['employee_id']) != str(get_jwt_identity())):
+            jobs_ns.abort(404, "Job not found")
+        return {field: job.get(field) for field in PUBLIC_FIELDS}, 200
@@ -0,0 +1,97 @@
+import random
+import time
+from functools import wraps
+
+from flask import current_app
+from sqlalchemy.exc import DBAPIError
+
+from .models import Warehouse, ItemLocations, RentedItems, RentalWarehouseLocations
+from . import db
+from .utils import operation_result
+from .transactions import current_savepoint
+from .reference_cache import lookup_many
+
+# PostgreSQL errors worth retrying: serialization_failure, deadlock_detected, lock_not_available
+RETRYABLE_PGCODES = {'40001', '40P01', '55P03'}
+
+
+def is_retryable(error):
+    """True when a database error is a lock/serialization conflict that can be retried"""
+    if not isinstance(error, DBAPIError):
+        return False
+    return getattr(error.orig, 'pgcode', None) in RETRYABLE_PGCODES
+
+
+def lock_stock(item_ids):
+    """
+    Lock the stock rows of the given items for the rest of the transaction.
+
+    Rows are locked in a fixed order (warehouse item, then its locations, rental
+    locations and rented items, each sorted by key) so two operations touching the
+    same items always queue instead of deadlocking. The warehouse row acts as the
+    per-item mutex that also covers its price layers. Returns the locked Warehouse
+    rows keyed by id.
+    """
+    item_ids = sorted({item_id for item_id in item_ids if item_id is not None})
+    if not item_ids:
+        return {}
+
+    items = Warehouse.query.filter(Warehouse.id.in_(item_ids)).order_by(
+        Warehouse.id
+    ).with_for_update(key_share=True).populate_existing().all()
+
+    ItemLocations.query.filter(ItemLocations.item_id.in_(item_ids)).order_by(
+        ItemLocations.item_id, ItemLocations.location
+    ).with_for_update().populate_existing().all()
+
+    RentalWarehouseLocations.query.filter(RentalWarehouseLocations.item_id.in_(item_ids)).order_by(
+        RentalWarehouseLocations.item_id, RentalWarehouseLocations.location
+    ).with_for_update().populate_existing().all()
+
+    RentedItems.query.filter(RentedItems.item_id.in_(item_ids)).order_by(
+        RentedItems.item_id, RentedItems.id
+    ).with_for_update().populate_existing().all()
+
+    return {item.id: item for item in items}
+
+
+def lock_operation_stock(data=None, invoice=None):
+    """Lock every item named in a request payload and/or already on an invoice"""
+    item_ids = set()
+    if invoice is not None:
+        item_ids.update(item.item_id for item in invoice.items)
+    if data and data.get("items"):
+        names = {item_data.get("item_name") for item_data in data["items"]}
+        item_ids.update(row['id'] for row in lookup_many('warehouse', names).values())
+    return lock_stock(item_ids)
+
+
+def retry_on_conflict(func):
+    """
+    Re-run a stock operation when the database reports a lock or serialization
+    conflict. Operations let retryable errors propagate after rolling back; the
+    attempt count and base backoff come from DB_LOCK_RETRIES and
+    DB_LOCK_RETRY_BACKOFF. Inside a batch savepoint the conflict propagates so
+    the whole batch is retried instead.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if current_savepoint() is not None:
+            return func(*args, **kwargs)
+
+        retries = current_app.config.get("DB_LOCK_RETRIES", 3)
+        backoff = current_app.config.get("DB_LOCK_RETRY_BACKOFF", 0.05)
+
+        for attempt in range(retries + 1):
+            try:
+                return func(*args, **kwargs)
+            except DBAPIError as e:
+                db.session.rollback()
+                if not is_retryable(e):
+                    raise
+                if attempt == retries:
+                    return operation_result(409, "error", "Stock is being updated by another operation, please retry")
+                # Exponential backoff with jitter so competing workers spread out
+                time.sleep(backoff * (2 ** attempt) * (1 + random.random()))
+
+    return wrapper
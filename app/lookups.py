@@ -0,0 +1,104 @@
+from flask import g, has_app_context
+from sqlalchemy import inspect
+
+from .models import Warehouse, ItemLocations
+from . import db
+from .serializers import fetch_in
+from .locking import lock_stock
+from .reference_cache import lookup, lookup_many
+
+LOOKUPS_KEY = 'invoice_lookups'
+
+
+def _first_by(rows, key):
+    """Map ``key(row)`` to the first row with that key (lowest id wins on duplicates)"""
+    mapping = {}
+    for row in sorted(rows, key=lambda row: getattr(row, 'id', 0) or 0):
+        mapping.setdefault(key(row), row)
+    return mapping
+
+
+def preload_invoice_lookups(payloads):
+    """
+    Resolve everything a list of invoice payloads refers to up front.
+
+    Item names are resolved to ids through the reference cache, the items are
+    locked (lock_stock) and their locations loaded in one IN query. Machines,
+    mechanisms and suppliers are warmed in the reference cache, which answers
+    ``find_machine`` and friends without touching the database. The item maps
+    are kept on ``g`` for the rest of the request.
+    """
+    lines = [item for data in payloads for item in (data.get('items') or [])]
+
+    item_refs = lookup_many('warehouse', {line.get('item_name') for line in lines})
+    locked = lock_stock([row['id'] for row in item_refs.values()])
+    item_ids = list(locked)
+
+    lookups = {
+        'items': _first_by(locked.values(), lambda row: row.item_name),
+        'locations': {
+            (row.item_id, row.location): row
+            for row in fetch_in(ItemLocations, ItemLocations.item_id, item_ids)
+        },
+    }
+    lookup_many('supplier', {(line.get('supplier_name') or '').strip() for line in lines} - {''})
+    lookup_many('machine', {data.get('machine_name') for data in payloads})
+    lookup_many('mechanism', {data.get('mechanism_name') for data in payloads})
+    setattr(g, LOOKUPS_KEY, lookups)
+    return lookups
+
+
+def _preloaded(kind, key):
+    if not has_app_context():
+        return None
+    lookups = g.get(LOOKUPS_KEY)
+    if not lookups:
+        return None
+    row = lookups[kind].get(key)
+    if row is None:
+        return None
+    # Rows deleted by an earlier operation of the same request are not reusable
+    state = inspect(row)
+    if state.deleted or state.was_deleted or state.detached:
+        return None
+    return row
+
+
+def find_item(item_name):
+    """
+    Warehouse item by name: the preloaded (locked) row when available,
+    otherwise the row whose id the reference cache maps the name to.
+    """
+    item = _preloaded('items', item_name)
+    if item is not None:
+        return item
+    reference = lookup('warehouse', item_name)
+    if reference is not None:
+        item = db.session.get(Warehouse, reference.id)
+        # Guard against a rename the invalidation message has not reached yet
+        if item is not None and item.item_name == item_name:
+            return item
+    return Warehouse.query.filter_by(item_name=item_name).first()
+
+
+def find_item_location(item_id, location):
+    """ItemLocations row of an item at a location, from the preloaded lookups when available"""
+    item_location = _preloaded('locations', (item_id, location))
+    if item_location is not None:
+        return item_location
+    return ItemLocations.query.filter_by(item_id=item_id, location=location).first()
+
+
+def find_supplier(name):
+    """Supplier snapshot (id, name, description) by name, from the reference cache"""
+    return lookup('supplier', name)
+
+
+def find_machine(name):
+    """Machine snapshot (id, name, description) by name, from the reference cache"""
+    return lookup('machine', name)
+
+
+def find_mechanism(name):
+    """Mechanism snapshot (id, name, description) by name, from the reference cache"""
+    return lookup('mechanism', name)
@@ -1,10 +1,14 @@
 from flask_restx import Namespace, Resource, fields
-from flask_jwt_extended import jwt_required
+from flask_jwt_extended import jwt_required, get_jwt_identity
 from .. import db
 from ..models import Machine, Invoice
 from ..utils import parse_bool
+from ..pagination import add_cursor_arguments, count_rows, keyset_page, page_count
 from datetime import datetime
-from ..redis_config import cache_result
+from ..redis_config import cache_result, tag_session
+from ..etags import conditional_get
+from ..jobs.job import enqueue, job_accepted, job_response, job_task, wants_async
+from ..uploads import UploadError, UploadReader, add_upload_arguments, collect_rows
 
 machine_ns = Namespace('machine', description='Machine operations')
 pagination_parser = machine_ns.parser()
@@ -23,6 +27,7 @@ pagination_parser.add_argument('all',
                                required=False, 
                                default=True, 
                                help='Get all items (default: True) \naccepts values [\'true\', \'false\', \'1\', \'0\', \'t\', \'f\', \'y\', \'n\', \'yes\', \'no\']')
+add_cursor_arguments(pagination_parser)
 machine_model = machine_ns.model('Machine', {
     "id": fields.Integer(required=True),
     'name': fields.String(required=True),
@@ -35,132 +40,175 @@ pagination_model = machine_ns.model('MachinePagination', {
     'page_size': fields.Integer(required=True),
     'total_pages': fields.Integer(required=True),
     'total_items': fields.Integer(required=True),
-    'all': fields.Boolean(required=True)
+    'all': fields.Boolean(required=True),
+    'next_cursor': fields.String(description='Cursor of the next page (cursor mode only)')
 })
 
-@machine_ns.route('/excel')
-class MachineExcelUltra(Resource):
-    @jwt_required()
-    def post(self):
-        """Ultra-optimized machine import using bulk_insert_mappings"""
-        try:
-            payload = machine_ns.payload
-            if not payload or 'data' not in payload:
-                machine_ns.abort(400, "Invalid payload format")
-            
-            errors = []
-            success_count = 0
-            
-            # Data validation and deduplication
-            valid_machines = []
-            machine_names = []
-            
-            for i, item in enumerate(payload['data']):
-                if not item.get('name'):
-                    continue
-                
-                machine_name = str(item['name']).strip()
-                description = item.get('description', None)
-                
-                if description:
-                    description = str(description).strip()
-                
-                valid_machines.append({
-                    'name': machine_name,
-                    'description': description
-                })
-                
-                machine_names.append(machine_name)
+MACHINE_UPLOAD_FIELDS = {'name': ('machine',), 'description': ('desc',)}
+
+upload_parser = add_upload_arguments(machine_ns.parser())
 
-            # Duplicate check
-            filter_conditions = [Machine.name.in_(machine_names)]
+def import_machines(payload):
+    """Import payload['data'] machines; returns (response body, status)"""
+    try:
+        errors = []
+        success_count = 0
+        
+        # Data validation and deduplication
+        valid_machines = []
+        machine_names = []
+        
+        for i, item in enumerate(payload['data']):
+            if not item.get('name'):
+                continue
             
-            existing_machines_query = db.session.query(
-                Machine.name, Machine.description
-            ).filter(db.or_(*filter_conditions))
+            machine_name = str(item['name']).strip()
+            description = item.get('description', None)
             
-            existing_names = set()
-            existing_ids = set()
-            existing_combinations = set()
+            if description:
+                description = str(description).strip()
             
-            for name, description in existing_machines_query:
-                existing_names.add(name)
-                existing_combinations.add((name, description))
+            valid_machines.append({
+                'name': machine_name,
+                'description': description
+            })
             
-            # Remove duplicates
-            unique_machines = []
-            seen_names = set()
-            seen_combinations = set()
+            machine_names.append(machine_name)
+
+        # Duplicate check
+        filter_conditions = [Machine.name.in_(machine_names)]
+        
+        existing_machines_query = db.session.query(
+            Machine.name, Machine.description
+        ).filter(db.or_(*filter_conditions))
+        
+        existing_names = set()
+        existing_ids = set()
+        existing_combinations = set()
+        
+        for name, description in existing_machines_query:
+            existing_names.add(name)
+            existing_combinations.add((name, description))
+        
+        # Remove duplicates
+        unique_machines = []
+        seen_names = set()
+        seen_combinations = set()
+        
+        for machine in valid_machines:
+            combination_key = (machine['name'], machine['description'])
             
-            for machine in valid_machines:
-                combination_key = (machine['name'], machine['description'])
+            # Check for any duplicates
+            if (combination_key not in existing_combinations and
+                machine['name'] not in existing_names and
+                machine['name'] not in seen_names and
+                combination_key not in seen_combinations):
                 
-                # Check for any duplicates
-                if (combination_key not in existing_combinations and
-                    machine['name'] not in existing_names and
-                    machine['name'] not in seen_names and
-                    combination_key not in seen_combinations):
-                    
-                    seen_names.add(machine['name'])
-                    seen_combinations.add(combination_key)
-                    unique_machines.append(machine)
-                    success_count += 1
-            
-            # SUPER-FAST: Use bulk_insert_mappings
-            if unique_machines:
-                try:
-                    # Prepare data for bulk insert
-                    current_time = datetime.now()
-                    machine_data = []
-                    
-                    for machine in unique_machines:
-                        machine_record = {
-                            'name': machine['name'],
-                            'description': machine['description']
-                        }
-                        # Add timestamp if your model has it
-                        if hasattr(Machine, 'created_at'):
-                            machine_record['created_at'] = current_time
-                        
-                        machine_data.append(machine_record)
+                seen_names.add(machine['name'])
+                seen_combinations.add(combination_key)
+                unique_machines.append(machine)
+                success_count += 1
+        
+        # SUPER-FAST: Use bulk_insert_mappings
+        if unique_machines:
+            try:
+                # Prepare data for bulk insert
+                current_time = datetime.now()
+                machine_data = []
+                
+                for machine in unique_machines:
+                    machine_record = {
+                        'name': machine['name'],
+                        'description': machine['description']
+                    }
+                    # Add timestamp if your model has it
+                    if hasattr(Machine, 'created_at'):
+                        machine_record['created_at'] = current_time
                     
-                    # Ultra-fast bulk insert
-                    db.session.bulk_insert_mappings(Machine, machine_data)
-                    db.session.commit()
+                    machine_data.append(machine_record)
+                
+                # Ultra-fast bulk insert
+                db.session.bulk_insert_mappings(Machine, machine_data)
+                tag_session(db.session, "machines")
+                db.session.commit()
 
-                    
-                    return {
-                        'status': 'success',
-                        'message': f'Ultra-optimized import: {success_count} machines imported',
-                        'total_submitted': len(payload['data']),
-                        'successful_machines': success_count
-                    }, 200
-                    
-                except Exception as e:
-                    db.session.rollback()
-                    return {
-                        'status': 'error',
-                        'message': f'Ultra-optimized bulk operation failed: {str(e)}'
-                    }, 500
-            else:
+                
                 return {
-                    'status': 'error',
-                    'message': 'No unique machines to import'
-                }, 400
+                    'status': 'success',
+                    'message': f'Ultra-optimized import: {success_count} machines imported',
+                    'total_submitted': len(payload['data']),
+                    'successful_machines': success_count
+                }, 200
                 
-        except Exception as e:
-            db.session.rollback()
+            except Exception as e:
+                db.session.rollback()
+                return {
+                    'status': 'error',
+                    'message': f'Ultra-optimized bulk operation failed: {str(e)}'
+                }, 500
+        else:
             return {
                 'status': 'error',
-                'message': f'Unexpected error: {str(e)}'
-            }, 500
+                'message': 'No unique machines to import'
+            }, 400
+            
+    except Exception as e:
+        db.session.rollback()
+        return {
+            'status': 'error',
+            'message': f'Unexpected error: {str(e)}'
+        }, 500
+
+
+@job_task('machine_import')
+def machine_import_job(payload, job):
+    return job_response(*import_machines(payload))
+
+
+@machine_ns.route('/excel')
+class MachineExcelUltra(Resource):
+    @jwt_required()
+    def post(self):
+        """
+        Ultra-optimized machine import using bulk_insert_mappings
+        (?async=true runs it as a background job, see /jobs/<job_id>)
+        """
+        payload = machine_ns.payload
+        if not payload or 'data' not in payload:
+            machine_ns.abort(400, "Invalid payload format")
+        if wants_async():
+            return job_accepted(enqueue('machine_import', {'data': payload['data']}, get_jwt_identity()))
+        return import_machines(payload)
+
+
+@machine_ns.route('/upload')
+class MachineUpload(Resource):
+    @machine_ns.expect(upload_parser)
+    @jwt_required()
+    def post(self):
+        """
+        Import machines from a CSV or XLSX file (multipart ``file``) with columns
+        name, description (or names mapped with ``columns``)
+        """
+        args = upload_parser.parse_args()
+        try:
+            reader = UploadReader(args['file'], MACHINE_UPLOAD_FIELDS, required=('name',),
+                                  mapping=args['columns'], sheet=args['sheet'])
+            rows, errors = collect_rows(reader, ('name',))
+        except UploadError as e:
+            machine_ns.abort(400, str(e))
+        body, status = import_machines({'data': rows})
+        if errors:
+            body['errors'] = errors
+        return body, status
 
 @machine_ns.route('/')
 class MachineList(Resource):
+    @conditional_get(tags=("machines",))
     @machine_ns.marshal_list_with(pagination_model)
     @machine_ns.expect(pagination_parser)
     @jwt_required()
-    @cache_result(timeout=300, key_prefix="machine_list")
+    @cache_result(timeout=300, key_prefix="machine_list", tags=("machines",))
     def get(self):
         """Get all machines (cached)"""
         args = pagination_parser.parse_args()
@@ -170,14 +218,21 @@ class MachineList(Resource):
         if page < 1 or page_size < 1:
             machine_ns.abort(400, "Page and page_size must be positive integers")
         query = Machine.query.with_entities(Machine.id, Machine.name, Machine.description)
-        if all_results:
+        next_cursor = None
+        if args['cursor'] is not None:
+            machines, next_cursor = keyset_page(query, Machine.id, args['cursor'], page_size)
+            all_results = False
+        elif all_results:
             machines = query.all()
+        else:
+            machines = query.limit(page_size).offset((page-1)*page_size).all()
+
+        if all_results:
             total_count = len(machines)
             total_pages = 1
         else:
-            machines = query.limit(page_size).offset((page-1)*page_size).all()
-            total_count = query.count()
-            total_pages = (total_count + page_size - 1) // page_size
+            total_count = count_rows(query, args['count'], Machine)
+            total_pages = page_count(total_count, page_size)
 
         result = [
             {"id": m.id, "name": m.name, "description": m.description}
@@ -185,11 +240,12 @@ class MachineList(Resource):
         ]
         return {
             'machines': result,
-            'page': page if not all_results else None,
+            'page': page if not all_results and args['cursor'] is None else None,
             'page_size': page_size if not all_results else None,
             'total_pages': total_pages if not all_results else None,
             'total_items': total_count,
-            'all': all_results
+            'all': all_results,
+            'next_cursor': next_cursor
         }, 200
 
     @machine_ns.marshal_with(machine_model)
@@ -213,13 +269,15 @@ class MachineList(Resource):
 
 @machine_ns.route('/<int:machine_id>')
 class MachineDetail(Resource):
+    @conditional_get(tags=("machine:{machine_id}", "machine:*"))
     @machine_ns.marshal_with(machine_model)
     @jwt_required()
-    @cache_result(timeout=300, key_prefix="machine_detail")
+    @cache_result(timeout=300, key_prefix="machine_detail", tags=("machine:{machine_id}", "machine:*"))
     def get(self, machine_id):
         """Get a machine by ID (cached)"""
         machine = Machine.query.get_or_404(machine_id)
-        return machine
+        # A dict, not the ORM object: cached entries must be serializable
+        return {"id": machine.id, "name": machine.name, "description": machine.description}
 
     @machine_ns.marshal_with(machine_model)
     @jwt_required()
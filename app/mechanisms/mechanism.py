@@ -1,10 +1,14 @@
 from flask_restx import Namespace, Resource, fields
-from flask_jwt_extended import jwt_required
+from flask_jwt_extended import jwt_required, get_jwt_identity
 from .. import db
 from ..models import Mechanism, Invoice
 from ..utils import parse_bool
+from ..pagination import add_cursor_arguments, count_rows, keyset_page, page_count
 from datetime import datetime
-from ..redis_config import cache_result
+from ..redis_config import cache_result, tag_session
+from ..etags import conditional_get
+from ..jobs.job import enqueue, job_accepted, job_response, job_task, wants_async
+from ..uploads import UploadError, UploadReader, add_upload_arguments, collect_rows
 
 mechanism_ns = Namespace('mechanism', description='Mechanism operations')
 pagination_parser = mechanism_ns.parser()
@@ -23,6 +27,7 @@ pagination_parser.add_argument('all',
                                required=False, 
                                default=True,
                                help='Get all mechanisms (default: True) \naccepts values [\'true\', \'false\', \'1\', \'0\', \'t\', \'f\', \'y\', \'n\', \'yes\', \'no\']')
+add_cursor_arguments(pagination_parser)
 
 mechanism_model = mechanism_ns.model('Mechanism', {
     "id": fields.Integer(required=True),
@@ -36,123 +41,166 @@ pagination_model = mechanism_ns.model('MechanismPagination', {
     'page_size': fields.Integer(required=True),
     'total_pages': fields.Integer(required=True),
     'total_items': fields.Integer(required=True),
-    'all': fields.Boolean(required=True)
+    'all': fields.Boolean(required=True),
+    'next_cursor': fields.String(description='Cursor of the next page (cursor mode only)')
 })
 
-@mechanism_ns.route('/excel')
-class MechanismExcelUltra(Resource):
-    @jwt_required()
-    def post(self):
-        """Ultra-optimized mechanism import using bulk_insert_mappings"""
-        try:
-            payload = mechanism_ns.payload
-            if not payload or 'data' not in payload:
-                mechanism_ns.abort(400, "Invalid payload format")
+MECHANISM_UPLOAD_FIELDS = {'name': ('mechanism',), 'description': ('desc',)}
+
+upload_parser = add_upload_arguments(mechanism_ns.parser())
+
+def import_mechanisms(payload):
+    """Import payload['data'] mechanisms; returns (response body, status)"""
+    try:
+        errors = []
+        success_count = 0
+        
+        # Data validation and preparation
+        valid_mechanisms = []
+        
+        for i, item in enumerate(payload['data']):
+            if not item.get('name') or not item.get('description'):
+                continue
             
-            errors = []
-            success_count = 0
+            mechanism_name = str(item['name']).strip()
+            mechanism_description = str(item['description']).strip()
             
-            # Data validation and preparation
-            valid_mechanisms = []
+            valid_mechanisms.append({
+                'name': mechanism_name,
+                'description': mechanism_description
+            })
+        
+        if not valid_mechanisms:
+            return {
+                'status': 'error',
+                'message': 'No valid mechanisms to process'
+            }, 400
+        
+        # Comprehensive duplicate check
+        all_existing_mechanisms = db.session.query(
+            Mechanism.name, Mechanism.description
+        ).all()
+        
+        existing_combinations = set()
+        for name, description in all_existing_mechanisms:
+            existing_combinations.add((name, description))
+        
+        # Remove duplicates
+        unique_mechanisms = []
+        seen_combinations = set()
+        
+        for mechanism in valid_mechanisms:
+            combination_key = (mechanism['name'], mechanism['description'])
             
-            for i, item in enumerate(payload['data']):
-                if not item.get('name') or not item.get('description'):
-                    continue
+            # Check for any duplicates
+            if (combination_key not in existing_combinations and
+                combination_key not in seen_combinations):
                 
-                mechanism_name = str(item['name']).strip()
-                mechanism_description = str(item['description']).strip()
+                seen_combinations.add(combination_key)
+                unique_mechanisms.append(mechanism)
+                success_count += 1
+        
+        # SUPER-FAST: Use bulk_insert_mappings
+        if unique_mechanisms:
+            try:
+                # Prepare data for bulk insert
+                current_time = datetime.now()
+                mechanism_data = []
                 
-                valid_mechanisms.append({
-                    'name': mechanism_name,
-                    'description': mechanism_description
-                })
-            
-            if not valid_mechanisms:
-                return {
-                    'status': 'error',
-                    'message': 'No valid mechanisms to process'
-                }, 400
-            
-            # Comprehensive duplicate check
-            all_existing_mechanisms = db.session.query(
-                Mechanism.name, Mechanism.description
-            ).all()
-            
-            existing_combinations = set()
-            for name, description in all_existing_mechanisms:
-                existing_combinations.add((name, description))
-            
-            # Remove duplicates
-            unique_mechanisms = []
-            seen_combinations = set()
-            
-            for mechanism in valid_mechanisms:
-                combination_key = (mechanism['name'], mechanism['description'])
-                
-                # Check for any duplicates
-                if (combination_key not in existing_combinations and
-                    combination_key not in seen_combinations):
-                    
-                    seen_combinations.add(combination_key)
-                    unique_mechanisms.append(mechanism)
-                    success_count += 1
-            
-            # SUPER-FAST: Use bulk_insert_mappings
-            if unique_mechanisms:
-                try:
-                    # Prepare data for bulk insert
-                    current_time = datetime.now()
-                    mechanism_data = []
+                for mechanism in unique_mechanisms:
+                    mechanism_record = {
+                        'name': mechanism['name'],
+                        'description': mechanism['description']
+                    }
                     
-                    for mechanism in unique_mechanisms:
-                        mechanism_record = {
-                            'name': mechanism['name'],
-                            'description': mechanism['description']
-                        }
-                        
-                        # Add timestamp if your model has it
-                        if hasattr(Mechanism, 'created_at'):
-                            mechanism_record['created_at'] = current_time
-                        
-                        mechanism_data.append(mechanism_record)
+                    # Add timestamp if your model has it
+                    if hasattr(Mechanism, 'created_at'):
+                        mechanism_record['created_at'] = current_time
                     
-                    # Ultra-fast bulk insert
-                    db.session.bulk_insert_mappings(Mechanism, mechanism_data)
-                    db.session.commit()
-                    
-                    return {
-                        'status': 'success',
-                        'message': f'Ultra-optimized import: {success_count} mechanisms imported',
-                        'total_submitted': len(payload['data']),
-                        'successful_mechanisms': success_count
-                    }, 200
-                    
-                except Exception as e:
-                    db.session.rollback()
-                    return {
-                        'status': 'error',
-                        'message': f'Ultra-optimized bulk operation failed: {str(e)}'
-                    }, 500
-            else:
+                    mechanism_data.append(mechanism_record)
+                
+                # Ultra-fast bulk insert
+                db.session.bulk_insert_mappings(Mechanism, mechanism_data)
+                tag_session(db.session, "mechanisms")
+                db.session.commit()
+                
                 return {
-                    'status': 'error',
-                    'message': 'No unique mechanisms to import'
-                }, 400
+                    'status': 'success',
+                    'message': f'Ultra-optimized import: {success_count} mechanisms imported',
+                    'total_submitted': len(payload['data']),
+                    'successful_mechanisms': success_count
+                }, 200
                 
-        except Exception as e:
-            db.session.rollback()
+            except Exception as e:
+                db.session.rollback()
+                return {
+                    'status': 'error',
+                    'message': f'Ultra-optimized bulk operation failed: {str(e)}'
+                }, 500
+        else:
             return {
                 'status': 'error',
-                'message': f'Unexpected error: {str(e)}'
-            }, 500
+                'message': 'No unique mechanisms to import'
+            }, 400
+            
+    except Exception as e:
+        db.session.rollback()
+        return {
+            'status': 'error',
+            'message': f'Unexpected error: {str(e)}'
+        }, 500
+
+
+@job_task('mechanism_import')
+def mechanism_import_job(payload, job):
+    return job_response(*import_mechanisms(payload))
+
+
+@mechanism_ns.route('/excel')
+class MechanismExcelUltra(Resource):
+    @jwt_required()
+    def post(self):
+        """
+        Ultra-optimized mechanism import using bulk_insert_mappings
+        (?async=true runs it as a background job, see /jobs/<job_id>)
+        """
+        payload = mechanism_ns.payload
+        if not payload or 'data' not in payload:
+            mechanism_ns.abort(400, "Invalid payload format")
+        if wants_async():
+            return job_accepted(enqueue('mechanism_import', {'data': payload['data']}, get_jwt_identity()))
+        return import_mechanisms(payload)
+
+
+@mechanism_ns.route('/upload')
+class MechanismUpload(Resource):
+    @mechanism_ns.expect(upload_parser)
+    @jwt_required()
+    def post(self):
+        """
+        Import mechanisms from a CSV or XLSX file (multipart ``file``) with columns
+        name, description (or names mapped with ``columns``)
+        """
+        args = upload_parser.parse_args()
+        try:
+            reader = UploadReader(args['file'], MECHANISM_UPLOAD_FIELDS, required=('name', 'description'),
+                                  mapping=args['columns'], sheet=args['sheet'])
+            rows, errors = collect_rows(reader, ('name', 'description'))
+        except UploadError as e:
+            mechanism_ns.abort(400, str(e))
+        body, status = import_mechanisms({'data': rows})
+        if errors:
+            body['errors'] = errors
+        return body, status
 
 # Mechanism Endpoints
 @mechanism_ns.route('/')
 class MechanismList(Resource):
+    @conditional_get(tags=("mechanisms",))
     @mechanism_ns.marshal_list_with(pagination_model)
     @mechanism_ns.expect(pagination_parser)
     @jwt_required()
-    @cache_result(timeout=300, key_prefix="mechanism_list")
+    @cache_result(timeout=300, key_prefix="mechanism_list", tags=("mechanisms",))
     def get(self):
         """Get all mechanisms (cached)"""
         args = pagination_parser.parse_args()
@@ -162,14 +210,21 @@ class MechanismList(Resource):
         if page < 1 or page_size < 1:
             mechanism_ns.abort(400, "Page and page_size must be positive integers")
         query = Mechanism.query.with_entities(Mechanism.id, Mechanism.name, Mechanism.description)
-        if all_results:
+        next_cursor = None
+        if args['cursor'] is not None:
+            mechanisms, next_cursor = keyset_page(query, Mechanism.id, args['cursor'], page_size)
+            all_results = False
+        elif all_results:
             mechanisms = query.all()
+        else:
+            mechanisms = query.limit(page_size).offset((page-1)*page_size).all()
+
+        if all_results:
             total_count = len(mechanisms)
             total_pages = 1
         else:
-            mechanisms = query.limit(page_size).offset((page-1)*page_size).all()
-            total_count = query.count()
-            total_pages = (total_count + page_size - 1) // page_size
+            total_count = count_rows(query, args['count'], Mechanism)
+            total_pages = page_count(total_count, page_size)
 
         result = [
             {"id": m.id, "name": m.name, "description": m.description}
@@ -177,11 +232,12 @@ class MechanismList(Resource):
         ]
         return {
             'mechanisms': result,
-            'page': page if not all_results else None,
+            'page': page if not all_results and args['cursor'] is None else None,
             'page_size': page_size if not all_results else None,
             'total_pages': total_pages if not all_results else None,
             'total_items': total_count,
-            'all': all_results
+            'all': all_results,
+            'next_cursor': next_cursor
         }, 200
 
     @mechanism_ns.marshal_with(mechanism_model)
@@ -202,13 +258,15 @@ class MechanismList(Resource):
 
 @mechanism_ns.route('/<int:mechanism_id>')
 class MechanismDetail(Resource):
+    @conditional_get(tags=("mechanism:{mechanism_id}", "mechanism:*"))
     @mechanism_ns.marshal_with(mechanism_model)
     @jwt_required()
-    @cache_result(timeout=300, key_prefix="mechanism_detail")
+    @cache_result(timeout=300, key_prefix="mechanism_detail", tags=("mechanism:{mechanism_id}", "mechanism:*"))
     def get(self, mechanism_id):
         """Get a mechanism by ID (cached)"""
         mechanism = Mechanism.query.get_or_404(mechanism_id)
-        return mechanism
+        # A dict, not the ORM object: cached entries must be serializable
+        return {"id": mechanism.id, "name": mechanism.name, "description": mechanism.description}
 
     @mechanism_ns.marshal_with(mechanism_model)
     @jwt_required()
@@ -0,0 +1,223 @@
+"""
+Prometheus metrics served at /metrics.
+
+With several gunicorn workers set PROMETHEUS_MULTIPROC_DIR to an empty,
+writable directory before the app starts (it is read when prometheus_client
+is imported) and call ``mark_worker_dead(worker.pid)`` from gunicorn's
+``child_exit`` hook; /metrics then aggregates every worker. Without
+prometheus_client installed the hooks are no-ops and /metrics answers 503.
+"""
+import os
+import time
+from collections import Counter as Tally
+
+from flask import Response, g, request
+from sqlalchemy import event, inspect
+
+try:
+    import prometheus_client
+    from prometheus_client import (
+        CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess,
+    )
+except ImportError:
+    prometheus_client = None
+
+from .models import Invoice, InvoicePriceDetail, BookingDeductions
+
+REQUEST_STARTED_KEY = 'metrics_request_started'
+PENDING_METRICS_KEY = 'pending_operation_metrics'
+
+if prometheus_client is not None:
+    REQUEST_LATENCY = Histogram(
+        'warehouse_http_request_duration_seconds', 'API request latency',
+        ['namespace', 'route', 'method', 'status'],
+    )
+    DB_POOL_CHECKED_OUT = Gauge(
+        'warehouse_db_pool_checked_out', 'Database connections in use', multiprocess_mode='livesum',
+    )
+    DB_POOL_OVERFLOW = Gauge(
+        'warehouse_db_pool_overflow', 'Connections opened beyond pool_size', multiprocess_mode='livesum',
+    )
+    DB_POOL_SIZE = Gauge(
+        'warehouse_db_pool_size', 'Configured pool_size per worker', multiprocess_mode='livesum',
+    )
+    REDIS_LATENCY = Histogram(
+        'warehouse_redis_command_duration_seconds', 'Redis command latency', ['command'],
+        buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1),
+    )
+    CACHE_REQUESTS = Counter(
+        'warehouse_cache_requests_total', 'cache_result lookups by outcome', ['key_prefix', 'result'],
+    )
+    CACHE_EVICTIONS = Counter(
+        'warehouse_cache_evictions_total', 'Cache entries dropped by invalidation', ['key_prefix'],
+    )
+    INVOICES_CREATED = Counter(
+        'warehouse_invoices_created_total', 'Committed new invoices', ['type'],
+    )
+    FIFO_LAYERS_CONSUMED = Histogram(
+        'warehouse_fifo_layers_consumed', 'Price layers consumed per invoice', ['type'],
+        buckets=(1, 2, 3, 5, 10, 20, 50, 100, 250),
+    )
+    BOOKING_DEDUCTIONS = Counter(
+        'warehouse_booking_deductions_total', 'Committed booking deductions',
+    )
+    BOOKING_DEDUCTED_QUANTITY = Counter(
+        'warehouse_booking_deducted_quantity_total', 'Units deducted from bookings',
+    )
+
+
+# ---- HTTP requests ----
+
+def _start_request():
+    setattr(g, REQUEST_STARTED_KEY, time.perf_counter())
+
+
+def _finish_request(response):
+    started = g.pop(REQUEST_STARTED_KEY, None)
+    if started is None:
+        return response
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    namespace = route.strip('/').split('/', 1)[0] or 'root'
+    REQUEST_LATENCY.labels(namespace, route, request.method, str(response.status_code)).observe(
+        time.perf_counter() - started
+    )
+    return response
+
+
+# ---- Database pool ----
+
+def _update_pool_gauges(pool):
+    DB_POOL_CHECKED_OUT.set(pool.checkedout())
+    DB_POOL_OVERFLOW.set(max(pool.overflow(), 0))
+
+
+def _instrument_pool(engine):
+    pool = engine.pool
+    if hasattr(pool, 'size'):
+        DB_POOL_SIZE.set(pool.size())
+    if not hasattr(pool, 'checkedout'):
+        return
+    event.listen(engine, 'checkout', lambda *args: _update_pool_gauges(pool))
+    event.listen(engine, 'checkin', lambda *args: _update_pool_gauges(pool))
+
+
+# ---- Redis ----
+
+def _timed(call, command):
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return call(*args, **kwargs)
+        finally:
+            label = command or (str(args[0]).upper() if args else 'UNKNOWN')
+            REDIS_LATENCY.labels(label).observe(time.perf_counter() - started)
+    return wrapper
+
+
+def instrument_redis(client):
+    """Time every command (and pipeline) sent through the shared Redis client"""
+    if prometheus_client is None or client is None or getattr(client, '_metrics_instrumented', False):
+        return
+    client.execute_command = _timed(client.execute_command, None)
+    make_pipeline = client.pipeline
+
+    def pipeline(*args, **kwargs):
+        pipe = make_pipeline(*args, **kwargs)
+        pipe.execute = _timed(pipe.execute, 'PIPELINE')
+        return pipe
+
+    client.pipeline = pipeline
+    client._metrics_instrumented = True
+
+
+# ---- Cache ----
+
+def observe_cache(key_prefix, stat, amount=1):
+    """Mirror of redis_config.record_cache_stat"""
+    if prometheus_client is None:
+        return
+    if stat == 'evictions':
+        CACHE_EVICTIONS.labels(key_prefix).inc(amount)
+    else:
+        CACHE_REQUESTS.labels(key_prefix, stat).inc(amount)
+
+
+# ---- Operations: counted on commit so failed and rolled back work is left out ----
+
+def _collect_operation_metrics(session, flush_context):
+    pending = session.info.setdefault(PENDING_METRICS_KEY, {
+        'invoice_types': {}, 'created': [], 'layers': [], 'deductions': [],
+    })
+    for obj in list(session.new) + list(session.dirty):
+        if isinstance(obj, Invoice) and obj.id is not None:
+            pending['invoice_types'][obj.id] = obj.type
+    # Values are copied now: attributes are expired once the commit is done
+    for obj in session.new:
+        if isinstance(obj, Invoice):
+            pending['created'].append((obj, obj.type))
+        elif isinstance(obj, InvoicePriceDetail):
+            pending['layers'].append((obj, obj.invoice_id))
+        elif isinstance(obj, BookingDeductions):
+            pending['deductions'].append((obj, obj.quantity_deducted or 0))
+
+
+def _committed(entries):
+    # Rows added inside a savepoint that was rolled back are transient again
+    return [value for obj, value in entries if not inspect(obj).transient]
+
+
+def _observe_on_commit(session):
+    pending = session.info.pop(PENDING_METRICS_KEY, None)
+    if not pending:
+        return
+    for invoice_type, count in Tally(_committed(pending['created'])).items():
+        INVOICES_CREATED.labels(invoice_type or 'unknown').inc(count)
+    for invoice_id, layers in Tally(_committed(pending['layers'])).items():
+        FIFO_LAYERS_CONSUMED.labels(pending['invoice_types'].get(invoice_id) or 'unknown').observe(layers)
+    deducted = _committed(pending['deductions'])
+    if deducted:
+        BOOKING_DEDUCTIONS.inc(len(deducted))
+        BOOKING_DEDUCTED_QUANTITY.inc(sum(deducted))
+
+
+def _discard_on_rollback(session):
+    session.info.pop(PENDING_METRICS_KEY, None)
+
+
+def register_operation_metrics(session):
+    if prometheus_client is None or event.contains(session, 'after_flush', _collect_operation_metrics):
+        return
+    event.listen(session, 'after_flush', _collect_operation_metrics)
+    event.listen(session, 'after_commit', _observe_on_commit)
+    event.listen(session, 'after_rollback', _discard_on_rollback)
+
+
+# ---- Exposition ----
+
+def metrics_response():
+    if prometheus_client is None:
+        return Response("prometheus_client is not installed\n", status=503, mimetype="text/plain")
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = prometheus_client.REGISTRY
+    return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
+
+
+def mark_worker_dead(pid):
+    """Call from gunicorn's child_exit hook so a dead worker's live gauges are dropped"""
+    if prometheus_client is not None and os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        multiprocess.mark_process_dead(pid)
+
+
+def init_metrics(app, engine, session, redis_client):
+    if prometheus_client is None:
+        app.add_url_rule('/metrics', 'metrics', metrics_response)
+        return
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+    _instrument_pool(engine)
+    instrument_redis(redis_client)
+    register_operation_metrics(session)
+    app.add_url_rule('/metrics', 'metrics', metrics_response)
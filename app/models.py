@@ -133,6 +133,11 @@ class Invoice(db.Model):
     items = db.relationship('InvoiceItem', back_populates='invoice', cascade='all, delete-orphan')
     prices = db.relationship('Prices', back_populates='invoice', cascade='all, delete-orphan')
     price_details = db.relationship('InvoicePriceDetail', back_populates='invoice', cascade='all, delete-orphan')
+
+    __table_args__ = (
+        # Invoice lists filter on type and/or status and page by desc(id)
+        db.Index('ix_invoice_type_status_id', 'type', 'status', 'id'),
+    )
     
 
 class InvoiceItem(db.Model):
@@ -155,6 +160,11 @@ class InvoiceItem(db.Model):
     warehouse = db.relationship('Warehouse', back_populates='invoice_items')
     supplier = db.relationship('Supplier', backref='invoice_items')  # NEW relationship
 
+    __table_args__ = (
+        # The primary key starts with invoice_id; item lookups need their own index
+        db.Index('ix_invoice_item_item_id', 'item_id'),
+    )
+
 # Warehouse Model
 class Warehouse(db.Model):
     __tablename__ = 'warehouse'
@@ -206,6 +216,43 @@ class Prices(db.Model):
                                                "Prices.supplier_id==InvoicePriceDetail.source_price_supplier_id)",
                                    backref="source_price", viewonly=True)
 
+    __table_args__ = (
+        # Per-item layer lookups (latest price, item history); the PK starts with invoice_id
+        db.Index('ix_prices_item_invoice', 'item_id', 'invoice_id'),
+        # Open FIFO layers only: exhausted rows stay for price detail references
+        db.Index(
+            'ix_prices_open_layers', 'item_id', 'location', 'invoice_id',
+            postgresql_where=db.text('quantity > 0')
+        ),
+    )
+
+# Per-(item, location) stock and open FIFO valuation, kept in step with
+# ItemLocations and Prices on every flush (see app/stock_summary.py)
+class StockSummary(db.Model):
+    __tablename__ = 'stock_summary'
+    item_id = db.Column(db.Integer, db.ForeignKey('warehouse.id', ondelete='CASCADE'), primary_key=True)
+    location = db.Column(db.String(255), primary_key=True)
+    on_hand_quantity = db.Column(db.Integer, nullable=False, default=0)
+    fifo_quantity = db.Column(db.Integer, nullable=False, default=0)
+    fifo_value = db.Column(db.Float, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now)
+
+# Append-only log of warehouse stock changes, read by GET /warehouse/changes
+# (see app/stock_changes.py). txid is the writing transaction; a NULL item_id
+# means "anything may have changed" (bulk writes, pruned history).
+class StockChange(db.Model):
+    __tablename__ = 'stock_changes'
+    id = db.Column(db.BigInteger, primary_key=True)
+    txid = db.Column(db.BigInteger, nullable=False, server_default=db.text('txid_current()'))
+    # No foreign key: the entry must outlive a deleted item (it becomes a tombstone)
+    item_id = db.Column(db.Integer, nullable=True)
+    changed_at = db.Column(db.DateTime, default=datetime.now, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_stock_changes_txid', 'txid'),
+        db.Index('ix_stock_changes_changed_at', 'changed_at'),
+    )
+
 # New model to store price breakdown details
 class InvoicePriceDetail(db.Model):
     __tablename__ = 'invoice_price_detail'
@@ -230,6 +277,11 @@ class InvoicePriceDetail(db.Model):
             ['source_price_invoice_id', 'source_price_item_id', 'source_price_location', 'source_price_supplier_id'],
             ['prices.invoice_id', 'prices.item_id', 'prices.location', 'prices.supplier_id']
         ),
+        db.Index('ix_invoice_price_detail_invoice_item', 'invoice_id', 'item_id'),
+        db.Index(
+            'ix_invoice_price_detail_source',
+            'source_price_invoice_id', 'source_price_item_id', 'source_price_location'
+        ),
     )
     
     
@@ -267,6 +319,10 @@ class ReturnSales(db.Model):
     #Relationships
     sales_invoice = db.relationship('Invoice', foreign_keys=[sales_invoice_id], backref='sales_returns')
     return_invoice = db.relationship('Invoice', foreign_keys=[return_invoice_id], backref='return_invoices')
+
+    __table_args__ = (
+        db.Index('ix_return_sales_return_invoice_id', 'return_invoice_id'),
+    )
     
     
 class WarrantyReturn(db.Model):
@@ -332,6 +388,7 @@ class RentedItems(db.Model):
         db.Index('idx_rented_items_invoice_item', 'rental_invoice_id', 'item_id'),
         db.Index('idx_rented_items_status', 'status'),
         db.Index('idx_rented_items_customer', 'customer_name'),
+        db.Index('idx_rented_items_item_status_created', 'item_id', 'status', 'created_at'),
     )
 
 
@@ -1,9 +1,13 @@
 from datetime import datetime
-from ..models import Invoice, Warehouse, ItemLocations, InvoiceItem, Prices, InvoicePriceDetail
+from ..models import Invoice, ItemLocations, InvoiceItem, Prices, InvoicePriceDetail
 from .. import db
 from sqlalchemy.exc import SQLAlchemyError
 from ..utils import operation_result
+from ..transactions import commit_operation, rollback_operation
+from ..lookups import find_item, find_item_location
+from ..locking import retry_on_conflict, lock_operation_stock, is_retryable
 
+@retry_on_conflict
 def Booking_Operations(data, machine, mechanism, supplier, employee, machine_ns, warehouse_ns, invoice_ns, mechanism_ns, item_location_n, supplier_ns):
     """
     Create a booking invoice (حجز type).
@@ -13,6 +17,8 @@ def Booking_Operations(data, machine, mechanism, supplier, employee, machine_ns,
     """
     
     try:
+        lock_operation_stock(data)
+
         # Create new invoice
         new_invoice = Invoice(
             type=data["type"],
@@ -37,24 +43,21 @@ def Booking_Operations(data, machine, mechanism, supplier, employee, machine_ns,
         
         for item_data in data["items"]:
             # Look up the warehouse item by name
-            warehouse_item = Warehouse.query.filter_by(item_name=item_data["item_name"]).first()
+            warehouse_item = find_item(item_data["item_name"])
             if not warehouse_item:
-                db.session.rollback()
+                rollback_operation()
                 return operation_result(404, "error", f"Item '{item_data['item_name']}' not found in warehouse")
             
             # Verify the location exists and has enough quantity
-            item_location = ItemLocations.query.filter_by(
-                item_id=warehouse_item.id,
-                location=item_data['location']
-            ).first()
+            item_location = find_item_location(warehouse_item.id, item_data['location'])
             
             if not item_location:
-                db.session.rollback()
+                rollback_operation()
                 return operation_result(404, "error", f"Item '{item_data['item_name']}' not found in location '{item_data['location']}'")
             
             # Check for duplicate items
             if (warehouse_item.id, item_data['location']) in item_ids:
-                db.session.rollback()
+                rollback_operation()
                 return operation_result(400, "error", f"Item '{item_data['item_name']}' already added to invoice")
             
             item_ids.append((warehouse_item.id, item_data['location']))
@@ -62,7 +65,7 @@ def Booking_Operations(data, machine, mechanism, supplier, employee, machine_ns,
             # Check if enough quantity available
             requested_quantity = item_data["quantity"]
             if item_location.quantity < requested_quantity:
-                db.session.rollback()
+                rollback_operation()
                 return operation_result(400, "error", f"Not enough quantity for item '{item_data['item_name']}' in location '{item_data['location']}'. Available: {item_location.quantity}, Requested: {requested_quantity}",)
             
             # Update physical inventory in ItemLocations
@@ -116,23 +119,28 @@ def Booking_Operations(data, machine, mechanism, supplier, employee, machine_ns,
         new_invoice.total_amount = total_invoice_amount
         new_invoice.residual = total_invoice_amount - new_invoice.paid
         
-        db.session.commit()
+        commit_operation()
         return operation_result(201, "success", "Invoice created successfully", invoice=new_invoice)
         
     except SQLAlchemyError as e:
-        db.session.rollback()
+        rollback_operation()
+        if is_retryable(e):
+            raise
         return operation_result(500, "error", f"Database error: {str(e)}")
     except Exception as e:
-        db.session.rollback()
+        rollback_operation()
         return operation_result(500, "error", f"Error processing booking: {str(e)}")
 
+@retry_on_conflict
 def delete_booking(invoice, invoice_ns):
     # Check if it's a booking invoice
     if invoice.type != 'حجز':
-        db.session.rollback()
+        rollback_operation()
         return operation_result(400, "error", "Can only delete booking invoices with this method")
 
     try:
+        lock_operation_stock(invoice=invoice)
+
         # Restore quantities for each item
         for invoice_item in invoice.items:
             # Find the item location
@@ -167,15 +175,20 @@ def delete_booking(invoice, invoice_ns):
         InvoiceItem.query.filter_by(invoice_id=invoice.id).delete()
         db.session.delete(invoice)
         
-        db.session.commit()
+        commit_operation()
         return {"message": "Booking invoice deleted and stock restored successfully"}, 200
 
     except Exception as e:
-        db.session.rollback()
+        rollback_operation()
+        if is_retryable(e):
+            raise
         return operation_result(500, "error", f"Error deleting booking invoice: {str(e)}")
 
+@retry_on_conflict
 def put_booking(data, invoice, machine, mechanism, invoice_ns):
     try:
+        lock_operation_stock(data, invoice)
+
         with db.session.begin_nested():
             # Create a dictionary of original items for easy lookup
             original_items = {(item.item_id, item.location): item for item in invoice.items}
@@ -186,9 +199,9 @@ def put_booking(data, invoice, machine, mechanism, invoice_ns):
 
             # Process updates and new items
             for item_data in data["items"]:
-                warehouse_item = Warehouse.query.filter_by(item_name=item_data["item_name"]).first()
+                warehouse_item = find_item(item_data["item_name"])
                 if not warehouse_item:
-                    db.session.rollback()
+                    rollback_operation()
                     return operation_result(404, "error", f"Item '{item_data['item_name']}' not found in warehouse")
                 
                 location = item_data["location"]
@@ -200,7 +213,7 @@ def put_booking(data, invoice, machine, mechanism, invoice_ns):
                 ).first()
 
                 if not item_location:
-                    db.session.rollback()
+                    rollback_operation()
                     return operation_result(404, "error", f"Item location not found")
 
                 # Calculate quantity difference
@@ -215,7 +228,7 @@ def put_booking(data, invoice, machine, mechanism, invoice_ns):
 
                 # Check stock availability for increases
                 if quantity_diff > 0 and item_location.quantity < quantity_diff:
-                    db.session.rollback()
+                    rollback_operation()
                     return operation_result(400, "error", f"Insufficient stock for {item_data['item_name']}")
 
                 # Update inventory
@@ -314,13 +327,15 @@ def put_booking(data, invoice, machine, mechanism, invoice_ns):
             if "supplier_id" in data and data["supplier_id"] is not None:
                 invoice.supplier_id = data["supplier_id"]
             
-            db.session.commit()
+            commit_operation()
         
         return {"message": "Booking invoice updated successfully"}, 200
 
     except SQLAlchemyError as e:
-        db.session.rollback()
+        rollback_operation()
+        if is_retryable(e):
+            raise
         return operation_result(500, "error", f"Database error: {str(e)}")
     except Exception as e:
-        db.session.rollback()
+        rollback_operation()
         return operation_result(500, "error", f"Error updating booking invoice: {str(e)}")
\ No newline at end of file
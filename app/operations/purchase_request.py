@@ -1,8 +1,10 @@
 from datetime import datetime
-from ..models import Invoice, Warehouse, ItemLocations, InvoiceItem, Prices, InvoicePriceDetail, PurchaseRequests
+from ..models import Invoice, InvoiceItem, Prices, InvoicePriceDetail, PurchaseRequests
 from .. import db
 from sqlalchemy.exc import SQLAlchemyError
 from ..utils import operation_result
+from ..transactions import commit_operation, rollback_operation
+from ..lookups import find_item, find_item_location
 
 def PurchaseRequest_Operations(data, machine, mechanism, supplier, employee, machine_ns, warehouse_ns, invoice_ns, mechanism_ns, item_location_n, supplier_ns):
     """
@@ -38,23 +40,20 @@ def PurchaseRequest_Operations(data, machine, mechanism, supplier, employee, mac
         
         for item_data in data["items"]:
             # Verify the warehouse item exists
-            warehouse_item = Warehouse.query.filter_by(item_name=item_data["item_name"]).first()
+            warehouse_item = find_item(item_data["item_name"])
             if not warehouse_item:
-                db.session.rollback()
+                rollback_operation()
                 return operation_result(404, "error", f"Item '{item_data['item_name']}' not found in warehouse")
             
-            item_location = ItemLocations.query.filter_by(
-                item_id=warehouse_item.id,
-                location=item_data['location']
-            ).first()
+            item_location = find_item_location(warehouse_item.id, item_data['location'])
             
             if not item_location:
-                db.session.rollback()
+                rollback_operation()
                 return operation_result(404, "error", f"Item '{item_data['item_name']}' not found in location '{item_data['location']}'")
             
             # Check for duplicate items
             if (warehouse_item.id, item_data['location']) in item_ids:
-                db.session.rollback()
+                rollback_operation()
                 return operation_result(400, "error", f"Item '{item_data['item_name']}' already added to invoice")
             
             item_ids.append((warehouse_item.id, item_data['location']))
@@ -66,7 +65,7 @@ def PurchaseRequest_Operations(data, machine, mechanism, supplier, employee, mac
             ).order_by(Prices.invoice_id.desc()).first()
             
             if not last_price_entry:
-                db.session.rollback()
+                rollback_operation()
                 return operation_result(400, "error", f"No price information found for item '{item_data['item_name']}' in location '{item_data['location']}'")
 
             subtotal = item_data["quantity"] * last_price_entry.unit_price
@@ -114,26 +113,26 @@ def PurchaseRequest_Operations(data, machine, mechanism, supplier, employee, mac
     
         new_invoice.total_amount = total_invoice_amount
         
-        db.session.commit()
+        commit_operation()
         return operation_result(201, "success", message="invoice created successfully", invoice=new_invoice)
         
     except SQLAlchemyError as e:
-        db.session.rollback()
+        rollback_operation()
         return operation_result(500, "error", f"Database error: {str(e)}")
     
     except Exception as e:
-        db.session.rollback()
+        rollback_operation()
         return operation_result(500, "error", f"Error processing sale: {str(e)}")
 
 def delete_purchase_request(invoice, invoice_ns):
     # Check if it's a purchase request invoice
     if invoice.type != 'طلب شراء':
-        db.session.rollback()
+        rollback_operation()
         return operation_result(400, "error", "Can only delete purchase request invoices with this method")
     try:
         purchase_request = PurchaseRequests.query.filter_by(invoice_id=invoice.id).first()
         if not purchase_request:
-            db.session.rollback()
+            rollback_operation()
             return operation_result(404, "error", "لم يتم العثور على طلب شراء")
         
         # Delete price detail records
@@ -144,11 +143,11 @@ def delete_purchase_request(invoice, invoice_ns):
         InvoiceItem.query.filter_by(invoice_id=invoice.id).delete()
         db.session.delete(invoice)
         
-        db.session.commit()
+        commit_operation()
         return {"message": "Purchase request deleted successfully"}, 200
 
     except Exception as e:
-        db.session.rollback()
+        rollback_operation()
         return operation_result(500, "error", f"Error deleting invoice: {str(e)}")
 
 def put_purchase_request(data, invoice, machine, mechanism, invoice_ns):
@@ -169,23 +168,20 @@ def put_purchase_request(data, invoice, machine, mechanism, invoice_ns):
             
             for item_data in data["items"]:
                 # Verify the warehouse item exists
-                warehouse_item = Warehouse.query.filter_by(item_name=item_data["item_name"]).first()
+                warehouse_item = find_item(item_data["item_name"])
                 if not warehouse_item:
-                    db.session.rollback()
+                    rollback_operation()
                     return operation_result(404, "error", f"Item '{item_data['item_name']}' not found in warehouse")
                 
-                item_location = ItemLocations.query.filter_by(
-                    item_id=warehouse_item.id,
-                    location=item_data['location']
-                ).first()
+                item_location = find_item_location(warehouse_item.id, item_data['location'])
                 
                 if not item_location:
-                    db.session.rollback()
+                    rollback_operation()
                     return operation_result(404, "error", f"Item '{item_data['item_name']}' not found in location '{item_data['location']}'")
                 
                 # Check for duplicate items
                 if (warehouse_item.id, item_data['location']) in item_ids:
-                    db.session.rollback()
+                    rollback_operation()
                     return operation_result(400, "error", f"Item '{item_data['item_name']}' already added to invoice")
                 
                 item_ids.append((warehouse_item.id, item_data['location']))
@@ -197,7 +193,7 @@ def put_purchase_request(data, invoice, machine, mechanism, invoice_ns):
                 ).order_by(Prices.invoice_id.desc()).first()
                 
                 if not last_price_entry:
-                    db.session.rollback()
+                    rollback_operation()
                     return operation_result(400, "error", f"No price information found for item '{item_data['item_name']}' in location '{item_data['location']}'")
 
                 subtotal = item_data["quantity"] * last_price_entry.unit_price
@@ -260,13 +256,13 @@ def put_purchase_request(data, invoice, machine, mechanism, invoice_ns):
             if mechanism:
                 invoice.mechanism_id = mechanism.id
             
-            db.session.commit()
+            commit_operation()
         
         return {"message": "Invoice updated successfully"}, 200
 
     except SQLAlchemyError as e:
-        db.session.rollback()
+        rollback_operation()
         return operation_result(500, "error", f"Database error: {str(e)}")
     except Exception as e:
-        db.session.rollback()
+        rollback_operation()
         return operation_result(500, "error", f"Error updating invoice: {str(e)}")
\ No newline at end of file
@@ -1,9 +1,14 @@
 from datetime import datetime
-from ..models import Invoice, Warehouse, ItemLocations, InvoiceItem, Prices, InvoicePriceDetail, RentedItems, RentalWarehouseLocations, BookingDeductions
+from ..models import Invoice, Warehouse, ItemLocations, InvoiceItem, InvoicePriceDetail, RentedItems, RentalWarehouseLocations, BookingDeductions
 from .. import db
 from sqlalchemy.exc import SQLAlchemyError
 from ..utils import operation_result
+from ..transactions import commit_operation, rollback_operation
+from ..lookups import find_item, find_item_location
+from ..locking import retry_on_conflict, lock_operation_stock, lock_stock, is_retryable
+from ..fifo import consume, restore
 
+@retry_on_conflict
 def Rent_Operations(data, machine, mechanism, supplier, employee, machine_ns, warehouse_ns, invoice_ns, mechanism_ns, item_location_n, supplier_ns):
     """
     Create a rental invoice (حجز) that:
@@ -13,6 +18,8 @@ def Rent_Operations(data, machine, mechanism, supplier, employee, machine_ns, wa
     4. Tracks rental status and customer information
     """
     try:
+        lock_operation_stock(data)
+
         # Create new rental invoice
         new_invoice = Invoice(
             type="حجز",  # Rental invoice type
@@ -50,24 +57,21 @@ def Rent_Operations(data, machine, mechanism, supplier, employee, machine_ns, wa
         
         for item_data in data["items"]:
             # Verify the warehouse item exists
-            warehouse_item = Warehouse.query.filter_by(item_name=item_data["item_name"]).first()
+            warehouse_item = find_item(item_data["item_name"])
             if not warehouse_item:
-                db.session.rollback()
+                rollback_operation()
                 return operation_result(404, "error", f"Item '{item_data['item_name']}' not found in warehouse")
             
             # Verify the location exists and has enough quantity in main warehouse
-            item_location = ItemLocations.query.filter_by(
-                item_id=warehouse_item.id,
-                location=item_data['location']
-            ).first()
+            item_location = find_item_location(warehouse_item.id, item_data['location'])
             
             if not item_location:
-                db.session.rollback()
+                rollback_operation()
                 return operation_result(404, "error", f"Item '{item_data['item_name']}' not found in location '{item_data['location']}'")
             
             # Check for duplicate items
             if (warehouse_item.id, item_data['location']) in item_ids:
-                db.session.rollback()
+                rollback_operation()
                 return operation_result(400, "error", f"Item '{item_data['item_name']}' already added to rental invoice")
             
             item_ids.append((warehouse_item.id, item_data['location']))
@@ -75,72 +79,30 @@ def Rent_Operations(data, machine, mechanism, supplier, employee, machine_ns, wa
             # Check if enough quantity available in main warehouse location
             requested_quantity = item_data["quantity"]
             if item_location.quantity < requested_quantity:
-                db.session.rollback()
+                rollback_operation()
                 return operation_result(400, "error", f"Not enough quantity for item '{item_data['item_name']}' in location '{item_data['location']}'. Available: {item_location.quantity}, Requested: {requested_quantity}")
             
             # Update physical inventory in main warehouse (decrease)
             item_location.quantity -= requested_quantity
             
-            # Handle pricing using FIFO from the Prices table
-            remaining_to_rent = requested_quantity
-            fifo_total = 0
-            price_breakdown = []
-            
-            # Get all price records for this item ordered by creation date (oldest first for FIFO)
-            price_entries = Prices.query.filter_by(
-                item_id=warehouse_item.id
-            ).order_by(Prices.invoice_id.asc()).all()
+            # Handle pricing using FIFO from the open price layers
+            fifo_result = consume(
+                warehouse_item.id,
+                requested_quantity,
+                invoice_id=new_invoice.id,
+                precision=3
+            )
+            price_breakdown = fifo_result['breakdown']
+            fifo_total = fifo_result['total']
             
-            if not price_entries:
-                db.session.rollback()
+            if not price_breakdown:
+                rollback_operation()
                 return operation_result(400, "error", f"No price information found for item '{item_data['item_name']}'")
             
-            # Process each price entry using FIFO
-            for price_entry in price_entries:
-                if remaining_to_rent <= 0:
-                    break
-                
-                # Calculate how much we can take from this price entry
-                quantity_from_this_entry = min(remaining_to_rent, price_entry.quantity)
-                
-                # Calculate price for this portion
-                subtotal = round(quantity_from_this_entry * price_entry.unit_price, 3)
-                
-                # Track this price breakdown for reference
-                price_breakdown.append({
-                    'quantity': quantity_from_this_entry,
-                    'unit_price': round(price_entry.unit_price, 3),
-                    'subtotal': subtotal,
-                    'source_invoice_id': price_entry.invoice_id,
-                    'source_location': price_entry.location
-                })
-                
-                # Create a price detail record
-                price_detail = InvoicePriceDetail(
-                    invoice_id=new_invoice.id,
-                    item_id=warehouse_item.id,
-                    source_price_invoice_id=price_entry.invoice_id,
-                    source_price_item_id=price_entry.item_id,
-                    source_price_location=price_entry.location,
-                    source_price_supplier_id=price_entry.supplier_id,
-                    quantity=quantity_from_this_entry,
-                    unit_price=round(price_entry.unit_price, 3),
-                    subtotal=subtotal
-                )
-                
-                db.session.add(price_detail)
-                
-                # Update our running totals
-                fifo_total += subtotal
-                remaining_to_rent -= quantity_from_this_entry
-                
-                # Update the price entry quantity
-                price_entry.quantity -= quantity_from_this_entry
-            
             # Check if we've fulfilled the entire requested quantity
-            if remaining_to_rent > 0:
-                db.session.rollback()
-                return operation_result(400, "error", f"Insufficient priced inventory for '{item_data['item_name']}'. Missing price data for {remaining_to_rent} units.")
+            if fifo_result['remaining'] > 0:
+                rollback_operation()
+                return operation_result(400, "error", f"Insufficient priced inventory for '{item_data['item_name']}'. Missing price data for {fifo_result['remaining']} units.")
             
             # Calculate effective unit price based on FIFO total
             fifo_total = round(fifo_total, 3)
@@ -205,23 +167,28 @@ def Rent_Operations(data, machine, mechanism, supplier, employee, machine_ns, wa
         new_invoice.total_amount = total_invoice_amount
         new_invoice.residual = round(total_invoice_amount - new_invoice.paid, 3)
         
-        db.session.commit()
+        commit_operation()
         return operation_result(201, "success", invoice=new_invoice)
         
     except SQLAlchemyError as e:
-        db.session.rollback()
+        rollback_operation()
+        if is_retryable(e):
+            raise
         return operation_result(500, "error", message=f"Database error: {str(e)}")
     except Exception as e:
-        db.session.rollback()
+        rollback_operation()
         return operation_result(500, "error", message=f"Error processing rental: {str(e)}")
 
 
+@retry_on_conflict
 def update_rental_status(rental_invoice_id, item_id, new_status, employee_id, notes=None):
     """
     Update the status of a rented item
     Statuses: 'reserved', 'given', 'returned', 'borrowed_to_main'
     """
     try:
+        lock_stock([item_id])
+
         rented_item = RentedItems.query.filter_by(
             rental_invoice_id=rental_invoice_id,
             item_id=item_id
@@ -257,22 +224,27 @@ def update_rental_status(rental_invoice_id, item_id, new_status, employee_id, no
             # Return items to main warehouse from rental warehouse
             return_to_main_warehouse(item_id, rented_item.quantity, employee_id)
         
-        db.session.commit()
+        commit_operation()
         return operation_result(200, "success", message=f"Rental status updated to {new_status}")
         
     except SQLAlchemyError as e:
-        db.session.rollback()
+        rollback_operation()
+        if is_retryable(e):
+            raise
         return operation_result(500, "error", message=f"Database error: {str(e)}")
     except Exception as e:
-        db.session.rollback()
+        rollback_operation()
         return operation_result(500, "error", message=f"Error updating rental status: {str(e)}")
 
 
+@retry_on_conflict
 def borrow_from_rental_to_main(item_id, quantity, location, employee_id, notes=None):
     """
     Borrow items from rental warehouse to main warehouse when main warehouse runs out
     """
     try:
+        lock_stock([item_id])
+
         # Check rental warehouse availability
         rental_location = RentalWarehouseLocations.query.filter_by(
             item_id=item_id,
@@ -333,15 +305,17 @@ def borrow_from_rental_to_main(item_id, quantity, location, employee_id, notes=N
                     rented_item.notes = f"{rented_item.notes or ''} | Borrowed to main: {notes}"
                 remaining_to_borrow -= quantity_to_borrow
 
-        db.session.commit()
+        commit_operation()
         borrowed_amount = quantity - remaining_to_borrow
         return operation_result(200, "success", message=f"Successfully borrowed {borrowed_amount} items from rental to main warehouse")
 
     except SQLAlchemyError as e:
-        db.session.rollback()
+        rollback_operation()
+        if is_retryable(e):
+            raise
         return operation_result(500, "error", message=f"Database error: {str(e)}")
     except Exception as e:
-        db.session.rollback()
+        rollback_operation()
         return operation_result(500, "error", message=f"Error borrowing from rental warehouse: {str(e)}")
 
 
@@ -377,25 +351,30 @@ def return_to_main_warehouse(item_id, quantity, employee_id):
         return True
         
     except Exception as e:
+        if is_retryable(e):
+            raise
         print(f"Error returning to main warehouse: {str(e)}")
         return False
 
 
+@retry_on_conflict
 def put_rental(data, invoice, machine, mechanism, invoice_ns):
     """
     Update a rental invoice
     """
     try:
+        lock_operation_stock(data, invoice)
+
         # Check if it's a rental invoice
         if invoice.type != 'حجز':
-            db.session.rollback()
+            rollback_operation()
             return operation_result(400, "error", "Can only update rental invoices with this method")
 
         # Check if any items have been given to customers
         rented_items = RentedItems.query.filter_by(rental_invoice_id=invoice.id).all()
         for rented_item in rented_items:
             if rented_item.status == 'given':
-                db.session.rollback()
+                rollback_operation()
                 return operation_result(400, "error", "Cannot update rental invoice after items have been given to customer")
 
         with db.session.begin_nested():
@@ -419,9 +398,9 @@ def put_rental(data, invoice, machine, mechanism, invoice_ns):
 
             # Process updates and new items
             for item_data in data["items"]:
-                warehouse_item = Warehouse.query.filter_by(item_name=item_data["item_name"]).first()
+                warehouse_item = find_item(item_data["item_name"])
                 if not warehouse_item:
-                    db.session.rollback()
+                    rollback_operation()
                     return operation_result(404, "error", f"Item '{item_data['item_name']}' not found in warehouse")
 
                 location = item_data["location"]
@@ -433,7 +412,7 @@ def put_rental(data, invoice, machine, mechanism, invoice_ns):
                 ).first()
 
                 if not item_location:
-                    db.session.rollback()
+                    rollback_operation()
                     return operation_result(404, "error", f"Item location not found")
 
                 # Calculate quantity difference
@@ -448,7 +427,7 @@ def put_rental(data, invoice, machine, mechanism, invoice_ns):
 
                 # Check stock availability for increases
                 if quantity_diff > 0 and item_location.quantity < quantity_diff:
-                    db.session.rollback()
+                    rollback_operation()
                     return operation_result(400, "error", f"Insufficient stock for {item_data['item_name']}")
 
                 # Update main warehouse inventory
@@ -457,19 +436,10 @@ def put_rental(data, invoice, machine, mechanism, invoice_ns):
                 # Handle pricing using FIFO
                 # First, restore old price quantities if this is an update
                 if key in original_items:
-                    old_price_details = InvoicePriceDetail.query.filter_by(
+                    restore(InvoicePriceDetail.query.filter_by(
                         invoice_id=invoice.id,
                         item_id=warehouse_item.id
-                    ).all()
-                    for detail in old_price_details:
-                        price_entry = Prices.query.filter_by(
-                            invoice_id=detail.source_price_invoice_id,
-                            item_id=detail.source_price_item_id,
-                            location=detail.source_price_location,
-                            supplier_id=detail.source_price_supplier_id
-                        ).first()
-                        if price_entry:
-                            price_entry.quantity += detail.quantity
+                    ).all())
 
                     # Delete old price details for this item
                     InvoicePriceDetail.query.filter_by(
@@ -478,43 +448,20 @@ def put_rental(data, invoice, machine, mechanism, invoice_ns):
                     ).delete()
 
                 # Apply new FIFO pricing
-                remaining_to_rent = new_quantity
-                fifo_total = 0
-
-                price_entries = Prices.query.filter_by(
-                    item_id=warehouse_item.id
-                ).order_by(Prices.invoice_id.asc()).all()
+                fifo_result = consume(
+                    warehouse_item.id,
+                    new_quantity,
+                    invoice_id=invoice.id,
+                    precision=3
+                )
+                fifo_total = fifo_result['total']
 
-                if not price_entries:
-                    db.session.rollback()
+                if not fifo_result['breakdown']:
+                    rollback_operation()
                     return operation_result(400, "error", f"No price information found for item '{item_data['item_name']}'")
 
-                for price_entry in price_entries:
-                    if remaining_to_rent <= 0:
-                        break
-
-                    quantity_from_this_entry = min(remaining_to_rent, price_entry.quantity)
-                    subtotal = round(quantity_from_this_entry * price_entry.unit_price, 3)
-
-                    price_detail = InvoicePriceDetail(
-                        invoice_id=invoice.id,
-                        item_id=warehouse_item.id,
-                        source_price_invoice_id=price_entry.invoice_id,
-                        source_price_item_id=price_entry.item_id,
-                        source_price_location=price_entry.location,
-                        source_price_supplier_id=price_entry.supplier_id,
-                        quantity=quantity_from_this_entry,
-                        unit_price=round(price_entry.unit_price, 3),
-                        subtotal=subtotal
-                    )
-
-                    db.session.add(price_detail)
-                    fifo_total += subtotal
-                    remaining_to_rent -= quantity_from_this_entry
-                    price_entry.quantity -= quantity_from_this_entry
-
-                if remaining_to_rent > 0:
-                    db.session.rollback()
+                if fifo_result['remaining'] > 0:
+                    rollback_operation()
                     return operation_result(400, "error", f"Insufficient priced inventory for '{item_data['item_name']}'")
 
                 fifo_total = round(fifo_total, 3)
@@ -634,35 +581,40 @@ def put_rental(data, invoice, machine, mechanism, invoice_ns):
             if mechanism:
                 invoice.mechanism_id = mechanism.id
 
-            db.session.commit()
+            commit_operation()
 
         return {"message": "Rental invoice updated successfully"}, 200
 
     except SQLAlchemyError as e:
-        db.session.rollback()
+        rollback_operation()
+        if is_retryable(e):
+            raise
         return operation_result(500, "error", f"Database error: {str(e)}")
     except Exception as e:
-        db.session.rollback()
+        rollback_operation()
         return operation_result(500, "error", f"Error updating rental invoice: {str(e)}")
 
 
+@retry_on_conflict
 def delete_rental_invoice(invoice, invoice_ns):
     """
     Delete a rental invoice and restore inventory
     """
     # Check if it's a rental invoice
     if invoice.type != 'حجز':
-        db.session.rollback()
+        rollback_operation()
         return operation_result(400, "error", "Can only delete rental invoices with this method")
 
     try:
+        lock_operation_stock(invoice=invoice)
+
         # Get all rented items for this invoice
         rented_items = RentedItems.query.filter_by(rental_invoice_id=invoice.id).all()
 
         for rented_item in rented_items:
             # If item was given to customer, we can't delete the invoice
             if rented_item.status == 'given':
-                db.session.rollback()
+                rollback_operation()
                 return operation_result(400, "error", f"Cannot delete rental invoice. Item {rented_item.item.item_name} has been given to customer.")
 
             # Get the original invoice item to find the correct location
@@ -672,7 +624,7 @@ def delete_rental_invoice(invoice, invoice_ns):
             ).first()
 
             if not invoice_item:
-                db.session.rollback()
+                rollback_operation()
                 return operation_result(500, "error", f"Invoice item not found for item {rented_item.item_id}")
 
             # Restore main warehouse inventory to the original location
@@ -705,18 +657,7 @@ def delete_rental_invoice(invoice, invoice_ns):
                     db.session.delete(rental_location)
 
         # Restore price entries
-        price_details = InvoicePriceDetail.query.filter_by(invoice_id=invoice.id).all()
-
-        for detail in price_details:
-            price_entry = Prices.query.filter_by(
-                invoice_id=detail.source_price_invoice_id,
-                item_id=detail.source_price_item_id,
-                location=detail.source_price_location,
-                supplier_id=detail.source_price_supplier_id
-            ).first()
-
-            if price_entry:
-                price_entry.quantity += detail.quantity
+        restore(InvoicePriceDetail.query.filter_by(invoice_id=invoice.id).all())
 
         # Delete related records
         RentedItems.query.filter_by(rental_invoice_id=invoice.id).delete()
@@ -726,14 +667,16 @@ def delete_rental_invoice(invoice, invoice_ns):
         # Delete the invoice
         db.session.delete(invoice)
 
-        db.session.commit()
+        commit_operation()
         return operation_result(200, "success", message="Rental invoice deleted successfully")
 
     except SQLAlchemyError as e:
-        db.session.rollback()
+        rollback_operation()
+        if is_retryable(e):
+            raise
         return operation_result(500, "error", message=f"Database error: {str(e)}")
     except Exception as e:
-        db.session.rollback()
+        rollback_operation()
         return operation_result(500, "error", message=f"Error deleting rental invoice: {str(e)}")
 
 
@@ -1,9 +1,13 @@
 from datetime import datetime
-from ..models import Invoice, Warehouse, ItemLocations, InvoiceItem, Prices, InvoicePriceDetail, ReturnSales
+from ..models import Invoice, ItemLocations, InvoiceItem, Prices, InvoicePriceDetail, ReturnSales
 from .. import db
 from sqlalchemy.exc import SQLAlchemyError
 from ..utils import operation_result
+from ..transactions import commit_operation, rollback_operation
+from ..lookups import find_item, find_item_location
+from ..locking import retry_on_conflict, lock_operation_stock, is_retryable
 
+@retry_on_conflict
 def Return_Operations(data, machine, mechanism, supplier, employee, machine_ns, warehouse_ns, invoice_ns, mechanism_ns, item_location_n, supplier_ns):
     """
     Create a return invoice (مرتجع type).
@@ -12,6 +16,8 @@ def Return_Operations(data, machine, mechanism, supplier, employee, machine_ns,
     Updated to work with new Prices table schema that includes location.
     """
     try:
+        lock_operation_stock(data)
+
         # Create new invoice
         new_invoice = Invoice(
             type=data["type"],
@@ -44,7 +50,7 @@ def Return_Operations(data, machine, mechanism, supplier, employee, machine_ns,
         if original_invoice_id:
             original_invoice = Invoice.query.get(original_invoice_id)
             if not original_invoice:
-                db.session.rollback()
+                rollback_operation()
                 return operation_result(404, "error", f"Original invoice {original_invoice_id} not found", None)
             
             if original_invoice.type == 'صرف':
@@ -52,21 +58,18 @@ def Return_Operations(data, machine, mechanism, supplier, employee, machine_ns,
             elif original_invoice.type == 'اضافه':
                 return_type = 'purchase'
             else:
-                db.session.rollback()
+                rollback_operation()
                 return operation_result(400, "error", f"Cannot return from invoice type '{original_invoice.type}'. Only sales (صرف) and purchase (اضافه) invoices can be returned.", None)
         
         for item_data in data["items"]:
             # Look up the warehouse item by name
-            warehouse_item = Warehouse.query.filter_by(item_name=item_data["item_name"]).first()
+            warehouse_item = find_item(item_data["item_name"])
             if not warehouse_item:
-                db.session.rollback()
+                rollback_operation()
                 return operation_result(404, "error", f"Item '{item_data['item_name']}' not found in warehouse", None)
             
             # Verify or create the location
-            item_location = ItemLocations.query.filter_by(
-                item_id=warehouse_item.id,
-                location=item_data['location']
-            ).first()
+            item_location = find_item_location(warehouse_item.id, item_data['location'])
             
             if not item_location:
                 item_location = ItemLocations(
@@ -78,7 +81,7 @@ def Return_Operations(data, machine, mechanism, supplier, employee, machine_ns,
             
             # Check for duplicate items
             if (warehouse_item.id, item_data['location']) in item_ids:
-                db.session.rollback()
+                rollback_operation()
                 return operation_result(400, "error", f"Item '{item_data['item_name']}' already added to invoice", None)
             
             item_ids.append((warehouse_item.id, item_data['location']))
@@ -96,7 +99,7 @@ def Return_Operations(data, machine, mechanism, supplier, employee, machine_ns,
             elif return_type == 'purchase':
                 # Check if we have enough quantity to return
                 if item_location.quantity < quantity:
-                    db.session.rollback()
+                    rollback_operation()
                     return operation_result(400, "error", f"Not enough quantity to return for item '{item_data['item_name']}' in location '{item_data['location']}'. Available: {item_location.quantity}, Requested: {quantity}", None)
                 item_location.quantity -= quantity  # Remove from inventory
             else:
@@ -170,14 +173,16 @@ def Return_Operations(data, machine, mechanism, supplier, employee, machine_ns,
         new_invoice.total_amount = total_invoice_amount
         new_invoice.residual = total_invoice_amount - new_invoice.paid
         
-        db.session.commit()
+        commit_operation()
         return operation_result(200, "success", "Invoice created successfully", new_invoice)
         
     except SQLAlchemyError as e:
-        db.session.rollback()
+        rollback_operation()
+        if is_retryable(e):
+            raise
         return operation_result(500, "error", f"Database error: {str(e)}", None)
     except Exception as e:
-        db.session.rollback()
+        rollback_operation()
         return operation_result(500, "error", f"Error processing return: {str(e)}", None)
 
 
@@ -211,7 +216,7 @@ def handle_sales_return(original_invoice_id, warehouse_item, item_data, new_invo
                 total_returned_quantity += old_invoice_item.quantity
     
     if total_returned_quantity + item_data['quantity'] > total_sales_items:
-        db.session.rollback()
+        rollback_operation()
         raise Exception(f"Return quantity exceeds the total sales quantity for item '{item_data['item_name']}' in location '{item_data['location']}'")
     
     # Restore quantities proportionally based on FIFO consumption
@@ -235,7 +240,7 @@ def handle_sales_return(original_invoice_id, warehouse_item, item_data, new_invo
             remaining_to_return -= quantity_to_return
     
     if remaining_to_return > 0:
-        db.session.rollback()
+        rollback_operation()
         raise Exception(f"Cannot properly restore all returned quantities for item '{item_data['item_name']}' in location '{item_data['location']}'")
     
     return True
@@ -274,7 +279,7 @@ def handle_purchase_return(original_invoice_id, warehouse_item, item_data, new_i
     
     # Validate return quantity doesn't exceed purchased quantity
     if total_returned_quantity + item_data['quantity'] > total_purchased_quantity:
-        db.session.rollback()
+        rollback_operation()
         raise Exception(f"Return quantity exceeds the total purchased quantity for item '{item_data['item_name']}' in location '{item_data['location']}'")
     
     # For purchase returns, we need to reduce the price record created by the purchase
@@ -291,7 +296,7 @@ def handle_purchase_return(original_invoice_id, warehouse_item, item_data, new_i
             available_to_return = price_record.quantity
             already_sold = (total_purchased_quantity - total_returned_quantity) - available_to_return
             
-            db.session.rollback()
+            rollback_operation()
             raise Exception(f"Cannot return {item_data['quantity']} units of '{item_data['item_name']}' in location '{item_data['location']}'. " +
                           f"Only {available_to_return} units available to return. " +
                           f"{already_sold} units have already been sold.")
@@ -314,14 +319,17 @@ def handle_purchase_return(original_invoice_id, warehouse_item, item_data, new_i
         return True
     
     return False
+@retry_on_conflict
 def delete_return(invoice, invoice_ns):
     """Delete a return invoice and restore original state for both sales and purchase returns (updated with location support)"""
     # Check if it's a return invoice
     if invoice.type != 'مرتجع':
-        db.session.rollback()
+        rollback_operation()
         return operation_result(400, "error", "Can only delete return invoices with this method")
 
     try:
+        lock_operation_stock(invoice=invoice)
+
         # Get the original invoice information
         return_sales_record = ReturnSales.query.filter_by(return_invoice_id=invoice.id).first()
         original_invoice_id = None
@@ -348,7 +356,7 @@ def delete_return(invoice, invoice_ns):
                     invoice_item, warehouse_item, original_invoice_id
                 )
                 if result is not True:
-                    db.session.rollback()
+                    rollback_operation()
                     return result
                     
             elif return_type == 'purchase':
@@ -357,7 +365,7 @@ def delete_return(invoice, invoice_ns):
                     invoice_item, warehouse_item, original_invoice_id
                 )
                 if result is not True:
-                    db.session.rollback()
+                    rollback_operation()
                     return result
             
             # Handle price records created specifically by this return invoice
@@ -378,7 +386,7 @@ def delete_return(invoice, invoice_ns):
                 consumed_from_return_price = sum(detail.quantity for detail in price_details_consuming_this)
                 
                 if consumed_from_return_price > 0:
-                    db.session.rollback()
+                    rollback_operation()
                     return operation_result(400, "error", 
                         f"Cannot delete return invoice: {consumed_from_return_price} units of "
                         f"'{warehouse_item.item_name}' from location '{invoice_item.location}' have already been sold again.")
@@ -401,7 +409,7 @@ def delete_return(invoice, invoice_ns):
                 item_location.quantity -= invoice_item.quantity
                 # Check for negative quantity
                 if item_location.quantity < 0:
-                    db.session.rollback()
+                    rollback_operation()
                     return operation_result(400, "error", 
                         f"Cannot delete return invoice: Not enough quantity for item "
                         f"'{warehouse_item.item_name}' in location '{invoice_item.location}'. "
@@ -414,7 +422,7 @@ def delete_return(invoice, invoice_ns):
                 # No original invoice - default behavior (subtract)
                 item_location.quantity -= invoice_item.quantity
                 if item_location.quantity < 0:
-                    db.session.rollback()
+                    rollback_operation()
                     return operation_result(400, "error", 
                         f"Cannot delete return invoice: Not enough quantity for item "
                         f"'{warehouse_item.item_name}' in location '{invoice_item.location}'.")
@@ -433,7 +441,7 @@ def delete_return(invoice, invoice_ns):
             if not referencing_details:
                 db.session.delete(price_record)
             else:
-                db.session.rollback()
+                rollback_operation()
                 return operation_result(400, "error", 
                     f"Cannot delete return invoice: Items from this return have already been sold again. "
                     f"Delete the subsequent sales invoices first.")
@@ -448,14 +456,16 @@ def delete_return(invoice, invoice_ns):
         # Delete the invoice itself
         db.session.delete(invoice)
         
-        db.session.commit()
+        commit_operation()
         return {"message": "Return invoice deleted and stock adjusted successfully"}, 200
 
     except SQLAlchemyError as e:
-        db.session.rollback()
+        rollback_operation()
+        if is_retryable(e):
+            raise
         return operation_result(500, "error", f"Database error: {str(e)}", None)
     except Exception as e:
-        db.session.rollback()
+        rollback_operation()
         return operation_result(500, "error", f"Error deleting return invoice: {str(e)}", None)
 
 
@@ -555,9 +565,12 @@ def handle_purchase_return_deletion(invoice_item, warehouse_item, original_invoi
     return True
 
 
+@retry_on_conflict
 def put_return(data, invoice, machine, mechanism, invoice_ns):
     """Update a return invoice - supports both sales and purchase returns (updated with location support)"""
     try:
+        lock_operation_stock(data, invoice)
+
         with db.session.begin_nested():
             # Get the original invoice information to determine return type
             return_sales_record = ReturnSales.query.filter_by(return_invoice_id=invoice.id).first()
@@ -582,9 +595,9 @@ def put_return(data, invoice, machine, mechanism, invoice_ns):
 
             # Process updates and new items
             for item_data in data["items"]:
-                warehouse_item = Warehouse.query.filter_by(item_name=item_data["item_name"]).first()
+                warehouse_item = find_item(item_data["item_name"])
                 if not warehouse_item:
-                    db.session.rollback()
+                    rollback_operation()
                     return operation_result(404, "error", f"Item '{item_data['item_name']}' not found in warehouse")
                 
                 location = item_data["location"]
@@ -622,7 +635,7 @@ def put_return(data, invoice, machine, mechanism, invoice_ns):
                     item_location.quantity += quantity_diff
                     # Check for negative quantity after adjustment
                     if item_location.quantity < 0:
-                        db.session.rollback()
+                        rollback_operation()
                         return operation_result(400, "error", 
                             f"Cannot update return invoice: Not enough quantity for item " +
                             f"'{item_data['item_name']}' in location '{location}'. " +
@@ -632,7 +645,7 @@ def put_return(data, invoice, machine, mechanism, invoice_ns):
                     if quantity_diff > 0:  # Increasing return quantity
                         # Need to check if we have enough to remove
                         if item_location.quantity < quantity_diff:
-                            db.session.rollback()
+                            rollback_operation()
                             return operation_result(400, "error", 
                                 f"Cannot update return invoice: Not enough quantity for item " +
                                 f"'{item_data['item_name']}' in location '{location}'. " +
@@ -640,7 +653,7 @@ def put_return(data, invoice, machine, mechanism, invoice_ns):
                     item_location.quantity -= quantity_diff
                     # Check for negative quantity after adjustment
                     if item_location.quantity < 0:
-                        db.session.rollback()
+                        rollback_operation()
                         return operation_result(400, "error", 
                             f"Cannot update return invoice: Not enough quantity for item " +
                             f"'{item_data['item_name']}' in location '{location}'.")
@@ -648,7 +661,7 @@ def put_return(data, invoice, machine, mechanism, invoice_ns):
                     # No original invoice - default behavior (add)
                     item_location.quantity += quantity_diff
                     if item_location.quantity < 0:
-                        db.session.rollback()
+                        rollback_operation()
                         return operation_result(400, "error", 
                             f"Cannot update return invoice: Not enough quantity for item " +
                             f"'{item_data['item_name']}' in location '{location}'.")
@@ -660,7 +673,7 @@ def put_return(data, invoice, machine, mechanism, invoice_ns):
                         new_quantity, original_invoice_id, location  # NEW: Pass location
                     )
                     if result != True:
-                        db.session.rollback()
+                        rollback_operation()
                         return result
                         
                 elif return_type == 'purchase' and original_invoice_id:
@@ -669,7 +682,7 @@ def put_return(data, invoice, machine, mechanism, invoice_ns):
                         new_quantity, original_invoice_id, location  # NEW: Pass location
                     )
                     if result != True:
-                        db.session.rollback()
+                        rollback_operation()
                         return result
 
                 # Update or create invoice item
@@ -711,7 +724,7 @@ def put_return(data, invoice, machine, mechanism, invoice_ns):
                         
                         # Cannot reduce below the consumed amount
                         if new_quantity < consumed:
-                            db.session.rollback()
+                            rollback_operation()
                             return operation_result(400, "error", 
                                 f"Cannot update return invoice: {consumed} units of " +
                                 f"'{item_data['item_name']}' in location '{location}' have already been sold again. " +
@@ -750,7 +763,7 @@ def put_return(data, invoice, machine, mechanism, invoice_ns):
                             item, item_id, original_invoice_id, location  # NEW: Pass location
                         )
                         if result != True:
-                            db.session.rollback()
+                            rollback_operation()
                             return result
                             
                     elif return_type == 'purchase' and original_invoice_id:
@@ -758,7 +771,7 @@ def put_return(data, invoice, machine, mechanism, invoice_ns):
                             item, item_id, original_invoice_id, location  # NEW: Pass location
                         )
                         if result != True:
-                            db.session.rollback()
+                            rollback_operation()
                             return result
                     
                     item_location = ItemLocations.query.filter_by(
@@ -773,7 +786,7 @@ def put_return(data, invoice, machine, mechanism, invoice_ns):
                             item_location.quantity -= item.quantity
                             # Check for negative quantity
                             if item_location.quantity < 0:
-                                db.session.rollback()
+                                rollback_operation()
                                 return operation_result(400, "error", 
                                     f"Cannot remove item: Not enough quantity for " +
                                     f"'{item.warehouse.item_name}' in location '{location}'. " +
@@ -785,7 +798,7 @@ def put_return(data, invoice, machine, mechanism, invoice_ns):
                             # Default behavior
                             item_location.quantity -= item.quantity
                             if item_location.quantity < 0:
-                                db.session.rollback()
+                                rollback_operation()
                                 return operation_result(400, "error", 
                                     f"Cannot remove item: Not enough quantity for " +
                                     f"'{item.warehouse.item_name}' in location '{location}'.")
@@ -823,16 +836,18 @@ def put_return(data, invoice, machine, mechanism, invoice_ns):
             if "supplier_id" in data and data["supplier_id"] is not None:
                 invoice.supplier_id = data["supplier_id"]
             
-            db.session.commit()
+            commit_operation()
         
         return {"message": "Return invoice updated successfully"}, 200
 
     except SQLAlchemyError as e:
-        db.session.rollback()
+        rollback_operation()
+        if is_retryable(e):
+            raise
         return operation_result(500, "error", f"Database error: {str(e)}")
         
     except Exception as e:
-        db.session.rollback()
+        rollback_operation()
         return operation_result(500, "error", f"Unexpected error: {str(e)}")
 
 
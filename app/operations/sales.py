@@ -1,8 +1,12 @@
 from datetime import datetime
-from ..models import Invoice, Warehouse, ItemLocations, InvoiceItem, Prices, InvoicePriceDetail, RentedItems, RentalWarehouseLocations, BookingDeductions
+from ..models import Invoice, ItemLocations, InvoiceItem, InvoicePriceDetail, RentedItems, RentalWarehouseLocations, BookingDeductions
 from .. import db
 from sqlalchemy.exc import SQLAlchemyError
 from ..utils import operation_result
+from ..transactions import commit_operation, rollback_operation
+from ..lookups import find_item, find_item_location
+from ..locking import retry_on_conflict, lock_operation_stock, is_retryable
+from ..fifo import consume, restore
 
 
 def deduct_from_booking_invoices(item_id, shortage_quantity, deducted_invoice_id, warehouse_item):
@@ -68,7 +72,7 @@ def deduct_from_booking_invoices(item_id, shortage_quantity, deducted_invoice_id
             ).first()
 
             if not booking_invoice_item:
-                db.session.rollback()
+                rollback_operation()
                 return {
                     "status": "error",
                     "message": f"No price found for item in booking invoice #{rented_item.rental_invoice_id}"
@@ -111,14 +115,19 @@ def deduct_from_booking_invoices(item_id, shortage_quantity, deducted_invoice_id
         }
 
     except Exception as e:
+        if is_retryable(e):
+            raise
         return {
             "status": "error",
             "message": f"Error deducting from bookings: {str(e)}"
         }
 
 
+@retry_on_conflict
 def Sales_Operations(data, machine, mechanism, supplier, employee, machine_ns, warehouse_ns, invoice_ns, mechanism_ns, item_location_n, supplier_ns):
     try:
+        lock_operation_stock(data)
+
         # Create new invoice
         new_invoice = Invoice(
             type=data["type"],
@@ -145,24 +154,21 @@ def Sales_Operations(data, machine, mechanism, supplier, employee, machine_ns, w
         
         for item_data in data["items"]:
             # Verify the warehouse item exists
-            warehouse_item = Warehouse.query.filter_by(item_name=item_data["item_name"]).first()
+            warehouse_item = find_item(item_data["item_name"])
             if not warehouse_item:
-                db.session.rollback()
+                rollback_operation()
                 return operation_result(404, "error", f"Item '{item_data['item_name']}' not found in warehouse")
             
             # Verify the location exists and has enough quantity
-            item_location = ItemLocations.query.filter_by(
-                item_id=warehouse_item.id,
-                location=item_data['location']
-            ).first()
+            item_location = find_item_location(warehouse_item.id, item_data['location'])
             
             if not item_location:
-                db.session.rollback()
+                rollback_operation()
                 return operation_result(404, "error", f"Item '{item_data['item_name']}' not found in location '{item_data['location']}'")
             
             # Check for duplicate items
             if (warehouse_item.id, item_data['location']) in item_ids:
-                db.session.rollback()
+                rollback_operation()
                 return operation_result(400, "error", f"Item '{item_data['item_name']}' already added to invoice")
             
             item_ids.append((warehouse_item.id, item_data['location']))
@@ -186,7 +192,7 @@ def Sales_Operations(data, machine, mechanism, supplier, employee, machine_ns, w
                 )
 
                 if deduction_result["status"] == "error":
-                    db.session.rollback()
+                    rollback_operation()
                     return operation_result(400, "error", deduction_result["message"])
 
                 # Successfully deducted from bookings
@@ -196,7 +202,7 @@ def Sales_Operations(data, machine, mechanism, supplier, employee, machine_ns, w
                 # Check if we have enough now
                 total_available = main_available + borrowed_from_bookings
                 if total_available < requested_quantity:
-                    db.session.rollback()
+                    rollback_operation()
                     return operation_result(400, "error", f"Not enough quantity for item '{item_data['item_name']}' in location '{item_data['location']}'. Available: {main_available}, From Bookings: {borrowed_from_bookings}, Total: {total_available}, Requested: {requested_quantity}")
             
             # Update physical inventory in ItemLocations (deduct from main warehouse)
@@ -208,60 +214,22 @@ def Sales_Operations(data, machine, mechanism, supplier, employee, machine_ns, w
             fifo_total = 0
             price_breakdown = []
 
-            # First, price the quantity from main warehouse using FIFO
+            # First, price the quantity from main warehouse using FIFO across ALL locations
             if actual_from_main > 0:
-                # Get all price records for this item across ALL locations ordered by creation date (oldest first for FIFO)
-                price_entries = Prices.query.filter_by(
-                    item_id=warehouse_item.id
-                ).order_by(Prices.invoice_id.asc()).all()
+                fifo_result = consume(
+                    warehouse_item.id,
+                    actual_from_main,
+                    invoice_id=new_invoice.id,
+                    precision=3
+                )
 
-                if not price_entries:
-                    db.session.rollback()
+                if not fifo_result['breakdown']:
+                    rollback_operation()
                     return operation_result(400, "error", f"No price information found for item '{item_data['item_name']}'")
 
-                # Process FIFO pricing for main warehouse quantity
-                remaining_from_main = actual_from_main
-                for price_entry in price_entries:
-                    if remaining_from_main <= 0:
-                        break
-
-                    # Calculate how much we can take from this price entry
-                    quantity_from_this_entry = min(remaining_from_main, price_entry.quantity)
-
-                    # Calculate price for this portion
-                    subtotal = round(quantity_from_this_entry * price_entry.unit_price, 3)
-
-                    # Track this price breakdown for reference
-                    price_breakdown.append({
-                        'quantity': quantity_from_this_entry,
-                        'unit_price': round(price_entry.unit_price, 3),
-                        'subtotal': subtotal,
-                        'source_invoice_id': price_entry.invoice_id,
-                        'source_location': price_entry.location
-                    })
-
-                    # Create a price detail record
-                    price_detail = InvoicePriceDetail(
-                        invoice_id=new_invoice.id,
-                        item_id=warehouse_item.id,
-                        source_price_invoice_id=price_entry.invoice_id,
-                        source_price_item_id=price_entry.item_id,
-                        source_price_location=price_entry.location,
-                        source_price_supplier_id=price_entry.supplier_id,
-                        quantity=quantity_from_this_entry,
-                        unit_price=round(price_entry.unit_price, 3),
-                        subtotal=subtotal
-                    )
-
-                    db.session.add(price_detail)
-
-                    # Update our running totals
-                    fifo_total += subtotal
-                    remaining_from_main -= quantity_from_this_entry
-                    remaining_to_sell -= quantity_from_this_entry
-
-                    # Update the price entry quantity
-                    price_entry.quantity -= quantity_from_this_entry
+                price_breakdown.extend(fifo_result['breakdown'])
+                fifo_total += fifo_result['total']
+                remaining_to_sell -= actual_from_main - fifo_result['remaining']
 
             # Second, add prices from booking invoices (if any)
             if borrowed_from_bookings > 0 and booking_deduction_info:
@@ -280,7 +248,7 @@ def Sales_Operations(data, machine, mechanism, supplier, employee, machine_ns, w
 
             # Check if we've fulfilled the entire requested quantity
             if remaining_to_sell > 0:
-                db.session.rollback()
+                rollback_operation()
                 return operation_result(400, "error", f"Insufficient priced inventory for '{item_data['item_name']}'. Missing price data for {remaining_to_sell} units.")
 
             # Calculate effective unit price based on total
@@ -312,24 +280,29 @@ def Sales_Operations(data, machine, mechanism, supplier, employee, machine_ns, w
         new_invoice.total_amount = total_invoice_amount
         new_invoice.residual = round(total_invoice_amount - new_invoice.paid, 3)
         
-        db.session.commit()
+        commit_operation()
         return operation_result(201, "success", invoice=new_invoice)
         
     except SQLAlchemyError as e:
-        db.session.rollback()
+        rollback_operation()
+        if is_retryable(e):
+            raise
         return operation_result(500, "error", message=f"Database error: {str(e)}")
     except Exception as e:
-        db.session.rollback()
+        rollback_operation()
         return operation_result(500, "error", message=f"Error processing sale: {str(e)}")
 
 
+@retry_on_conflict
 def delete_sales(invoice, invoice_ns):
     # Check if it's a sales invoice
     if invoice.type != 'صرف':
-        db.session.rollback()
+        rollback_operation()
         return operation_result(400, "error", "Can only delete sales invoices with this method")
 
     try:
+        lock_operation_stock(invoice=invoice)
+
         # FIRST: Check and restore booking deductions
         booking_deductions = BookingDeductions.query.filter_by(
             deducted_invoice_id=invoice.id
@@ -361,48 +334,7 @@ def delete_sales(invoice, invoice_ns):
             db.session.delete(deduction)
 
         # SECOND: Restore price details from main warehouse
-        price_details = InvoicePriceDetail.query.filter_by(invoice_id=invoice.id).all()
-
-        # Dictionary to track price restorations by source (including location)
-        price_restorations = {}
-
-        # Process each price detail to prepare for restoring
-        for detail in price_details:
-            key = (detail.source_price_invoice_id, detail.source_price_item_id, detail.source_price_location)  # Include location
-            if key in price_restorations:
-                price_restorations[key]['quantity'] += detail.quantity
-            else:
-                price_restorations[key] = {
-                    'invoice_id': detail.source_price_invoice_id,
-                    'item_id': detail.source_price_item_id,
-                    'location': detail.source_price_location,  # Include location
-                    'quantity': detail.quantity,
-                    'unit_price': detail.unit_price
-                }
-        
-        # Restore prices - either update existing or create new price entries
-        for key, restoration in price_restorations.items():
-            # Check if the price entry still exists (including location)
-            price_entry = Prices.query.filter_by(
-                invoice_id=restoration['invoice_id'],
-                item_id=restoration['item_id'],
-                location=restoration['location']  # Include location filter
-            ).first()
-            
-            if price_entry:
-                # Update existing price entry
-                price_entry.quantity += restoration['quantity']
-            else:
-                # Create a new price entry
-                new_price = Prices(
-                    invoice_id=restoration['invoice_id'],
-                    item_id=restoration['item_id'],
-                    location=restoration['location'],  # Include location
-                    quantity=restoration['quantity'],
-                    unit_price=restoration['unit_price'],
-                    supplier_id=0  # Use default supplier for sales operations
-                )
-                db.session.add(new_price)
+        restore(InvoicePriceDetail.query.filter_by(invoice_id=invoice.id).all())
         
         # Restore quantities for each item
         for invoice_item in invoice.items:
@@ -427,16 +359,21 @@ def delete_sales(invoice, invoice_ns):
         # Delete the invoice and all related records (cascade will handle invoice items and price details)
         db.session.delete(invoice)
         
-        db.session.commit()
+        commit_operation()
         return {"message": "Invoice deleted and inventory restored successfully"}, 200
 
     except Exception as e:
-        db.session.rollback()
+        rollback_operation()
+        if is_retryable(e):
+            raise
         return operation_result(500, "error", f"Error deleting invoice: {str(e)}")
 
 
+@retry_on_conflict
 def put_sales(data, invoice, machine, mechanism, invoice_ns):
     try:
+        lock_operation_stock(data, invoice)
+
         with db.session.begin_nested():  # Use a savepoint for the complex operation
             # First, restore everything as if we're deleting the invoice
             # But keep the invoice itself
@@ -451,41 +388,8 @@ def put_sales(data, invoice, machine, mechanism, invoice_ns):
                 if location:
                     location.quantity += item.quantity
             
-            # 2. Restore prices based on price details (UPDATED with location)
-            price_details = InvoicePriceDetail.query.filter_by(invoice_id=invoice.id).all()
-            price_restorations = {}
-            
-            for detail in price_details:
-                key = (detail.source_price_invoice_id, detail.source_price_item_id, detail.source_price_location)  # Include location
-                if key in price_restorations:
-                    price_restorations[key]['quantity'] += detail.quantity
-                else:
-                    price_restorations[key] = {
-                        'invoice_id': detail.source_price_invoice_id,
-                        'item_id': detail.source_price_item_id,
-                        'location': detail.source_price_location,  # Include location
-                        'quantity': detail.quantity,
-                        'unit_price': detail.unit_price
-                    }
-            
-            for key, restoration in price_restorations.items():
-                price_entry = Prices.query.filter_by(
-                    invoice_id=restoration['invoice_id'],
-                    item_id=restoration['item_id'],
-                    location=restoration['location']  # Include location filter
-                ).first()
-                
-                if price_entry:
-                    price_entry.quantity += restoration['quantity']
-                else:
-                    new_price = Prices(
-                        invoice_id=restoration['invoice_id'],
-                        item_id=restoration['item_id'],
-                        location=restoration['location'],  # Include location
-                        quantity=restoration['quantity'],
-                        unit_price=restoration['unit_price']
-                    )
-                    db.session.add(new_price)
+            # 2. Restore prices based on price details
+            restore(InvoicePriceDetail.query.filter_by(invoice_id=invoice.id).all())
             
             # 3. Delete existing invoice items and price details
             InvoiceItem.query.filter_by(invoice_id=invoice.id).delete()
@@ -497,24 +401,21 @@ def put_sales(data, invoice, machine, mechanism, invoice_ns):
             
             for item_data in data["items"]:
                 # Verify the warehouse item exists
-                warehouse_item = Warehouse.query.filter_by(item_name=item_data["item_name"]).first()
+                warehouse_item = find_item(item_data["item_name"])
                 if not warehouse_item:
-                    db.session.rollback()
+                    rollback_operation()
                     return operation_result(404, "error", f"Item '{item_data['item_name']}' not found in warehouse")
                 
                 # Verify the location exists and has enough quantity
-                item_location = ItemLocations.query.filter_by(
-                    item_id=warehouse_item.id,
-                    location=item_data['location']
-                ).first()
+                item_location = find_item_location(warehouse_item.id, item_data['location'])
                 
                 if not item_location:
-                    db.session.rollback()
+                    rollback_operation()
                     return operation_result(404, "error", f"Item '{item_data['item_name']}' not found in location '{item_data['location']}'")
                 
                 # Check for duplicate items
                 if (warehouse_item.id, item_data['location']) in item_ids:
-                    db.session.rollback()
+                    rollback_operation()
                     return operation_result(400, "error", f"Item '{item_data['item_name']}' already added to invoice")
                 
                 item_ids.append((warehouse_item.id, item_data['location']))
@@ -522,74 +423,31 @@ def put_sales(data, invoice, machine, mechanism, invoice_ns):
                 # Check if enough quantity available in location
                 requested_quantity = item_data["quantity"]
                 if item_location.quantity < requested_quantity:
-                    db.session.rollback()
+                    rollback_operation()
                     return operation_result(400, "error", f"Not enough quantity for item '{item_data['item_name']}' in location '{item_data['location']}'. Available: {item_location.quantity}, Requested: {requested_quantity}")
                     
                 
                 # Update physical inventory in ItemLocations
                 item_location.quantity -= requested_quantity
                 
-                # UPDATED: Handle pricing using FIFO from the Prices table (location-specific)
-                remaining_to_sell = requested_quantity
-                total_item_price = 0
-                
-                # Get all price records for this specific item and location ordered by creation date (oldest first for FIFO)
-                price_entries = Prices.query.filter_by(
-                    item_id=warehouse_item.id,
-                    location=item_data['location']  # FIXED: Filter by specific location
-                ).order_by(Prices.invoice_id.asc()).all()
+                # Handle pricing using FIFO from the open price layers of this location
+                fifo_result = consume(
+                    warehouse_item.id,
+                    requested_quantity,
+                    location=item_data['location'],
+                    invoice_id=invoice.id
+                )
                 
-                if not price_entries:
-                    db.session.rollback()
+                if not fifo_result['breakdown']:
+                    rollback_operation()
                     return operation_result(400, "error", f"No price information found for item '{item_data['item_name']}' in location '{item_data['location']}'")
                 
-                entries_to_delete = []
-                
-                # Process each price entry using FIFO
-                for price_entry in price_entries:
-                    if remaining_to_sell <= 0:
-                        break
-                    
-                    # Calculate how much we can take from this price entry
-                    quantity_from_this_entry = min(remaining_to_sell, price_entry.quantity)
-                    
-                    # Calculate price for this portion
-                    subtotal = quantity_from_this_entry * price_entry.unit_price
-                    
-                    # Create a price detail record (UPDATED with location)
-                    price_detail = InvoicePriceDetail(
-                        invoice_id=invoice.id,
-                        item_id=warehouse_item.id,
-                        source_price_invoice_id=price_entry.invoice_id,
-                        source_price_item_id=price_entry.item_id,
-                        source_price_location=price_entry.location,  # Include location
-                        source_price_supplier_id=price_entry.supplier_id,  # Include supplier
-                        quantity=quantity_from_this_entry,
-                        unit_price=price_entry.unit_price,
-                        subtotal=subtotal
-                    )
-                    
-                    db.session.add(price_detail)
-                    
-                    # Update our running totals
-                    total_item_price += subtotal
-                    remaining_to_sell -= quantity_from_this_entry
-                    
-                    # Update the price entry quantity
-                    price_entry.quantity -= quantity_from_this_entry
-                    
-                    # If the price entry is now empty, mark it for deletion
-                    if price_entry.quantity <= 0:
-                        entries_to_delete.append(price_entry)
-                
                 # Check if we've fulfilled the entire requested quantity
-                if remaining_to_sell > 0:
-                    db.session.rollback()
-                    return operation_result(400, "error", f"Insufficient priced inventory for '{item_data['item_name']}' in location '{item_data['location']}'. Missing price data for {remaining_to_sell} units.")
+                if fifo_result['remaining'] > 0:
+                    rollback_operation()
+                    return operation_result(400, "error", f"Insufficient priced inventory for '{item_data['item_name']}' in location '{item_data['location']}'. Missing price data for {fifo_result['remaining']} units.")
                 
-                # Delete the empty price entries (optional)
-                # for entry in entries_to_delete:
-                #     db.session.delete(entry)
+                total_item_price = fifo_result['total']
                 
                 # Calculate the average unit price
                 average_unit_price = total_item_price / requested_quantity
@@ -624,13 +482,15 @@ def put_sales(data, invoice, machine, mechanism, invoice_ns):
             if mechanism:
                 invoice.mechanism_id = mechanism.id
             
-            db.session.commit()
+            commit_operation()
         
         return {"message": "Invoice updated successfully"}, 200
 
     except SQLAlchemyError as e:
-        db.session.rollback()
+        rollback_operation()
+        if is_retryable(e):
+            raise
         return operation_result(500, "error", f"Database error: {str(e)}")
     except Exception as e:
-        db.session.rollback()
+        rollback_operation()
         return operation_result(500, "error", f"Error updating invoice: {str(e)}")
\ No newline at end of file
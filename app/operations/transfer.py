@@ -1,10 +1,15 @@
 from datetime import datetime
-from ..models import Invoice, Warehouse, ItemLocations, InvoiceItem, Prices, InvoicePriceDetail
+from ..models import Invoice, ItemLocations, InvoiceItem, Prices, InvoicePriceDetail
 from .. import db
 from sqlalchemy.exc import SQLAlchemyError
 from ..utils import operation_result
+from ..transactions import commit_operation, rollback_operation
+from ..lookups import find_item, find_item_location
+from ..locking import retry_on_conflict, lock_operation_stock, is_retryable
+from ..fifo import open_layers, has_open_layers
 
 
+@retry_on_conflict
 def Transfer_Operations(data, machine, mechanism, supplier, employee, machine_ns, warehouse_ns, invoice_ns, mechanism_ns, item_location_n, supplier_ns):
     """
     Create a transfer invoice (تحويل type).
@@ -13,6 +18,8 @@ def Transfer_Operations(data, machine, mechanism, supplier, employee, machine_ns
     FIXED: Properly handles foreign key constraints with InvoicePriceDetail records and supplier names.
     """
     try:
+        lock_operation_stock(data)
+
         # Create new invoice
         new_invoice = Invoice(
             type=data["type"],
@@ -39,24 +46,21 @@ def Transfer_Operations(data, machine, mechanism, supplier, employee, machine_ns
         
         for item_data in data["items"]:
             # Look up the warehouse item by name
-            warehouse_item = Warehouse.query.filter_by(item_name=item_data["item_name"]).first()
+            warehouse_item = find_item(item_data["item_name"])
             if not warehouse_item:
-                db.session.rollback()
+                rollback_operation()
                 return operation_result(404, "error", f"Item '{item_data['item_name']}' not found in warehouse")
             
             # Verify the source location exists and has enough quantity
-            source_location = ItemLocations.query.filter_by(
-                item_id=warehouse_item.id,
-                location=item_data['location']
-            ).first()
+            source_location = find_item_location(warehouse_item.id, item_data['location'])
             
             if not source_location:
-                db.session.rollback()
+                rollback_operation()
                 return operation_result(404, "error", f"Item '{item_data['item_name']}' not found in source location '{item_data['location']}'")
             
             # Check for duplicate items (same item, same source location)
             if (warehouse_item.id, item_data['location']) in item_ids:
-                db.session.rollback()
+                rollback_operation()
                 return operation_result(400, "error", f"Item '{item_data['item_name']}' from location '{item_data['location']}' already added to invoice")
             
             item_ids.append((warehouse_item.id, item_data['location']))
@@ -64,28 +68,25 @@ def Transfer_Operations(data, machine, mechanism, supplier, employee, machine_ns
             # Check if enough quantity available in source location
             requested_quantity = item_data["quantity"]
             if source_location.quantity < requested_quantity:
-                db.session.rollback()
+                rollback_operation()
                 return operation_result(400, "error", f"Not enough quantity for item '{item_data['item_name']}' in location '{item_data['location']}'. Available: {source_location.quantity}, Requested: {requested_quantity}")
             
             # Validate new_location is provided
             new_location = item_data.get("new_location")
             if not new_location:
-                db.session.rollback()
+                rollback_operation()
                 return operation_result(400, "error", f"New location must be specified for item '{item_data['item_name']}'")
             
             # Check if source and destination locations are the same
             if item_data['location'] == new_location:
-                db.session.rollback()
+                rollback_operation()
                 return operation_result(400, "error", f"Source and destination locations cannot be the same for item '{item_data['item_name']}'")
             
             # Update source location inventory (reduce quantity)
             source_location.quantity -= requested_quantity
             
             # Find or create destination location
-            destination_location = ItemLocations.query.filter_by(
-                item_id=warehouse_item.id,
-                location=new_location
-            ).first()
+            destination_location = find_item_location(warehouse_item.id, new_location)
             
             if not destination_location:
                 # Create new location if it doesn't exist
@@ -103,21 +104,16 @@ def Transfer_Operations(data, machine, mechanism, supplier, employee, machine_ns
             # Handle price record splitting and invoice item updates using FIFO
             remaining_to_transfer = requested_quantity
             
-            # Get all price records for this item in the source location (FIFO order)
-            source_price_records = Prices.query.filter_by(
-                item_id=warehouse_item.id,
-                location=item_data['location']
-            ).order_by(Prices.invoice_id.asc()).all()
-            
-            if not source_price_records:
-                db.session.rollback()
+            # Only open price layers of the source location are walked (FIFO order)
+            if not has_open_layers(warehouse_item.id, item_data['location']):
+                rollback_operation()
                 return operation_result(400, "error", f"No price records found for item '{item_data['item_name']}' in source location '{item_data['location']}'")
             
             # Track which purchase invoices are affected for invoice item updates
             affected_purchase_invoices = {}
             
             # Process each price record using FIFO and split them
-            for source_price in source_price_records:
+            for source_price in open_layers(warehouse_item.id, item_data['location']):
                 if remaining_to_transfer <= 0:
                     break
                 
@@ -193,7 +189,7 @@ def Transfer_Operations(data, machine, mechanism, supplier, employee, machine_ns
             
             # Check if we transferred all requested quantity
             if remaining_to_transfer > 0:
-                db.session.rollback()
+                rollback_operation()
                 return operation_result(400, "error", f"Insufficient price records for transferring {requested_quantity} units of '{item_data['item_name']}' from '{item_data['location']}'. Missing price data for {remaining_to_transfer} units.")
             
             # Update the original purchase invoice items
@@ -299,16 +295,19 @@ def Transfer_Operations(data, machine, mechanism, supplier, employee, machine_ns
         new_invoice.total_amount = total_invoice_amount
         new_invoice.residual = total_invoice_amount - new_invoice.paid
         
-        db.session.commit()
+        commit_operation()
         return operation_result(201, "success", invoice=new_invoice)
         
     except SQLAlchemyError as e:
-        db.session.rollback()
+        rollback_operation()
+        if is_retryable(e):
+            raise
         return operation_result(500, "error", message=f"Database error: {str(e)}")
     except Exception as e:
-        db.session.rollback()
+        rollback_operation()
         return operation_result(500, "error", message=f"Error processing transfer: {str(e)}")
 
+@retry_on_conflict
 def delete_transfer(invoice, invoice_ns):
     """
     Delete a transfer invoice and reverse all location changes.
@@ -316,10 +315,12 @@ def delete_transfer(invoice, invoice_ns):
     """
     # Check if it's a transfer invoice
     if invoice.type != 'تحويل':
-        db.session.rollback()
+        rollback_operation()
         return operation_result(400, "error", "Can only delete transfer invoices with this method")
 
     try:
+        lock_operation_stock(invoice=invoice)
+
         # Track affected purchase invoices for invoice item restoration
         affected_purchase_invoices = {}
         
@@ -329,7 +330,7 @@ def delete_transfer(invoice, invoice_ns):
             source_location_name = invoice_item.location
             
             if not new_location:
-                db.session.rollback()
+                rollback_operation()
                 return operation_result(400, "error", f"Could not determine destination location for item transfer")
             
             # Find source location
@@ -345,12 +346,12 @@ def delete_transfer(invoice, invoice_ns):
             ).first()
             
             if not destination_location:
-                db.session.rollback()
+                rollback_operation()
                 return operation_result(404, "error", f"Destination location '{new_location}' not found for reversal")
             
             # Check if destination has enough quantity to reverse
             if destination_location.quantity < invoice_item.quantity:
-                db.session.rollback()
+                rollback_operation()
                 return operation_result(400, "error", f"Not enough quantity in destination location '{new_location}' to reverse transfer. Available: {destination_location.quantity}, Required: {invoice_item.quantity}")
             
             # Reverse the physical inventory transfer
@@ -368,17 +369,12 @@ def delete_transfer(invoice, invoice_ns):
             source_location.quantity += invoice_item.quantity
             
             # Reverse the price record splits and track affected purchase invoices with detailed supplier mapping
-            dest_price_records = Prices.query.filter_by(
-                item_id=invoice_item.item_id,
-                location=new_location
-            ).order_by(Prices.invoice_id.asc()).all()
-            
             remaining_to_reverse = invoice_item.quantity
             
             # ENHANCED: Track exactly which suppliers and quantities are being reversed
             supplier_reversal_map = {}  # Maps purchase_invoice_id to supplier details
             
-            for dest_price in dest_price_records:
+            for dest_price in open_layers(invoice_item.item_id, new_location):
                 if remaining_to_reverse <= 0:
                     break
                 
@@ -540,19 +536,24 @@ def delete_transfer(invoice, invoice_ns):
         InvoiceItem.query.filter_by(invoice_id=invoice.id).delete()
         db.session.delete(invoice)
         
-        db.session.commit()
+        commit_operation()
         return {"message": "Transfer invoice deleted and all records restored successfully"}, 200
 
     except Exception as e:
-        db.session.rollback()
+        rollback_operation()
+        if is_retryable(e):
+            raise
         return operation_result(500, "error", message=f"Error deleting transfer invoice: {str(e)}")
 
+@retry_on_conflict
 def put_transfer(data, invoice, machine, mechanism, invoice_ns):
     """
     Update a transfer invoice by reversing previous transfers and applying new ones.
     FIXED: Properly handles supplier names during updates.
     """
     try:
+        lock_operation_stock(data, invoice)
+
         with db.session.begin_nested():
             # First, reverse all existing transfers
             for item in invoice.items:
@@ -597,24 +598,21 @@ def put_transfer(data, invoice, machine, mechanism, invoice_ns):
             
             for item_data in data["items"]:
                 # Look up the warehouse item by name
-                warehouse_item = Warehouse.query.filter_by(item_name=item_data["item_name"]).first()
+                warehouse_item = find_item(item_data["item_name"])
                 if not warehouse_item:
-                    db.session.rollback()
+                    rollback_operation()
                     return operation_result(404, "error", f"Item '{item_data['item_name']}' not found in warehouse")
                 
                 # Verify the source location exists and has enough quantity
-                source_location = ItemLocations.query.filter_by(
-                    item_id=warehouse_item.id,
-                    location=item_data['location']
-                ).first()
+                source_location = find_item_location(warehouse_item.id, item_data['location'])
                 
                 if not source_location:
-                    db.session.rollback()
+                    rollback_operation()
                     return operation_result(404, "error", f"Item '{item_data['item_name']}' not found in source location '{item_data['location']}'")
                 
                 # Check for duplicate items
                 if (warehouse_item.id, item_data['location']) in item_ids:
-                    db.session.rollback()
+                    rollback_operation()
                     return operation_result(400, "error", f"Item '{item_data['item_name']}' from location '{item_data['location']}' already added to invoice")
                 
                 item_ids.append((warehouse_item.id, item_data['location']))
@@ -622,28 +620,25 @@ def put_transfer(data, invoice, machine, mechanism, invoice_ns):
                 # Check if enough quantity available in source location
                 requested_quantity = item_data["quantity"]
                 if source_location.quantity < requested_quantity:
-                    db.session.rollback()
+                    rollback_operation()
                     return operation_result(400, "error", f"Not enough quantity for item '{item_data['item_name']}' in location '{item_data['location']}'. Available: {source_location.quantity}, Requested: {requested_quantity}")
                 
                 # Validate new_location is provided
                 new_location = item_data.get("new_location")
                 if not new_location:
-                    db.session.rollback()
+                    rollback_operation()
                     return operation_result(400, "error", f"New location must be specified for item '{item_data['item_name']}'")
                 
                 # Check if source and destination locations are the same
                 if item_data['location'] == new_location:
-                    db.session.rollback()
+                    rollback_operation()
                     return operation_result(400, "error", f"Source and destination locations cannot be the same for item '{item_data['item_name']}'")
                 
                 # Update source location inventory (reduce quantity)
                 source_location.quantity -= requested_quantity
                 
                 # Find or create destination location
-                destination_location = ItemLocations.query.filter_by(
-                    item_id=warehouse_item.id,
-                    location=new_location
-                ).first()
+                destination_location = find_item_location(warehouse_item.id, new_location)
                 
                 if not destination_location:
                     # Create new location if it doesn't exist
@@ -697,13 +692,15 @@ def put_transfer(data, invoice, machine, mechanism, invoice_ns):
             if "supplier_id" in data and data["supplier_id"] is not None:
                 invoice.supplier_id = data["supplier_id"]
             
-            db.session.commit()
+            commit_operation()
         
         return {"message": "Transfer invoice updated successfully"}, 200
 
     except SQLAlchemyError as e:
-        db.session.rollback()
+        rollback_operation()
+        if is_retryable(e):
+            raise
         return operation_result(500, "error", f"Database error: {str(e)}")
     except Exception as e:
-        db.session.rollback()
+        rollback_operation()
         return operation_result(500, "error", f"Unexpected error: {str(e)}")
\ No newline at end of file
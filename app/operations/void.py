@@ -1,9 +1,13 @@
-from datetime import datetime
-from ..models import Invoice, Warehouse, ItemLocations, InvoiceItem, Prices, InvoicePriceDetail
+from ..models import Invoice, ItemLocations, InvoiceItem, InvoicePriceDetail
 from .. import db
 from sqlalchemy.exc import SQLAlchemyError
 from ..utils import operation_result
+from ..transactions import commit_operation, rollback_operation
+from ..lookups import find_item, find_item_location
+from ..locking import retry_on_conflict, lock_operation_stock, is_retryable
+from ..fifo import consume, restore
 
+@retry_on_conflict
 def Void_Operations(data, machine, mechanism, supplier, employee, machine_ns, warehouse_ns, invoice_ns, mechanism_ns, item_location_n, supplier_ns):
     """
     Create a void invoice (توالف type).
@@ -12,6 +16,8 @@ def Void_Operations(data, machine, mechanism, supplier, employee, machine_ns, wa
     FIXED: Now supports location-based pricing.
     """
     try:
+        lock_operation_stock(data)
+
         # Create new invoice
         new_invoice = Invoice(
             type=data["type"],
@@ -38,24 +44,21 @@ def Void_Operations(data, machine, mechanism, supplier, employee, machine_ns, wa
         
         for item_data in data["items"]:
             # Look up the warehouse item by name
-            warehouse_item = Warehouse.query.filter_by(item_name=item_data["item_name"]).first()
+            warehouse_item = find_item(item_data["item_name"])
             if not warehouse_item:
-                db.session.rollback()
+                rollback_operation()
                 return operation_result(404, "error", f"Item '{item_data['item_name']}' not found in warehouse")
             
             # Verify the location exists and has enough quantity
-            item_location = ItemLocations.query.filter_by(
-                item_id=warehouse_item.id,
-                location=item_data['location']
-            ).first()
+            item_location = find_item_location(warehouse_item.id, item_data['location'])
             
             if not item_location:
-                db.session.rollback()
+                rollback_operation()
                 return operation_result(404, "error", f"Item '{item_data['item_name']}' not found in location '{item_data['location']}'")
             
             # Check for duplicate items
             if (warehouse_item.id, item_data['location']) in item_ids:
-                db.session.rollback()
+                rollback_operation()
                 return operation_result(400, "error", f"Item '{item_data['item_name']}' already added to invoice")
             
             item_ids.append((warehouse_item.id, item_data['location']))
@@ -63,7 +66,7 @@ def Void_Operations(data, machine, mechanism, supplier, employee, machine_ns, wa
             # Check if enough quantity available in location
             requested_quantity = item_data["quantity"]
             if item_location.quantity < requested_quantity:
-                db.session.rollback()
+                rollback_operation()
                 return operation_result(400, "error", f"Not enough quantity for item '{item_data['item_name']}' in location '{item_data['location']}'. Available: {item_location.quantity}, Requested: {requested_quantity}")
             # Update physical inventory in ItemLocations
             item_location.quantity -= requested_quantity
@@ -78,94 +81,18 @@ def Void_Operations(data, machine, mechanism, supplier, employee, machine_ns, wa
             
             # If no price is provided, calculate using FIFO
             if not unit_price or not total_price:
-                # FIXED: Handle pricing using FIFO from the Prices table (location-specific)
-                remaining_to_void = requested_quantity
-                calculated_total_price = 0
-                
-                # FIXED: Get all price records for this item and location ordered by creation date (oldest first for FIFO)
-                price_entries = Prices.query.filter_by(
-                    item_id=warehouse_item.id,
-                    location=item_data['location']  # FIXED: Filter by location
-                ).order_by(Prices.invoice_id.asc()).all()
+                # Handle pricing using FIFO from the open price layers of this location;
+                # anything left once they run out is priced at the most recent layer
+                fifo_result = consume(
+                    warehouse_item.id,
+                    requested_quantity,
+                    location=item_data['location'],
+                    invoice_id=new_invoice.id,
+                    fill_from_latest=True
+                )
                 
-                if not price_entries:
-                    # If no price records, use zero (or a default price)
-                    unit_price = 0
-                    total_price = 0
-                else:
-                    # Process each price entry using FIFO
-                    price_details = []
-                    entries_to_update = []
-                    
-                    for price_entry in price_entries:
-                        if remaining_to_void <= 0:
-                            break
-                        
-                        # Calculate how much we can take from this price entry
-                        quantity_from_this_entry = min(remaining_to_void, price_entry.quantity)
-                        
-                        # Calculate price for this portion
-                        subtotal = quantity_from_this_entry * price_entry.unit_price
-                        
-                        # FIXED: Create a price detail record with location
-                        price_detail = InvoicePriceDetail(
-                            invoice_id=new_invoice.id,
-                            item_id=warehouse_item.id,
-                            source_price_invoice_id=price_entry.invoice_id,
-                            source_price_item_id=price_entry.item_id,
-                            source_price_location=price_entry.location,  # FIXED: Include location
-                            source_price_supplier_id=price_entry.supplier_id,  # FIXED: Include supplier_id
-                            quantity=quantity_from_this_entry,
-                            unit_price=price_entry.unit_price,
-                            subtotal=subtotal
-                        )
-                        
-                        db.session.add(price_detail)
-                        price_details.append(price_detail)
-                        
-                        # Update our running totals
-                        calculated_total_price += subtotal
-                        remaining_to_void -= quantity_from_this_entry
-                        
-                        # Update the price entry quantity
-                        price_entry.quantity -= quantity_from_this_entry
-                        entries_to_update.append(price_entry)
-                        
-                        # If the price entry is now empty, delete it
-                        # if price_entry.quantity <= 0:
-                        #     db.session.delete(price_entry)
-                    
-                    # Check if we've accounted for the entire requested quantity
-                    if remaining_to_void > 0:
-                        # For void operations, we might allow this and just use zero price for the remainder
-                        # Or abort with an error depending on business rules
-                        if price_details:
-                            # Use the most recent price for the remainder
-                            latest_price = price_entries[-1].unit_price
-                            remainder_price = remaining_to_void * latest_price
-                            calculated_total_price += remainder_price
-                            
-                            # FIXED: Create a price detail for the remainder with location
-                            remainder_detail = InvoicePriceDetail(
-                                invoice_id=new_invoice.id,
-                                item_id=warehouse_item.id,
-                                source_price_invoice_id=price_entries[-1].invoice_id,
-                                source_price_item_id=price_entries[-1].item_id,
-                                source_price_location=price_entries[-1].location,  # FIXED: Include location
-                                source_price_supplier_id=price_entries[-1].supplier_id,  # FIXED: Include supplier_id
-                                quantity=remaining_to_void,
-                                unit_price=latest_price,
-                                subtotal=remainder_price
-                            )
-                            db.session.add(remainder_detail)
-                    
-                    # Calculate average unit price
-                    if requested_quantity > 0:
-                        unit_price = calculated_total_price / requested_quantity
-                    else:
-                        unit_price = 0
-                    
-                    total_price = calculated_total_price
+                total_price = fifo_result['total']
+                unit_price = total_price / requested_quantity if requested_quantity > 0 else 0
             
             # Create the invoice item
             invoice_item = InvoiceItem(
@@ -185,66 +112,30 @@ def Void_Operations(data, machine, mechanism, supplier, employee, machine_ns, wa
         new_invoice.total_amount = total_invoice_amount
         new_invoice.residual = total_invoice_amount - new_invoice.paid
         
-        db.session.commit()
+        commit_operation()
         return operation_result(201, "success", invoice=new_invoice)
         
     except SQLAlchemyError as e:
-        db.session.rollback()
+        rollback_operation()
+        if is_retryable(e):
+            raise
         return operation_result(500, "error", message=f"Database error: {str(e)}")
     except Exception as e:
-        db.session.rollback()
+        rollback_operation()
         return operation_result(500, "error", message=f"Error processing void: {str(e)}")
 
+@retry_on_conflict
 def delete_void(invoice, invoice_ns):
     # Check if it's a void invoice
     if invoice.type != 'توالف':
-        db.session.rollback()
+        rollback_operation()
         return operation_result(400, "error", "Can only delete void invoices with this method")
 
     try:
-        # FIXED: Get price details to restore prices (with location support)
-        price_details = InvoicePriceDetail.query.filter_by(invoice_id=invoice.id).all()
-        
-        # Dictionary to track price restorations by source (including location)
-        price_restorations = {}
-        
-        # FIXED: Process each price detail to prepare for restoring (with location)
-        for detail in price_details:
-            key = (detail.source_price_invoice_id, detail.source_price_item_id, detail.source_price_location)  # Include location
-            if key in price_restorations:
-                price_restorations[key]['quantity'] += detail.quantity
-            else:
-                price_restorations[key] = {
-                    'invoice_id': detail.source_price_invoice_id,
-                    'item_id': detail.source_price_item_id,
-                    'location': detail.source_price_location,  # Include location
-                    'quantity': detail.quantity,
-                    'unit_price': detail.unit_price
-                }
-        
-        # Restore prices - either update existing or create new price entries
-        for key, restoration in price_restorations.items():
-            # FIXED: Check if the price entry still exists (including location)
-            price_entry = Prices.query.filter_by(
-                invoice_id=restoration['invoice_id'],
-                item_id=restoration['item_id'],
-                location=restoration['location']  # Include location filter
-            ).first()
-            
-            if price_entry:
-                # Update existing price entry
-                price_entry.quantity += restoration['quantity']
-            else:
-                # Create a new price entry
-                new_price = Prices(
-                    invoice_id=restoration['invoice_id'],
-                    item_id=restoration['item_id'],
-                    location=restoration['location'],  # Include location
-                    quantity=restoration['quantity'],
-                    unit_price=restoration['unit_price'],
-                    created_at=datetime.now()  # Use current time for FIFO ordering
-                )
-                db.session.add(new_price)
+        lock_operation_stock(invoice=invoice)
+
+        # Restore the consumed price layers
+        restore(InvoicePriceDetail.query.filter_by(invoice_id=invoice.id).all())
         
         # Restore quantities for each item
         for invoice_item in invoice.items:
@@ -273,55 +164,26 @@ def delete_void(invoice, invoice_ns):
         InvoiceItem.query.filter_by(invoice_id=invoice.id).delete()
         db.session.delete(invoice)
         
-        db.session.commit()
+        commit_operation()
         return {"message": "Void invoice deleted and inventory restored successfully"}, 200
 
     except Exception as e:
-        db.session.rollback()
+        rollback_operation()
+        if is_retryable(e):
+            raise
         return operation_result(500, "error", message=f"Error deleting void invoice: {str(e)}")
 
+@retry_on_conflict
 def put_void(data, invoice, machine, mechanism, invoice_ns):
     try:
+        lock_operation_stock(data, invoice)
+
         with db.session.begin_nested():
             # First, restore everything as if we're deleting the invoice
             # But keep the invoice itself
             
-            # FIXED: 1. Restore prices based on price details (with location support)
-            price_details = InvoicePriceDetail.query.filter_by(invoice_id=invoice.id).all()
-            price_restorations = {}
-            
-            for detail in price_details:
-                key = (detail.source_price_invoice_id, detail.source_price_item_id, detail.source_price_location)  # Include location
-                if key in price_restorations:
-                    price_restorations[key]['quantity'] += detail.quantity
-                else:
-                    price_restorations[key] = {
-                        'invoice_id': detail.source_price_invoice_id,
-                        'item_id': detail.source_price_item_id,
-                        'location': detail.source_price_location,  # Include location
-                        'quantity': detail.quantity,
-                        'unit_price': detail.unit_price
-                    }
-            
-            for key, restoration in price_restorations.items():
-                price_entry = Prices.query.filter_by(
-                    invoice_id=restoration['invoice_id'],
-                    item_id=restoration['item_id'],
-                    location=restoration['location']  # Include location filter
-                ).first()
-                
-                if price_entry:
-                    price_entry.quantity += restoration['quantity']
-                else:
-                    new_price = Prices(
-                        invoice_id=restoration['invoice_id'],
-                        item_id=restoration['item_id'],
-                        location=restoration['location'],  # Include location
-                        quantity=restoration['quantity'],
-                        unit_price=restoration['unit_price'],
-                        created_at=datetime.now()
-                    )
-                    db.session.add(new_price)
+            # 1. Restore prices based on price details
+            restore(InvoicePriceDetail.query.filter_by(invoice_id=invoice.id).all())
             
             # 2. Restore quantities in ItemLocations
             for item in invoice.items:
@@ -343,24 +205,21 @@ def put_void(data, invoice, machine, mechanism, invoice_ns):
             
             for item_data in data["items"]:
                 # Look up the warehouse item by name
-                warehouse_item = Warehouse.query.filter_by(item_name=item_data["item_name"]).first()
+                warehouse_item = find_item(item_data["item_name"])
                 if not warehouse_item:
-                    db.session.rollback()
+                    rollback_operation()
                     return operation_result(404, "error", f"Item '{item_data['item_name']}' not found in warehouse")
                 
                 # Verify the location exists and has enough quantity
-                item_location = ItemLocations.query.filter_by(
-                    item_id=warehouse_item.id,
-                    location=item_data['location']
-                ).first()
+                item_location = find_item_location(warehouse_item.id, item_data['location'])
                 
                 if not item_location:
-                    db.session.rollback()
+                    rollback_operation()
                     return operation_result(404, "error", f"Item '{item_data['item_name']}' not found in location '{item_data['location']}'")
                 
                 # Check for duplicate items
                 if (warehouse_item.id, item_data['location']) in item_ids:
-                    db.session.rollback()
+                    rollback_operation()
                     return operation_result(400, "error", f"Item '{item_data['item_name']}' already added to invoice")
                 
                 item_ids.append((warehouse_item.id, item_data['location']))
@@ -368,7 +227,7 @@ def put_void(data, invoice, machine, mechanism, invoice_ns):
                 # Check if enough quantity available in location
                 requested_quantity = item_data["quantity"]
                 if item_location.quantity < requested_quantity:
-                    db.session.rollback()
+                    rollback_operation()
                     return operation_result(400, "error", f"Not enough quantity for item '{item_data['item_name']}' in location '{item_data['location']}'. Available: {item_location.quantity}, Requested: {requested_quantity}")
                 
                 # Update physical inventory in ItemLocations
@@ -380,94 +239,18 @@ def put_void(data, invoice, machine, mechanism, invoice_ns):
                 
                 # If no price is provided, calculate using FIFO
                 if not unit_price or not total_price:
-                    # FIXED: Handle pricing using FIFO from the Prices table (location-specific)
-                    remaining_to_void = requested_quantity
-                    calculated_total_price = 0
-                    
-                    # FIXED: Get all price records for this item and location ordered by creation date (oldest first for FIFO)
-                    price_entries = Prices.query.filter_by(
-                        item_id=warehouse_item.id,
-                        location=item_data['location']  # FIXED: Filter by location
-                    ).order_by(Prices.invoice_id.asc()).all()
+                    # Handle pricing using FIFO from the open price layers of this location;
+                    # anything left once they run out is priced at the most recent layer
+                    fifo_result = consume(
+                        warehouse_item.id,
+                        requested_quantity,
+                        location=item_data['location'],
+                        invoice_id=invoice.id,
+                        fill_from_latest=True
+                    )
                     
-                    if not price_entries:
-                        # If no price records, use zero (or a default price)
-                        unit_price = 0
-                        total_price = 0
-                    else:
-                        # Process each price entry using FIFO
-                        price_details = []
-                        entries_to_update = []
-                        
-                        for price_entry in price_entries:
-                            if remaining_to_void <= 0:
-                                break
-                            
-                            # Calculate how much we can take from this price entry
-                            quantity_from_this_entry = min(remaining_to_void, price_entry.quantity)
-                            
-                            # Calculate price for this portion
-                            subtotal = quantity_from_this_entry * price_entry.unit_price
-                            
-                            # FIXED: Create a price detail record with location
-                            price_detail = InvoicePriceDetail(
-                                invoice_id=invoice.id,
-                                item_id=warehouse_item.id,
-                                source_price_invoice_id=price_entry.invoice_id,
-                                source_price_item_id=price_entry.item_id,
-                                source_price_location=price_entry.location,  # FIXED: Include location
-                                source_price_supplier_id=price_entry.supplier_id,  # FIXED: Include supplier_id
-                                quantity=quantity_from_this_entry,
-                                unit_price=price_entry.unit_price,
-                                subtotal=subtotal
-                            )
-                            
-                            db.session.add(price_detail)
-                            price_details.append(price_detail)
-                            
-                            # Update our running totals
-                            calculated_total_price += subtotal
-                            remaining_to_void -= quantity_from_this_entry
-                            
-                            # Update the price entry quantity
-                            price_entry.quantity -= quantity_from_this_entry
-                            entries_to_update.append(price_entry)
-                            
-                            # If the price entry is now empty, delete it
-                            if price_entry.quantity <= 0:
-                                db.session.delete(price_entry)
-                        
-                        # Check if we've accounted for the entire requested quantity
-                        if remaining_to_void > 0:
-                            # For void operations, we might allow this and just use zero price for the remainder
-                            # Or abort with an error depending on business rules
-                            if price_details:
-                                # Use the most recent price for the remainder
-                                latest_price = price_entries[-1].unit_price
-                                remainder_price = remaining_to_void * latest_price
-                                calculated_total_price += remainder_price
-                                
-                                # FIXED: Create a price detail for the remainder with location
-                                remainder_detail = InvoicePriceDetail(
-                                    invoice_id=invoice.id,
-                                    item_id=warehouse_item.id,
-                                    source_price_invoice_id=price_entries[-1].invoice_id,
-                                    source_price_item_id=price_entries[-1].item_id,
-                                    source_price_location=price_entries[-1].location,  # FIXED: Include location
-                                    source_price_supplier_id=price_entries[-1].supplier_id,  # FIXED: Include supplier_id
-                                    quantity=remaining_to_void,
-                                    unit_price=latest_price,
-                                    subtotal=remainder_price
-                                )
-                                db.session.add(remainder_detail)
-                        
-                        # Calculate average unit price
-                        if requested_quantity > 0:
-                            unit_price = calculated_total_price / requested_quantity
-                        else:
-                            unit_price = 0
-                        
-                        total_price = calculated_total_price
+                    total_price = fifo_result['total']
+                    unit_price = total_price / requested_quantity if requested_quantity > 0 else 0
                 
                 # Create the invoice item
                 invoice_item = InvoiceItem(
@@ -503,13 +286,15 @@ def put_void(data, invoice, machine, mechanism, invoice_ns):
             if "supplier_id" in data and data["supplier_id"] is not None:
                 invoice.supplier_id = data["supplier_id"]
             
-            db.session.commit()
+            commit_operation()
         
         return {"message": "Void invoice updated successfully"}, 200
 
     except SQLAlchemyError as e:
-        db.session.rollback()
+        rollback_operation()
+        if is_retryable(e):
+            raise
         return operation_result(500, "error", f"Database error: {str(e)}")
     except Exception as e:
-        db.session.rollback()
+        rollback_operation()
         return operation_result(500, "error", f"Unexpected error: {str(e)}")
\ No newline at end of file
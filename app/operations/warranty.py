@@ -1,8 +1,12 @@
 from datetime import datetime
-from ..models import Invoice, Warehouse, ItemLocations, InvoiceItem, Prices, InvoicePriceDetail, RentedItems, BookingDeductions
+from ..models import Invoice, ItemLocations, InvoiceItem, InvoicePriceDetail, RentedItems, BookingDeductions
 from .. import db
 from sqlalchemy.exc import SQLAlchemyError
 from ..utils import operation_result
+from ..transactions import commit_operation, rollback_operation
+from ..lookups import find_item, find_item_location
+from ..locking import retry_on_conflict, lock_operation_stock, is_retryable
+from ..fifo import consume, restore, has_open_layers
 
 
 def deduct_from_booking_invoices(item_id, shortage_quantity, deducted_invoice_id, warehouse_item):
@@ -69,7 +73,7 @@ def deduct_from_booking_invoices(item_id, shortage_quantity, deducted_invoice_id
             ).first()
 
             if not booking_invoice_item:
-                db.session.rollback()
+                rollback_operation()
                 return {
                     "status": "error",
                     "message": f"No price found for item in booking invoice #{rented_item.rental_invoice_id}"
@@ -112,12 +116,15 @@ def deduct_from_booking_invoices(item_id, shortage_quantity, deducted_invoice_id
         }
 
     except Exception as e:
+        if is_retryable(e):
+            raise
         return {
             "status": "error",
             "message": f"Error deducting from bookings: {str(e)}"
         }
 
 
+@retry_on_conflict
 def Warranty_Operations(data, machine, mechanism, supplier, employee, machine_ns, warehouse_ns, invoice_ns, mechanism_ns, item_location_n, supplier_ns):
     """
     Create a warranty invoice (أمانات type).
@@ -126,6 +133,8 @@ def Warranty_Operations(data, machine, mechanism, supplier, employee, machine_ns
     Updated to work with new Prices table schema that includes location.
     """
     try:
+        lock_operation_stock(data)
+
         # Create new invoice
         new_invoice = Invoice(
             type=data["type"],
@@ -152,24 +161,21 @@ def Warranty_Operations(data, machine, mechanism, supplier, employee, machine_ns
         
         for item_data in data["items"]:
             # Look up the warehouse item by name
-            warehouse_item = Warehouse.query.filter_by(item_name=item_data["item_name"]).first()
+            warehouse_item = find_item(item_data["item_name"])
             if not warehouse_item:
-                db.session.rollback()
+                rollback_operation()
                 return operation_result(404, "error", f"Item '{item_data['item_name']}' not found in warehouse")
             
             # Verify the location exists and has enough quantity
-            item_location = ItemLocations.query.filter_by(
-                item_id=warehouse_item.id,
-                location=item_data['location']
-            ).first()
+            item_location = find_item_location(warehouse_item.id, item_data['location'])
             
             if not item_location:
-                db.session.rollback()
+                rollback_operation()
                 return operation_result(404, "error", f"Item '{item_data['item_name']}' not found in location '{item_data['location']}'")
             
             # Check for duplicate items
             if (warehouse_item.id, item_data['location']) in item_ids:
-                db.session.rollback()
+                rollback_operation()
                 return operation_result(400, "error", f"Item '{item_data['item_name']}' already added to invoice")
             
             item_ids.append((warehouse_item.id, item_data['location']))
@@ -193,7 +199,7 @@ def Warranty_Operations(data, machine, mechanism, supplier, employee, machine_ns
                 )
 
                 if deduction_result["status"] == "error":
-                    db.session.rollback()
+                    rollback_operation()
                     return operation_result(400, "error", deduction_result["message"])
 
                 # Successfully deducted from bookings
@@ -203,7 +209,7 @@ def Warranty_Operations(data, machine, mechanism, supplier, employee, machine_ns
                 # Check if we have enough now
                 total_available = main_available + borrowed_from_bookings
                 if total_available < requested_quantity:
-                    db.session.rollback()
+                    rollback_operation()
                     return operation_result(400, "error", f"Not enough quantity for item '{item_data['item_name']}' in location '{item_data['location']}'. Available: {main_available}, From Bookings: {borrowed_from_bookings}, Total: {total_available}, Requested: {requested_quantity}")
 
             # Update physical inventory in ItemLocations (deduct from main warehouse)
@@ -220,191 +226,37 @@ def Warranty_Operations(data, machine, mechanism, supplier, employee, machine_ns
             
             # If no price is provided, calculate using FIFO + booking prices
             if not unit_price or not total_price:
-                # Handle pricing - combination of FIFO from Prices table + booking invoice prices
-                remaining_to_process = requested_quantity
                 calculated_total_price = 0
 
-                # First, price the quantity from main warehouse using FIFO
+                # First, price the quantity from main warehouse using FIFO, falling back
+                # to other locations when this one has no open price layers
                 if actual_from_main > 0:
-                    # Get all price records for this item and location ordered by creation date (oldest first for FIFO)
-                    price_entries = Prices.query.filter_by(
-                        item_id=warehouse_item.id,
-                        location=item_data['location']  # NEW: Filter by location
-                    ).filter(Prices.quantity > 0).order_by(Prices.invoice_id.asc()).all()
-                
-                if not price_entries:
-                    # If no price records for this location, try to get from any location for this item
-                    # This is a fallback behavior - you might want to handle this differently
-                    price_entries = Prices.query.filter_by(
-                        item_id=warehouse_item.id
-                    ).filter(Prices.quantity > 0).order_by(Prices.invoice_id.asc()).all()
-                    
-                    if not price_entries:
-                        # If no price records at all, use zero (or a default price)
-                        unit_price = 0
-                        total_price = 0
-                    else:
-                        # Use prices from other locations but track in price details with actual location
-                        price_details = []
-                        entries_to_update = []
-                        
-                        for price_entry in price_entries:
-                            if remaining_to_process <= 0:
-                                break
-                            
-                            # Calculate how much we can take from this price entry
-                            quantity_from_this_entry = min(remaining_to_process, price_entry.quantity)
-                            
-                            # Calculate price for this portion
-                            subtotal = round(quantity_from_this_entry * price_entry.unit_price, 3)
-                            
-                            # Create a price detail record (NEW: with location support)
-                            price_detail = InvoicePriceDetail(
-                                invoice_id=new_invoice.id,
-                                item_id=warehouse_item.id,
-                                source_price_invoice_id=price_entry.invoice_id,
-                                source_price_item_id=price_entry.item_id,
-                                source_price_location=price_entry.location,  # NEW: Track source location
-                                source_price_supplier_id=price_entry.supplier_id,  # FIXED: Include supplier_id
-                                quantity=quantity_from_this_entry,
-                                unit_price=round(price_entry.unit_price, 3),
-                                subtotal=subtotal
-                            )
-                            
-                            db.session.add(price_detail)
-                            price_details.append(price_detail)
-                            
-                            # Update our running totals
-                            calculated_total_price += subtotal
-                            remaining_to_process -= quantity_from_this_entry
-                            
-                            # Update the price entry quantity (but DON'T delete)
-                            price_entry.quantity -= quantity_from_this_entry
-                            entries_to_update.append(price_entry)
-                            
-                            # FIXED: Don't delete empty price entries to avoid foreign key violations
-                            # Keep them with quantity = 0 for referential integrity
-                        
-                        # Check if we've accounted for the entire requested quantity
-                        if remaining_to_process > 0:
-                            # For warranty operations, we might want to use the most recent price for the remainder
-                            if price_details:
-                                # Use the most recent price for the remainder
-                                latest_price = price_entries[-1].unit_price if price_entries else 0
-                                remainder_price = round(remaining_to_process * latest_price, 3)
-                                calculated_total_price += remainder_price
-                                
-                                # Create a price detail for the remainder (NEW: with location support)
-                                remainder_detail = InvoicePriceDetail(
-                                    invoice_id=new_invoice.id,
-                                    item_id=warehouse_item.id,
-                                    source_price_invoice_id=price_entries[-1].invoice_id,
-                                    source_price_item_id=price_entries[-1].item_id,
-                                    source_price_location=price_entries[-1].location,  # NEW: Source location
-                                    source_price_supplier_id=price_entries[-1].supplier_id,  # FIXED: Include supplier_id
-                                    quantity=remaining_to_process,
-                                    unit_price=round(latest_price, 3),
-                                    subtotal=remainder_price
-                                )
-                                db.session.add(remainder_detail)
-                            else:
-                                # No price records with quantity, use default or zero
-                                pass
-                        
-                        # Add prices from booking invoices (if any)
-                        if borrowed_from_bookings > 0 and booking_deduction_info:
-                            for deduction in booking_deduction_info:
-                                calculated_total_price += deduction['subtotal']
-                                remaining_to_process -= deduction['quantity']
-
-                        # Calculate effective unit price
-                        if requested_quantity > 0:
-                            unit_price = round(calculated_total_price / requested_quantity, 3)
-                        else:
-                            unit_price = 0
-
-                        total_price = round(calculated_total_price, 3)
+                    fifo_location = item_data['location']
+                    if not has_open_layers(warehouse_item.id, fifo_location):
+                        fifo_location = None
+
+                    fifo_result = consume(
+                        warehouse_item.id,
+                        actual_from_main,
+                        location=fifo_location,
+                        invoice_id=new_invoice.id,
+                        precision=3,
+                        fill_from_latest=True
+                    )
+                    calculated_total_price += fifo_result['total']
+
+                # Add prices from booking invoices (if any)
+                if borrowed_from_bookings > 0 and booking_deduction_info:
+                    for deduction in booking_deduction_info:
+                        calculated_total_price += deduction['subtotal']
+
+                # Calculate effective unit price
+                if requested_quantity > 0:
+                    unit_price = round(calculated_total_price / requested_quantity, 3)
                 else:
-                    # Process price entries from the same location (preferred path)
-                    price_details = []
-                    entries_to_update = []
-                    
-                    for price_entry in price_entries:
-                        if remaining_to_process <= 0:
-                            break
-                        
-                        # Calculate how much we can take from this price entry
-                        quantity_from_this_entry = min(remaining_to_process, price_entry.quantity)
-                        
-                        # Calculate price for this portion
-                        subtotal = round(quantity_from_this_entry * price_entry.unit_price, 3)
-                        
-                        # Create a price detail record (NEW: with location support)
-                        price_detail = InvoicePriceDetail(
-                            invoice_id=new_invoice.id,
-                            item_id=warehouse_item.id,
-                            source_price_invoice_id=price_entry.invoice_id,
-                            source_price_item_id=price_entry.item_id,
-                            source_price_location=price_entry.location,  # NEW: Track source location
-                            source_price_supplier_id=price_entry.supplier_id,  # FIXED: Include supplier_id
-                            quantity=quantity_from_this_entry,
-                            unit_price=round(price_entry.unit_price, 3),
-                            subtotal=subtotal
-                        )
-                        
-                        db.session.add(price_detail)
-                        price_details.append(price_detail)
-                        
-                        # Update our running totals
-                        calculated_total_price += subtotal
-                        remaining_to_process -= quantity_from_this_entry
-                        
-                        # Update the price entry quantity (but DON'T delete)
-                        price_entry.quantity -= quantity_from_this_entry
-                        entries_to_update.append(price_entry)
-                        
-                        # FIXED: Don't delete empty price entries to avoid foreign key violations
-                        # Keep them with quantity = 0 for referential integrity
-                    
-                    # Check if we've accounted for the entire requested quantity
-                    if remaining_to_process > 0:
-                        # For warranty operations, we might want to use the most recent price for the remainder
-                        if price_details:
-                            # Use the most recent price for the remainder
-                            latest_price = price_entries[-1].unit_price if price_entries else 0
-                            remainder_price = round(remaining_to_process * latest_price, 3)
-                            calculated_total_price += remainder_price
-                            
-                            # Create a price detail for the remainder (NEW: with location support)
-                            remainder_detail = InvoicePriceDetail(
-                                invoice_id=new_invoice.id,
-                                item_id=warehouse_item.id,
-                                source_price_invoice_id=price_entries[-1].invoice_id,
-                                source_price_item_id=price_entries[-1].item_id,
-                                source_price_location=price_entries[-1].location,  # NEW: Source location
-                                source_price_supplier_id=price_entries[-1].supplier_id,  # FIXED: Include supplier_id
-                                quantity=remaining_to_process,
-                                unit_price=round(latest_price, 3),
-                                subtotal=remainder_price
-                            )
-                            db.session.add(remainder_detail)
-                        else:
-                            # No price records with quantity, use default or zero
-                            pass
-                    
-                    # Add prices from booking invoices (if any)
-                    if borrowed_from_bookings > 0 and booking_deduction_info:
-                        for deduction in booking_deduction_info:
-                            calculated_total_price += deduction['subtotal']
-                            remaining_to_process -= deduction['quantity']
-
-                    # Calculate effective unit price
-                    if requested_quantity > 0:
-                        unit_price = round(calculated_total_price / requested_quantity, 3)
-                    else:
-                        unit_price = 0
-
-                    total_price = round(calculated_total_price, 3)
+                    unit_price = 0
+
+                total_price = round(calculated_total_price, 3)
             
             # Create the invoice item
             invoice_item = InvoiceItem(
@@ -425,17 +277,20 @@ def Warranty_Operations(data, machine, mechanism, supplier, employee, machine_ns
         new_invoice.total_amount = total_invoice_amount
         new_invoice.residual = round(total_invoice_amount - new_invoice.paid, 3)
         
-        db.session.commit()
+        commit_operation()
         return operation_result(201, "success", "Invoice created successfully", new_invoice)
         
     except SQLAlchemyError as e:
-        db.session.rollback()
+        rollback_operation()
+        if is_retryable(e):
+            raise
         return operation_result(500, "error", f"Database error: {str(e)}")
 
     except Exception as e:
-        db.session.rollback()
+        rollback_operation()
         return operation_result(500, "error", f"Error processing warranty: {str(e)}")
 
+@retry_on_conflict
 def delete_warranty(invoice, invoice_ns):
     """Delete a warranty invoice and restore inventory (updated with location support)"""
     # Check if it's a warranty invoice
@@ -443,6 +298,8 @@ def delete_warranty(invoice, invoice_ns):
         return operation_result(400, "error", "Can only delete warranty invoices with this method")
 
     try:
+        lock_operation_stock(invoice=invoice)
+
         # FIRST: Check and restore booking deductions
         booking_deductions = BookingDeductions.query.filter_by(
             deducted_invoice_id=invoice.id
@@ -473,49 +330,8 @@ def delete_warranty(invoice, invoice_ns):
             # Delete the deduction record
             db.session.delete(deduction)
 
-        # SECOND: Get price details to restore prices - FIXED VERSION with location support
-        price_details = InvoicePriceDetail.query.filter_by(invoice_id=invoice.id).all()
-
-        # Dictionary to track price restorations by source (including location)
-        price_restorations = {}
-
-        # Process each price detail to prepare for restoring - FIXED VERSION with location
-        for detail in price_details:
-            key = (detail.source_price_invoice_id, detail.source_price_item_id, detail.source_price_location)  # NEW: Include location
-            if key in price_restorations:
-                price_restorations[key]['quantity'] += detail.quantity
-            else:
-                price_restorations[key] = {
-                    'invoice_id': detail.source_price_invoice_id,
-                    'item_id': detail.source_price_item_id,
-                    'location': detail.source_price_location,  # NEW: Include location
-                    'quantity': detail.quantity,
-                    'unit_price': detail.unit_price
-                }
-        
-        # Restore prices - either update existing or create new price entries
-        for key, restoration in price_restorations.items():
-            # Check if the price entry still exists (NEW: include location)
-            price_entry = Prices.query.filter_by(
-                invoice_id=restoration['invoice_id'],
-                item_id=restoration['item_id'],
-                location=restoration['location']  # NEW: Match location
-            ).first()
-            
-            if price_entry:
-                # Update existing price entry
-                price_entry.quantity += restoration['quantity']
-            else:
-                # Create a new price entry (NEW: include location)
-                new_price = Prices(
-                    invoice_id=restoration['invoice_id'],
-                    item_id=restoration['item_id'],
-                    location=restoration['location'],  # NEW: Include location
-                    quantity=restoration['quantity'],
-                    unit_price=restoration['unit_price'],
-                    created_at=datetime.now()  # Use current time for FIFO ordering
-                )
-                db.session.add(new_price)
+        # SECOND: Restore the consumed price layers
+        restore(InvoicePriceDetail.query.filter_by(invoice_id=invoice.id).all())
         
         # Restore quantities for each item
         for invoice_item in invoice.items:
@@ -544,56 +360,27 @@ def delete_warranty(invoice, invoice_ns):
         InvoiceItem.query.filter_by(invoice_id=invoice.id).delete()
         db.session.delete(invoice)
         
-        db.session.commit()
+        commit_operation()
         return {"message": "Warranty invoice deleted and inventory restored successfully"}, 200
 
     except Exception as e:
-        db.session.rollback()
+        rollback_operation()
+        if is_retryable(e):
+            raise
         return operation_result(500, "error", f"Error deleting warranty invoice: {str(e)}")
 
+@retry_on_conflict
 def put_warranty(data, invoice, machine, mechanism, invoice_ns):
     """Update a warranty invoice (updated with location support)"""
     try:
+        lock_operation_stock(data, invoice)
+
         with db.session.begin_nested():
             # First, restore everything as if we're deleting the invoice
             # But keep the invoice itself
             
-            # 1. Restore prices based on price details - FIXED VERSION with location
-            price_details = InvoicePriceDetail.query.filter_by(invoice_id=invoice.id).all()
-            price_restorations = {}
-            
-            for detail in price_details:
-                key = (detail.source_price_invoice_id, detail.source_price_item_id, detail.source_price_location)  # NEW: Include location
-                if key in price_restorations:
-                    price_restorations[key]['quantity'] += detail.quantity
-                else:
-                    price_restorations[key] = {
-                        'invoice_id': detail.source_price_invoice_id,
-                        'item_id': detail.source_price_item_id,
-                        'location': detail.source_price_location,  # NEW: Include location
-                        'quantity': detail.quantity,
-                        'unit_price': detail.unit_price
-                    }
-            
-            for key, restoration in price_restorations.items():
-                price_entry = Prices.query.filter_by(
-                    invoice_id=restoration['invoice_id'],
-                    item_id=restoration['item_id'],
-                    location=restoration['location']  # NEW: Match location
-                ).first()
-                
-                if price_entry:
-                    price_entry.quantity += restoration['quantity']
-                else:
-                    new_price = Prices(
-                        invoice_id=restoration['invoice_id'],
-                        item_id=restoration['item_id'],
-                        location=restoration['location'],  # NEW: Include location
-                        quantity=restoration['quantity'],
-                        unit_price=restoration['unit_price'],
-                        created_at=datetime.now()
-                    )
-                    db.session.add(new_price)
+            # 1. Restore prices based on price details
+            restore(InvoicePriceDetail.query.filter_by(invoice_id=invoice.id).all())
             
             # 2. Restore quantities in ItemLocations
             for item in invoice.items:
@@ -615,24 +402,21 @@ def put_warranty(data, invoice, machine, mechanism, invoice_ns):
             
             for item_data in data["items"]:
                 # Look up the warehouse item by name
-                warehouse_item = Warehouse.query.filter_by(item_name=item_data["item_name"]).first()
+                warehouse_item = find_item(item_data["item_name"])
                 if not warehouse_item:
-                    db.session.rollback()
+                    rollback_operation()
                     return operation_result(404, "error", f"Item '{item_data['item_name']}' not found in warehouse")
                 
                 # Verify the location exists and has enough quantity
-                item_location = ItemLocations.query.filter_by(
-                    item_id=warehouse_item.id,
-                    location=item_data['location']
-                ).first()
+                item_location = find_item_location(warehouse_item.id, item_data['location'])
                 
                 if not item_location:
-                    db.session.rollback()
+                    rollback_operation()
                     return operation_result(404, "error", f"Item '{item_data['item_name']}' not found in location '{item_data['location']}'")
                 
                 # Check for duplicate items
                 if (warehouse_item.id, item_data['location']) in item_ids:
-                    db.session.rollback()
+                    rollback_operation()
                     return operation_result(400, "error", f"Item '{item_data['item_name']}' already added to invoice")
                 
                 item_ids.append((warehouse_item.id, item_data['location']))
@@ -640,7 +424,7 @@ def put_warranty(data, invoice, machine, mechanism, invoice_ns):
                 # Check if enough quantity available in location
                 requested_quantity = item_data["quantity"]
                 if item_location.quantity < requested_quantity:
-                    db.session.rollback()
+                    rollback_operation()
                     return operation_result(400, "error", f"Not enough quantity for item '{item_data['item_name']}' in location '{item_data['location']}'. Available: {item_location.quantity}, Requested: {requested_quantity}")
                 
                 # Update physical inventory in ItemLocations
@@ -652,102 +436,21 @@ def put_warranty(data, invoice, machine, mechanism, invoice_ns):
                 
                 # If no price is provided, calculate using FIFO (similar to create operation)
                 if not unit_price or not total_price:
-                    # Handle pricing using FIFO from the Prices table (UPDATED: with location support)
-                    remaining_to_process = requested_quantity
-                    calculated_total_price = 0
-                    
-                    # Get all price records for this item and location ordered by creation date
-                    price_entries = Prices.query.filter_by(
-                        item_id=warehouse_item.id,
-                        location=item_data['location']  # NEW: Filter by location
-                    ).filter(Prices.quantity > 0).order_by(Prices.invoice_id.asc()).all()
-                    
-                    if not price_entries:
+                    fifo_location = item_data['location']
+                    if not has_open_layers(warehouse_item.id, fifo_location):
                         # Fallback: try other locations
-                        price_entries = Prices.query.filter_by(
-                            item_id=warehouse_item.id
-                        ).filter(Prices.quantity > 0).order_by(Prices.invoice_id.asc()).all()
+                        fifo_location = None
+
+                    fifo_result = consume(
+                        warehouse_item.id,
+                        requested_quantity,
+                        location=fifo_location,
+                        invoice_id=invoice.id,
+                        fill_from_latest=True
+                    )
                     
-                    if not price_entries:
-                        # If no price records, use zero (or a default price)
-                        unit_price = 0
-                        total_price = 0
-                    else:
-                        # Process each price entry using FIFO
-                        price_details = []
-                        entries_to_update = []
-                        
-                        for price_entry in price_entries:
-                            if remaining_to_process <= 0:
-                                break
-                            
-                            # Calculate how much we can take from this price entry
-                            quantity_from_this_entry = min(remaining_to_process, price_entry.quantity)
-                            
-                            # Calculate price for this portion
-                            subtotal = quantity_from_this_entry * price_entry.unit_price
-                            
-                            # Create a price detail record - FIXED VERSION with location
-                            price_detail = InvoicePriceDetail(
-                                invoice_id=invoice.id,
-                                item_id=warehouse_item.id,
-                                source_price_invoice_id=price_entry.invoice_id,
-                                source_price_item_id=price_entry.item_id,
-                                source_price_location=price_entry.location,  # NEW: Include source location
-                                source_price_supplier_id=price_entry.supplier_id,  # FIXED: Include supplier_id
-                                quantity=quantity_from_this_entry,
-                                unit_price=price_entry.unit_price,
-                                subtotal=subtotal
-                            )
-                            
-                            db.session.add(price_detail)
-                            price_details.append(price_detail)
-                            
-                            # Update our running totals
-                            calculated_total_price += subtotal
-                            remaining_to_process -= quantity_from_this_entry
-                            
-                            # Update the price entry quantity
-                            price_entry.quantity -= quantity_from_this_entry
-                            entries_to_update.append(price_entry)
-                            
-                            # If the price entry is now empty, delete it
-                            if price_entry.quantity <= 0:
-                                db.session.delete(price_entry)
-                        
-                        # Check if we've accounted for the entire requested quantity
-                        if remaining_to_process > 0:
-                            # For warranty operations, we might want to use the most recent price for the remainder
-                            if price_details:
-                                # Use the most recent price for the remainder
-                                latest_price = price_entries[-1].unit_price
-                                remainder_price = remaining_to_process * latest_price
-                                calculated_total_price += remainder_price
-                                
-                                # Create a price detail for the remainder - FIXED VERSION with location
-                                remainder_detail = InvoicePriceDetail(
-                                    invoice_id=invoice.id,
-                                    item_id=warehouse_item.id,
-                                    source_price_invoice_id=price_entries[-1].invoice_id,
-                                    source_price_item_id=price_entries[-1].item_id,
-                                    source_price_location=price_entries[-1].location,  # NEW: Include source location
-                                    source_price_supplier_id=price_entries[-1].supplier_id,  # FIXED: Include supplier_id
-                                    quantity=remaining_to_process,
-                                    unit_price=latest_price,
-                                    subtotal=remainder_price
-                                )
-                                db.session.add(remainder_detail)
-                            else:
-                                # No price records with quantity, use default or zero
-                                pass
-                        
-                        # Calculate average unit price
-                        if requested_quantity > 0:
-                            unit_price = calculated_total_price / requested_quantity
-                        else:
-                            unit_price = 0
-                        
-                        total_price = calculated_total_price
+                    total_price = fifo_result['total']
+                    unit_price = total_price / requested_quantity if requested_quantity > 0 else 0
                 
                 # Create the invoice item
                 invoice_item = InvoiceItem(
@@ -783,13 +486,15 @@ def put_warranty(data, invoice, machine, mechanism, invoice_ns):
             if "supplier_id" in data and data["supplier_id"] is not None:
                 invoice.supplier_id = data["supplier_id"]
             
-            db.session.commit()
+            commit_operation()
         
         return {"message": "Warranty invoice updated successfully"}, 200
 
     except SQLAlchemyError as e:
-        db.session.rollback()
+        rollback_operation()
+        if is_retryable(e):
+            raise
         return operation_result(500, "error", f"Database error: {str(e)}")
     except Exception as e:
-        db.session.rollback()
+        rollback_operation()
         return operation_result(500, "error", f"Unexpected error: {str(e)}")
\ No newline at end of file
@@ -0,0 +1,179 @@
+import time
+
+from flask import current_app
+from flask_jwt_extended import get_jwt, get_jwt_identity
+from sqlalchemy import event
+
+from .models import Employee
+from . import db
+from .redis_config import redis_manager
+
+# Bit position of every Employee permission flag. Append new flags at the end:
+# reordering changes the meaning of masks already cached or embedded in tokens.
+PERMISSION_FIELDS = (
+    'create_inventory_operations', 'create_additions',
+    'view_additions', 'view_withdrawals', 'view_deposits', 'view_returns',
+    'view_damages', 'view_reservations', 'view_prices', 'view_purchase_requests',
+    'view_reports', 'view_transfers',
+    'view_zero_valued', 'view_confirmed', 'view_unreviewed', 'view_unconfirmed',
+    'can_edit', 'can_delete', 'can_confirm_withdrawal', 'can_withdraw',
+    'can_update_prices', 'can_recover_deposits', 'can_confirm_purchase_requests',
+    'can_change_zero_valued', 'can_change_confirmed', 'can_change_unreviewed',
+    'can_change_unconfirmed',
+    'items_can_edit', 'items_can_delete', 'items_can_add',
+    'machines_can_edit', 'machines_can_delete', 'machines_can_add',
+    'mechanism_can_edit', 'mechanism_can_delete', 'mechanism_can_add',
+    'suppliers_can_edit', 'suppliers_can_delete', 'suppliers_can_add',
+)
+PERMISSION_BITS = {name: 1 << index for index, name in enumerate(PERMISSION_FIELDS)}
+
+# Invoice types an employee may list, by view permission
+INVOICE_TYPE_PERMISSIONS = {
+    'view_additions': 'اضافه',
+    'view_withdrawals': 'صرف',
+    'view_returns': 'مرتجع',
+    'view_damages': 'توالف',
+    'view_deposits': 'أمانات',
+    'view_reservations': 'حجز',
+    'view_purchase_requests': 'طلب شراء',
+    'view_transfers': 'تحويل',
+}
+
+PERMISSIONS_KEY_PREFIX = "warehouse_app:perms:"
+PERMISSIONS_TIMEOUT = 3600
+# Seconds a worker trusts its in-process copy; bounds staleness across workers
+PERMISSIONS_LOCAL_TTL = 30
+PERMISSIONS_CLAIM = 'perms'
+PENDING_EMPLOYEES_KEY = 'pending_permission_invalidations'
+
+_local_permissions = {}
+
+
+def _mask_from_flags(flags):
+    mask = 0
+    for name, value in flags:
+        if value:
+            mask |= PERMISSION_BITS[name]
+    return mask
+
+
+def compile_permissions(employee):
+    """Pack an employee's permission flags into an integer bitmask"""
+    return _mask_from_flags((name, getattr(employee, name, False)) for name in PERMISSION_FIELDS)
+
+
+def permission_set(mask):
+    """The permission names set in ``mask``"""
+    return frozenset(name for name, bit in PERMISSION_BITS.items() if mask & bit)
+
+
+def has_permission(mask, name):
+    return bool(mask & PERMISSION_BITS[name])
+
+
+def allowed_invoice_types(mask):
+    """Invoice types the permission mask allows listing"""
+    return tuple(
+        invoice_type for name, invoice_type in INVOICE_TYPE_PERMISSIONS.items()
+        if has_permission(mask, name)
+    )
+
+
+def _load_mask(employee_id):
+    columns = [getattr(Employee, name) for name in PERMISSION_FIELDS]
+    row = db.session.query(*columns).filter(Employee.id == employee_id).first()
+    if row is None:
+        return 0
+    return _mask_from_flags(zip(PERMISSION_FIELDS, row))
+
+
+def get_permissions(employee_id):
+    """
+    Permission bitmask of an employee: in-process copy, then Redis, then a
+    single-row query of the flag columns. Unknown employees get no permissions.
+    """
+    employee_id = int(employee_id)
+    now = time.monotonic()
+    cached = _local_permissions.get(employee_id)
+    if cached and cached[1] > now:
+        return cached[0]
+
+    mask = None
+    client = redis_manager.redis_client
+    if client:
+        try:
+            value = client.get(f"{PERMISSIONS_KEY_PREFIX}{employee_id}")
+            if value is not None:
+                mask = int(value)
+        except Exception:
+            pass
+
+    if mask is None:
+        mask = _load_mask(employee_id)
+        if client:
+            try:
+                client.set(f"{PERMISSIONS_KEY_PREFIX}{employee_id}", mask, ex=PERMISSIONS_TIMEOUT)
+            except Exception:
+                pass
+
+    _local_permissions[employee_id] = (mask, now + PERMISSIONS_LOCAL_TTL)
+    return mask
+
+
+def current_permissions():
+    """
+    Permission bitmask of the calling employee. Uses the token claim when
+    JWT_PERMISSION_CLAIMS is enabled and the token carries one.
+    """
+    if current_app.config.get("JWT_PERMISSION_CLAIMS"):
+        mask = get_jwt().get(PERMISSIONS_CLAIM)
+        if mask is not None:
+            return int(mask)
+    return get_permissions(get_jwt_identity())
+
+
+def permission_claims(employee):
+    """Extra JWT claims for Login.post (empty unless JWT_PERMISSION_CLAIMS is enabled)"""
+    if not current_app.config.get("JWT_PERMISSION_CLAIMS"):
+        return {}
+    return {PERMISSIONS_CLAIM: compile_permissions(employee)}
+
+
+def invalidate_permissions(*employee_ids):
+    for employee_id in employee_ids:
+        _local_permissions.pop(int(employee_id), None)
+    client = redis_manager.redis_client
+    if client and employee_ids:
+        try:
+            client.delete(*(f"{PERMISSIONS_KEY_PREFIX}{employee_id}" for employee_id in employee_ids))
+        except Exception:
+            pass
+
+
+# ---- Session hooks: drop cached permission sets when an employee row changes ----
+
+def _collect_employees(session, flush_context):
+    changed = {
+        obj.id for obj in list(session.dirty) + list(session.deleted)
+        if isinstance(obj, Employee) and obj.id is not None
+    }
+    if changed:
+        session.info.setdefault(PENDING_EMPLOYEES_KEY, set()).update(changed)
+
+
+def _invalidate_on_commit(session):
+    employee_ids = session.info.pop(PENDING_EMPLOYEES_KEY, None)
+    if employee_ids:
+        invalidate_permissions(*employee_ids)
+
+
+def _discard_on_rollback(session):
+    session.info.pop(PENDING_EMPLOYEES_KEY, None)
+
+
+def register_permission_invalidation(session):
+    if event.contains(session, 'after_flush', _collect_employees):
+        return
+    event.listen(session, 'after_flush', _collect_employees)
+    event.listen(session, 'after_commit', _invalidate_on_commit)
+    event.listen(session, 'after_rollback', _discard_on_rollback)
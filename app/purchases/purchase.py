@@ -1,12 +1,18 @@
 from datetime import datetime
 
-from sqlalchemy import func
-from ..models import Invoice, Warehouse, ItemLocations, InvoiceItem, Prices, InvoicePriceDetail, Supplier, RentedItems, RentalWarehouseLocations
+from sqlalchemy import Numeric, and_, case, cast, func, select, tuple_, update
+from ..models import Invoice, ItemLocations, InvoiceItem, Prices, InvoicePriceDetail, Supplier, RentedItems, RentalWarehouseLocations
 from .. import db
 from sqlalchemy.exc import SQLAlchemyError
 from ..utils import operation_result
+from ..transactions import commit_operation, rollback_operation
+from ..lookups import find_item, find_item_location, find_supplier
+from ..stock_summary import refresh_stock_summary
+from ..redis_config import tag_session
+from ..locking import retry_on_conflict, lock_operation_stock, is_retryable
 
 
+@retry_on_conflict
 def Purchase_Operations(data, machine, mechanism, supplier, employee, machine_ns, warehouse_ns, invoice_ns, mechanism_ns, item_location_n, supplier_ns):
     """
     Create a purchase invoice (اضافه type).
@@ -14,6 +20,8 @@ def Purchase_Operations(data, machine, mechanism, supplier, employee, machine_ns
     Now supports individual supplier names per item and location-based pricing.
     """
     try:
+        lock_operation_stock(data)
+
         # Ensure default supplier exists (id=0 for items without supplier)
         default_supplier = Supplier.query.filter_by(id=0).first()
         if not default_supplier:
@@ -52,9 +60,9 @@ def Purchase_Operations(data, machine, mechanism, supplier, employee, machine_ns
         
         for item_data in data["items"]:
             # Look up the warehouse item by name
-            warehouse_item = Warehouse.query.filter_by(item_name=item_data["item_name"]).first()
+            warehouse_item = find_item(item_data["item_name"])
             if not warehouse_item:
-                db.session.rollback()
+                rollback_operation()
                 return operation_result(404, "error", f"Item '{item_data['item_name']}' not found in warehouse")
             
             # Handle supplier for this specific item
@@ -62,7 +70,7 @@ def Purchase_Operations(data, machine, mechanism, supplier, employee, machine_ns
             item_supplier_id = 0  # Default supplier_id for items without supplier
             
             if item_supplier_name:
-                item_supplier = Supplier.query.filter_by(name=item_supplier_name).first()
+                item_supplier = find_supplier(item_supplier_name)
                 if not item_supplier:
                     item_supplier = Supplier(
                         name=item_supplier_name,
@@ -74,10 +82,7 @@ def Purchase_Operations(data, machine, mechanism, supplier, employee, machine_ns
                 item_supplier_id = item_supplier.id
             
             # Verify the location exists
-            item_location = ItemLocations.query.filter_by(
-                item_id=warehouse_item.id,
-                location=item_data['location']
-            ).first()
+            item_location = find_item_location(warehouse_item.id, item_data['location'])
             
             if not item_location:
                 item_location = ItemLocations(
@@ -90,7 +95,7 @@ def Purchase_Operations(data, machine, mechanism, supplier, employee, machine_ns
             # Check for duplicate items IN THE SAME LOCATION WITH SAME SUPPLIER
             location_key = (warehouse_item.id, item_data['location'], item_supplier_id)
             if location_key in item_ids:
-                db.session.rollback()
+                rollback_operation()
                 return operation_result(400, "error", f"Item '{item_data['item_name']}' with supplier '{item_supplier_name}' already added to location '{item_data['location']}' in this invoice")
             
             item_ids.append(location_key)
@@ -143,24 +148,29 @@ def Purchase_Operations(data, machine, mechanism, supplier, employee, machine_ns
         new_invoice.total_amount = total_invoice_amount
         new_invoice.residual = total_invoice_amount - new_invoice.paid
         
-        db.session.commit()
+        commit_operation()
          
         return operation_result(201, "success", "Purchase invoice created successfully", invoice=new_invoice)
         
     except SQLAlchemyError as e:
-        db.session.rollback()
+        rollback_operation()
+        if is_retryable(e):
+            raise
         return operation_result(500, "error", f"Error processing purchase: {str(e)}")
     except Exception as e:
-        db.session.rollback()
+        rollback_operation()
         return operation_result(500, "error", f"Error processing purchase: {str(e)}")
 
 
+@retry_on_conflict
 def delete_purchase(invoice, invoice_ns):
     # Check if it's a purchase invoice
     if invoice.type != 'اضافه':
         return operation_result(400, "error", "Can only delete purchase invoices with this method")
 
     try:
+        lock_operation_stock(invoice=invoice)
+
         # First check if any items have been consumed in sales
         for invoice_item in invoice.items:
             # Get the price record for this item
@@ -172,7 +182,7 @@ def delete_purchase(invoice, invoice_ns):
             if price_record:
                 # If original quantity doesn't match current quantity, some has been consumed
                 if price_record.quantity < invoice_item.quantity:
-                    db.session.rollback()
+                    rollback_operation()
                     return operation_result(400, "error",  f"Cannot delete purchase invoice: Item '{invoice_item.warehouse.item_name}' " +
                         f"has already been partially sold using FIFO pricing. " +
                         f"Original: {invoice_item.quantity}, Remaining: {price_record.quantity}"
@@ -196,7 +206,7 @@ def delete_purchase(invoice, invoice_ns):
             
             # Check for negative quantity
             if item_location.quantity < 0:
-                db.session.rollback()
+                rollback_operation()
                 return operation_result(400, "error",  f"Cannot delete purchase invoice: Not enough quantity for item " +
                     f"'{invoice_item.warehouse.item_name}' in location '{invoice_item.location}'. " +
                     f"Some items may have already been moved or sold."
@@ -204,30 +214,37 @@ def delete_purchase(invoice, invoice_ns):
 
         # Delete price records first
         Prices.query.filter_by(invoice_id=invoice.id).delete()
+        # The bulk delete bypasses the flush hook, so recompute the affected summaries
+        refresh_stock_summary(item.item_id for item in invoice.items)
         
         # Delete invoice items and the invoice
         InvoiceItem.query.filter_by(invoice_id=invoice.id).delete()
         db.session.delete(invoice)
         
-        db.session.commit()
+        commit_operation()
         return {"message": "Purchase invoice deleted and stock adjusted successfully"}, 200
 
     except SQLAlchemyError as e:
-        db.session.rollback()
+        rollback_operation()
+        if is_retryable(e):
+            raise
         return operation_result(500, "error", f"Database error: {str(e)}")
     except Exception as e:
-        db.session.rollback()
+        rollback_operation()
         return operation_result(500, "error", f"Error deleting purchase invoice: {str(e)}")
 
+@retry_on_conflict
 def put_purchase(data, invoice, machine, mechanism, invoice_ns):
     """
     FIXED: Enhanced purchase update that properly handles location-based pricing.
     Each item-location combination maintains its own price record.
     """
     try:
+        lock_operation_stock(data, invoice)
+
         with db.session.begin_nested():
-            # Track all affected sales invoices for recalculation
-            affected_sales_invoices = set()
+            # New unit prices of changed layers, carried into the consuming invoices at the end
+            repriced_layers = {}
             
             # Get original items for comparison (now includes supplier_id in key)
             original_items = {(item.item_id, item.location, item.supplier_id): item for item in invoice.items}
@@ -236,7 +253,7 @@ def put_purchase(data, invoice, machine, mechanism, invoice_ns):
 
             # Process updates and new items
             for item_data in data["items"]:
-                warehouse_item = Warehouse.query.filter_by(item_name=item_data["item_name"]).first()
+                warehouse_item = find_item(item_data["item_name"])
                 if not warehouse_item:
                     return operation_result(404, "error", f"Item '{item_data['item_name']}' not found in warehouse")
                     
@@ -247,7 +264,7 @@ def put_purchase(data, invoice, machine, mechanism, invoice_ns):
                 item_supplier_name = item_data.get("supplier_name", "").strip()
                 
                 if item_supplier_name:
-                    item_supplier = Supplier.query.filter_by(name=item_supplier_name).first()
+                    item_supplier = find_supplier(item_supplier_name)
                     if not item_supplier:
                         item_supplier = Supplier(
                             name=item_supplier_name,
@@ -285,7 +302,7 @@ def put_purchase(data, invoice, machine, mechanism, invoice_ns):
                 item_location.quantity += quantity_diff
                 
                 if item_location.quantity < 0:
-                    db.session.rollback()
+                    rollback_operation()
                     return operation_result(400, "error", f"Cannot update purchase invoice: Not enough quantity for item '{item_data['item_name']}' in location '{location}'.")
 
                 # Update or create invoice item
@@ -330,35 +347,22 @@ def put_purchase(data, invoice, machine, mechanism, invoice_ns):
                     original_price_quantity = original_items[key].quantity if key in original_items else 0
                     old_unit_price = price_record.unit_price
                     
-                    # Get all price details that reference this specific price record (item + location)
-                    price_details = InvoicePriceDetail.query.filter_by(
-                        source_price_invoice_id=invoice.id,
-                        source_price_item_id=warehouse_item.id,
-                        source_price_location=location  # Add location filter
-                    ).all()
-                    
-                    consumed_quantity = sum(detail.quantity for detail in price_details)
+                    consumed_quantity = consumed_layer_quantity(invoice.id, warehouse_item.id, location)
                     
                     if consumed_quantity > 0:
                         if new_quantity < consumed_quantity:
-                            db.session.rollback()
+                            rollback_operation()
                             return operation_result(400, "error", f"Cannot update purchase invoice: {consumed_quantity} units of '{item_data['item_name']}' in location '{location}' have already been sold. Cannot reduce quantity below {consumed_quantity}.")
                         
                         price_record.quantity = new_quantity - consumed_quantity
                     else:
                         price_record.quantity = new_quantity
                     
-                    # Update unit price and track affected sales invoices
+                    # Update unit price; the details and invoices that consumed this layer follow
                     if old_unit_price != new_unit_price:
                         price_record.unit_price = new_unit_price
-                        
-                        # Update all price details that use this specific price record
-                        for detail in price_details:
-                            detail.unit_price = new_unit_price
-                            detail.subtotal = detail.quantity * new_unit_price
-                            
-                            # Track the sales invoice for recalculation
-                            affected_sales_invoices.add(detail.invoice_id)
+                        if consumed_quantity > 0:
+                            repriced_layers[(warehouse_item.id, location)] = new_unit_price
                 else:
                     # Create new price record for this specific location
                     price_record = Prices(
@@ -378,16 +382,10 @@ def put_purchase(data, invoice, machine, mechanism, invoice_ns):
                     item_id, location, supplier_id = key
                     
                     # Check for consumption before allowing removal (location-specific)
-                    price_details = InvoicePriceDetail.query.filter_by(
-                        source_price_invoice_id=invoice.id,
-                        source_price_item_id=item_id,
-                        source_price_location=location  # Add location filter
-                    ).all()
-                    
-                    consumed_quantity = sum(detail.quantity for detail in price_details) if price_details else 0
+                    consumed_quantity = consumed_layer_quantity(invoice.id, item_id, location)
                     
                     if consumed_quantity > 0:
-                        db.session.rollback()
+                        rollback_operation()
                         return operation_result(400, "error", f"Cannot remove item: {consumed_quantity} units of '{item.warehouse.item_name}' in location '{location}' have already been sold using FIFO pricing.")
                     
                     # Restore inventory
@@ -400,7 +398,7 @@ def put_purchase(data, invoice, machine, mechanism, invoice_ns):
                         item_location.quantity -= item.quantity
                         
                         if item_location.quantity < 0:
-                            db.session.rollback()
+                            rollback_operation()
                             return operation_result(400, "error", f"Cannot remove item: Not enough quantity for '{item.warehouse.item_name}' in location '{location}'.")
                     
                     # Delete the specific price record for this location
@@ -416,10 +414,7 @@ def put_purchase(data, invoice, machine, mechanism, invoice_ns):
                     db.session.delete(item)
 
             # Recalculate all affected sales invoices
-            for sales_invoice_id in affected_sales_invoices:
-                sales_invoice = Invoice.query.get(sales_invoice_id)
-                if sales_invoice:
-                    recalculate_sales_invoice_total(sales_invoice)
+            repricing = reprice_sales_invoices(invoice.id, repriced_layers)
 
             # Update main invoice fields
             invoice.type = data["type"]
@@ -441,87 +436,154 @@ def put_purchase(data, invoice, machine, mechanism, invoice_ns):
             if mechanism:
                 invoice.mechanism_id = mechanism.id
             
-            db.session.commit()
+            commit_operation()
             
             # Return information about affected sales invoices
             message = "Purchase invoice updated successfully"
-            if affected_sales_invoices:
-                message += f". {len(affected_sales_invoices)} sales invoice(s) were automatically recalculated due to price changes."
+            if repricing['invoices']:
+                message += f". {len(repricing['invoices'])} sales invoice(s) were automatically recalculated due to price changes."
         
         return {"message": message}, 200
 
     except SQLAlchemyError as e:
-        db.session.rollback()
+        rollback_operation()
+        if is_retryable(e):
+            raise
         return operation_result(500, "error", f"Database error: {str(e)}")
     except Exception as e:
-        db.session.rollback()
+        rollback_operation()
         return operation_result(500, "error", f"Unexpected error: {str(e)}")
 
 
-def recalculate_sales_invoice_total(sales_invoice):
+def consumed_layer_quantity(purchase_invoice_id, item_id, location):
+    """Units of a purchase price layer already consumed by sales, voids and warranties"""
+    return db.session.query(func.coalesce(func.sum(InvoicePriceDetail.quantity), 0)).filter_by(
+        source_price_invoice_id=purchase_invoice_id,
+        source_price_item_id=item_id,
+        source_price_location=location
+    ).scalar()
+
+
+def _sales_line_totals(affected, subtotal):
+    """FIFO subtotal and quantity per consuming invoice line (invoice, item, source location)"""
+    return db.session.query(
+        InvoicePriceDetail.invoice_id.label('invoice_id'),
+        InvoicePriceDetail.item_id.label('item_id'),
+        InvoicePriceDetail.source_price_location.label('location'),
+        func.sum(subtotal).label('subtotal'),
+        func.sum(InvoicePriceDetail.quantity).label('quantity'),
+    ).filter(
+        InvoicePriceDetail.invoice_id.in_(affected)
+    ).group_by(
+        InvoicePriceDetail.invoice_id, InvoicePriceDetail.item_id, InvoicePriceDetail.source_price_location
+    ).subquery()
+
+
+def _rounded(value):
+    # PostgreSQL only rounds numerics to a number of decimals
+    return func.round(cast(value, Numeric), 3)
+
+
+def reprice_sales_invoices(purchase_invoice_id, new_prices, dry_run=False):
     """
-    SIMPLE AND DIRECT: No complex JOINs, just map FIFO details to locations
+    Carry new unit prices of a purchase invoice's price layers into the
+    invoices that consumed them (sales, voids, warranties).
+
+    ``new_prices`` maps (item_id, location) to the new unit price. The price
+    details, the consuming invoice lines and the invoice totals are each
+    updated with one statement; with ``dry_run`` nothing is written and only
+    the impact is returned: the number of price details and, per invoice, the
+    current and the repriced total.
     """
-    try:
-        
-        # Step 1: Get all FIFO price details for this invoice
-        price_details = InvoicePriceDetail.query.filter_by(
-            invoice_id=sales_invoice.id
-        ).all()
-        
-        if not price_details:
-            return
-        
-        # Step 2: Group FIFO details by source location
-        location_totals = {}
-        
-        for detail in price_details:
-            location = detail.source_price_location
-            
-            if location not in location_totals:
-                location_totals[location] = {
-                    'total_subtotal': 0,
-                    'total_quantity': 0
-                }
-            
-            location_totals[location]['total_subtotal'] += detail.subtotal
-            location_totals[location]['total_quantity'] += detail.quantity
-        
-        
-        # Step 3: Update each invoice item with its location's FIFO total
-        total_invoice_amount = 0
-        
-        for invoice_item in sales_invoice.items:
-            location = invoice_item.location
-            
-            if location in location_totals:
-                # Use the exact FIFO total for this location
-                fifo_data = location_totals[location]
-                fifo_subtotal = fifo_data['total_subtotal']
-                fifo_quantity = fifo_data['total_quantity']
-                
-                # Calculate unit price from FIFO
-                fifo_unit_price = round(fifo_subtotal / fifo_quantity, 3) if fifo_quantity > 0 else 0
-                
-                # Update invoice item
-                invoice_item.unit_price = fifo_unit_price
-                invoice_item.total_price = round(fifo_subtotal, 3)
-                
-                total_invoice_amount += fifo_subtotal
-                
-            else:
-                total_invoice_amount += invoice_item.total_price
-        
-        # Step 4: Update invoice totals
-        sales_invoice.total_amount = round(total_invoice_amount, 3)
-        sales_invoice.residual = round(sales_invoice.total_amount - sales_invoice.paid, 3)
-        
-        db.session.add(sales_invoice)
-        
-    except Exception as e:
-        # Log error but don't fail the operation
-        print(f"Error recalculating sales invoice total for invoice {sales_invoice.id}: {str(e)}")
-        # Continue without failing the parent operation
+    report = {'dry_run': dry_run, 'price_details': 0, 'invoices': [], 'total_difference': 0}
+    if not new_prices:
+        return report
+    # The statements below read the database, so pending ORM changes go first
+    db.session.flush()
+
+    layer = and_(
+        InvoicePriceDetail.source_price_invoice_id == purchase_invoice_id,
+        tuple_(InvoicePriceDetail.source_price_item_id, InvoicePriceDetail.source_price_location).in_(list(new_prices)),
+    )
+    new_unit_price = case(*[
+        (and_(InvoicePriceDetail.source_price_item_id == item_id,
+              InvoicePriceDetail.source_price_location == location), unit_price)
+        for (item_id, location), unit_price in new_prices.items()
+    ], else_=InvoicePriceDetail.unit_price)
+    affected = select(InvoicePriceDetail.invoice_id).where(layer).distinct()
+
+    report['price_details'] = db.session.query(func.count(InvoicePriceDetail.id)).filter(layer).scalar() or 0
+    if not report['price_details']:
+        return report
+
+    # Impact: every line of an affected invoice, at its repriced FIFO total when it has price details
+    lines = _sales_line_totals(affected, case(
+        (layer, InvoicePriceDetail.quantity * new_unit_price), else_=InvoicePriceDetail.subtotal
+    ))
+    new_line_total = func.coalesce(_rounded(lines.c.subtotal), InvoiceItem.total_price, 0)
+    impact = db.session.query(
+        Invoice.id, Invoice.type, Invoice.total_amount, _rounded(func.sum(new_line_total))
+    ).join(
+        InvoiceItem, InvoiceItem.invoice_id == Invoice.id
+    ).outerjoin(lines, and_(
+        lines.c.invoice_id == InvoiceItem.invoice_id,
+        lines.c.item_id == InvoiceItem.item_id,
+        lines.c.location == InvoiceItem.location,
+    )).filter(
+        Invoice.id.in_(affected)
+    ).group_by(Invoice.id, Invoice.type, Invoice.total_amount).order_by(Invoice.id).all()
+
+    for invoice_id, invoice_type, old_total, new_total in impact:
+        old_total, new_total = float(old_total or 0), float(new_total or 0)
+        report['invoices'].append({
+            'invoice_id': invoice_id,
+            'type': invoice_type,
+            'old_total': round(old_total, 3),
+            'new_total': round(new_total, 3),
+        })
+        report['total_difference'] += new_total - old_total
+    report['total_difference'] = round(report['total_difference'], 3)
+    if dry_run:
+        return report
+
+    db.session.execute(
+        update(InvoicePriceDetail).where(layer).values(
+            unit_price=new_unit_price,
+            subtotal=InvoicePriceDetail.quantity * new_unit_price,
+        ).execution_options(synchronize_session=False)
+    )
+
+    lines = _sales_line_totals(affected, InvoicePriceDetail.subtotal)
+    db.session.execute(
+        update(InvoiceItem).where(
+            InvoiceItem.invoice_id == lines.c.invoice_id,
+            InvoiceItem.item_id == lines.c.item_id,
+            InvoiceItem.location == lines.c.location,
+        ).values(
+            unit_price=case((lines.c.quantity > 0, _rounded(lines.c.subtotal / lines.c.quantity)), else_=0),
+            total_price=_rounded(lines.c.subtotal),
+        ).execution_options(synchronize_session=False)
+    )
+
+    totals = db.session.query(
+        InvoiceItem.invoice_id.label('invoice_id'), func.sum(InvoiceItem.total_price).label('total')
+    ).filter(InvoiceItem.invoice_id.in_(affected)).group_by(InvoiceItem.invoice_id).subquery()
+    db.session.execute(
+        update(Invoice).where(Invoice.id == totals.c.invoice_id).values(
+            total_amount=_rounded(totals.c.total),
+            residual=_rounded(totals.c.total - func.coalesce(Invoice.paid, 0)),
+        ).execution_options(synchronize_session=False)
+    )
+
+    repriced = {row['invoice_id'] for row in report['invoices']}
+    # The bulk updates tag the invoice lists; the repriced invoices' own entries as well
+    tag_session(db.session, *[f"invoice:{invoice_id}" for invoice_id in repriced])
+    # Rows of those invoices already loaded in this session still hold the old values
+    for obj in list(db.session.identity_map.values()):
+        invoice_id = obj.id if isinstance(obj, Invoice) else getattr(obj, 'invoice_id', None)
+        if isinstance(obj, (Invoice, InvoiceItem, InvoicePriceDetail)) and invoice_id in repriced:
+            db.session.expire(obj)
+    return report
 
 
 def restock_rental_warehouse(item_id, purchased_quantity):
@@ -612,6 +674,8 @@ def restock_rental_warehouse(item_id, purchased_quantity):
             main_location.quantity -= quantity_to_return
         
     except Exception as e:
+        if is_retryable(e):
+            raise
         # Log error but don't fail the purchase operation
         print(f"Error restocking rental warehouse for item {item_id}: {str(e)}")
         # Continue with purchase operation even if rental restocking fails
@@ -1,14 +1,39 @@
 import os
 import redis
+from flask import request, has_request_context
 from flask_caching import Cache
 from functools import wraps
+from collections import defaultdict
+from sqlalchemy import event
 import json
 import hashlib
+import math
+import pickle
+import zlib
+import random
+import threading
+import time
+import uuid
+from datetime import date, datetime
+from decimal import Decimal
+
+from .metrics import observe_cache
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 class RedisManager:
     def __init__(self, app=None):
         self.redis_client = None
         self.cache = None
+        self.codec = None
         if app:
             self.init_app(app)
     
@@ -31,6 +56,7 @@ class RedisManager:
             
         except Exception as e:
             # Fallback to SimpleCache if Redis is not available
+            self.redis_client = None
             redis_url = None
         
         # Flask-Caching configuration
@@ -50,6 +76,11 @@ class RedisManager:
         
         app.config.update(cache_config)
         self.cache = Cache(app)
+        self.codec = CacheCodec(
+            serializer=app.config.get('CACHE_SERIALIZER') or os.getenv('CACHE_SERIALIZER'),
+            compression=app.config.get('CACHE_COMPRESSION') or os.getenv('CACHE_COMPRESSION'),
+            min_size=int(app.config.get('CACHE_COMPRESS_MIN_SIZE') or os.getenv('CACHE_COMPRESS_MIN_SIZE', COMPRESS_MIN_SIZE)),
+        )
     
     def get_client(self):
         return self.redis_client
@@ -57,6 +88,116 @@ class RedisManager:
     def get_cache(self):
         return self.cache
 
+
+# ---- Cache codec: compact serialization and compression of cached entries ----
+#
+# Entries are stored as bytes: a header naming the format version, serializer
+# and compression, then the payload. Readers take the serializer and
+# compression from the header, so changing the configured codec never breaks
+# entries already stored; an unknown version is treated as a miss.
+
+CACHE_FORMAT_VERSION = b"wc1"
+# Payloads smaller than this (bytes) are stored uncompressed
+COMPRESS_MIN_SIZE = 1024
+
+
+def _encode_default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, (set, frozenset, tuple)):
+        return list(value)
+    # Anything else (ORM objects in particular) would come back as its str();
+    # refusing it makes cache_result skip the entry instead of storing garbage
+    raise TypeError(f"Cannot cache value of type {type(value).__name__}")
+
+
+SERIALIZERS = {
+    'json': (
+        lambda value: json.dumps(value, ensure_ascii=False, separators=(',', ':'), default=_encode_default).encode(),
+        lambda payload: json.loads(payload.decode()),
+    ),
+    'pickle': (
+        lambda value: pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL),
+        pickle.loads,
+    ),
+}
+if msgpack is not None:
+    SERIALIZERS['msgpack'] = (
+        lambda value: msgpack.packb(value, use_bin_type=True, default=_encode_default),
+        lambda payload: msgpack.unpackb(payload, raw=False, strict_map_key=False),
+    )
+
+COMPRESSORS = {
+    'none': (lambda payload: payload, lambda payload: payload),
+    'zlib': (lambda payload: zlib.compress(payload, 6), zlib.decompress),
+}
+if zstandard is not None:
+    COMPRESSORS['zstd'] = (
+        lambda payload: zstandard.ZstdCompressor(level=3).compress(payload),
+        lambda payload: zstandard.ZstdDecompressor().decompress(payload),
+    )
+
+
+def register_serializer(name, dumps, loads):
+    """Make a serializer available to CacheCodec (and readable in stored entries)"""
+    SERIALIZERS[name] = (dumps, loads)
+
+
+def register_compressor(name, compress, decompress):
+    COMPRESSORS[name] = (compress, decompress)
+
+
+class CacheCodec:
+    """
+    Encode cached values to compact bytes. Defaults to msgpack and zstd when
+    installed, JSON and zlib otherwise.
+    """
+
+    def __init__(self, serializer=None, compression=None, min_size=COMPRESS_MIN_SIZE):
+        self.serializer = serializer or ('msgpack' if 'msgpack' in SERIALIZERS else 'json')
+        self.compression = compression or ('zstd' if 'zstd' in COMPRESSORS else 'zlib')
+        if self.serializer not in SERIALIZERS:
+            raise ValueError(f"Unknown cache serializer: {self.serializer}")
+        if self.compression not in COMPRESSORS:
+            raise ValueError(f"Unknown cache compression: {self.compression}")
+        self.min_size = min_size
+
+    def encode(self, value):
+        """Returns (stored bytes, uncompressed payload size)"""
+        payload = SERIALIZERS[self.serializer][0](value)
+        compression = self.compression if len(payload) >= self.min_size else 'none'
+        header = b"|".join((CACHE_FORMAT_VERSION, self.serializer.encode(), compression.encode(), b""))
+        return header + COMPRESSORS[compression][0](payload), len(payload)
+
+    def decode(self, data):
+        """The stored value, or None when ``data`` is not in a format this version reads"""
+        if not isinstance(data, bytes):
+            return None
+        try:
+            version, serializer, compression, payload = data.split(b"|", 3)
+            if version != CACHE_FORMAT_VERSION:
+                return None
+            payload = COMPRESSORS[compression.decode()][1](payload)
+            return SERIALIZERS[serializer.decode()][1](payload)
+        except Exception as e:
+            # Truncated or foreign data, or a serializer not installed here
+            return None
+
+
+def cache_codec_info():
+    codec = redis_manager.codec
+    if codec is None:
+        return None
+    return {
+        'format': CACHE_FORMAT_VERSION.decode(),
+        'serializer': codec.serializer,
+        'compression': codec.compression,
+        'compress_min_size': codec.min_size,
+    }
+
+
 # Global instance
 redis_manager = RedisManager()
 
@@ -69,52 +210,661 @@ def cache_key_generator(*args, **kwargs):
     return hashlib.md5(key_string.encode()).hexdigest()
 
 
-def cache_result(timeout=300, key_prefix=""):
-    """Decorator to cache function results"""
+def request_cache_key(key_prefix, scope=None, view_kwargs=None):
+    """
+    Build a cache key from the current request: route, normalized query args
+    and the caller's scope. The Resource instance is deliberately left out.
+    """
+    query_args = sorted(
+        (key, value) for key, values in request.args.lists() for value in values
+    )
+    key_data = {
+        'path': request.path,
+        'view_args': view_kwargs or {},
+        'query': query_args,
+        'scope': scope,
+    }
+    key_string = json.dumps(key_data, sort_keys=True, default=str)
+    return f"{key_prefix}:{hashlib.md5(key_string.encode()).hexdigest()}"
+
+
+def identity_scope():
+    """Cache scope for endpoints whose payload depends on the calling employee"""
+    from flask_jwt_extended import get_jwt_identity
+    return str(get_jwt_identity())
+
+
+# ---- Cache statistics (shared across workers through Redis when available) ----
+
+STATS_KEY = "warehouse_app:cache_stats"
+_local_stats = defaultdict(int)
+
+
+def record_cache_stat(key_prefix, stat, amount=1):
+    observe_cache(key_prefix, stat, amount)
+    field = f"{key_prefix}:{stat}"
+    if redis_manager.redis_client:
+        try:
+            redis_manager.redis_client.hincrby(STATS_KEY, field, amount)
+            return
+        except Exception as e:
+            pass
+    _local_stats[field] += amount
+
+
+def get_cache_stats():
+    """Return hit/miss/stale/eviction counters and entry sizes grouped by key_prefix"""
+    raw = dict(_local_stats)
+    if redis_manager.redis_client:
+        try:
+            for field, value in redis_manager.redis_client.hgetall(STATS_KEY).items():
+                raw[field] = raw.get(field, 0) + int(value)
+        except Exception as e:
+            pass
+
+    stats = {}
+    for field, value in raw.items():
+        key_prefix, _, stat = field.rpartition(':')
+        stats.setdefault(key_prefix, {'hits': 0, 'misses': 0, 'stale': 0, 'evictions': 0})[stat] = value
+    for key_prefix in CACHE_NAMESPACES:
+        namespace_stats = stats.setdefault(key_prefix, {'hits': 0, 'misses': 0, 'stale': 0, 'evictions': 0})
+        namespace_stats['entries'] = count_entries(key_prefix)
+        namespace_stats.update(size_summary(key_prefix))
+    return stats
+
+
+# ---- Namespaces: generation counters and live-entry indexes per key_prefix ----
+#
+# Every cache key embeds its namespace generation, so bumping the generation
+# invalidates the whole namespace in O(1); the orphaned entries expire on their
+# own TTL. Live entries are tracked in a sorted set per namespace scored by
+# expiry time, so counts never need a key enumeration; a hash per namespace
+# keeps each entry's stored and uncompressed size.
+
+GENERATION_KEY_PREFIX = "warehouse_app:generation:"
+ENTRY_INDEX_PREFIX = "warehouse_app:entries:"
+ENTRY_SIZES_PREFIX = "warehouse_app:sizes:"
+# Keys per SCAN page / UNLINK call when a pattern has to be enumerated
+SCAN_BATCH_SIZE = 500
+
+CACHE_NAMESPACES = set()
+_local_generations = defaultdict(int)
+_local_entries = defaultdict(dict)
+_local_sizes = defaultdict(dict)
+
+
+def namespace_generation(namespace):
+    if redis_manager.redis_client:
+        try:
+            return int(redis_manager.redis_client.get(f"{GENERATION_KEY_PREFIX}{namespace}") or 0)
+        except Exception as e:
+            pass
+    return _local_generations[namespace]
+
+
+def _index_entry(namespace, cache_key, timeout, size=None):
+    """Track a live entry; ``size`` is (stored bytes, uncompressed bytes)"""
+    now = time.time()
+    if redis_manager.redis_client:
+        try:
+            index_key = f"{ENTRY_INDEX_PREFIX}{namespace}"
+            pipe = redis_manager.redis_client.pipeline()
+            pipe.zadd(index_key, {cache_key: now + timeout})
+            pipe.zremrangebyscore(index_key, '-inf', now)
+            pipe.expire(index_key, timeout)
+            if size is not None:
+                pipe.hset(f"{ENTRY_SIZES_PREFIX}{namespace}", cache_key, f"{size[0]},{size[1]}")
+                pipe.expire(f"{ENTRY_SIZES_PREFIX}{namespace}", timeout)
+            pipe.execute()
+            return
+        except Exception as e:
+            pass
+    entries = _local_entries[namespace]
+    entries[cache_key] = now + timeout
+    if size is not None:
+        _local_sizes[namespace][cache_key] = size
+    for key in [key for key, expires_at in entries.items() if expires_at <= now]:
+        del entries[key]
+        _local_sizes[namespace].pop(key, None)
+
+
+def _unindex_entries(cache_keys):
+    by_namespace = defaultdict(list)
+    for cache_key in cache_keys:
+        by_namespace[cache_key.split(':', 1)[0]].append(cache_key)
+    if redis_manager.redis_client:
+        try:
+            pipe = redis_manager.redis_client.pipeline()
+            for namespace, keys in by_namespace.items():
+                pipe.zrem(f"{ENTRY_INDEX_PREFIX}{namespace}", *keys)
+                pipe.hdel(f"{ENTRY_SIZES_PREFIX}{namespace}", *keys)
+            pipe.execute()
+        except Exception as e:
+            pass
+    for namespace, keys in by_namespace.items():
+        for cache_key in keys:
+            _local_entries[namespace].pop(cache_key, None)
+            _local_sizes[namespace].pop(cache_key, None)
+
+
+def count_entries(namespace):
+    """Number of live cache entries in a namespace, from its entry index"""
+    now = time.time()
+    if redis_manager.redis_client:
+        try:
+            return redis_manager.redis_client.zcount(f"{ENTRY_INDEX_PREFIX}{namespace}", now, '+inf')
+        except Exception as e:
+            pass
+    return sum(1 for expires_at in _local_entries[namespace].values() if expires_at > now)
+
+
+def entry_sizes(namespace):
+    """Stored and uncompressed size of every live entry of a namespace: {cache_key: (stored, raw)}"""
+    now = time.time()
+    if redis_manager.redis_client:
+        try:
+            pipe = redis_manager.redis_client.pipeline()
+            pipe.zrangebyscore(f"{ENTRY_INDEX_PREFIX}{namespace}", now, '+inf')
+            pipe.hgetall(f"{ENTRY_SIZES_PREFIX}{namespace}")
+            live, sizes = pipe.execute()
+            live = set(live)
+            stale = [key for key in sizes if key not in live]
+            if stale:
+                redis_manager.redis_client.hdel(f"{ENTRY_SIZES_PREFIX}{namespace}", *stale)
+            return {
+                key: tuple(int(part) for part in value.split(','))
+                for key, value in sizes.items() if key in live
+            }
+        except Exception as e:
+            pass
+    entries = _local_entries[namespace]
+    return {
+        key: size for key, size in _local_sizes[namespace].items()
+        if entries.get(key, 0) > now
+    }
+
+
+def size_summary(namespace):
+    sizes = entry_sizes(namespace)
+    stored = sum(size[0] for size in sizes.values())
+    raw = sum(size[1] for size in sizes.values())
+    largest = max(sizes.items(), key=lambda item: item[1][0], default=(None, (0, 0)))
+    return {
+        'stored_bytes': stored,
+        'uncompressed_bytes': raw,
+        'compression_ratio': round(raw / stored, 2) if stored else None,
+        'largest_entry_key': largest[0],
+        'largest_entry_bytes': largest[1][0],
+    }
+
+
+def invalidate_namespace(namespace):
+    """Invalidate every entry of a namespace in O(1) by bumping its generation"""
+    _local_generations[namespace] += 1
+    dropped = len(_local_entries.pop(namespace, {}))
+    _local_sizes.pop(namespace, None)
+    if redis_manager.redis_client:
+        try:
+            index_key = f"{ENTRY_INDEX_PREFIX}{namespace}"
+            pipe = redis_manager.redis_client.pipeline()
+            pipe.incr(f"{GENERATION_KEY_PREFIX}{namespace}")
+            pipe.zcount(index_key, time.time(), '+inf')
+            pipe.unlink(index_key, f"{ENTRY_SIZES_PREFIX}{namespace}")
+            dropped = pipe.execute()[1]
+        except Exception as e:
+            pass
+    if dropped:
+        record_cache_stat(namespace, 'evictions', dropped)
+    return dropped
+
+
+def unlink_matching(match):
+    """
+    Delete every Redis key matching ``match`` without blocking the server:
+    incremental SCAN pages, each unlinked in one batched call.
+    """
+    client = redis_manager.redis_client
+    if not client:
+        return 0
+    deleted = 0
+    batch = []
+    for key in client.scan_iter(match=match, count=SCAN_BATCH_SIZE):
+        batch.append(key)
+        if len(batch) >= SCAN_BATCH_SIZE:
+            deleted += client.unlink(*batch)
+            batch = []
+    if batch:
+        deleted += client.unlink(*batch)
+    return deleted
+
+
+# ---- Tag registry: tag -> cache keys stored under that tag ----
+
+TAG_KEY_PREFIX = "warehouse_app:tag:"
+_local_tags = defaultdict(set)
+
+
+def _tag_cache_key(cache_key, tags, timeout):
+    if not tags:
+        return
+    if redis_manager.redis_client:
+        try:
+            pipe = redis_manager.redis_client.pipeline()
+            for tag in tags:
+                pipe.sadd(f"{TAG_KEY_PREFIX}{tag}", cache_key)
+                pipe.expire(f"{TAG_KEY_PREFIX}{tag}", timeout)
+            pipe.execute()
+            return
+        except Exception as e:
+            pass
+    for tag in tags:
+        _local_tags[tag].add(cache_key)
+
+
+def invalidate_tags(*tags):
+    """Drop every cached response stored under any of the given tags"""
+    if not redis_manager.cache or not tags:
+        return 0
+
+    keys = set()
+    if redis_manager.redis_client:
+        try:
+            pipe = redis_manager.redis_client.pipeline()
+            for tag in tags:
+                pipe.smembers(f"{TAG_KEY_PREFIX}{tag}")
+                pipe.delete(f"{TAG_KEY_PREFIX}{tag}")
+            results = pipe.execute()
+            for members in results[::2]:
+                keys.update(members)
+        except Exception as e:
+            pass
+    for tag in tags:
+        keys.update(_local_tags.pop(tag, ()))
+
+    if not keys:
+        return 0
+    try:
+        redis_manager.cache.delete_many(*keys)
+    except Exception as e:
+        return 0
+
+    _unindex_entries(keys)
+    for cache_key in keys:
+        record_cache_stat(cache_key.split(':', 1)[0], 'evictions')
+    return len(keys)
+
+
+# ---- Tag versions: a stamp per tag, replaced on every commit touching it ----
+#
+# Stamps are random rather than counters, so a version key lost to a Redis
+# restart or eviction comes back as a stamp no client has seen yet.
+
+VERSION_KEY_PREFIX = "warehouse_app:version:"
+
+
+def _new_version():
+    return uuid.uuid4().hex[:16]
+
+
+def bump_versions(*tags):
+    client = redis_manager.redis_client
+    if not client or not tags:
+        return
+    try:
+        pipe = client.pipeline()
+        for tag in tags:
+            pipe.set(f"{VERSION_KEY_PREFIX}{tag}", _new_version())
+        pipe.execute()
+    except Exception as e:
+        pass
+
+
+def tag_versions(tags):
+    """Current version stamp of each tag in one round trip, or None when Redis is unavailable"""
+    client = redis_manager.redis_client
+    if not client:
+        return None
+    keys = [f"{VERSION_KEY_PREFIX}{tag}" for tag in tags]
+    if not keys:
+        return []
+    try:
+        versions = client.mget(keys)
+        missing = [key for key, version in zip(keys, versions) if version is None]
+        if missing:
+            pipe = client.pipeline()
+            for key in missing:
+                pipe.set(key, _new_version(), nx=True)
+            pipe.mget(missing)
+            stamped = dict(zip(missing, pipe.execute()[-1]))
+            versions = [version if version is not None else stamped[key] for key, version in zip(keys, versions)]
+        return versions
+    except Exception as e:
+        return None
+
+
+def resolve_tags(tags, view_kwargs):
+    resolved = []
+    for tag in tags:
+        try:
+            resolved.append(tag.format(**view_kwargs))
+        except (KeyError, IndexError):
+            resolved.append(tag)
+    return resolved
+
+
+# ---- Single flight and early refresh ----
+#
+# Entries are stored with the time the value took to compute and its logical
+# expiry. A hit may volunteer to refresh the value before it expires, with a
+# probability growing as expiry nears and with the compute time (XFetch), so hot
+# keys rarely expire at all. With ``single_flight`` only the request holding a
+# short lock recomputes; the others keep serving the previous value (kept
+# ``stale_ttl`` seconds past expiry) or, when there is none, wait for the result.
+
+LOCK_KEY_PREFIX = "warehouse_app:lock:"
+# Seconds a recompute may hold the lock before another request takes over
+SINGLE_FLIGHT_LOCK_TIMEOUT = 30
+# Seconds a request without a cached value waits for the lock holder
+SINGLE_FLIGHT_WAIT = 10
+SINGLE_FLIGHT_POLL_INTERVAL = 0.05
+STALE_TTL = 60
+# XFetch beta: > 1 refreshes earlier, < 1 later
+EARLY_REFRESH_BETA = 1.0
+
+RELEASE_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+_local_locks = {}
+_local_locks_guard = threading.Lock()
+
+
+def _make_entry(result, timeout, delta):
+    entry = {'expires_at': time.time() + timeout, 'delta': delta}
+    # Codecs other than pickle turn tuples into lists; keep (body, status, headers) apart
+    if isinstance(result, tuple):
+        entry['value'], entry['response'] = result[0], list(result[1:])
+    else:
+        entry['value'] = result
+    return entry
+
+
+def _entry_result(entry):
+    if 'response' in entry:
+        return (entry['value'], *entry['response'])
+    return entry['value']
+
+
+def _get_entry(cache_key):
+    try:
+        cached = redis_manager.cache.get(cache_key)
+    except Exception as e:
+        return None
+    if cached is None:
+        return None
+    # Entries in an older format read as misses and get overwritten
+    return redis_manager.codec.decode(cached)
+
+
+def should_refresh(entry, beta=EARLY_REFRESH_BETA):
+    """True once an entry expired, or (XFetch) randomly shortly before it does"""
+    jitter = entry['delta'] * beta * -math.log(1.0 - random.random())
+    return time.time() + jitter >= entry['expires_at']
+
+
+def acquire_lock(cache_key, timeout=SINGLE_FLIGHT_LOCK_TIMEOUT):
+    """Take the recompute lock of a cache key; returns a token, or None when someone else holds it"""
+    token = uuid.uuid4().hex
+    if redis_manager.redis_client:
+        try:
+            if redis_manager.redis_client.set(f"{LOCK_KEY_PREFIX}{cache_key}", token, nx=True, px=int(timeout * 1000)):
+                return token
+            return None
+        except Exception as e:
+            pass
+    now = time.monotonic()
+    with _local_locks_guard:
+        held = _local_locks.get(cache_key)
+        if held and held[1] > now:
+            return None
+        _local_locks[cache_key] = (token, now + timeout)
+    return token
+
+
+def release_lock(cache_key, token):
+    if redis_manager.redis_client:
+        try:
+            redis_manager.redis_client.eval(RELEASE_LOCK_SCRIPT, 1, f"{LOCK_KEY_PREFIX}{cache_key}", token)
+        except Exception as e:
+            pass
+    with _local_locks_guard:
+        held = _local_locks.get(cache_key)
+        if held and held[0] == token:
+            del _local_locks[cache_key]
+
+
+def _lock_held(cache_key):
+    if redis_manager.redis_client:
+        try:
+            return bool(redis_manager.redis_client.exists(f"{LOCK_KEY_PREFIX}{cache_key}"))
+        except Exception as e:
+            pass
+    held = _local_locks.get(cache_key)
+    return bool(held and held[1] > time.monotonic())
+
+
+def _wait_for_entry(cache_key, wait=SINGLE_FLIGHT_WAIT):
+    """Poll for the entry the lock holder is computing; None if it gave up or took too long"""
+    deadline = time.monotonic() + wait
+    while time.monotonic() < deadline:
+        time.sleep(SINGLE_FLIGHT_POLL_INTERVAL)
+        entry = _get_entry(cache_key)
+        if entry is not None:
+            return entry
+        if not _lock_held(cache_key):
+            return None
+    return None
+
+
+def cache_result(timeout=300, key_prefix="", tags=(), scope=None, single_flight=False, stale_ttl=STALE_TTL):
+    """
+    Decorator to cache view results.
+
+    The key is built from the request route, normalized query-string args and
+    the optional ``scope`` callable (e.g. ``identity_scope``). ``tags`` are
+    format strings filled from the view kwargs (e.g. ``"warehouse:{item_id}"``);
+    committing a change to a tagged model drops every entry stored under it.
+    ``key_prefix`` is also the namespace dropped as a whole by
+    ``invalidate_namespace``.
+
+    Hot entries are refreshed early (XFetch). ``single_flight`` is meant for
+    expensive views: one request recomputes under a lock while the others get
+    the previous value, kept ``stale_ttl`` seconds past ``timeout``, or wait.
+    """
+    CACHE_NAMESPACES.add(key_prefix)
+    ttl = timeout + stale_ttl if single_flight else timeout
+
     def decorator(func):
         @wraps(func)
         def wrapper(*args, **kwargs):
             if not redis_manager.cache:
                 return func(*args, **kwargs)
-            
+
             # Generate cache key
-            cache_key = f"{key_prefix}:{func.__name__}:{cache_key_generator(*args, **kwargs)}"
-            
+            namespace = f"{key_prefix}:g{namespace_generation(key_prefix)}"
+            if has_request_context():
+                cache_key = request_cache_key(namespace, scope() if scope else None, kwargs)
+            else:
+                cache_key = f"{namespace}:{func.__name__}:{cache_key_generator(*args[1:], **kwargs)}"
+
             # Try to get from cache
+            entry = _get_entry(cache_key)
+            if entry is not None and not should_refresh(entry):
+                record_cache_stat(key_prefix, 'hits')
+                return _entry_result(entry)
+
+            token = None
+            if single_flight:
+                token = acquire_lock(cache_key)
+                if token is None:
+                    # Someone else is recomputing: serve what we have, or wait for theirs
+                    if entry is not None:
+                        record_cache_stat(key_prefix, 'stale')
+                        return _entry_result(entry)
+                    entry = _wait_for_entry(cache_key)
+                    if entry is not None:
+                        record_cache_stat(key_prefix, 'hits')
+                        return _entry_result(entry)
+
+            record_cache_stat(key_prefix, 'misses')
             try:
-                cached_result = redis_manager.cache.get(cache_key)
-                if cached_result is not None:
-                    return cached_result
-            except Exception as e:
-                pass
-            
-            # Execute function and cache result
-            try:
+                started = time.monotonic()
                 result = func(*args, **kwargs)
-                redis_manager.cache.set(cache_key, result, timeout=timeout)
-                return result
-            except Exception as e:
-                return func(*args, **kwargs)
-        
+                delta = time.monotonic() - started
+
+                # Only successful responses are cached
+                status_code = result[1] if isinstance(result, tuple) and len(result) > 1 else 200
+                if isinstance(status_code, int) and status_code < 400:
+                    try:
+                        data, raw_size = redis_manager.codec.encode(_make_entry(result, timeout, delta))
+                        redis_manager.cache.set(cache_key, data, timeout=ttl)
+                        _tag_cache_key(cache_key, resolve_tags(tags, kwargs), ttl)
+                        _index_entry(key_prefix, cache_key, ttl, (len(data), raw_size))
+                    except Exception as e:
+                        pass
+            finally:
+                if token is not None:
+                    release_lock(cache_key, token)
+            return result
+
         return wrapper
     return decorator
 
+
+# ---- Write-driven invalidation ----
+
+# Tags dropped when a row of the given table is inserted, updated or deleted
+MODEL_CACHE_TAGS = {
+    'warehouse': lambda obj: ['warehouses', f'warehouse:{obj.id}'],
+    'item_locations': lambda obj: ['warehouses', f'warehouse:{obj.item_id}'],
+    'rental_warehouse_locations': lambda obj: ['warehouses', 'rentals', f'warehouse:{obj.item_id}'],
+    'prices': lambda obj: ['prices', f'warehouse:{obj.item_id}'],
+    'machine': lambda obj: ['machines', f'machine:{obj.id}'],
+    'mechanism': lambda obj: ['mechanisms', f'mechanism:{obj.id}'],
+    'supplier': lambda obj: ['suppliers', f'supplier:{obj.id}'],
+    'employee': lambda obj: ['employees', f'employee:{obj.id}'],
+    'invoice': lambda obj: ['invoices', f'invoice:{obj.id}'],
+    'invoice_item': lambda obj: ['invoices', f'invoice:{obj.invoice_id}'],
+    'invoice_price_detail': lambda obj: ['invoices', f'invoice:{obj.invoice_id}'],
+    'rented_items': lambda obj: ['rentals', f'invoice:{obj.rental_invoice_id}'],
+}
+
+# Table-level tags used when a bulk UPDATE/DELETE cannot tell which rows changed.
+# The '<row>:*' tags stand for "any row": per-row entries (detail views, their
+# ETags) list them next to their own row tag, so a set-based write reaches them
+# without ORM row writes invalidating every detail.
+TABLE_CACHE_TAGS = {
+    'warehouse': ['warehouses', 'warehouse:*'],
+    'item_locations': ['warehouses', 'warehouse:*'],
+    'rental_warehouse_locations': ['warehouses', 'rentals', 'warehouse:*'],
+    'prices': ['prices', 'warehouses', 'warehouse:*'],
+    'machine': ['machines', 'machine:*'],
+    'mechanism': ['mechanisms', 'mechanism:*'],
+    'supplier': ['suppliers', 'supplier:*'],
+    'employee': ['employees', 'employee:*'],
+    'invoice': ['invoices', 'invoice:*'],
+    'invoice_item': ['invoices', 'invoice:*'],
+    'invoice_price_detail': ['invoices', 'invoice:*'],
+    'rented_items': ['rentals', 'invoice:*'],
+}
+
+PENDING_TAGS_KEY = 'pending_cache_tags'
+
+
+def tags_for_instance(obj):
+    table_name = getattr(obj, '__tablename__', None)
+    tag_builder = MODEL_CACHE_TAGS.get(table_name)
+    if tag_builder:
+        return tag_builder(obj)
+    return [table_name] if table_name else []
+
+
+def tag_session(session, *tags):
+    """Queue tags for invalidation on the next commit (for bulk writes that skip ORM events)"""
+    session.info.setdefault(PENDING_TAGS_KEY, set()).update(tags)
+
+
+def _collect_flush_tags(session, flush_context):
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        tag_session(session, *tags_for_instance(obj))
+
+
+def _collect_bulk_tags(orm_execute_state):
+    if not (orm_execute_state.is_update or orm_execute_state.is_delete):
+        return
+    mapper = orm_execute_state.bind_mapper
+    if mapper is not None:
+        table_name = mapper.local_table.name
+        tag_session(orm_execute_state.session, *TABLE_CACHE_TAGS.get(table_name, [table_name]))
+
+
+def _invalidate_on_commit(session):
+    tags = session.info.pop(PENDING_TAGS_KEY, None)
+    if tags:
+        bump_versions(*tags)
+        invalidate_tags(*tags)
+
+
+def _discard_on_rollback(session):
+    session.info.pop(PENDING_TAGS_KEY, None)
+
+
+def register_cache_invalidation(session):
+    """Hook cache invalidation into the SQLAlchemy session lifecycle"""
+    if event.contains(session, 'after_commit', _invalidate_on_commit):
+        return
+    event.listen(session, 'after_flush', _collect_flush_tags)
+    event.listen(session, 'do_orm_execute', _collect_bulk_tags)
+    event.listen(session, 'after_commit', _invalidate_on_commit)
+    event.listen(session, 'after_rollback', _discard_on_rollback)
+
+
 def invalidate_cache_pattern(pattern):
-    """Invalidate cache keys matching a pattern"""
+    """
+    Invalidate cache keys starting with ``pattern``.
+
+    A pattern naming a whole namespace (a cache_result key_prefix) is dropped in
+    O(1) through its generation counter; anything else falls back to a
+    non-blocking SCAN/UNLINK.
+    """
+    if pattern in CACHE_NAMESPACES:
+        return invalidate_namespace(pattern)
     if not redis_manager.redis_client:
-        return
-    
+        return 0
+
     try:
-        keys = redis_manager.redis_client.keys(f"warehouse_app:{pattern}*")
-        if keys:
-            redis_manager.redis_client.delete(*keys)
+        return unlink_matching(f"warehouse_app:{pattern}*")
     except Exception as e:
-        pass
+        return 0
 
 def clear_all_cache():
     """Clear all application cache"""
-    if redis_manager.cache:
+    if redis_manager.redis_client:
+        # Flask-Caching's clear() enumerates keys with KEYS; scan instead
+        try:
+            unlink_matching("warehouse_app:*")
+        except Exception as e:
+            pass
+    elif redis_manager.cache:
         try:
             redis_manager.cache.clear()
         except Exception as e:
-            pass
\ No newline at end of file
+            pass
+    _local_tags.clear()
+    _local_entries.clear()
+    _local_sizes.clear()
+    for namespace in CACHE_NAMESPACES:
+        _local_generations[namespace] += 1
@@ -0,0 +1,293 @@
+import json
+import os
+import threading
+from collections import OrderedDict, defaultdict
+from types import SimpleNamespace
+
+from sqlalchemy import event
+from sqlalchemy.orm import attributes
+
+from .models import Machine, Mechanism, Supplier, Warehouse
+from .redis_config import redis_manager
+from .serializers import chunked
+
+# Reference tables served from the cache: kind -> (model, name column, cached columns)
+REFERENCE_MODELS = {
+    'machine': (Machine, 'name', ('id', 'name', 'description')),
+    'mechanism': (Mechanism, 'name', ('id', 'name', 'description')),
+    'supplier': (Supplier, 'name', ('id', 'name', 'description')),
+    'warehouse': (Warehouse, 'item_name', ('id', 'item_name', 'item_bar')),
+}
+REFERENCE_TABLES = {model.__tablename__: kind for kind, (model, _, _) in REFERENCE_MODELS.items()}
+
+REFERENCE_KEY_PREFIX = "warehouse_app:ref:"
+REFERENCE_CHANNEL = "warehouse_app:ref:invalidate"
+REFERENCE_TIMEOUT = 3600
+LOCAL_CACHE_SIZE = 4096
+PENDING_REFERENCES_KEY = 'pending_reference_invalidations'
+
+
+class LRUCache:
+    """Bounded, thread-safe least-recently-used map"""
+
+    def __init__(self, maxsize=LOCAL_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self, kind=None):
+        with self._lock:
+            if kind is None:
+                self._data.clear()
+                return
+            for key in [key for key in self._data if key[0] == kind]:
+                del self._data[key]
+
+    def __len__(self):
+        return len(self._data)
+
+
+_local = LRUCache()
+_subscriber = {'pid': None, 'thread': None}
+
+
+def _hash_key(kind):
+    return f"{REFERENCE_KEY_PREFIX}{kind}"
+
+
+def _snapshot(row):
+    return SimpleNamespace(**row) if row is not None else None
+
+
+def _remember(kind, row):
+    name_column = REFERENCE_MODELS[kind][1]
+    _local.set((kind, 'name', row[name_column]), row)
+    _local.set((kind, 'id', row['id']), row)
+
+
+def _store_remote(kind, rows):
+    client = redis_manager.redis_client
+    if not client or not rows:
+        return
+    name_column = REFERENCE_MODELS[kind][1]
+    mapping = {}
+    for row in rows:
+        payload = json.dumps(row, default=str)
+        mapping[f"name:{row[name_column]}"] = payload
+        mapping[f"id:{row['id']}"] = payload
+    try:
+        pipe = client.pipeline()
+        pipe.hset(_hash_key(kind), mapping=mapping)
+        pipe.expire(_hash_key(kind), REFERENCE_TIMEOUT)
+        pipe.execute()
+    except Exception as e:
+        pass
+
+
+def _load_remote(kind, fields):
+    client = redis_manager.redis_client
+    if not client or not fields:
+        return {}
+    try:
+        values = client.hmget(_hash_key(kind), fields)
+    except Exception as e:
+        return {}
+    return {field: json.loads(value) for field, value in zip(fields, values) if value is not None}
+
+
+def _load_rows(kind, column_name, values):
+    model, _, columns = REFERENCE_MODELS[kind]
+    column = getattr(model, column_name)
+    rows = []
+    for batch in chunked(values):
+        query = model.query.with_entities(*(getattr(model, name) for name in columns))
+        rows.extend(dict(zip(columns, values)) for values in query.filter(column.in_(batch)).all())
+    return rows
+
+
+def lookup_many(kind, names):
+    """
+    Resolve reference rows by name: per-worker LRU, then Redis, then one IN
+    query for whatever is left. Returns {name: row dict}; unknown names are
+    left out and never cached, so rows created later are found.
+    """
+    _ensure_subscriber()
+    name_column = REFERENCE_MODELS[kind][1]
+    names = {name for name in names if name is not None}
+
+    found = {}
+    for name in names:
+        row = _local.get((kind, 'name', name))
+        if row is not None:
+            found[name] = row
+
+    missing = [name for name in names if name not in found]
+    for field, row in _load_remote(kind, [f"name:{name}" for name in missing]).items():
+        found[row[name_column]] = row
+        _remember(kind, row)
+
+    missing = [name for name in missing if name not in found]
+    if missing:
+        # Lowest id wins when a name is not unique, like filter_by().first() on the PK order
+        loaded = {}
+        for row in sorted(_load_rows(kind, name_column, missing), key=lambda row: row['id']):
+            loaded.setdefault(row[name_column], row)
+        for name, row in loaded.items():
+            found[name] = row
+            _remember(kind, row)
+        _store_remote(kind, list(loaded.values()))
+
+    return found
+
+
+def lookup(kind, name):
+    """Reference row snapshot (attribute access) by name, or None"""
+    if name is None:
+        return None
+    return _snapshot(lookup_many(kind, [name]).get(name))
+
+
+def lookup_id(kind, row_id):
+    """Reference row snapshot by primary key, or None"""
+    _ensure_subscriber()
+    row = _local.get((kind, 'id', row_id))
+    if row is None:
+        row = _load_remote(kind, [f"id:{row_id}"]).get(f"id:{row_id}")
+        if row is None:
+            rows = _load_rows(kind, 'id', [row_id])
+            row = rows[0] if rows else None
+            if row is not None:
+                _store_remote(kind, [row])
+        if row is not None:
+            _remember(kind, row)
+    return _snapshot(row)
+
+
+# ---- Invalidation: drop changed rows locally, in Redis, and in every other worker ----
+
+def _evict_local(message):
+    kind = message.get('kind')
+    if kind not in REFERENCE_MODELS:
+        return
+    if message.get('all'):
+        _local.clear(kind)
+        return
+    for row_id in message.get('ids', ()):
+        _local.pop((kind, 'id', row_id))
+    for name in message.get('names', ()):
+        _local.pop((kind, 'name', name))
+
+
+def invalidate_references(kind, ids=(), names=(), everything=False):
+    """Forget cached reference rows everywhere: this worker, Redis and (via pub/sub) the others"""
+    message = {'kind': kind, 'ids': list(ids), 'names': list(names), 'all': everything}
+    _evict_local(message)
+
+    client = redis_manager.redis_client
+    if not client:
+        return
+    try:
+        pipe = client.pipeline()
+        if everything:
+            pipe.unlink(_hash_key(kind))
+        else:
+            fields = [f"id:{row_id}" for row_id in ids] + [f"name:{name}" for name in names]
+            if fields:
+                pipe.hdel(_hash_key(kind), *fields)
+        message['pid'] = os.getpid()
+        pipe.publish(REFERENCE_CHANNEL, json.dumps(message, default=str))
+        pipe.execute()
+    except Exception as e:
+        pass
+
+
+def _handle_message(raw):
+    try:
+        message = json.loads(raw['data'])
+    except (TypeError, ValueError):
+        return
+    if message.get('pid') == os.getpid():
+        return
+    _evict_local(message)
+
+
+def _ensure_subscriber():
+    """Start this worker's pub/sub listener (once per process, so forked workers get their own)"""
+    client = redis_manager.redis_client
+    if not client or _subscriber['pid'] == os.getpid():
+        return
+    _subscriber['pid'] = os.getpid()
+    # Anything cached before the fork may have missed messages
+    _local.clear()
+    try:
+        pubsub = client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{REFERENCE_CHANNEL: _handle_message})
+        _subscriber['thread'] = pubsub.run_in_thread(sleep_time=1.0, daemon=True)
+    except Exception as e:
+        _subscriber['thread'] = None
+
+
+def _collect_reference_changes(session, flush_context):
+    pending = session.info.setdefault(PENDING_REFERENCES_KEY, defaultdict(lambda: {'ids': set(), 'names': set()}))
+    # New rows count too: a lookup inside the transaction may have cached them
+    # before a rollback made them disappear
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        kind = REFERENCE_TABLES.get(getattr(obj, '__tablename__', None))
+        if kind is None or obj.id is None:
+            continue
+        name_column = REFERENCE_MODELS[kind][1]
+        pending[kind]['ids'].add(obj.id)
+        history = attributes.get_history(obj, name_column)
+        pending[kind]['names'].update(history.deleted or ())
+        pending[kind]['names'].update(history.unchanged or ())
+        pending[kind]['names'].update(history.added or ())
+
+
+def _collect_bulk_reference_changes(orm_execute_state):
+    if not (orm_execute_state.is_update or orm_execute_state.is_delete):
+        return
+    mapper = orm_execute_state.bind_mapper
+    kind = REFERENCE_TABLES.get(mapper.local_table.name) if mapper is not None else None
+    if kind is not None:
+        pending = orm_execute_state.session.info.setdefault(
+            PENDING_REFERENCES_KEY, defaultdict(lambda: {'ids': set(), 'names': set()})
+        )
+        pending[kind]['all'] = True
+
+
+def _invalidate_pending(session):
+    pending = session.info.pop(PENDING_REFERENCES_KEY, None)
+    for kind, changes in (pending or {}).items():
+        if changes.get('all'):
+            invalidate_references(kind, everything=True)
+        elif changes['ids'] or changes['names']:
+            invalidate_references(kind, changes['ids'], changes['names'])
+
+
+def register_reference_invalidation(session):
+    if event.contains(session, 'after_flush', _collect_reference_changes):
+        return
+    event.listen(session, 'after_flush', _collect_reference_changes)
+    event.listen(session, 'do_orm_execute', _collect_bulk_reference_changes)
+    # Rolled back changes are invalidated as well: lookups made inside the
+    # transaction see (and cache) its uncommitted rows
+    event.listen(session, 'after_commit', _invalidate_pending)
+    event.listen(session, 'after_rollback', _invalidate_pending)
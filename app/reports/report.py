@@ -1,6 +1,11 @@
+import csv
+import io
+import json
+from flask import Response, stream_with_context
 from flask_restx import Namespace, Resource, fields
 from flask_jwt_extended import jwt_required
-from sqlalchemy import or_, and_, desc
+from sqlalchemy import or_, and_, desc, select, func
+from sqlalchemy.orm import selectinload
 from ..models import (
     Mechanism,
     Employee,
@@ -20,6 +25,10 @@ from ..models import (
 )
 from datetime import datetime
 from ..utils import parse_bool
+from ..pagination import add_cursor_arguments, count_rows, keyset_page, page_count
+from ..serializers import chunked, fetch_in, index_by, group_by, load_invoice_bundle
+from .. import db
+from ..redis_config import cache_result
 
 reports_ns = Namespace("reports", description="Reports operations")
 
@@ -127,8 +136,22 @@ pagination_parser.add_argument(
     help="Get all items (default: True) \naccepts values [\'true\', \'false\', \'1\', \'0\', \'t\', \'f\', \'y\', \'n\', \'yes\', \'no\']",
 )
 
+# Full dump parser: json (default) or a streamed ndjson / csv export
+export_parser = pagination_parser.copy()
+export_parser.add_argument(
+    "format",
+    type=str,
+    required=False,
+    default="json",
+    choices=("json", "ndjson", "csv"),
+    help="Response format: json (default), or ndjson / csv streamed table by table",
+)
+export_parser.add_argument(
+    "tables", type=str, required=False, help="Comma-separated table names to export (default: all)"
+)
+
 # Updated filter parser (removed machine and mechanism filters)
-filter_parser = pagination_parser.copy()
+filter_parser = add_cursor_arguments(pagination_parser.copy())
 filter_parser.add_argument("type", type=str, required=True, help="Report type (invoice, item)")
 filter_parser.add_argument("invoice_id", type=int, required=False, help="Filter by specific invoice ID")
 filter_parser.add_argument("warehouse_manager", type=str, required=False, help="Filter by warehouse manager")
@@ -151,13 +174,133 @@ def serialize_value(value):
         return value.strftime("%Y-%m-%d %H:%M:%S")  
     return value
 
+# Tables included in the full-database report, in output order
+REPORT_MODELS = [
+    Employee,
+    Supplier,
+    Machine,
+    Mechanism,
+    Invoice,
+    InvoiceItem,
+    Warehouse,
+    ItemLocations,
+    Prices,
+    InvoicePriceDetail,
+    PurchaseRequests,
+    RentedItems,
+    RentalWarehouseLocations,
+]
+
+EXCLUDED_COLUMNS = ("password", "password_hash")
+
+# Rows fetched per server-side cursor round trip while streaming
+EXPORT_YIELD_PER = 1000
+
+
+def _export_columns(model):
+    return [col for col in model.__table__.columns if col.name not in EXCLUDED_COLUMNS]
+
+
+def _export_statement(model, limit=None, offset=None):
+    statement = select(*_export_columns(model))
+    if hasattr(model, 'id'):
+        statement = statement.order_by(desc(model.__table__.c.id))
+    if limit is not None:
+        statement = statement.limit(limit).offset(offset)
+    return statement
+
+
+def _stream_rows(model, limit=None, offset=None):
+    """Yield rows of one table through a server-side cursor"""
+    result = db.session.execute(
+        _export_statement(model, limit, offset).execution_options(
+            stream_results=True, yield_per=EXPORT_YIELD_PER
+        )
+    )
+    try:
+        for row in result:
+            yield row
+    finally:
+        result.close()
+
+
+def _export_manifest(models, export_format, limit=None, offset=None):
+    tables = {}
+    for model in models:
+        count = db.session.execute(select(func.count()).select_from(model.__table__)).scalar()
+        if limit is not None:
+            count = max(0, min(limit, count - offset))
+        tables[model.__tablename__] = {
+            "rows": count,
+            "columns": [col.name for col in _export_columns(model)],
+        }
+    return {
+        "format": export_format,
+        "generated_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "tables": tables,
+    }
+
+
+def generate_ndjson_export(models, limit=None, offset=None):
+    """
+    NDJSON stream: a manifest line with per-table row counts, then one line per row
+    ({"table": ..., "row": {...}}) and a closing {"table": ..., "rows_written": n}
+    line after each table.
+    """
+    yield json.dumps({"manifest": _export_manifest(models, "ndjson", limit, offset)}, ensure_ascii=False) + "\n"
+
+    for model in models:
+        table_name = model.__tablename__
+        columns = [col.name for col in _export_columns(model)]
+        rows_written = 0
+        buffer = []
+        for row in _stream_rows(model, limit, offset):
+            record = {col: serialize_value(value) for col, value in zip(columns, row)}
+            buffer.append(json.dumps({"table": table_name, "row": record}, ensure_ascii=False, default=str))
+            rows_written += 1
+            if len(buffer) >= EXPORT_YIELD_PER:
+                yield "\n".join(buffer) + "\n"
+                buffer = []
+        if buffer:
+            yield "\n".join(buffer) + "\n"
+        yield json.dumps({"table": table_name, "rows_written": rows_written}) + "\n"
+
+
+def generate_csv_export(models, limit=None, offset=None):
+    """
+    CSV stream: a '# manifest' comment line, then one block per table made of a
+    '# table=<name> rows=<count>' line, the header row and the data rows, separated
+    by blank lines.
+    """
+    manifest = _export_manifest(models, "csv", limit, offset)
+    yield "# manifest " + json.dumps(manifest, ensure_ascii=False) + "\n"
+
+    for model in models:
+        table_name = model.__tablename__
+        columns = [col.name for col in _export_columns(model)]
+        output = io.StringIO()
+        writer = csv.writer(output)
+
+        output.write(f"\n# table={table_name} rows={manifest['tables'][table_name]['rows']}\n")
+        writer.writerow(columns)
+        pending = 0
+        for row in _stream_rows(model, limit, offset):
+            writer.writerow([serialize_value(value) for value in row])
+            pending += 1
+            if pending >= EXPORT_YIELD_PER:
+                yield output.getvalue()
+                output.seek(0)
+                output.truncate(0)
+                pending = 0
+        yield output.getvalue()
+
 @reports_ns.route("/")
 class Reports(Resource):
-    @reports_ns.expect(pagination_parser)
+    @reports_ns.expect(export_parser)
     @jwt_required()
     def get(self):
-        """Get all reports"""
-        args = pagination_parser.parse_args()
+        """Get all reports (format=ndjson|csv streams the tables instead of building one JSON body)"""
+        args = export_parser.parse_args()
         page = int(args["page"])
         page_size = int(args["page_size"])
         all_results = bool(args["all"])
@@ -167,28 +310,39 @@ class Reports(Resource):
             
         offset = (page - 1) * page_size
         
-        models = [
-            Employee,
-            Supplier,
-            Machine,
-            Mechanism,
-            Invoice,
-            InvoiceItem,
-            Warehouse,
-            ItemLocations,
-            Prices,
-            InvoicePriceDetail,
-            PurchaseRequests,
-            RentedItems,
-            RentalWarehouseLocations,
-        ]
+        models = REPORT_MODELS
+        if args.get("tables"):
+            requested = [name.strip() for name in args["tables"].split(",") if name.strip()]
+            by_name = {model.__tablename__: model for model in REPORT_MODELS}
+            unknown = [name for name in requested if name not in by_name]
+            if unknown:
+                reports_ns.abort(400, f"Unknown tables: {', '.join(unknown)}")
+            models = [by_name[name] for name in requested]
+
+        export_format = args.get("format") or "json"
+        if export_format != "json":
+            limit = None if all_results else page_size
+            if export_format == "ndjson":
+                generator = generate_ndjson_export(models, limit, offset)
+                mimetype = "application/x-ndjson"
+            else:
+                generator = generate_csv_export(models, limit, offset)
+                mimetype = "text/csv"
+            filename = f"report_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{export_format}"
+            return Response(
+                stream_with_context(generator),
+                mimetype=mimetype,
+                headers={
+                    "Content-Disposition": f"attachment; filename={filename}",
+                    "X-Accel-Buffering": "no",
+                },
+            )
         
         full_report = {}
-        rows_data = []
         
         for model in models:
             table_name = model.__tablename__
-            columns = [col.name for col in model.__table__.columns if col.name not in ["password", "password_hash"]]
+            columns = [col.name for col in _export_columns(model)]
             
             # Add DESC ordering by id if the model has an id column
             query = model.query
@@ -207,7 +361,6 @@ class Reports(Resource):
                 ]
                 
             full_report[table_name] = row_data
-            rows_data.append({table_name: row_data})
             
         return full_report, 200
 
@@ -216,6 +369,11 @@ class FilterReports(Resource):
     @reports_ns.expect(filter_parser)
     @reports_ns.expect(pagination_parser)
     @jwt_required()
+    @cache_result(
+        timeout=300, key_prefix="reports_filter", single_flight=True,
+        tags=("invoices", "warehouses", "machines", "mechanisms", "suppliers", "employees", "warranty_return", "return_sales",
+              "purchase_requests", "prices", "rentals"),
+    )
     def get(self):
         """Filter reports based on query parameters"""
         args = filter_parser.parse_args()
@@ -325,7 +483,11 @@ class FilterReports(Resource):
                 invoices = invoices_query.limit(nested_page_size).offset(nested_offset).all()
             
             # Get related purchase requests with pagination
-            purchase_requests_query = PurchaseRequests.query.filter(PurchaseRequests.machine_id == machine.id)
+            purchase_requests_query = PurchaseRequests.query.options(
+                selectinload(PurchaseRequests.machine),
+                selectinload(PurchaseRequests.mechanism),
+                selectinload(PurchaseRequests.employee),
+            ).filter(PurchaseRequests.machine_id == machine.id)
             
             # Apply date filters if provided
             if start_date:
@@ -343,7 +505,11 @@ class FilterReports(Resource):
                 purchase_requests = purchase_requests_query.limit(nested_page_size).offset(nested_offset).all()
             
             # Get warranty returns for this machine
-            warranty_returns_query = WarrantyReturn.query.join(Invoice).filter(Invoice.machine_id == machine.id)
+            warranty_returns_query = WarrantyReturn.query.join(Invoice).options(
+                selectinload(WarrantyReturn.item),
+                selectinload(WarrantyReturn.returned_by),
+                selectinload(WarrantyReturn.warranty_invoice),
+            ).filter(Invoice.machine_id == machine.id)
             
             # Apply date filters to warranty returns
             if start_date:
@@ -535,7 +701,11 @@ class FilterReports(Resource):
                 invoices = invoices_query.limit(nested_page_size).offset(nested_offset).all()
             
             # Get related purchase requests with pagination
-            purchase_requests_query = PurchaseRequests.query.filter(PurchaseRequests.mechanism_id == mechanism.id)
+            purchase_requests_query = PurchaseRequests.query.options(
+                selectinload(PurchaseRequests.machine),
+                selectinload(PurchaseRequests.mechanism),
+                selectinload(PurchaseRequests.employee),
+            ).filter(PurchaseRequests.mechanism_id == mechanism.id)
             
             # Apply date filters if provided
             if start_date:
@@ -553,7 +723,11 @@ class FilterReports(Resource):
                 purchase_requests = purchase_requests_query.limit(nested_page_size).offset(nested_offset).all()
             
             # Get warranty returns for this mechanism
-            warranty_returns_query = WarrantyReturn.query.join(Invoice).filter(Invoice.mechanism_id == mechanism.id)
+            warranty_returns_query = WarrantyReturn.query.join(Invoice).options(
+                selectinload(WarrantyReturn.item),
+                selectinload(WarrantyReturn.returned_by),
+                selectinload(WarrantyReturn.warranty_invoice),
+            ).filter(Invoice.mechanism_id == mechanism.id)
             
             # Apply date filters to warranty returns
             if start_date:
@@ -676,212 +850,76 @@ class FilterReports(Resource):
             "results": result
         }, 200
     
-    def _serialize_invoices(self, invoices):
-        """Serialize invoices data with warranty return information and supplier per item"""
-        serialized_invoices = []
-        for invoice in invoices:
-            invoice_data = {
-                "id": invoice.id,
-                "type": invoice.type,
-                "created_at": serialize_value(invoice.created_at),
-                "client_name": invoice.client_name,
-                "warehouse_manager": invoice.warehouse_manager,
-                "accreditation_manager": invoice.accreditation_manager,
-                "total_amount": invoice.total_amount,
-                "paid": invoice.paid,
-                "residual": invoice.residual,
-                "comment": invoice.comment,
-                "status": invoice.status,
-                "employee_name": invoice.employee_name,
-                "machine": invoice.machine.name if invoice.machine else None,
-                "mechanism": invoice.mechanism.name if invoice.mechanism else None,
-                # Remove invoice-level supplier since it's now per item
-            }
-            
-            # Enhanced items with warranty return information and supplier info
-            items_with_return_info = []
-            suppliers_used = set()  # Track unique suppliers for summary
-            
-            for item in invoice.items:
-                # Get supplier information for this item
-                supplier_name = None
-                supplier_id = None
-                if hasattr(item, 'supplier_id') and item.supplier_id:
-                    supplier = Supplier.query.get(item.supplier_id)
-                    if supplier:
-                        supplier_name = supplier.name
-                        supplier_id = supplier.id
-                        suppliers_used.add(supplier_name)
-                elif hasattr(item, 'supplier_name') and item.supplier_name:
-                    supplier_name = item.supplier_name
-                    suppliers_used.add(supplier_name)
-                
-                # Get return history for warranty invoices
-                returned_quantity = 0
-                return_history = []
-                
-                if invoice.type == 'أمانات':
-                    item_returns = WarrantyReturn.query.filter_by(
-                        warranty_invoice_id=invoice.id,
-                        item_id=item.item_id,
-                        location=item.location
-                    ).all()
-                    
-                    returned_quantity = sum(wr.returned_quantity for wr in item_returns)
-                    return_history = [{
-                        "returned_quantity": wr.returned_quantity,
-                        "return_date": serialize_value(wr.return_date),
-                        "returned_by": wr.returned_by.username,
-                        "notes": wr.notes
-                    } for wr in item_returns]
-                
-                # NEW: Add transfer information for transfer invoices
-                transfer_info = None
-                if invoice.type == 'تحويل' and hasattr(item, 'new_location') and item.new_location:
-                    transfer_info = {
-                        "from_location": item.location,
-                        "to_location": item.new_location,
-                        "is_transfer": True,
-                        "affected_purchase_invoices": []
-                    }
-                    
-                    # Find which purchase invoices were affected by this transfer
-                    affected_prices = Prices.query.filter_by(
-                        item_id=item.item_id,
-                        location=item.new_location
-                    ).all()
-                    
-                    for price in affected_prices:
-                        if price.invoice_id not in transfer_info["affected_purchase_invoices"]:
-                            transfer_info["affected_purchase_invoices"].append(price.invoice_id)
-                
-                # NEW: For purchase invoices, show location distribution
-                location_distribution = None
-                if invoice.type == 'اضافه':
-                    # Check if this item has been split across multiple locations
-                    all_price_records = Prices.query.filter_by(
-                        invoice_id=invoice.id,
-                        item_id=item.item_id
-                    ).all()
-                    
-                    if len(all_price_records) > 1:
-                        location_distribution = {
-                            "total_locations": len(all_price_records),
-                            "locations": [{
-                                "location": pr.location,
-                                "quantity": pr.quantity,
-                                "unit_price": pr.unit_price
-                            } for pr in all_price_records],
-                            "is_split": True
-                        }
-                    elif len(all_price_records) == 1:
-                        location_distribution = {
-                            "total_locations": 1,
-                            "locations": [{
-                                "location": all_price_records[0].location,
-                                "quantity": all_price_records[0].quantity,
-                                "unit_price": all_price_records[0].unit_price
-                            }],
-                            "is_split": False
-                        }
-                
-                items_with_return_info.append({
-                    "item_name": item.warehouse.item_name,
-                    "item_bar": item.warehouse.item_bar,
-                    "location": item.location,
-                    "quantity": item.quantity,
-                    "unit_price": item.unit_price,
-                    "total_price": item.total_price,
-                    "description": item.description,
-                    "supplier_name": item.supplier_name,  # NEW: supplier per item
-                    "supplier_id": supplier_id,      # NEW: supplier ID per item
-                    "returned_quantity": returned_quantity,
-                    "remaining_quantity": item.quantity - returned_quantity,
-                    "return_history": return_history,
-                    "transfer_info": transfer_info,  # NEW: transfer information
-                    "location_distribution": location_distribution,  # NEW: location distribution for purchases
-                    "new_location": getattr(item, 'new_location', None)  # NEW: destination for transfers
-                })
-            
-            invoice_data["items"] = items_with_return_info
-            invoice_data["suppliers_summary"] = list(suppliers_used)  # NEW: Summary of suppliers used
-            
-            # Add warranty return summary for warranty invoices
-            if invoice.type == 'أمانات':
-                all_warranty_returns = WarrantyReturn.query.filter_by(warranty_invoice_id=invoice.id).all()
-                invoice_data["warranty_return_summary"] = {
-                    "total_returns": len(all_warranty_returns),
-                    "total_returned_items": sum(wr.returned_quantity for wr in all_warranty_returns)
-                }
-            
-            # NEW: Add transfer summary for transfer invoices
-            if invoice.type == 'تحويل':
-                total_transferred_items = len(invoice.items)
-                total_transferred_quantity = sum(item.quantity for item in invoice.items)
-                unique_source_locations = set(item.location for item in invoice.items)
-                unique_dest_locations = set(getattr(item, 'new_location', None) for item in invoice.items if hasattr(item, 'new_location'))
-                
-                # Find affected purchase invoices
-                affected_purchase_invoices = set()
-                for item in invoice.items:
-                    item_prices = Prices.query.filter_by(item_id=item.item_id).all()
-                    for price in item_prices:
-                        affected_purchase_invoices.add(price.invoice_id)
-                
-                invoice_data["transfer_summary"] = {
-                    "total_transferred_items": total_transferred_items,
-                    "total_transferred_quantity": total_transferred_quantity,
-                    "unique_source_locations": list(unique_source_locations),
-                    "unique_destination_locations": list(unique_dest_locations),
-                    "affected_purchase_invoices": list(affected_purchase_invoices)
-                }
-            
-            # NEW: Add purchase summary for purchase invoices showing location distribution
-            if invoice.type == 'اضافه':
-                location_summary = {}
-                total_split_items = 0
-                
-                for item in invoice.items:
-                    # Check how many locations this item exists in for this purchase
-                    price_records = Prices.query.filter_by(
-                        invoice_id=invoice.id,
-                        item_id=item.item_id
-                    ).all()
-                    
-                    if len(price_records) > 1:
-                        total_split_items += 1
-                    
-                    for price_record in price_records:
-                        if price_record.location not in location_summary:
-                            location_summary[price_record.location] = {
-                                "total_items": 0,
-                                "total_quantity": 0,
-                                "total_value": 0
-                            }
-                        
-                        location_summary[price_record.location]["total_items"] += 1
-                        location_summary[price_record.location]["total_quantity"] += price_record.quantity
-                        location_summary[price_record.location]["total_value"] += price_record.quantity * price_record.unit_price
-                
-            
-            # Add ReturnSales information if invoice type is "مرتجع"
-            if invoice.type == "مرتجع":
-                return_sales_record = ReturnSales.query.filter_by(return_invoice_id=invoice.id).first()
-                if return_sales_record:
-                    original_invoice = return_sales_record.sales_invoice
-                    invoice_data['return_sales_info'] = {
-                        'original_invoice_id': return_sales_record.sales_invoice_id,
-                        'original_invoice_type': original_invoice.type if original_invoice else None,
-                        'original_invoice_date': serialize_value(original_invoice.created_at) if original_invoice else None,
-                        'original_client_name': original_invoice.client_name if original_invoice else None,
-                        'original_total_amount': original_invoice.total_amount if original_invoice else None
-                    }
-                else:
-                    invoice_data['return_sales_info'] = None
-            
-            serialized_invoices.append(invoice_data)
-        return serialized_invoices
-    
+    def _load_invoice_relations(self, invoices, bundle=None):
+        """
+        Batch-load the per-item relations used by _filter_invoices (suppliers,
+        returns, prices, rentals). With a load_invoice_bundle() result the
+        items and suppliers come from the bundle instead of invoice.items.
+        """
+        if bundle is not None:
+            invoice_items = bundle['items']
+        else:
+            invoice_items = {invoice.id: invoice.items for invoice in invoices}
+        items = [item for invoice in invoices for item in invoice_items.get(invoice.id, [])]
+        transfer_items = [
+            item for invoice in invoices if invoice.type == 'تحويل'
+            for item in invoice_items.get(invoice.id, [])
+        ]
+        transfer_item_ids = {item.item_id for item in transfer_items}
+
+        warranty_ids = [invoice.id for invoice in invoices if invoice.type == 'أمانات']
+        warranty_returns = []
+        for batch in chunked(warranty_ids):
+            warranty_returns.extend(
+                WarrantyReturn.query.options(selectinload(WarrantyReturn.returned_by))
+                .filter(WarrantyReturn.warranty_invoice_id.in_(batch)).all()
+            )
+
+        purchase_items = []
+        for batch in chunked(transfer_item_ids):
+            purchase_items.extend(
+                InvoiceItem.query.join(Invoice).filter(
+                    Invoice.type == 'اضافه',
+                    InvoiceItem.item_id.in_(batch)
+                ).all()
+            )
+
+        prices = fetch_in(Prices, Prices.item_id, transfer_item_ids)
+
+        return_ids = [invoice.id for invoice in invoices if invoice.type == "مرتجع"]
+        return_sales = []
+        for batch in chunked(return_ids):
+            return_sales.extend(
+                ReturnSales.query.options(selectinload(ReturnSales.sales_invoice))
+                .filter(ReturnSales.return_invoice_id.in_(batch)).all()
+            )
+
+        rental_ids = [invoice.id for invoice in invoices if invoice.type == 'حجز']
+        rented_items = []
+        for batch in chunked(rental_ids):
+            rented_items.extend(
+                RentedItems.query.options(selectinload(RentedItems.item))
+                .filter(RentedItems.rental_invoice_id.in_(batch)).all()
+            )
+
+        if bundle is not None:
+            suppliers = bundle['suppliers']
+        else:
+            suppliers = index_by(
+                fetch_in(Supplier, Supplier.id, [item.supplier_id for item in items if item.supplier_id]),
+                lambda row: row.id
+            )
+
+        return {
+            'suppliers': suppliers,
+            'warranty_returns': group_by(warranty_returns, lambda row: row.warranty_invoice_id),
+            'purchase_items': group_by(purchase_items, lambda row: (row.item_id, row.location)),
+            'prices': index_by(prices, lambda row: (row.invoice_id, row.item_id, row.location)),
+            'prices_by_item': group_by(prices, lambda row: row.item_id),
+            'return_sales': index_by(return_sales, lambda row: row.return_invoice_id),
+            'rented_items': group_by(rented_items, lambda row: row.rental_invoice_id),
+        }
+
     def _filter_invoices(self, args, start_date, end_date, page_size, offset, all_results):
         """Filter invoices based on provided parameters"""
         # Start with base query with DESC ordering
@@ -945,14 +983,26 @@ class FilterReports(Resource):
             query = query.filter(Invoice.created_at <= end_date)
         
         # Get total count for pagination info
-        total_count = query.count()
+        total_count = count_rows(query, args["count"], Invoice)
         
-        # Apply pagination or get all
-        if all_results:
+        # Eager-load items, warehouse rows, machines and mechanisms for the whole page
+        query = query.options(
+            selectinload(Invoice.items).selectinload(InvoiceItem.warehouse),
+            selectinload(Invoice.machine),
+            selectinload(Invoice.mechanism),
+        )
+        
+        # Apply keyset, offset pagination or get all
+        next_cursor = None
+        if args["cursor"] is not None:
+            invoices, next_cursor = keyset_page(query, Invoice.id, args["cursor"], page_size)
+        elif all_results:
             invoices = query.all()
         else:
             invoices = query.limit(page_size).offset(offset).all()
         
+        related = self._load_invoice_relations(invoices)
+        
         # Serialize results with warranty return information and supplier per item
         result = []
         for invoice in invoices:
@@ -985,7 +1035,7 @@ class FilterReports(Resource):
                 supplier_name = None
                 supplier_id = None
                 if hasattr(item, 'supplier_id') and item.supplier_id:
-                    supplier = Supplier.query.get(item.supplier_id)
+                    supplier = related['suppliers'].get(item.supplier_id)
                     if supplier:
                         supplier_name = supplier.name
                         supplier_id = supplier.id
@@ -1003,11 +1053,10 @@ class FilterReports(Resource):
                 return_history = []
                 
                 if invoice.type == 'أمانات':  # Only for warranty invoices
-                    item_returns = WarrantyReturn.query.filter_by(
-                        warranty_invoice_id=invoice.id,
-                        item_id=item.item_id,
-                        location=item.location
-                    ).all()
+                    item_returns = [
+                        wr for wr in related['warranty_returns'].get(invoice.id, [])
+                        if wr.item_id == item.item_id and wr.location == item.location
+                    ]
                     
                     returned_quantity = sum(wr.returned_quantity for wr in item_returns)
                     return_history = [{
@@ -1033,27 +1082,12 @@ class FilterReports(Resource):
                 # Check if this item was transferred FROM other locations (for transfer invoices)
                 if invoice.type == 'تحويل':
                     # Look for items in purchase invoices that were split due to this transfer
-                    original_items = InvoiceItem.query.join(Invoice).filter(
-                        and_(
-                            Invoice.type == 'اضافه',  # Purchase invoices
-                            InvoiceItem.item_id == item.item_id,
-                            InvoiceItem.location == item.new_location if hasattr(item, 'new_location') else None
-                        )
-                    ).all()
+                    original_items = related['purchase_items'].get((item.item_id, item.new_location), [])
                     
                     for orig_item in original_items:
                         # Check if this purchase invoice has matching price records in both locations
-                        source_prices = Prices.query.filter_by(
-                            invoice_id=orig_item.invoice_id,
-                            item_id=item.item_id,
-                            location=item.location
-                        ).first()
-                        
-                        dest_prices = Prices.query.filter_by(
-                            invoice_id=orig_item.invoice_id,
-                            item_id=item.item_id,
-                            location=item.new_location if hasattr(item, 'new_location') else None
-                        ).first()
+                        source_prices = related['prices'].get((orig_item.invoice_id, item.item_id, item.location))
+                        dest_prices = related['prices'].get((orig_item.invoice_id, item.item_id, item.new_location))
                         
                         if source_prices and dest_prices:
                             transfer_history.append({
@@ -1088,7 +1122,7 @@ class FilterReports(Resource):
             
             # Add warranty return summary for warranty invoices
             if invoice.type == 'أمانات':
-                all_warranty_returns = WarrantyReturn.query.filter_by(warranty_invoice_id=invoice.id).all()
+                all_warranty_returns = related['warranty_returns'].get(invoice.id, [])
                 
                 items_with_returns = len(set((wr.item_id, wr.location) for wr in all_warranty_returns))
                 fully_returned_items = 0
@@ -1127,13 +1161,13 @@ class FilterReports(Resource):
                     "unique_destination_locations": list(unique_dest_locations),
                     "affected_purchase_invoices": list(set(
                         price.invoice_id for item in invoice.items 
-                        for price in Prices.query.filter_by(item_id=item.item_id).all()
+                        for price in related['prices_by_item'].get(item.item_id, [])
                     ))
                 }
             
             # Add ReturnSales information if invoice type is "مرتجع"
             if invoice.type == "مرتجع":
-                return_sales_record = ReturnSales.query.filter_by(return_invoice_id=invoice.id).first()
+                return_sales_record = related['return_sales'].get(invoice.id)
                 if return_sales_record:
                     # Get the original sales invoice
                     original_invoice = return_sales_record.sales_invoice
@@ -1151,7 +1185,7 @@ class FilterReports(Resource):
 
             # NEW: Add rental information for rental invoices (حجز)
             if invoice.type == 'حجز':
-                rented_items_records = RentedItems.query.filter_by(rental_invoice_id=invoice.id).all()
+                rented_items_records = related['rented_items'].get(invoice.id, [])
 
                 rental_summary = {
                     'total_rented_items': len(rented_items_records),
@@ -1199,11 +1233,127 @@ class FilterReports(Resource):
         
         return {
             "total": total_count,
-            "page": args["page"],
+            "page": args["page"] if args["cursor"] is None else None,
             "page_size": page_size,
-            "pages": (total_count + page_size - 1) // page_size,
+            "pages": page_count(total_count, page_size),
+            "next_cursor": next_cursor,
             "results": result
         }, 200
+
+    def _supplier_filter(self, supplier_search):
+        """InvoiceItem criterion matching a supplier by (appended) name or by supplier id"""
+        return or_(
+            InvoiceItem.supplier_name.ilike(f"%{supplier_search}%"),
+            and_(
+                InvoiceItem.supplier_id.isnot(None),
+                InvoiceItem.supplier_id == Supplier.query.filter(
+                    Supplier.name.ilike(f"%{supplier_search}%")
+                ).with_entities(Supplier.id).subquery().c.id
+            )
+        )
+
+    def _load_item_relations(self, items, args, start_date, end_date):
+        """Batch-load everything _filter_items shows per item, in a fixed number of queries"""
+        item_ids = [item.id for item in items]
+
+        invoice_items = []
+        warranty_returns = []
+        transfer_items = []
+        purchase_requests = []
+        for batch in chunked(item_ids):
+            # Same filters as the item's invoice history, newest invoice first
+            invoice_items_query = InvoiceItem.query.join(Invoice).options(
+                selectinload(InvoiceItem.invoice)
+            ).filter(InvoiceItem.item_id.in_(batch)).order_by(desc(Invoice.id))
+            if args["invoice_id"]:
+                invoice_items_query = invoice_items_query.filter(Invoice.id == args["invoice_id"])
+            if args["invoice_type"]:
+                invoice_items_query = invoice_items_query.filter(Invoice.type == args["invoice_type"])
+            if start_date:
+                invoice_items_query = invoice_items_query.filter(Invoice.created_at >= start_date)
+            if end_date:
+                invoice_items_query = invoice_items_query.filter(Invoice.created_at <= end_date)
+            if args["location"]:
+                invoice_items_query = invoice_items_query.filter(InvoiceItem.location.ilike(f"%{args['location']}%"))
+            if args["supplier"]:
+                invoice_items_query = invoice_items_query.filter(self._supplier_filter(args["supplier"].strip()))
+            invoice_items.extend(invoice_items_query.all())
+
+            warranty_returns_query = WarrantyReturn.query.options(
+                selectinload(WarrantyReturn.returned_by),
+                selectinload(WarrantyReturn.warranty_invoice),
+            ).filter(WarrantyReturn.item_id.in_(batch)).order_by(desc(WarrantyReturn.id))
+            if start_date:
+                warranty_returns_query = warranty_returns_query.filter(WarrantyReturn.return_date >= start_date)
+            if end_date:
+                warranty_returns_query = warranty_returns_query.filter(WarrantyReturn.return_date <= end_date)
+            if args["location"]:
+                warranty_returns_query = warranty_returns_query.filter(WarrantyReturn.location.ilike(f"%{args['location']}%"))
+            warranty_returns.extend(warranty_returns_query.all())
+
+            transfer_items.extend(
+                InvoiceItem.query.join(Invoice).options(selectinload(InvoiceItem.invoice)).filter(
+                    Invoice.type == 'تحويل',
+                    InvoiceItem.item_id.in_(batch)
+                ).order_by(desc(Invoice.created_at)).all()
+            )
+
+            purchase_requests.extend(
+                PurchaseRequests.query.options(
+                    selectinload(PurchaseRequests.machine),
+                    selectinload(PurchaseRequests.mechanism),
+                    selectinload(PurchaseRequests.employee),
+                ).filter(PurchaseRequests.item_id.in_(batch)).all()
+            )
+
+        prices = fetch_in(Prices, Prices.item_id, item_ids)
+        rented_items = fetch_in(RentedItems, RentedItems.item_id, item_ids)
+        history_invoices = [inv_item.invoice for inv_item in invoice_items]
+        # Warranty returns behind each warranty line's returned quantity (not date filtered)
+        line_returns = fetch_in(
+            WarrantyReturn, WarrantyReturn.warranty_invoice_id,
+            [invoice.id for invoice in history_invoices if invoice.type == 'أمانات'],
+            WarrantyReturn.item_id.in_(item_ids)
+        )
+        # Purchase invoices of the price layers (for the split analysis) and rental invoices
+        invoices = fetch_in(
+            Invoice, Invoice.id,
+            [price.invoice_id for price in prices] + [record.rental_invoice_id for record in rented_items]
+        )
+
+        return {
+            'locations': group_by(fetch_in(ItemLocations, ItemLocations.item_id, item_ids), lambda row: row.item_id),
+            'invoice_items': group_by(invoice_items, lambda row: row.item_id),
+            'prices': group_by(prices, lambda row: row.item_id),
+            'warranty_returns': group_by(warranty_returns, lambda row: row.item_id),
+            'transfer_items': group_by(transfer_items, lambda row: row.item_id),
+            'purchase_requests': group_by(purchase_requests, lambda row: row.item_id),
+            'line_returns': group_by(line_returns, lambda row: (row.warranty_invoice_id, row.item_id, row.location)),
+            'rented_items': group_by(
+                sorted(rented_items, key=lambda row: row.id, reverse=True), lambda row: row.item_id
+            ),
+            'rental_warehouse': index_by(
+                fetch_in(
+                    RentalWarehouseLocations, RentalWarehouseLocations.item_id, item_ids,
+                    RentalWarehouseLocations.location == 'RENTAL_WAREHOUSE'
+                ),
+                lambda row: row.item_id
+            ),
+            'invoices': index_by(invoices, lambda row: row.id),
+            'suppliers': index_by(
+                fetch_in(Supplier, Supplier.id, [inv_item.supplier_id for inv_item in invoice_items]),
+                lambda row: row.id
+            ),
+            'machines': index_by(
+                fetch_in(Machine, Machine.id, [invoice.machine_id for invoice in history_invoices]),
+                lambda row: row.id
+            ),
+            'mechanisms': index_by(
+                fetch_in(Mechanism, Mechanism.id, [invoice.mechanism_id for invoice in history_invoices]),
+                lambda row: row.id
+            ),
+        }
+
     def _filter_items(self, args, start_date, end_date, page_size, offset, all_results):
         """Filter warehouse items based on provided parameters"""
         # Start with base query with DESC ordering
@@ -1221,32 +1371,28 @@ class FilterReports(Resource):
             supplier_search = args["supplier"].strip()
             
             # Find items that have invoice items with the specified supplier (including appended names)
+            # (matches appended "Supplier X, Supplier Y" names and supplier ids)
             items_with_supplier = InvoiceItem.query.filter(
-                or_(
-                    # Match appended supplier names (handles "Supplier X, Supplier Y" cases)
-                    InvoiceItem.supplier_name.ilike(f"%{supplier_search}%"),
-                    # Also check via supplier_id join
-                    and_(
-                        InvoiceItem.supplier_id.isnot(None),
-                        InvoiceItem.supplier_id == Supplier.query.filter(
-                            Supplier.name.ilike(f"%{supplier_search}%")
-                        ).with_entities(Supplier.id).subquery().c.id
-                    )
-                )
+                self._supplier_filter(supplier_search)
             ).with_entities(InvoiceItem.item_id).distinct().subquery()
             
             # Filter warehouse items to only those with the specified supplier
             query = query.filter(Warehouse.id.in_(items_with_supplier))
         
         # Get total count for pagination info
-        total_count = query.count()
+        total_count = count_rows(query, args["count"], Warehouse)
         
-        # Apply pagination or get all
-        if all_results:
+        # Apply keyset, offset pagination or get all
+        next_cursor = None
+        if args["cursor"] is not None:
+            items, next_cursor = keyset_page(query, Warehouse.id, args["cursor"], page_size)
+        elif all_results:
             items = query.all()
         else:
             items = query.limit(page_size).offset(offset).all()
         
+        related = self._load_item_relations(items, args, start_date, end_date)
+        
         # Prepare results
         result = []
         for item in items:
@@ -1254,49 +1400,17 @@ class FilterReports(Resource):
             locations = [{
                 "location": loc.location,
                 "quantity": loc.quantity
-            } for loc in item.item_locations]
-            
-            # Get all invoices for this item, applying filters if needed
-            invoice_items_query = InvoiceItem.query.filter(InvoiceItem.item_id == item.id).join(Invoice).order_by(desc(Invoice.id))
-            
-            # Apply invoice_id filter if provided
-            if args["invoice_id"]:
-                invoice_items_query = invoice_items_query.filter(Invoice.id == args["invoice_id"])
-            
-            if args["invoice_type"]:
-                invoice_items_query = invoice_items_query.filter(Invoice.type == args["invoice_type"])
-                
-            if start_date:
-                invoice_items_query = invoice_items_query.filter(Invoice.created_at >= start_date)
-                
-            if end_date:
-                invoice_items_query = invoice_items_query.filter(Invoice.created_at <= end_date)
-                
-            if args["location"]:
-                invoice_items_query = invoice_items_query.filter(InvoiceItem.location.ilike(f"%{args['location']}%"))
+            } for loc in related['locations'].get(item.id, [])]
             
-            # ENHANCED: Apply supplier filter to invoice items as well
-            if args["supplier"]:
-                supplier_search = args["supplier"].strip()
-                invoice_items_query = invoice_items_query.filter(
-                    or_(
-                        InvoiceItem.supplier_name.ilike(f"%{supplier_search}%"),
-                        and_(
-                            InvoiceItem.supplier_id.isnot(None),
-                            InvoiceItem.supplier_id == Supplier.query.filter(
-                                Supplier.name.ilike(f"%{supplier_search}%")
-                            ).with_entities(Supplier.id).subquery().c.id
-                        )
-                    )
-                )
-            
-            invoice_items = invoice_items_query.all()
+            # All invoices for this item, with the report's filters applied
+            invoice_items = related['invoice_items'].get(item.id, [])
             
             # UPDATED: Get pricing history with location information (filter by invoice_id if provided) with DESC ordering
+            item_prices = related['prices'].get(item.id, [])
             if args["invoice_id"]:
-                prices = [price for price in item.prices if price.invoice_id == args["invoice_id"]]
+                prices = [price for price in item_prices if price.invoice_id == args["invoice_id"]]
             else:
-                prices = sorted(item.prices, key=lambda x: x.invoice_id, reverse=True)
+                prices = sorted(item_prices, key=lambda x: x.invoice_id, reverse=True)
             
             prices_serialized = [{
                 "invoice_id": price.invoice_id,
@@ -1306,29 +1420,14 @@ class FilterReports(Resource):
                 "created_at": serialize_value(price.created_at)
             } for price in prices]
             
-            # Get warranty returns for this item with DESC ordering
-            warranty_returns_query = WarrantyReturn.query.filter(WarrantyReturn.item_id == item.id).order_by(desc(WarrantyReturn.id))
-            
-            # Apply date filters to warranty returns
-            if start_date:
-                warranty_returns_query = warranty_returns_query.filter(WarrantyReturn.return_date >= start_date)
-            if end_date:
-                warranty_returns_query = warranty_returns_query.filter(WarrantyReturn.return_date <= end_date)
-            if args["location"]:
-                warranty_returns_query = warranty_returns_query.filter(WarrantyReturn.location.ilike(f"%{args['location']}%"))
-                
-            warranty_returns = warranty_returns_query.all()
+            # Warranty returns for this item (date and location filtered), newest first
+            warranty_returns = related['warranty_returns'].get(item.id, [])
             
             # NEW: Get transfer history for this item
             transfer_history = []
             
             # Find all transfer invoices that involved this item
-            transfer_invoice_items = InvoiceItem.query.join(Invoice).filter(
-                and_(
-                    Invoice.type == 'تحويل',
-                    InvoiceItem.item_id == item.id
-                )
-            ).order_by(desc(Invoice.created_at)).all()
+            transfer_invoice_items = related['transfer_items'].get(item.id, [])
             
             for transfer_item in transfer_invoice_items:
                 if hasattr(transfer_item, 'new_location') and transfer_item.new_location:
@@ -1347,14 +1446,14 @@ class FilterReports(Resource):
             
             # Group prices by invoice_id to see splits
             price_groups = {}
-            for price in item.prices:
+            for price in item_prices:
                 if price.invoice_id not in price_groups:
                     price_groups[price.invoice_id] = []
                 price_groups[price.invoice_id].append(price)
             
             for invoice_id, price_records in price_groups.items():
                 if len(price_records) > 1:  # This purchase invoice has been split
-                    purchase_invoice = Invoice.query.get(invoice_id)
+                    purchase_invoice = related['invoices'].get(invoice_id)
                     if purchase_invoice and purchase_invoice.type == 'اضافه':
                         price_splits.append({
                             "purchase_invoice_id": invoice_id,
@@ -1377,7 +1476,7 @@ class FilterReports(Resource):
                 supplier_name = None
                 supplier_id = None
                 if hasattr(inv_item, 'supplier_id') and inv_item.supplier_id:
-                    supplier = Supplier.query.get(inv_item.supplier_id)
+                    supplier = related['suppliers'].get(inv_item.supplier_id)
                     if supplier:
                         supplier_name = supplier.name
                         supplier_id = supplier.id
@@ -1393,7 +1492,7 @@ class FilterReports(Resource):
                 machine_name = None
                 machine_id = None
                 if inv_item.invoice.machine_id:
-                    machine = Machine.query.get(inv_item.invoice.machine_id)
+                    machine = related['machines'].get(inv_item.invoice.machine_id)
                     if machine:
                         machine_name = machine.name
                         machine_id = machine.id
@@ -1402,7 +1501,7 @@ class FilterReports(Resource):
                 mechanism_name = None
                 mechanism_id = None
                 if inv_item.invoice.mechanism_id:
-                    mechanism = Mechanism.query.get(inv_item.invoice.mechanism_id)
+                    mechanism = related['mechanisms'].get(inv_item.invoice.mechanism_id)
                     if mechanism:
                         mechanism_name = mechanism.name
                         mechanism_id = mechanism.id
@@ -1410,11 +1509,7 @@ class FilterReports(Resource):
                 # Calculate warranty return info for this specific invoice item
                 returned_quantity = 0
                 if inv_item.invoice.type == 'أمانات':
-                    item_returns = WarrantyReturn.query.filter_by(
-                        warranty_invoice_id=inv_item.invoice_id,
-                        item_id=item.id,
-                        location=inv_item.location
-                    ).all()
+                    item_returns = related['line_returns'].get((inv_item.invoice_id, item.id, inv_item.location), [])
                     returned_quantity = sum(wr.returned_quantity for wr in item_returns)
                 
                 # NEW: Add transfer information for this invoice item
@@ -1448,13 +1543,13 @@ class FilterReports(Resource):
                 })
             
             # NEW: Get rental history for this item
-            rental_records = RentedItems.query.filter_by(item_id=item.id).order_by(desc(RentedItems.id)).all()
+            rental_records = related['rented_items'].get(item.id, [])
 
             # Apply date filters to rental records
             if start_date or end_date:
                 filtered_rental_records = []
                 for rr in rental_records:
-                    rental_invoice = Invoice.query.get(rr.rental_invoice_id)
+                    rental_invoice = related['invoices'].get(rr.rental_invoice_id)
                     if rental_invoice:
                         if start_date and rental_invoice.created_at < start_date:
                             continue
@@ -1465,7 +1560,7 @@ class FilterReports(Resource):
 
             rental_history = []
             for rr in rental_records:
-                rental_invoice = Invoice.query.get(rr.rental_invoice_id)
+                rental_invoice = related['invoices'].get(rr.rental_invoice_id)
                 rental_history.append({
                     'rental_invoice_id': rr.rental_invoice_id,
                     'rental_invoice_date': serialize_value(rental_invoice.created_at) if rental_invoice else None,
@@ -1486,10 +1581,7 @@ class FilterReports(Resource):
                 })
 
             # NEW: Get rental warehouse information for this item
-            rental_warehouse_location = RentalWarehouseLocations.query.filter_by(
-                item_id=item.id,
-                location='RENTAL_WAREHOUSE'
-            ).first()
+            rental_warehouse_location = related['rental_warehouse'].get(item.id)
 
             rental_warehouse_info = None
             if rental_warehouse_location:
@@ -1538,16 +1630,17 @@ class FilterReports(Resource):
                     "machine": req.machine.name if req.machine else None,
                     "mechanism": req.mechanism.name if req.mechanism else None,
                     "employee": req.employee.username if req.employee else None
-                } for req in sorted(item.purchase_requests, key=lambda x: x.id, reverse=True)]
+                } for req in sorted(related['purchase_requests'].get(item.id, []), key=lambda x: x.id, reverse=True)]
             }
 
             result.append(item_data)
         
         return {
             "total": total_count,
-            "page": args["page"],
+            "page": args["page"] if args["cursor"] is None else None,
             "page_size": page_size,
-            "pages": (total_count + page_size - 1) // page_size,
+            "pages": page_count(total_count, page_size),
+            "next_cursor": next_cursor,
             "results": result
         }, 200
         
@@ -1568,8 +1661,19 @@ class FilterReports(Resource):
 
     def _serialize_invoices(self, invoices):
         """Serialize invoices data with warranty return information and supplier per item"""
+        # Every relation of the page in a fixed number of queries
+        bundle = load_invoice_bundle(invoices)
+        related = self._load_invoice_relations(invoices, bundle)
+        purchase_prices = group_by(
+            fetch_in(Prices, Prices.invoice_id, [invoice.id for invoice in invoices if invoice.type == 'اضافه']),
+            lambda row: (row.invoice_id, row.item_id)
+        )
+
         serialized_invoices = []
         for invoice in invoices:
+            machine = bundle['machines'].get(invoice.machine_id)
+            mechanism = bundle['mechanisms'].get(invoice.mechanism_id)
+            invoice_items = bundle['items'].get(invoice.id, [])
             invoice_data = {
                 "id": invoice.id,
                 "type": invoice.type,
@@ -1583,8 +1687,8 @@ class FilterReports(Resource):
                 "comment": invoice.comment,
                 "status": invoice.status,
                 "employee_name": invoice.employee_name,
-                "machine": invoice.machine.name if invoice.machine else None,
-                "mechanism": invoice.mechanism.name if invoice.mechanism else None,
+                "machine": machine.name if machine else None,
+                "mechanism": mechanism.name if mechanism else None,
                 # Remove invoice-level supplier since it's now per item
             }
             
@@ -1592,12 +1696,13 @@ class FilterReports(Resource):
             items_with_return_info = []
             suppliers_used = set()  # Track unique suppliers for summary
             
-            for item in invoice.items:
+            for item in invoice_items:
+                warehouse = bundle['warehouses'].get(item.item_id)
                 # Get supplier information for this item
                 supplier_name = None
                 supplier_id = None
                 if hasattr(item, 'supplier_id') and item.supplier_id:
-                    supplier = Supplier.query.get(item.supplier_id)
+                    supplier = related['suppliers'].get(item.supplier_id)
                     if supplier:
                         supplier_name = supplier.name
                         supplier_id = supplier.id
@@ -1615,11 +1720,10 @@ class FilterReports(Resource):
                 return_history = []
                 
                 if invoice.type == 'أمانات':
-                    item_returns = WarrantyReturn.query.filter_by(
-                        warranty_invoice_id=invoice.id,
-                        item_id=item.item_id,
-                        location=item.location
-                    ).all()
+                    item_returns = [
+                        wr for wr in related['warranty_returns'].get(invoice.id, [])
+                        if wr.item_id == item.item_id and wr.location == item.location
+                    ]
                     
                     returned_quantity = sum(wr.returned_quantity for wr in item_returns)
                     return_history = [{
@@ -1640,10 +1744,10 @@ class FilterReports(Resource):
                     }
                     
                     # Find which purchase invoices were affected by this transfer
-                    affected_prices = Prices.query.filter_by(
-                        item_id=item.item_id,
-                        location=item.new_location
-                    ).all()
+                    affected_prices = [
+                        price for price in related['prices_by_item'].get(item.item_id, [])
+                        if price.location == item.new_location
+                    ]
                     
                     for price in affected_prices:
                         if price.invoice_id not in transfer_info["affected_purchase_invoices"]:
@@ -1653,10 +1757,7 @@ class FilterReports(Resource):
                 location_distribution = None
                 if invoice.type == 'اضافه':
                     # Check if this item has been split across multiple locations
-                    all_price_records = Prices.query.filter_by(
-                        invoice_id=invoice.id,
-                        item_id=item.item_id
-                    ).all()
+                    all_price_records = purchase_prices.get((invoice.id, item.item_id), [])
                     
                     if len(all_price_records) > 1:
                         location_distribution = {
@@ -1680,8 +1781,8 @@ class FilterReports(Resource):
                         }
                 
                 items_with_return_info.append({
-                    "item_name": item.warehouse.item_name,
-                    "item_bar": item.warehouse.item_bar,
+                    "item_name": warehouse.item_name if warehouse else None,
+                    "item_bar": warehouse.item_bar if warehouse else None,
                     "location": item.location,
                     "quantity": item.quantity,
                     "unit_price": item.unit_price,
@@ -1702,7 +1803,7 @@ class FilterReports(Resource):
             
             # Add warranty return summary for warranty invoices
             if invoice.type == 'أمانات':
-                all_warranty_returns = WarrantyReturn.query.filter_by(warranty_invoice_id=invoice.id).all()
+                all_warranty_returns = related['warranty_returns'].get(invoice.id, [])
                 invoice_data["warranty_return_summary"] = {
                     "total_returns": len(all_warranty_returns),
                     "total_returned_items": sum(wr.returned_quantity for wr in all_warranty_returns)
@@ -1710,15 +1811,15 @@ class FilterReports(Resource):
             
             # NEW: Add transfer summary for transfer invoices
             if invoice.type == 'تحويل':
-                total_transferred_items = len(invoice.items)
-                total_transferred_quantity = sum(item.quantity for item in invoice.items)
-                unique_source_locations = set(item.location for item in invoice.items)
-                unique_dest_locations = set(getattr(item, 'new_location', None) for item in invoice.items if hasattr(item, 'new_location'))
+                total_transferred_items = len(invoice_items)
+                total_transferred_quantity = sum(item.quantity for item in invoice_items)
+                unique_source_locations = set(item.location for item in invoice_items)
+                unique_dest_locations = set(getattr(item, 'new_location', None) for item in invoice_items if hasattr(item, 'new_location'))
                 
                 # Find affected purchase invoices
                 affected_purchase_invoices = set()
-                for item in invoice.items:
-                    item_prices = Prices.query.filter_by(item_id=item.item_id).all()
+                for item in invoice_items:
+                    item_prices = related['prices_by_item'].get(item.item_id, [])
                     for price in item_prices:
                         affected_purchase_invoices.add(price.invoice_id)
                 
@@ -1735,12 +1836,9 @@ class FilterReports(Resource):
                 location_summary = {}
                 total_split_items = 0
                 
-                for item in invoice.items:
+                for item in invoice_items:
                     # Check how many locations this item exists in for this purchase
-                    price_records = Prices.query.filter_by(
-                        invoice_id=invoice.id,
-                        item_id=item.item_id
-                    ).all()
+                    price_records = purchase_prices.get((invoice.id, item.item_id), [])
                     
                     if len(price_records) > 1:
                         total_split_items += 1
@@ -1765,7 +1863,7 @@ class FilterReports(Resource):
 
             # Add ReturnSales information if invoice type is "مرتجع"
             if invoice.type == "مرتجع":
-                return_sales_record = ReturnSales.query.filter_by(return_invoice_id=invoice.id).first()
+                return_sales_record = related['return_sales'].get(invoice.id)
                 if return_sales_record:
                     original_invoice = return_sales_record.sales_invoice
                     invoice_data['return_sales_info'] = {
@@ -1780,7 +1878,7 @@ class FilterReports(Resource):
 
             # NEW: Add rental information for rental invoices (حجز) in _serialize_invoices
             if invoice.type == 'حجز':
-                rented_items_records = RentedItems.query.filter_by(rental_invoice_id=invoice.id).all()
+                rented_items_records = related['rented_items'].get(invoice.id, [])
 
                 rental_summary = {
                     'total_rented_items': len(rented_items_records),
@@ -1841,35 +1939,64 @@ class FilterReports(Resource):
             "employee": pr.employee.username if pr.employee else None
         } for pr in purchase_requests]
 
+    def _load_entity_item_relations(self, related_items, entity_column, entity_id, args):
+        """
+        Batch-load what the machine/mechanism item serializers show per item;
+        ``entity_column`` is Invoice.machine_id or Invoice.mechanism_id.
+        """
+        item_ids = [item.id for item in related_items]
+        invoice_items = []
+        transfer_items = []
+        for batch in chunked(item_ids):
+            invoice_items_query = InvoiceItem.query.join(Invoice).options(
+                selectinload(InvoiceItem.invoice)
+            ).filter(InvoiceItem.item_id.in_(batch), entity_column == entity_id)
+            if args["invoice_id"]:
+                invoice_items_query = invoice_items_query.filter(Invoice.id == args["invoice_id"])
+            invoice_items.extend(invoice_items_query.all())
+
+            transfer_items.extend(
+                InvoiceItem.query.join(Invoice).options(selectinload(InvoiceItem.invoice)).filter(
+                    Invoice.type == 'تحويل',
+                    entity_column == entity_id,
+                    InvoiceItem.item_id.in_(batch)
+                ).order_by(desc(Invoice.created_at)).all()
+            )
+
+        prices = fetch_in(Prices, Prices.item_id, item_ids)
+        return {
+            'locations': group_by(fetch_in(ItemLocations, ItemLocations.item_id, item_ids), lambda row: row.item_id),
+            'invoice_items': group_by(invoice_items, lambda row: row.item_id),
+            'transfer_items': group_by(transfer_items, lambda row: row.item_id),
+            'prices': group_by(prices, lambda row: row.item_id),
+            'prices_by_invoice': group_by(prices, lambda row: (row.invoice_id, row.item_id)),
+            # The entity's purchase invoices, checked for split layers of every item
+            'purchase_invoices': Invoice.query.filter(entity_column == entity_id, Invoice.type == 'اضافه').all(),
+            'suppliers': index_by(
+                fetch_in(Supplier, Supplier.id, [inv_item.supplier_id for inv_item in invoice_items]),
+                lambda row: row.id
+            ),
+        }
+
     def _serialize_items_for_machine(self, related_items, purchase_requests, machine, args):
         """Serialize items data for machine reports with invoice_id filtering"""
+        related = self._load_entity_item_relations(related_items, Invoice.machine_id, machine.id, args)
         serialized_items = []
         for item in related_items:
             # Get all locations for this item
             locations = [{
                 "location": loc.location,
                 "quantity": loc.quantity
-            } for loc in item.item_locations]
+            } for loc in related['locations'].get(item.id, [])]
             
             # Get this machine's purchase requests for this item
             machine_prs = [pr for pr in purchase_requests if pr.item_id == item.id]
             
             # Get all invoices for this item related to this machine
-            invoice_items_query = InvoiceItem.query.join(Invoice).filter(
-                and_(
-                    InvoiceItem.item_id == item.id,
-                    Invoice.machine_id == machine.id
-                )
-            )
-            
-            # Apply invoice_id filter if provided
-            if args["invoice_id"]:
-                invoice_items_query = invoice_items_query.filter(Invoice.id == args["invoice_id"])
-            
-            invoice_items = invoice_items_query.all()
+            invoice_items = related['invoice_items'].get(item.id, [])
             
             # UPDATED: Get pricing history with location information (filter by invoice_id if provided)
-            prices_query = item.prices
+            prices_query = related['prices'].get(item.id, [])
             if args["invoice_id"]:
                 prices = [price for price in prices_query if price.invoice_id == args["invoice_id"]]
             else:
@@ -1887,13 +2014,7 @@ class FilterReports(Resource):
             transfer_history = []
             
             # Find transfer invoices involving this item and this machine
-            transfer_invoice_items = InvoiceItem.query.join(Invoice).filter(
-                and_(
-                    Invoice.type == 'تحويل',
-                    Invoice.machine_id == machine.id,
-                    InvoiceItem.item_id == item.id
-                )
-            ).order_by(desc(Invoice.created_at)).all()
+            transfer_invoice_items = related['transfer_items'].get(item.id, [])
             
             for transfer_item in transfer_invoice_items:
                 if hasattr(transfer_item, 'new_location') and transfer_item.new_location:
@@ -1911,15 +2032,8 @@ class FilterReports(Resource):
             machine_price_splits = []
             
             # Find purchase invoices made by this machine that have been split
-            machine_purchase_invoices = Invoice.query.filter(
-                and_(
-                    Invoice.machine_id == machine.id,
-                    Invoice.type == 'اضافه'
-                )
-            ).all()
-            
-            for purchase_invoice in machine_purchase_invoices:
-                item_prices = [p for p in item.prices if p.invoice_id == purchase_invoice.id]
+            for purchase_invoice in related['purchase_invoices']:
+                item_prices = related['prices_by_invoice'].get((purchase_invoice.id, item.id), [])
                 if len(item_prices) > 1:  # This purchase has been split
                     machine_price_splits.append({
                         "purchase_invoice_id": purchase_invoice.id,
@@ -1940,7 +2054,7 @@ class FilterReports(Resource):
                 supplier_name = None
                 supplier_id = None
                 if hasattr(inv_item, 'supplier_id') and inv_item.supplier_id:
-                    supplier = Supplier.query.get(inv_item.supplier_id)
+                    supplier = related['suppliers'].get(inv_item.supplier_id)
                     if supplier:
                         supplier_name = supplier.name
                         supplier_id = supplier.id
@@ -1959,10 +2073,7 @@ class FilterReports(Resource):
                 # NEW: For purchase invoices, check current location distribution
                 location_distribution = None
                 if inv_item.invoice.type == 'اضافه':
-                    current_price_records = Prices.query.filter_by(
-                        invoice_id=inv_item.invoice_id,
-                        item_id=item.id
-                    ).all()
+                    current_price_records = related['prices_by_invoice'].get((inv_item.invoice_id, item.id), [])
                     
                     if len(current_price_records) > 1:
                         location_distribution = {
@@ -1985,7 +2096,7 @@ class FilterReports(Resource):
                     "unit_price": inv_item.unit_price,
                     "total_price": inv_item.total_price,
                     "status": inv_item.invoice.status,
-                    "supplier_name": item.supplier_name,  # NEW: supplier information
+                    "supplier_name": supplier_name,  # NEW: supplier information
                     "supplier_id": supplier_id,      # NEW: supplier ID
                     "transfer_info": transfer_info,  # NEW: transfer information
                     "location_distribution": location_distribution,  # NEW: location distribution
@@ -2021,33 +2132,23 @@ class FilterReports(Resource):
 
     def _serialize_items_for_mechanism(self, related_items, purchase_requests, mechanism, args):
         """Serialize items data for mechanism reports with invoice_id filtering"""
+        related = self._load_entity_item_relations(related_items, Invoice.mechanism_id, mechanism.id, args)
         serialized_items = []
         for item in related_items:
             # Get all locations for this item
             locations = [{
                 "location": loc.location,
                 "quantity": loc.quantity
-            } for loc in item.item_locations]
+            } for loc in related['locations'].get(item.id, [])]
             
             # Get this mechanism's purchase requests for this item
             mechanism_prs = [pr for pr in purchase_requests if pr.item_id == item.id]
             
             # Get all invoices for this item related to this mechanism
-            invoice_items_query = InvoiceItem.query.join(Invoice).filter(
-                and_(
-                    InvoiceItem.item_id == item.id,
-                    Invoice.mechanism_id == mechanism.id
-                )
-            )
-            
-            # Apply invoice_id filter if provided
-            if args["invoice_id"]:
-                invoice_items_query = invoice_items_query.filter(Invoice.id == args["invoice_id"])
-            
-            invoice_items = invoice_items_query.all()
+            invoice_items = related['invoice_items'].get(item.id, [])
             
             # UPDATED: Get pricing history with location information (filter by invoice_id if provided)
-            prices_query = item.prices
+            prices_query = related['prices'].get(item.id, [])
             if args["invoice_id"]:
                 prices = [price for price in prices_query if price.invoice_id == args["invoice_id"]]
             else:
@@ -2065,13 +2166,7 @@ class FilterReports(Resource):
             transfer_history = []
             
             # Find transfer invoices involving this item and this mechanism
-            transfer_invoice_items = InvoiceItem.query.join(Invoice).filter(
-                and_(
-                    Invoice.type == 'تحويل',
-                    Invoice.mechanism_id == mechanism.id,
-                    InvoiceItem.item_id == item.id
-                )
-            ).order_by(desc(Invoice.created_at)).all()
+            transfer_invoice_items = related['transfer_items'].get(item.id, [])
             
             for transfer_item in transfer_invoice_items:
                 if hasattr(transfer_item, 'new_location') and transfer_item.new_location:
@@ -2089,15 +2184,8 @@ class FilterReports(Resource):
             mechanism_price_splits = []
             
             # Find purchase invoices made by this mechanism that have been split
-            mechanism_purchase_invoices = Invoice.query.filter(
-                and_(
-                    Invoice.mechanism_id == mechanism.id,
-                    Invoice.type == 'اضافه'
-                )
-            ).all()
-            
-            for purchase_invoice in mechanism_purchase_invoices:
-                item_prices = [p for p in item.prices if p.invoice_id == purchase_invoice.id]
+            for purchase_invoice in related['purchase_invoices']:
+                item_prices = related['prices_by_invoice'].get((purchase_invoice.id, item.id), [])
                 if len(item_prices) > 1:  # This purchase has been split
                     mechanism_price_splits.append({
                         "purchase_invoice_id": purchase_invoice.id,
@@ -2118,7 +2206,7 @@ class FilterReports(Resource):
                 supplier_name = None
                 supplier_id = None
                 if hasattr(inv_item, 'supplier_id') and inv_item.supplier_id:
-                    supplier = Supplier.query.get(inv_item.supplier_id)
+                    supplier = related['suppliers'].get(inv_item.supplier_id)
                     if supplier:
                         supplier_name = supplier.name
                         supplier_id = supplier.id
@@ -2137,10 +2225,7 @@ class FilterReports(Resource):
                 # NEW: For purchase invoices, check current location distribution
                 location_distribution = None
                 if inv_item.invoice.type == 'اضافه':
-                    current_price_records = Prices.query.filter_by(
-                        invoice_id=inv_item.invoice_id,
-                        item_id=item.id
-                    ).all()
+                    current_price_records = related['prices_by_invoice'].get((inv_item.invoice_id, item.id), [])
                     
                     if len(current_price_records) > 1:
                         location_distribution = {
@@ -2163,7 +2248,7 @@ class FilterReports(Resource):
                     "unit_price": inv_item.unit_price,
                     "total_price": inv_item.total_price,
                     "status": inv_item.invoice.status,
-                    "supplier_name": item.supplier_name,  # NEW: supplier information
+                    "supplier_name": supplier_name,  # NEW: supplier information
                     "supplier_id": supplier_id,      # NEW: supplier ID
                     "transfer_info": transfer_info,  # NEW: transfer information
                     "location_distribution": location_distribution,  # NEW: location distribution
@@ -10,7 +10,7 @@ from .operations.sales import Sales_Operations, delete_sales, put_sales
 from .operations.warranty import Warranty_Operations, delete_warranty, put_warranty
 from .operations.void import Void_Operations, delete_void, put_void
 from .operations.rent import Rent_Operations, update_rental_status, borrow_from_rental_to_main, return_to_main_warehouse, delete_rental_invoice, put_rental, get_booking_deductions
-from .purchases.purchase import Purchase_Operations, delete_purchase, put_purchase
+from .purchases.purchase import Purchase_Operations, delete_purchase, put_purchase, reprice_sales_invoices
 from .operations.purchase_request import PurchaseRequest_Operations, put_purchase_request, delete_purchase_request
 from .warehouses.warehouse import warehouse_ns, item_location_ns
 from .machines.machine import machine_ns
@@ -18,12 +18,23 @@ from .mechanisms.mechanism import mechanism_ns
 from .suppliers.supplier import supplier_ns
 from .models import (
     Employee, Machine, Mechanism, Warehouse, ItemLocations, Invoice, InvoiceItem,
-    Supplier, Prices, InvoicePriceDetail, PurchaseRequests, ReturnSales, WarrantyReturn,
-    RentedItems, RentalWarehouseLocations,
+    Supplier, Prices, InvoicePriceDetail, PurchaseRequests, WarrantyReturn,
+    RentedItems, RentalWarehouseLocations, StockSummary,
 )
 from sqlalchemy import desc, exists, or_
 from sqlalchemy.exc import SQLAlchemyError
-from .utils import parse_bool
+from .utils import parse_bool, operation_result
+from .serializers import serialize_invoice, serialize_invoices, load_invoice_bundle, fetch_in, index_by, group_by
+from .fifo import restore
+from .pagination import add_cursor_arguments, count_rows, keyset_page, page_count
+from .permissions import allowed_invoice_types, current_permissions
+from .locking import retry_on_conflict
+from .lookups import preload_invoice_lookups, find_item, find_machine, find_mechanism
+from .transactions import operation_savepoint
+from .redis_config import cache_result, identity_scope
+from .etags import conditional_get
+from .jobs.job import JobFailed, enqueue, job_accepted, job_response, job_task, wants_async
+from werkzeug.exceptions import HTTPException
 
 invoice_ns = Namespace('invoice', description='Invoice operations')
 
@@ -45,6 +56,9 @@ pagination_parser.add_argument('all',
                                default=True, 
                                help='Get all invoices (default: True) \naccepts values [\'true\', \'false\', \'1\', \'0\', \'t\', \'f\', \'y\', \'n\', \'yes\', \'no\']')
 
+# Invoice listings also accept keyset cursors and a count mode
+list_parser = add_cursor_arguments(pagination_parser.copy())
+
 # Price Detail Model (for FIFO tracking)
 price_detail_model = invoice_ns.model('PriceDetail', {
     'source_invoice_id': fields.Integer(description='ID of the source invoice'),
@@ -94,6 +108,17 @@ invoice_model = invoice_ns.model('Invoice', {
     'suppliers_summary': fields.List(fields.String, description='List of unique suppliers used in this invoice')
 })
 
+# Batch creation payload: a list of regular invoice payloads
+invoice_batch_model = invoice_ns.model('InvoiceBatch', {
+    'invoices': fields.List(fields.Raw, required=True, description='Invoice payloads, same shape as POST /invoice/'),
+    'atomic': fields.Boolean(default=False, description='Roll back the whole batch when any invoice fails')
+})
+
+# Purchase price edit preview: new unit prices for some of the invoice's lines
+reprice_preview_model = invoice_ns.model('RepricePreview', {
+    'items': fields.List(fields.Raw, required=True, description='Lines with item_name, location and unit_price, as in PUT /invoice/<id>')
+})
+
 # Model for pagination
 pagination_model = invoice_ns.model('InvoicesPagination', {
     'invoices': fields.List(fields.Nested(invoice_model)),
@@ -101,49 +126,123 @@ pagination_model = invoice_ns.model('InvoicesPagination', {
     'page_size': fields.Integer(required=True),
     'total_pages': fields.Integer(required=True),
     'total_items': fields.Integer(required=True),
-    'all': fields.Boolean(required=True)
+    'all': fields.Boolean(required=True),
+    'next_cursor': fields.String(description='Cursor of the next page (cursor mode only)')
 })
 
 
 
-def filter_perms(user_id, query):
-    employee = Employee.query.filter_by(id=user_id).first()
-    
-    # Map permissions to invoice types
-    permission_map = {
-        'view_additions': 'اضافه',
-        'view_withdrawals': 'صرف', 
-        'view_returns': 'مرتجع',
-        'view_damages': 'توالف',
-        'view_deposits': 'امانات',
-        'view_reservations': 'حجز',
-        'view_purchase_requests': 'طلب شراء',
-        'view_transfers': 'تحويل',
-    }
-    
-    # Build conditions based on permissions
-    conditions = [
-        Invoice.type == invoice_type 
-        for perm, invoice_type in permission_map.items() 
-        if getattr(employee, perm, False)
-    ]
-    
+def filter_perms(query):
+    """Restrict an invoice query to the types the calling employee may view"""
+    invoice_types = allowed_invoice_types(current_permissions())
+
     # If no permissions, return empty query
-    if not conditions:
+    if not invoice_types:
         return query.filter(False)
-    
-    # Apply OR condition
-    return query.filter(or_(*conditions))
+
+    return query.filter(Invoice.type.in_(invoice_types))
+
+
+# Create operation for each invoice type
+CREATE_OPERATIONS = {
+    'صرف': Sales_Operations,
+    'اضافه': Purchase_Operations,
+    'أمانات': Warranty_Operations,
+    'مرتجع': Return_Operations,
+    'توالف': Void_Operations,
+    'حجز': Rent_Operations,
+    'طلب شراء': PurchaseRequest_Operations,
+    'تحويل': Transfer_Operations,
+}
+
+# Invoice types created without a machine and mechanism
+NO_MACHINE_TYPES = ('اضافه', 'تحويل')
+
+# Upper bound for the number of invoices accepted by /invoice/batch
+INVOICE_BATCH_LIMIT = 500
+
+
+def create_invoice(data, machine, mechanism, supplier, employee):
+    """Run the create operation for ``data['type']`` and return its operation_result"""
+    operation = CREATE_OPERATIONS.get(data.get('type'))
+    if operation is None:
+        return operation_result(400, "error", f"Invalid invoice type: {data.get('type')}")
+    return operation(data, machine, mechanism, supplier, employee, machine_ns, warehouse_ns, invoice_ns, mechanism_ns, item_location_ns, supplier_ns)
+
+
+def _batch_entry(index, result):
+    invoice = result.get("invoice")
+    return {
+        "index": index,
+        "status": result["status"],
+        "status_code": result["status_code"],
+        "message": result["message"],
+        "invoice_id": invoice.id if invoice is not None and result["status"] == "success" else None,
+    }
+
+
+@retry_on_conflict
+def process_invoice_batch(payloads, employee, atomic=False):
+    """
+    Create many invoices of mixed types in one transaction.
+
+    Items, their locations, machines, mechanisms and suppliers are resolved in
+    a few IN queries up front and every referenced item is locked once, in id
+    order. Each invoice then runs in its own savepoint: a failing invoice is
+    rolled back alone and reported, the rest are committed together. With
+    ``atomic`` the first failure rolls back the whole batch.
+
+    Returns an operation_result whose ``invoice`` field holds the per-invoice
+    results in payload order.
+    """
+    preload_invoice_lookups(payloads)
+
+    results = []
+    for index, data in enumerate(payloads):
+        with operation_savepoint() as savepoint:
+            try:
+                machine = mechanism = None
+                if data.get('type') not in NO_MACHINE_TYPES:
+                    machine = find_machine(data.get('machine_name'))
+                    mechanism = find_mechanism(data.get('mechanism_name'))
+                if data.get('type') not in NO_MACHINE_TYPES and (not machine or not mechanism):
+                    result = operation_result(404, "error", "Machine or Mechanism not found")
+                else:
+                    result = create_invoice(data, machine, mechanism, None, employee)
+            except HTTPException as e:
+                result = operation_result(e.code, "error", e.description)
+
+            if result["status"] == "error":
+                if savepoint.is_active:
+                    savepoint.rollback()
+            else:
+                savepoint.commit()
+        results.append(_batch_entry(index, result))
+
+        if atomic and result["status"] == "error":
+            db.session.rollback()
+            for entry in results[:-1]:
+                entry.update(status="error", status_code=424, invoice_id=None,
+                             message="Rolled back: another invoice in the batch failed")
+            return operation_result(result["status_code"], "error", f"Invoice {index} failed: {result['message']}", invoice=results)
+
+    db.session.commit()
+    failed = sum(1 for entry in results if entry["status"] == "error")
+    if failed:
+        return operation_result(207, "partial", f"{len(results) - failed} created, {failed} failed", invoice=results)
+    return operation_result(201, "success", f"{len(results)} created", invoice=results)
+
+
 @invoice_ns.route('/<string:type>')
 class invoices_get(Resource):
+    @conditional_get(tags=("invoices", "machines", "mechanisms", "suppliers", "warehouses", "employees", "return_sales"), scope=identity_scope)
     @invoice_ns.marshal_list_with(pagination_model)
     @jwt_required()
-    @invoice_ns.expect(pagination_parser)
+    @invoice_ns.expect(list_parser)
     def get(self, type):
         """Get invoices by type or status"""
         
-        current_user_id = get_jwt_identity()
-        args = pagination_parser.parse_args()
+        args = list_parser.parse_args()
         page = int(args['page'])
         page_size = int(args['page_size'])
         all_results = bool(args['all'])
@@ -159,135 +258,46 @@ class invoices_get(Resource):
         if type == "لم-تؤكد":
             # Draft status invoices
             query = query.filter_by(status="accreditation")
-            query = filter_perms(current_user_id, query)
+            query = filter_perms(query)
         elif type == "لم-تراجع":
             # Accreditation status invoices
             query = query.filter_by(status="draft")
-            query = filter_perms(current_user_id, query)
+            query = filter_perms(query)
         elif type == "تم":
             # Confirmed status invoices
             query = query.filter_by(status="confirmed")
-            query = filter_perms(current_user_id, query)
+            query = filter_perms(query)
         elif type == "صفرية":
             # Zero amount invoices (total_amount = 0)
             query = query.filter(exists().where(
                 (Prices.invoice_id == Invoice.id) & 
                 (Prices.unit_price == 0)
             ))
-            query = filter_perms(current_user_id, query)
+            query = filter_perms(query)
         else:
             # Regular invoice type filtering
             query = query.filter_by(type=type)
             
         # Applying pagination
-        if not all_results:
+        next_cursor = None
+        if args['cursor'] is not None:
+            invoices, next_cursor = keyset_page(query, Invoice.id, args['cursor'], page_size)
+        elif not all_results:
             invoices = query.limit(page_size).offset(offset).all()
         else:
             invoices = query.all()
-        total_count = query.count()
+        total_count = count_rows(query, args['count'], Invoice)
         
-        result = []
-        for invoice in invoices:
-            # Fetch related machine, mechanism (no more invoice-level supplier)
-            machine = Machine.query.get(invoice.machine_id) if invoice.machine_id else None
-            mechanism = Mechanism.query.get(invoice.mechanism_id) if invoice.mechanism_id else None
+        result = serialize_invoices(invoices)
 
-            # Fetch related items data
-            items = InvoiceItem.query.filter_by(invoice_id=invoice.id).all()
-            
-            # Prepare items with price details for FIFO transactions and supplier info
-            item_list = []
-            suppliers_used = set()  # Track unique suppliers for summary
-            
-            for item in items:
-                # Get price details if this is a sales or void or warranty type invoice (FIFO consumer)
-                price_details = []
-                if invoice.type in ['صرف', 'توالف', 'أمانات']:
-                    details = InvoicePriceDetail.query.filter_by(
-                        invoice_id=invoice.id,
-                        item_id=item.item_id
-                    ).all()
-                    
-                    for detail in details:
-                        # Get source invoice information
-                        source_invoice = Invoice.query.get(detail.source_price_invoice_id)
-                        price_details.append({
-                            'source_invoice_id': detail.source_price_invoice_id,
-                            'source_price_invoice_id': detail.source_price_invoice_id,
-                            'source_price_item_id': detail.source_price_item_id,
-                            'quantity': detail.quantity,
-                            'unit_price': detail.unit_price,
-                            'subtotal': detail.subtotal
-                        })
-                
-                # Get supplier information for this item
-                supplier_name = None
-                supplier_id = None
-                if hasattr(item, 'supplier_id') and item.supplier_id:
-                    supplier = Supplier.query.get(item.supplier_id)
-                    if supplier:
-                        supplier_name = supplier.name
-                        supplier_id = supplier.id
-                        suppliers_used.add(supplier_name)
-                elif hasattr(item, 'supplier_name') and item.supplier_name:
-                    supplier_name = item.supplier_name
-                    suppliers_used.add(supplier_name)
-                
-                item_data = {
-                    "item_name": Warehouse.query.get(item.item_id).item_name,
-                    "barcode": Warehouse.query.get(item.item_id).item_bar,
-                    "quantity": item.quantity,
-                    "location": item.location,
-                    "total_price": item.total_price,
-                    'unit_price': item.unit_price,
-                    "description": item.description,
-                    "supplier_name": item.supplier_name,  # NEW: supplier per item
-                    "supplier_id": supplier_id,      # NEW: supplier ID per item
-                    "new_location": item.new_location
-                }
-                
-                # Add price details if they exist
-                if price_details:
-                    item_data['price_details'] = price_details
-                item_list.append(item_data)
-            
-            # Serialize the invoice with related data
-            invoice_data = {
-                "id": invoice.id,
-                "type": invoice.type,
-                "client_name": invoice.client_name,
-                "warehouse_manager": invoice.warehouse_manager,
-                'accreditation_manager': invoice.accreditation_manager,
-                "total_amount": invoice.total_amount,
-                'paid': invoice.paid,
-                'residual': invoice.residual,
-                'comment': invoice.comment,
-                'status': invoice.status,
-                "employee_name": invoice.employee_name,
-                "machine_name": machine.name if machine else None,
-                "mechanism_name": mechanism.name if mechanism else None,
-                # Remove supplier_name from invoice level
-                "created_at": invoice.created_at,
-                "payment_method": invoice.payment_method,
-                "custody_person": invoice.custody_person,
-                "items": item_list,
-                "suppliers_summary": list(suppliers_used)  # NEW: Summary of suppliers used
-            }
-            
-            # Add original invoice ID for returned sales
-            if invoice.type == 'مرتجع':
-                return_sales_record = ReturnSales.query.filter_by(return_invoice_id=invoice.id).first()
-                if return_sales_record:
-                    invoice_data['original_invoice_id'] = return_sales_record.sales_invoice_id
-            result.append(invoice_data)
-            
         final_result = {
             'invoices': result,
-            'page': page,
+            'page': page if args['cursor'] is None else None,
             'page_size': page_size,
-            'total_pages': (total_count + page_size - 1) // page_size,
+            'total_pages': page_count(total_count, page_size),
             'total_items': total_count,
-            'all': all_results 
+            'all': all_results if args['cursor'] is None else False,
+            'next_cursor': next_cursor
         }
         return final_result
 
@@ -295,12 +305,13 @@ class invoices_get(Resource):
 # Invoice Endpoints
 @invoice_ns.route('/')
 class InvoiceList(Resource):
+    @conditional_get(tags=("invoices", "machines", "mechanisms", "suppliers", "warehouses", "employees", "return_sales"), scope=identity_scope)
     @invoice_ns.marshal_list_with(pagination_model)
-    @invoice_ns.expect(pagination_parser)
+    @invoice_ns.expect(list_parser)
     @jwt_required()
     def get(self):
         """Get all invoices with related machine, mechanism, and item data"""
-        args = pagination_parser.parse_args()
+        args = list_parser.parse_args()
         page = int(args['page'])
         page_size = int(args['page_size'])
         all_results = bool(args['all'])
@@ -310,109 +321,26 @@ class InvoiceList(Resource):
         offset = (page - 1) * page_size
         # Fetch all invoices
         query = Invoice.query
-        if not all_results:
+        next_cursor = None
+        if args['cursor'] is not None:
+            invoices, next_cursor = keyset_page(query, Invoice.id, args['cursor'], page_size)
+        elif not all_results:
             invoices = query.limit(page_size).offset(offset).all()
         else: 
             invoices = query.all()
-        total_count = query.count()
-
-        # Prepare the response data
-        result = []
-        for invoice in invoices:
-            # Fetch related machine, mechanism (no more invoice-level supplier)
-            machine = Machine.query.get(invoice.machine_id) if invoice.machine_id else None
-            mechanism = Mechanism.query.get(invoice.mechanism_id) if invoice.mechanism_id else None
+        total_count = count_rows(query, args['count'], Invoice)
 
-            # Fetch related items data
-            items = InvoiceItem.query.filter_by(invoice_id=invoice.id).all()
-            
-            # Prepare items with price details for FIFO transactions and supplier info
-            item_list = []
-            suppliers_used = set()  # Track unique suppliers for summary
-            
-            for item in items:
-                # Get price details if this is a sales or void or warranty type invoice (FIFO consumer)
-                price_details = []
-                if invoice.type in ['صرف', 'توالف', 'أمانات']:
-                    details = InvoicePriceDetail.query.filter_by(
-                        invoice_id=invoice.id,
-                        item_id=item.item_id
-                    ).all()
-                    
-                    for detail in details:
-                        # Get source invoice information
-                        price_details.append({
-                            'source_invoice_id': detail.source_price_invoice_id,
-                            'source_price_invoice_id': detail.source_price_invoice_id,
-                            'source_price_item_id': detail.source_price_item_id,
-                            'quantity': detail.quantity,
-                            'unit_price': detail.unit_price,
-                            'subtotal': detail.subtotal
-                        })
-
-                # Get supplier information for this item
-                supplier_name = None
-                supplier_id = None
-                if hasattr(item, 'supplier_id') and item.supplier_id:
-                    supplier = Supplier.query.get(item.supplier_id)
-                    if supplier:
-                        supplier_name = supplier.name
-                        supplier_id = supplier.id
-                        suppliers_used.add(supplier_name)
-                elif hasattr(item, 'supplier_name') and item.supplier_name:
-                    supplier_name = item.supplier_name
-                    suppliers_used.add(supplier_name)
-
-                item_data = {
-                    "item_name": Warehouse.query.get(item.item_id).item_name,
-                    "barcode": Warehouse.query.get(item.item_id).item_bar,
-                    "quantity": item.quantity,
-                    "location": item.location,
-                    "total_price": item.total_price,
-                    'unit_price': item.unit_price,
-                    "description": item.description,
-                    "supplier_name": item.supplier_name,  # NEW: supplier per item
-                    "supplier_id": supplier_id,      # NEW: supplier ID per item\
-                    "new_location": item.new_location
-                }
-                
-                # Add price details if they exist
-                if price_details:
-                    item_data['price_details'] = price_details
-                    
-                item_list.append(item_data)
-            
-            # Serialize the invoice with related data
-            invoice_data = {
-                "id": invoice.id,
-                "type": invoice.type,
-                "client_name": invoice.client_name,
-                "warehouse_manager": invoice.warehouse_manager,
-                "accreditation_manager": invoice.accreditation_manager,
-                "total_amount": invoice.total_amount,
-                'paid': invoice.paid,
-                'residual': invoice.residual,
-                'comment': invoice.comment,
-                'status': invoice.status,
-                "employee_name": invoice.employee_name,
-                "machine_name": machine.name if machine else None,
-                "mechanism_name": mechanism.name if mechanism else None,
-                # Remove supplier_name from invoice level
-                "created_at": invoice.created_at,
-                "custody_person": invoice.custody_person,
-                "payment_method": invoice.payment_method,
-                "items": item_list,
-                "suppliers_summary": list(suppliers_used)  # NEW: Summary of suppliers used
-            }
-            result.append(invoice_data)
+        # Prepare the response data with a fixed number of batched queries
+        result = serialize_invoices(invoices)
 
         return {
             'invoices': result,
-            'page': page,
+            'page': page if args['cursor'] is None else None,
             'page_size': page_size,
-            'total_pages': (total_count + page_size - 1) // page_size,
+            'total_pages': page_count(total_count, page_size),
             'total_items': total_count,
-            'all': all_results 
+            'all': all_results if args['cursor'] is None else False,
+            'next_cursor': next_cursor
         }, 200
 
     @invoice_ns.marshal_with(invoice_model)
@@ -426,8 +354,8 @@ class InvoiceList(Resource):
         employee = Employee.query.filter_by(id=employee_id).first()  # Get the Employee object
         if data['type'] not in ['اضافه', 'تحويل']:
         # Get the machine and mechanism by name
-            machine = Machine.query.filter_by(name=data['machine_name']).first()  # Get the Machine object
-            mechanism = Mechanism.query.filter_by(name=data['mechanism_name']).first()  # Get the Mechanism object
+            machine = find_machine(data['machine_name'])  # Cached Machine snapshot
+            mechanism = find_mechanism(data['mechanism_name'])  # Cached Mechanism snapshot
             if not machine or not mechanism:
                 invoice_ns.abort(404, "Machine or Mechanism not found")
         else:
@@ -447,25 +375,7 @@ class InvoiceList(Resource):
         #     invoice_ns.abort(404, "Supplier is required for purchase invoices")
 
         # Create the invoice based on its type
-        result = None
-        if data['type'] == 'صرف':
-            result = Sales_Operations(data, machine, mechanism, supplier, employee, machine_ns, warehouse_ns, invoice_ns, mechanism_ns, item_location_ns, supplier_ns)
-        elif data['type'] == 'اضافه':
-            result = Purchase_Operations(data, machine, mechanism, supplier, employee, machine_ns, warehouse_ns, invoice_ns, mechanism_ns, item_location_ns, supplier_ns)
-        elif data['type'] == 'أمانات':
-            result = Warranty_Operations(data, machine, mechanism, supplier, employee, machine_ns, warehouse_ns, invoice_ns, mechanism_ns, item_location_ns, supplier_ns)
-        elif data['type'] == 'مرتجع':
-            result = Return_Operations(data, machine, mechanism, supplier, employee, machine_ns, warehouse_ns, invoice_ns, mechanism_ns, item_location_ns, supplier_ns)
-        elif data['type'] == 'توالف':
-            result = Void_Operations(data, machine, mechanism, supplier, employee, machine_ns, warehouse_ns, invoice_ns, mechanism_ns, item_location_ns, supplier_ns)
-        elif data['type'] == 'حجز':
-            result = Rent_Operations(data, machine, mechanism, supplier, employee, machine_ns, warehouse_ns, invoice_ns, mechanism_ns, item_location_ns, supplier_ns)
-        elif data['type'] == 'طلب شراء':
-            result = PurchaseRequest_Operations(data, machine, mechanism, supplier, employee, machine_ns, warehouse_ns, invoice_ns, mechanism_ns, item_location_ns, supplier_ns)
-        elif data['type'] == 'تحويل':
-            result = Transfer_Operations(data, machine, mechanism, supplier, employee, machine_ns, warehouse_ns, invoice_ns, mechanism_ns, item_location_ns, supplier_ns)
-        else:
-            invoice_ns.abort(400, f"Invalid invoice type: {data['type']}")
+        result = create_invoice(data, machine, mechanism, supplier, employee)
             
     
         if result["status"] == "error":
@@ -475,110 +385,75 @@ class InvoiceList(Resource):
 
         return {"message": "Invoice created"}, 201
     
+@invoice_ns.route('/batch')
+class InvoiceBatch(Resource):
+    @invoice_ns.expect(invoice_batch_model)
+    @jwt_required()
+    def post(self):
+        """Create many invoices of mixed types in one request (per-invoice results)"""
+        data = invoice_ns.payload or {}
+        payloads = data.get('invoices') or []
+        if not payloads:
+            invoice_ns.abort(400, "No invoices provided")
+        if len(payloads) > INVOICE_BATCH_LIMIT:
+            invoice_ns.abort(400, f"A batch accepts at most {INVOICE_BATCH_LIMIT} invoices")
+
+        employee = Employee.query.filter_by(id=get_jwt_identity()).first()
+        result = process_invoice_batch(payloads, employee, atomic=bool(data.get('atomic', False)))
+
+        results = result["invoice"] or []
+        return {
+            "status": result["status"],
+            "message": result["message"],
+            "created": sum(1 for entry in results if entry["status"] == "success"),
+            "failed": sum(1 for entry in results if entry["status"] == "error"),
+            "results": results,
+        }, result["status_code"]
+
+
+@job_task('purchase_update')
+def purchase_update_job(payload, job):
+    """PUT of a purchase invoice run in the background"""
+    invoice = Invoice.query.get(payload['invoice_id'])
+    if invoice is None or invoice.type != 'اضافه':
+        raise JobFailed("Purchase invoice not found")
+    data = payload['data']
+    machine = find_machine(data["machine_name"])
+    mechanism = find_mechanism(data["mechanism_name"])
+    result = put_purchase(data, invoice, machine, mechanism, invoice_ns)
+    if type(result) == dict:
+        return job_response(result, result["status_code"])
+    return job_response(*result)
+
+
 @invoice_ns.route('/<int:invoice_id>')
 class InvoiceDetail(Resource):
+    @conditional_get(tags=("invoice:{invoice_id}", "invoice:*", "machines", "mechanisms", "suppliers", "warehouses", "return_sales"))
     @invoice_ns.marshal_with(invoice_model)
     @jwt_required()
     def get(self, invoice_id):
         """Get an invoice by ID"""
         invoice = Invoice.query.get_or_404(invoice_id)
-        
-        # Fetch related machine, mechanism (no more invoice-level supplier)
-        machine = Machine.query.get(invoice.machine_id) if invoice.machine_id else None
-        mechanism = Mechanism.query.get(invoice.mechanism_id) if invoice.mechanism_id else None
-        
-        # Fetch related items data
-        items = InvoiceItem.query.filter_by(invoice_id=invoice.id).all()
-        
-        # Prepare items with price details for FIFO transactions and supplier info
-        item_list = []
-        suppliers_used = set()  # Track unique suppliers for summary
-        
-        for item in items:
-            # Get price details if this is a sales or void or warranty type invoice (FIFO consumer)
-            price_details = []
-            if invoice.type in ['صرف', 'توالف', 'أمانات']:
-                details = InvoicePriceDetail.query.filter_by(
-                    invoice_id=invoice.id,
-                    item_id=item.item_id
-                ).all()
-                
-                for detail in details:
-                    # Get source invoice information
-                    price_details.append({
-                        'source_invoice_id': detail.source_price_invoice_id,
-                        'source_price_invoice_id': detail.source_price_invoice_id,
-                        'source_price_item_id': detail.source_price_item_id,
-                        'quantity': detail.quantity,
-                        'unit_price': detail.unit_price,
-                        'subtotal': detail.subtotal
-                    })
-
-            # Get supplier information for this item
-            supplier_name = None
-            supplier_id = None
-            if hasattr(item, 'supplier_id') and item.supplier_id:
-                supplier = Supplier.query.get(item.supplier_id)
-                if supplier:
-                    supplier_name = supplier.name
-                    supplier_id = supplier.id
-                    suppliers_used.add(supplier_name)
-            elif hasattr(item, 'supplier_name') and item.supplier_name:
-                supplier_name = item.supplier_name
-                suppliers_used.add(supplier_name)
-
-            item_data = {
-                "item_name": Warehouse.query.get(item.item_id).item_name,
-                "barcode": Warehouse.query.get(item.item_id).item_bar,
-                "quantity": item.quantity,
-                "location": item.location,
-                "total_price": item.total_price,
-                'unit_price': item.unit_price,
-                "description": item.description,
-                "supplier_name": item.supplier_name,  # NEW: supplier per item
-                "supplier_id": supplier_id,      # NEW: supplier ID per item
-            }
-            
-            # Add price details if they exist
-            if price_details:
-                item_data['price_details'] = price_details
-                
-            item_list.append(item_data)
-        
-        # Serialize the invoice with related data
-        invoice_data = {
-            "id": invoice.id,
-            "type": invoice.type,
-            "client_name": invoice.client_name,
-            "warehouse_manager": invoice.warehouse_manager,
-            "accreditation_manager": invoice.accreditation_manager,
-            "total_amount": invoice.total_amount,
-            'paid': invoice.paid,
-            'residual': invoice.residual,
-            'comment': invoice.comment,
-            'status': invoice.status,
-            "employee_name": invoice.employee_name,
-            "machine_name": machine.name if machine else None,
-            "mechanism_name": mechanism.name if mechanism else None,
-            # Remove supplier_name from invoice level
-            "created_at": invoice.created_at,
-            "payment_method": invoice.payment_method,
-            "custody_person": invoice.custody_person,
-            "items": item_list,
-            "suppliers_summary": list(suppliers_used)  # NEW: Summary of suppliers used
-        }
-        return invoice_data
+        return serialize_invoice(invoice, load_invoice_bundle([invoice]))
 
     # @invoice_ns.marshal_with(invoice_model)
     @jwt_required()
     def put(self, invoice_id):
-        """Update an invoice"""
+        """
+        Update an invoice. Purchase updates, which recalculate the sales
+        invoices fed by the changed prices, accept ?async=true to run as a
+        background job (202 with the job id, see /jobs/<job_id>).
+        """
         data = invoice_ns.payload
         invoice = Invoice.query.get_or_404(invoice_id)
+
+        if invoice.type == 'اضافه' and wants_async():
+            job_id = enqueue('purchase_update', {'invoice_id': invoice.id, 'data': data}, get_jwt_identity())
+            return job_accepted(job_id)
         
         # Fetch the machine and mechanism by name
-        machine = Machine.query.filter_by(name=data["machine_name"]).first()
-        mechanism = Mechanism.query.filter_by(name=data["mechanism_name"]).first()
+        machine = find_machine(data["machine_name"])
+        mechanism = find_mechanism(data["mechanism_name"])
         supplier = None
         
         # Get supplier if name provided
@@ -680,6 +555,34 @@ class ConfirmInvoice(Resource):
         return {"message": f"Invoice status updated to '{invoice.status}'"}, 200
 
 
+@invoice_ns.route('/<int:invoice_id>/reprice-preview')
+class RepricePreview(Resource):
+    @invoice_ns.expect(reprice_preview_model)
+    @jwt_required()
+    def post(self, invoice_id):
+        """
+        Dry run of a purchase price edit: the invoices that consumed the changed
+        price layers, with their current and repriced totals. Nothing is written.
+        """
+        invoice = Invoice.query.get_or_404(invoice_id)
+        if invoice.type != 'اضافه':
+            invoice_ns.abort(400, "Only purchase invoices can be repriced")
+
+        current_prices = {(price.item_id, price.location): price.unit_price for price in invoice.prices}
+        new_prices = {}
+        for item_data in invoice_ns.payload['items']:
+            if not item_data.get('item_name') or not item_data.get('location') or item_data.get('unit_price') is None:
+                invoice_ns.abort(400, "Each line needs item_name, location and unit_price")
+            warehouse_item = find_item(item_data['item_name'])
+            if not warehouse_item:
+                invoice_ns.abort(404, f"Item '{item_data['item_name']}' not found in warehouse")
+            key = (warehouse_item.id, item_data['location'])
+            if key in current_prices and current_prices[key] != float(item_data['unit_price']):
+                new_prices[key] = float(item_data['unit_price'])
+
+        return reprice_sales_invoices(invoice.id, new_prices, dry_run=True), 200
+
+
 @invoice_ns.route('/fifo-prices/<int:item_id>')
 class FifoPriceList(Resource):
     @jwt_required()
@@ -690,12 +593,16 @@ class FifoPriceList(Resource):
         
         # Get all price records for this item ordered by creation date (oldest first for FIFO)
         price_entries = Prices.query.filter_by(item_id=item_id).order_by(Prices.invoice_id.asc()).all()
+        source_invoices = index_by(
+            fetch_in(Invoice, Invoice.id, [price.invoice_id for price in price_entries if price.quantity > 0]),
+            lambda row: row.id
+        )
         
         result = []
         for price in price_entries:
             if price.quantity > 0:  # Only include records with positive quantity
                 # Get source invoice information
-                source_invoice = Invoice.query.get(price.invoice_id)
+                source_invoice = source_invoices.get(price.invoice_id)
                 
                 result.append({
                     'price_id': price.invoice_id,  # This is actually a composite primary key
@@ -755,38 +662,7 @@ class ReturnWarranty(Resource):
             invoice_ns.abort(400, "Cannot do full return - some items have been partially returned. Use partial return for remaining items.")
 
         # Existing full return logic
-        price_details = InvoicePriceDetail.query.filter_by(invoice_id=invoice.id).all()
-        price_restorations = {}
-        
-        for detail in price_details:
-            key = (detail.source_price_invoice_id, detail.source_price_item_id)
-            if key in price_restorations:
-                price_restorations[key]['quantity'] += detail.quantity
-            else:
-                price_restorations[key] = {
-                    'invoice_id': detail.source_price_invoice_id,
-                    'item_id': detail.source_price_item_id,
-                    'quantity': detail.quantity,
-                    'unit_price': detail.unit_price
-                }
-        
-        for key, restoration in price_restorations.items():
-            price_entry = Prices.query.filter_by(
-                invoice_id=restoration['invoice_id'],
-                item_id=restoration['item_id']
-            ).first()
-            
-            if price_entry:
-                price_entry.quantity += restoration['quantity']
-            else:
-                new_price = Prices(
-                    invoice_id=restoration['invoice_id'],
-                    item_id=restoration['item_id'],
-                    quantity=restoration['quantity'],
-                    unit_price=restoration['unit_price'],
-                    created_at=datetime.now()
-                )
-                db.session.add(new_price)
+        restore(InvoicePriceDetail.query.filter_by(invoice_id=invoice.id).all())
 
         # Restore quantities for each item
         for invoice_item in invoice.items:
@@ -896,25 +772,7 @@ class ReturnWarranty(Resource):
             proportion = quantity_to_return / total_original_quantity
 
             # Restore proportional prices
-            for detail in price_details_to_restore:
-                quantity_to_restore = int(detail.quantity * proportion)
-                if quantity_to_restore > 0:
-                    price_entry = Prices.query.filter_by(
-                        invoice_id=detail.source_price_invoice_id,
-                        item_id=detail.source_price_item_id
-                    ).first()
-                    
-                    if price_entry:
-                        price_entry.quantity += quantity_to_restore
-                    else:
-                        new_price = Prices(
-                            invoice_id=detail.source_price_invoice_id,
-                            item_id=detail.source_price_item_id,
-                            quantity=quantity_to_restore,
-                            unit_price=detail.unit_price,
-                            created_at=datetime.now()
-                        )
-                        db.session.add(new_price)
+            restore(price_details_to_restore, proportion=proportion)
 
             # Restore stock in ItemLocations
             item_location = ItemLocations.query.filter_by(
@@ -1087,6 +945,7 @@ class PurchaseRequestConfirmation(Resource):
 class InventoryValue(Resource):
     @invoice_ns.expect(pagination_parser)
     @jwt_required()
+    @cache_result(timeout=300, key_prefix="inventory_value", tags=("warehouses", "prices"), single_flight=True)
     def get(self):
         """Get total inventory value based on FIFO pricing (updated with location support)"""
         # Calculate inventory value by item
@@ -1105,34 +964,32 @@ class InventoryValue(Resource):
         total_count = query.count()
         inventory_value = 0
         item_values = []
+
+        # One indexed query on the stock summary instead of every price layer per item
+        summaries = group_by(
+            fetch_in(StockSummary, StockSummary.item_id, [item.id for item in items]),
+            lambda row: row.item_id
+        )
         
         for item in items:
-            # Get all price records for this item (now with locations)
-            price_entries = Prices.query.filter_by(item_id=item.id).all()
+            rows = summaries.get(item.id, [])
             
-            # Calculate value for this item across all locations
-            item_value = sum(price.quantity * price.unit_price for price in price_entries if price.quantity > 0)
+            # Value and quantity for this item across all locations
+            item_value = sum(row.fifo_value for row in rows)
             inventory_value += item_value
-            
-            # Get total quantity for this item across all locations
-            total_quantity = sum(loc.quantity for loc in item.item_locations)
+            total_quantity = sum(row.on_hand_quantity for row in rows)
             
             # Get location breakdown with pricing
             location_breakdown = []
-            for loc in item.item_locations:
-                if loc.quantity > 0:
-                    # Get price records for this specific location
-                    location_prices = [p for p in price_entries if p.location == loc.location and p.quantity > 0]
-                    location_value = sum(p.quantity * p.unit_price for p in location_prices)
-                    priced_quantity = sum(p.quantity for p in location_prices)
-                    
+            for row in rows:
+                if row.on_hand_quantity > 0:
                     location_breakdown.append({
-                        'location': loc.location,
-                        'physical_quantity': loc.quantity,
-                        'priced_quantity': priced_quantity,
-                        'value': location_value,
-                        'average_unit_price': location_value / priced_quantity if priced_quantity > 0 else 0,
-                        'quantity_discrepancy': loc.quantity - priced_quantity
+                        'location': row.location,
+                        'physical_quantity': row.on_hand_quantity,
+                        'priced_quantity': row.fifo_quantity,
+                        'value': row.fifo_value,
+                        'average_unit_price': row.fifo_value / row.fifo_quantity if row.fifo_quantity > 0 else 0,
+                        'quantity_discrepancy': row.on_hand_quantity - row.fifo_quantity
                     })
             
             # Add item details to the result
@@ -1142,7 +999,7 @@ class InventoryValue(Resource):
                     'item_name': item.item_name,
                     'item_bar': item.item_bar,
                     'total_physical_quantity': total_quantity,
-                    'total_priced_quantity': sum(p.quantity for p in price_entries if p.quantity > 0),
+                    'total_priced_quantity': sum(row.fifo_quantity for row in rows),
                     'value': item_value,
                     'average_unit_value': item_value / total_quantity if total_quantity > 0 else 0,
                     'location_breakdown': location_breakdown
@@ -1195,17 +1052,33 @@ class PriceTrackingReport(Resource):
         # FIXED: Get unique items using proper deduplication
         items = self.get_items_simple_dedup(invoice.id)
 
+        # Load warehouse rows, locations, price details and source invoices in batches
+        item_ids = [item.item_id for item in items]
+        warehouse_items = index_by(fetch_in(Warehouse, Warehouse.id, item_ids), lambda row: row.id)
+        locations_by_item = group_by(
+            fetch_in(ItemLocations, ItemLocations.item_id, item_ids),
+            lambda row: row.item_id
+        )
+        details_by_item = group_by(
+            InvoicePriceDetail.query.filter_by(invoice_id=invoice.id).all(),
+            lambda row: row.item_id
+        )
+        source_invoices = index_by(
+            fetch_in(Invoice, Invoice.id, [
+                detail.source_price_invoice_id
+                for details in details_by_item.values() for detail in details
+            ]),
+            lambda row: row.id
+        )
+
         # Prepare detailed item reports
         item_reports = []
         for item in items:
-            warehouse_item = Warehouse.query.get(item.item_id)
-            locations = ItemLocations.query.filter_by(item_id=item.item_id).all()
+            warehouse_item = warehouse_items[item.item_id]
+            locations = locations_by_item.get(item.item_id, [])
             
             # Get price details for this item
-            price_details = InvoicePriceDetail.query.filter_by(
-                invoice_id=invoice.id,
-                item_id=item.item_id
-            ).all()
+            price_details = details_by_item.get(item.item_id, [])
             
             # GROUP price details by source invoice to consolidate duplicates
             source_invoice_groups = {}
@@ -1228,7 +1101,7 @@ class PriceTrackingReport(Resource):
             price_breakdowns = []
             for source_invoice_id, group_data in source_invoice_groups.items():
                 # Get source invoice information (only once per group)
-                source_invoice = Invoice.query.get(source_invoice_id)
+                source_invoice = source_invoices.get(source_invoice_id)
                 
                 # Create consolidated breakdown
                 breakdown = {
@@ -1379,6 +1252,7 @@ def get_items_simple_dedup(invoice_id):
 class FifoInventoryReport(Resource):
     @invoice_ns.expect(pagination_parser)
     @jwt_required()
+    @cache_result(timeout=300, key_prefix="fifo_report", tags=("warehouses", "prices", "invoices"), single_flight=True)
     def get(self):
         """Get comprehensive FIFO inventory report with price tracking (updated with location support)"""
         # Get all warehouse items
@@ -1402,80 +1276,58 @@ class FifoInventoryReport(Resource):
         total_inventory_value = 0
         total_inventory_quantity = 0
         
+        # Totals come from the stock summary; only open layers are loaded for the breakdown
+        item_ids = [item.id for item in items]
+        summaries = group_by(
+            fetch_in(StockSummary, StockSummary.item_id, item_ids),
+            lambda row: row.item_id
+        )
+        open_price_layers = sorted(
+            fetch_in(Prices, Prices.item_id, item_ids, Prices.quantity > 0),
+            key=lambda price: (price.location, price.invoice_id)
+        )
+        layers_by_location = group_by(open_price_layers, lambda price: (price.item_id, price.location))
+        source_invoices = index_by(
+            fetch_in(Invoice, Invoice.id, [price.invoice_id for price in open_price_layers]),
+            lambda row: row.id
+        )
+        
         for item in items:
-            # Get price records for this item (now includes location)
-            price_entries = Prices.query.filter_by(item_id=item.id).order_by(
-                Prices.location.asc(), 
-                Prices.invoice_id.asc()
-            ).all()
+            rows = summaries.get(item.id, [])
+            physical_inventory = sum(row.on_hand_quantity for row in rows)
+            priced_inventory = sum(row.fifo_quantity for row in rows)
+            item_value = sum(row.fifo_value for row in rows)
             
-            # Get physical inventory
-            locations = ItemLocations.query.filter_by(item_id=item.id).all()
-            physical_inventory = sum(loc.quantity for loc in locations)
-            
-            # Calculate priced inventory and value by location
-            location_price_layers = {}
-            priced_inventory = 0
-            item_value = 0
+            # Skip items with no inventory
+            if physical_inventory == 0 and priced_inventory == 0:
+                continue
             
-            for price in price_entries:
-                if price.quantity > 0:
-                    source_invoice = Invoice.query.get(price.invoice_id)
-                    layer_value = price.quantity * price.unit_price
-                    
-                    if price.location not in location_price_layers:
-                        location_price_layers[price.location] = {
-                            'location': price.location,
-                            'price_layers': [],
-                            'total_priced_quantity': 0,
-                            'total_value': 0,
-                            'physical_quantity': 0
-                        }
-                    
-                    layer = {
+            location_breakdown = []
+            for row in sorted(rows, key=lambda row: row.location):
+                if row.fifo_quantity <= 0 and row.on_hand_quantity <= 0:
+                    continue
+                
+                price_layers = []
+                for price in layers_by_location.get((item.id, row.location), []):
+                    source_invoice = source_invoices.get(price.invoice_id)
+                    price_layers.append({
                         'invoice_id': price.invoice_id,
                         'invoice_type': source_invoice.type if source_invoice else 'Unknown',
                         'date': price.created_at.strftime('%Y-%m-%d %H:%M:%S'),
                         'quantity': price.quantity,
                         'unit_price': price.unit_price,
-                        'layer_value': layer_value
-                    }
-                    
-                    location_price_layers[price.location]['price_layers'].append(layer)
-                    location_price_layers[price.location]['total_priced_quantity'] += price.quantity
-                    location_price_layers[price.location]['total_value'] += layer_value
-                    
-                    priced_inventory += price.quantity
-                    item_value += layer_value
-            
-            # Add physical quantities to location data
-            for location_obj in locations:
-                if location_obj.location in location_price_layers:
-                    location_price_layers[location_obj.location]['physical_quantity'] = location_obj.quantity
-                elif location_obj.quantity > 0:
-                    # Location has physical inventory but no price records
-                    location_price_layers[location_obj.location] = {
-                        'location': location_obj.location,
-                        'price_layers': [],
-                        'total_priced_quantity': 0,
-                        'total_value': 0,
-                        'physical_quantity': location_obj.quantity
-                    }
-            
-            # Calculate discrepancies per location
-            for loc_data in location_price_layers.values():
-                loc_data['quantity_discrepancy'] = loc_data['physical_quantity'] - loc_data['total_priced_quantity']
-                loc_data['average_unit_price'] = (
-                    loc_data['total_value'] / loc_data['total_priced_quantity'] 
-                    if loc_data['total_priced_quantity'] > 0 else 0
-                )
-            
-            # Calculate overall discrepancies
-            inventory_discrepancy = physical_inventory - priced_inventory
-            
-            # Skip items with no inventory
-            if physical_inventory == 0 and priced_inventory == 0:
-                continue
+                        'layer_value': price.quantity * price.unit_price
+                    })
+                
+                location_breakdown.append({
+                    'location': row.location,
+                    'price_layers': price_layers,
+                    'total_priced_quantity': row.fifo_quantity,
+                    'total_value': row.fifo_value,
+                    'physical_quantity': row.on_hand_quantity,
+                    'quantity_discrepancy': row.on_hand_quantity - row.fifo_quantity,
+                    'average_unit_price': row.fifo_value / row.fifo_quantity if row.fifo_quantity > 0 else 0
+                })
                 
             # Create the item report
             item_report = {
@@ -1484,10 +1336,10 @@ class FifoInventoryReport(Resource):
                 'item_bar': item.item_bar,
                 'physical_inventory': physical_inventory,
                 'priced_inventory': priced_inventory,
-                'inventory_discrepancy': inventory_discrepancy,
+                'inventory_discrepancy': physical_inventory - priced_inventory,
                 'total_value': item_value,
                 'average_unit_price': item_value / priced_inventory if priced_inventory > 0 else 0,
-                'location_breakdown': list(location_price_layers.values())
+                'location_breakdown': location_breakdown
             }
             
             item_reports.append(item_report)
@@ -1721,11 +1573,19 @@ class RentalItems(Resource):
         """Get all rented items with their status"""
         try:
             rented_items = RentedItems.query.all()
+            warehouse_items = index_by(
+                fetch_in(Warehouse, Warehouse.id, [item.item_id for item in rented_items]),
+                lambda row: row.id
+            )
+            invoices = index_by(
+                fetch_in(Invoice, Invoice.id, [item.rental_invoice_id for item in rented_items]),
+                lambda row: row.id
+            )
             result = []
             
             for item in rented_items:
-                warehouse_item = Warehouse.query.get(item.item_id)
-                invoice = Invoice.query.get(item.rental_invoice_id)
+                warehouse_item = warehouse_items.get(item.item_id)
+                invoice = invoices.get(item.rental_invoice_id)
                 
                 result.append({
                     'id': item.id,
@@ -1759,10 +1619,14 @@ class RentalWarehouse(Resource):
         """Get rental warehouse inventory"""
         try:
             rental_locations = RentalWarehouseLocations.query.all()
+            warehouse_items = index_by(
+                fetch_in(Warehouse, Warehouse.id, [location.item_id for location in rental_locations]),
+                lambda row: row.id
+            )
             result = []
             
             for location in rental_locations:
-                warehouse_item = Warehouse.query.get(location.item_id)
+                warehouse_item = warehouse_items.get(location.item_id)
                 
                 result.append({
                     'item_id': location.item_id,
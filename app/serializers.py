@@ -0,0 +1,175 @@
+from collections import defaultdict
+
+from .models import (
+    Machine, Mechanism, Warehouse, InvoiceItem, Supplier, InvoicePriceDetail,
+    ReturnSales,
+)
+
+# Invoice types that consume FIFO price layers and carry price details
+FIFO_CONSUMER_TYPES = ('صرف', 'توالف', 'أمانات')
+
+# Upper bound for the number of ids sent in a single IN (...) clause
+IN_BATCH_SIZE = 500
+
+
+def chunked(values, size=IN_BATCH_SIZE):
+    """Yield successive slices of ``values`` with at most ``size`` elements"""
+    values = list(values)
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def fetch_in(model, column, ids, *criteria):
+    """Load all rows of ``model`` whose ``column`` is in ``ids`` using batched IN queries"""
+    ids = {value for value in ids if value is not None}
+    rows = []
+    for batch in chunked(ids):
+        rows.extend(model.query.filter(column.in_(batch), *criteria).all())
+    return rows
+
+
+def index_by(rows, key):
+    """Map ``key(row)`` to row"""
+    return {key(row): row for row in rows}
+
+
+def group_by(rows, key):
+    """Map ``key(row)`` to the list of rows sharing that key (preserving order)"""
+    grouped = defaultdict(list)
+    for row in rows:
+        grouped[key(row)].append(row)
+    return grouped
+
+
+def load_invoice_bundle(invoices):
+    """
+    Load everything needed to serialize a page of invoices in a fixed number of queries.
+
+    Returns a dict of lookup maps keyed by primary key (or parent key for child rows),
+    regardless of how many invoices or items are on the page.
+    """
+    invoice_ids = [invoice.id for invoice in invoices]
+    consumer_ids = [invoice.id for invoice in invoices if invoice.type in FIFO_CONSUMER_TYPES]
+    return_ids = [invoice.id for invoice in invoices if invoice.type == 'مرتجع']
+
+    items = fetch_in(InvoiceItem, InvoiceItem.invoice_id, invoice_ids)
+    details = fetch_in(InvoicePriceDetail, InvoicePriceDetail.invoice_id, consumer_ids)
+
+    return {
+        'machines': index_by(
+            fetch_in(Machine, Machine.id, [invoice.machine_id for invoice in invoices]),
+            lambda row: row.id
+        ),
+        'mechanisms': index_by(
+            fetch_in(Mechanism, Mechanism.id, [invoice.mechanism_id for invoice in invoices]),
+            lambda row: row.id
+        ),
+        'items': group_by(items, lambda row: row.invoice_id),
+        'warehouses': index_by(
+            fetch_in(Warehouse, Warehouse.id, [item.item_id for item in items]),
+            lambda row: row.id
+        ),
+        'suppliers': index_by(
+            fetch_in(Supplier, Supplier.id, [item.supplier_id for item in items if item.supplier_id]),
+            lambda row: row.id
+        ),
+        'price_details': group_by(details, lambda row: (row.invoice_id, row.item_id)),
+        'return_sales': index_by(
+            fetch_in(ReturnSales, ReturnSales.return_invoice_id, return_ids),
+            lambda row: row.return_invoice_id
+        ),
+    }
+
+
+def serialize_price_detail(detail):
+    return {
+        'source_invoice_id': detail.source_price_invoice_id,
+        'source_price_invoice_id': detail.source_price_invoice_id,
+        'source_price_item_id': detail.source_price_item_id,
+        'quantity': detail.quantity,
+        'unit_price': detail.unit_price,
+        'subtotal': detail.subtotal
+    }
+
+
+def serialize_invoice_item(invoice, item, bundle, suppliers_used):
+    # Get supplier information for this item
+    supplier_id = None
+    if item.supplier_id:
+        supplier = bundle['suppliers'].get(item.supplier_id)
+        if supplier:
+            supplier_id = supplier.id
+            suppliers_used.add(supplier.name)
+    elif item.supplier_name:
+        suppliers_used.add(item.supplier_name)
+
+    warehouse_item = bundle['warehouses'].get(item.item_id)
+    item_data = {
+        "item_name": warehouse_item.item_name if warehouse_item else None,
+        "barcode": warehouse_item.item_bar if warehouse_item else None,
+        "quantity": item.quantity,
+        "location": item.location,
+        "total_price": item.total_price,
+        'unit_price': item.unit_price,
+        "description": item.description,
+        "supplier_name": item.supplier_name,
+        "supplier_id": supplier_id,
+        "new_location": item.new_location
+    }
+
+    # Price details only exist for FIFO consumers (sales, void, warranty)
+    if invoice.type in FIFO_CONSUMER_TYPES:
+        details = bundle['price_details'].get((invoice.id, item.item_id), [])
+        if details:
+            item_data['price_details'] = [serialize_price_detail(detail) for detail in details]
+
+    return item_data
+
+
+def serialize_invoice(invoice, bundle):
+    """Serialize one invoice into the ``invoice_model`` shape using a preloaded bundle"""
+    machine = bundle['machines'].get(invoice.machine_id)
+    mechanism = bundle['mechanisms'].get(invoice.mechanism_id)
+
+    suppliers_used = set()
+    item_list = [
+        serialize_invoice_item(invoice, item, bundle, suppliers_used)
+        for item in bundle['items'].get(invoice.id, [])
+    ]
+
+    invoice_data = {
+        "id": invoice.id,
+        "type": invoice.type,
+        "client_name": invoice.client_name,
+        "warehouse_manager": invoice.warehouse_manager,
+        "accreditation_manager": invoice.accreditation_manager,
+        "total_amount": invoice.total_amount,
+        'paid': invoice.paid,
+        'residual': invoice.residual,
+        'comment': invoice.comment,
+        'status': invoice.status,
+        "employee_name": invoice.employee_name,
+        "machine_name": machine.name if machine else None,
+        "mechanism_name": mechanism.name if mechanism else None,
+        "created_at": invoice.created_at,
+        "payment_method": invoice.payment_method,
+        "custody_person": invoice.custody_person,
+        "items": item_list,
+        "suppliers_summary": list(suppliers_used)
+    }
+
+    # Add original invoice ID for returned sales
+    if invoice.type == 'مرتجع':
+        return_sales_record = bundle['return_sales'].get(invoice.id)
+        if return_sales_record:
+            invoice_data['original_invoice_id'] = return_sales_record.sales_invoice_id
+
+    return invoice_data
+
+
+def serialize_invoices(invoices):
+    """Serialize a page of invoices with a constant number of queries"""
+    if not invoices:
+        return []
+    bundle = load_invoice_bundle(invoices)
+    return [serialize_invoice(invoice, bundle) for invoice in invoices]
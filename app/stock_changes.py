@@ -0,0 +1,151 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import event, func, insert, text
+from sqlalchemy.orm import attributes
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.elements import BinaryExpression, BindParameter, BooleanClauseList
+
+from .models import Warehouse, ItemLocations, RentalWarehouseLocations, StockChange
+from . import db
+
+# Tables whose rows make up an item's synced stock
+TRACKED_TABLES = {
+    Warehouse.__tablename__, ItemLocations.__tablename__, RentalWarehouseLocations.__tablename__,
+}
+# Changed items per /warehouse/changes response
+CHANGES_PAGE_SIZE = 1000
+
+
+def _item_ids(obj):
+    if isinstance(obj, Warehouse):
+        return {obj.id}
+    # A location moved to another item changes both items
+    history = attributes.get_history(obj, 'item_id')
+    return {obj.item_id, *(history.deleted or ())}
+
+
+def _log_changes(connection, item_ids):
+    now = datetime.now()
+    connection.execute(
+        insert(StockChange.__table__),
+        [{'item_id': item_id, 'changed_at': now} for item_id in sorted(item_ids, key=lambda item_id: item_id or 0)]
+    )
+
+
+def _collect_changes(session, flush_context):
+    item_ids = set()
+    for obj in list(session.new) + list(session.deleted):
+        if isinstance(obj, (Warehouse, ItemLocations, RentalWarehouseLocations)):
+            item_ids.update(_item_ids(obj))
+    for obj in session.dirty:
+        if isinstance(obj, (Warehouse, ItemLocations, RentalWarehouseLocations)) and session.is_modified(obj):
+            item_ids.update(_item_ids(obj))
+    item_ids.discard(None)
+    if item_ids:
+        _log_changes(session.connection(), item_ids)
+
+
+def _statement_item_ids(statement, table_name):
+    """Item ids a bulk UPDATE/DELETE is restricted to by a top-level item criterion, or None"""
+    column_name = 'id' if table_name == Warehouse.__tablename__ else 'item_id'
+    where = getattr(statement, 'whereclause', None)
+    if where is None:
+        return None
+    if isinstance(where, BooleanClauseList) and where.operator is operators.and_:
+        clauses = where.clauses
+    else:
+        clauses = [where]
+    for clause in clauses:
+        if not isinstance(clause, BinaryExpression) or getattr(clause.left, 'name', None) != column_name:
+            continue
+        if not isinstance(clause.right, BindParameter):
+            continue
+        if clause.operator is operators.eq:
+            return {clause.right.effective_value}
+        if clause.operator is operators.in_op:
+            return set(clause.right.effective_value)
+    return None
+
+
+def _collect_bulk_changes(orm_execute_state):
+    if not (orm_execute_state.is_update or orm_execute_state.is_delete):
+        return
+    mapper = orm_execute_state.bind_mapper
+    if mapper is None or mapper.local_table.name not in TRACKED_TABLES:
+        return
+    # filter_by(item_id=...) names the items; anything else may touch any row,
+    # so clients resync everything
+    item_ids = _statement_item_ids(orm_execute_state.statement, mapper.local_table.name)
+    _log_changes(orm_execute_state.session.connection(), item_ids or {None})
+
+
+def log_stock_changes(item_ids):
+    """Record changes made with Core/raw SQL that bypass the flush hook (None = everything)"""
+    if item_ids:
+        _log_changes(db.session.connection(), set(item_ids))
+
+
+def register_stock_changes(session):
+    """Log warehouse stock changes in the same transaction as the change"""
+    if event.contains(session, 'after_flush', _collect_changes):
+        return
+    event.listen(session, 'after_flush', _collect_changes)
+    event.listen(session, 'do_orm_execute', _collect_bulk_changes)
+
+
+def current_version():
+    """
+    High-water mark for delta sync: the oldest transaction still running.
+
+    Every transaction below it has finished, so its log entries are all
+    visible; entries of later transactions are picked up by the next sync.
+    Ids of the log itself are not usable because transactions commit out of
+    order.
+    """
+    return db.session.execute(text("SELECT txid_snapshot_xmin(txid_current_snapshot())")).scalar()
+
+
+def changes_since(since, limit=CHANGES_PAGE_SIZE):
+    """
+    Item ids changed by transactions in [since, version).
+
+    Returns (item_ids, version, reset, has_more). ``reset`` means the client has
+    to reload everything (bulk write or history pruned past ``since``). A page
+    always ends on a transaction boundary so the next one can resume from it.
+    """
+    high_water = version = current_version()
+    query = db.session.query(StockChange.txid, StockChange.item_id).filter(
+        StockChange.txid >= since, StockChange.txid < version
+    ).order_by(StockChange.txid, StockChange.id)
+
+    rows = query.limit(limit + 1).all()
+    has_more = len(rows) > limit
+    if has_more:
+        version = rows[-1].txid
+        rows = [row for row in rows if row.txid < version]
+        if not rows:
+            # One transaction larger than a page: return it whole
+            version = version + 1
+            rows = query.filter(StockChange.txid < version).all()
+            has_more = True
+
+    item_ids = {row.item_id for row in rows}
+    if None in item_ids:
+        return [], high_water, True, False
+    return sorted(item_ids), version, False, has_more
+
+
+def prune_stock_changes(days):
+    """
+    Delete log entries older than ``days``. Clients that last synced before the
+    pruned range are told to reload through a NULL entry at its upper bound.
+    Returns the number of entries deleted.
+    """
+    cutoff = datetime.now() - timedelta(days=days)
+    horizon = db.session.query(func.max(StockChange.txid)).filter(StockChange.changed_at < cutoff).scalar()
+    if horizon is None:
+        return 0
+    deleted = StockChange.query.filter(StockChange.changed_at < cutoff).delete(synchronize_session=False)
+    db.session.add(StockChange(txid=horizon, item_id=None, changed_at=datetime.now()))
+    db.session.commit()
+    return deleted
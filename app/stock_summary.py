@@ -0,0 +1,151 @@
+from collections import defaultdict
+from datetime import datetime
+
+from sqlalchemy import event, func, update, insert
+from sqlalchemy.orm import attributes
+
+from .models import ItemLocations, Prices, StockSummary
+from . import db
+from .serializers import chunked
+
+DELTA_FIELDS = ('on_hand_quantity', 'fifo_quantity', 'fifo_value')
+
+
+def _previous_value(obj, attr):
+    history = attributes.get_history(obj, attr)
+    if history.deleted:
+        return history.deleted[0]
+    if history.unchanged:
+        return history.unchanged[0]
+    return None
+
+
+def _contribution(obj, current=True):
+    """(on_hand, fifo_quantity, fifo_value) that one row adds to its summary row"""
+    if current:
+        quantity = obj.quantity
+        unit_price = obj.unit_price if isinstance(obj, Prices) else None
+    else:
+        quantity = _previous_value(obj, 'quantity')
+        unit_price = _previous_value(obj, 'unit_price') if isinstance(obj, Prices) else None
+
+    quantity = quantity or 0
+    if isinstance(obj, ItemLocations):
+        return (quantity, 0, 0)
+
+    # Only open layers count towards the FIFO valuation
+    if quantity <= 0:
+        return (0, 0, 0)
+    return (0, quantity, quantity * (unit_price or 0))
+
+
+def _collect_deltas(session, flush_context):
+    deltas = defaultdict(lambda: [0, 0, 0])
+
+    def add(obj, sign, current):
+        key = (obj.item_id, obj.location) if current else (
+            _previous_value(obj, 'item_id'), _previous_value(obj, 'location')
+        )
+        for index, value in enumerate(_contribution(obj, current)):
+            deltas[key][index] += sign * value
+
+    for obj in session.new:
+        if isinstance(obj, (ItemLocations, Prices)):
+            add(obj, 1, True)
+    for obj in session.dirty:
+        if isinstance(obj, (ItemLocations, Prices)) and session.is_modified(obj):
+            add(obj, -1, False)
+            add(obj, 1, True)
+    for obj in session.deleted:
+        if isinstance(obj, (ItemLocations, Prices)):
+            add(obj, -1, False)
+
+    if deltas:
+        apply_deltas(session.connection(), deltas)
+
+
+def apply_deltas(connection, deltas):
+    """Add per-(item, location) deltas to the summary, creating missing rows"""
+    table = StockSummary.__table__
+    now = datetime.now()
+    for (item_id, location), (on_hand, fifo_quantity, fifo_value) in deltas.items():
+        if item_id is None or (on_hand == 0 and fifo_quantity == 0 and fifo_value == 0):
+            continue
+        result = connection.execute(
+            update(table)
+            .where(table.c.item_id == item_id, table.c.location == location)
+            .values(
+                on_hand_quantity=table.c.on_hand_quantity + on_hand,
+                fifo_quantity=table.c.fifo_quantity + fifo_quantity,
+                fifo_value=table.c.fifo_value + fifo_value,
+                updated_at=now
+            )
+        )
+        if result.rowcount == 0:
+            connection.execute(insert(table).values(
+                item_id=item_id,
+                location=location,
+                on_hand_quantity=on_hand,
+                fifo_quantity=fifo_quantity,
+                fifo_value=fifo_value,
+                updated_at=now
+            ))
+
+
+def register_stock_summary(session):
+    """Keep stock_summary in the same transaction as every ORM stock change"""
+    if event.contains(session, 'after_flush', _collect_deltas):
+        return
+    event.listen(session, 'after_flush', _collect_deltas)
+
+
+def _summary_rows(item_ids=None):
+    """Aggregate ItemLocations and open Prices into summary rows"""
+    on_hand_query = db.session.query(
+        ItemLocations.item_id, ItemLocations.location, func.sum(ItemLocations.quantity)
+    )
+    fifo_query = db.session.query(
+        Prices.item_id, Prices.location,
+        func.sum(Prices.quantity), func.sum(Prices.quantity * Prices.unit_price)
+    ).filter(Prices.quantity > 0)
+    if item_ids is not None:
+        on_hand_query = on_hand_query.filter(ItemLocations.item_id.in_(item_ids))
+        fifo_query = fifo_query.filter(Prices.item_id.in_(item_ids))
+
+    rows = defaultdict(lambda: {'on_hand_quantity': 0, 'fifo_quantity': 0, 'fifo_value': 0})
+    for item_id, location, quantity in on_hand_query.group_by(ItemLocations.item_id, ItemLocations.location):
+        rows[(item_id, location)]['on_hand_quantity'] = quantity or 0
+    for item_id, location, quantity, value in fifo_query.group_by(Prices.item_id, Prices.location):
+        rows[(item_id, location)]['fifo_quantity'] = quantity or 0
+        rows[(item_id, location)]['fifo_value'] = value or 0
+
+    now = datetime.now()
+    return [
+        dict(item_id=item_id, location=location, updated_at=now, **values)
+        for (item_id, location), values in rows.items()
+    ]
+
+
+def refresh_stock_summary(item_ids):
+    """
+    Recompute the summary rows of the given items from the base tables.
+
+    Used after bulk writes (bulk_save_objects, Query.update/delete) that bypass
+    the flush hook. Runs inside the caller's transaction.
+    """
+    item_ids = sorted({item_id for item_id in item_ids if item_id is not None})
+    for batch in chunked(item_ids):
+        rows = _summary_rows(batch)
+        db.session.execute(StockSummary.__table__.delete().where(StockSummary.item_id.in_(batch)))
+        if rows:
+            db.session.execute(insert(StockSummary.__table__), rows)
+
+
+def rebuild_stock_summary():
+    """Rebuild the whole summary table from ItemLocations and Prices; returns the row count"""
+    rows = _summary_rows()
+    db.session.execute(StockSummary.__table__.delete())
+    for batch in chunked(rows):
+        db.session.execute(insert(StockSummary.__table__), batch)
+    db.session.commit()
+    return len(rows)
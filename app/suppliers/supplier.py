@@ -1,10 +1,14 @@
 from flask_restx import Namespace, Resource, fields
-from flask_jwt_extended import jwt_required
+from flask_jwt_extended import jwt_required, get_jwt_identity
 from .. import db
 from ..models import Supplier, Invoice
 from ..utils import parse_bool
+from ..pagination import add_cursor_arguments, count_rows, keyset_page, page_count
 from datetime import datetime
-from ..redis_config import cache_result
+from ..redis_config import cache_result, tag_session
+from ..etags import conditional_get
+from ..jobs.job import enqueue, job_accepted, job_response, job_task, wants_async
+from ..uploads import LINE_KEY, UploadError, UploadReader, add_upload_arguments, collect_rows
 
 supplier_ns = Namespace('supplier', description='supplier operations')
 
@@ -26,6 +30,7 @@ pagination_parser.add_argument('all',
                                required=False, 
                                default=True, 
                                help='Get all items (default: True) \naccepts values [\'true\', \'false\', \'1\', \'0\', \'t\', \'f\', \'y\', \'n\', \'yes\', \'no\']')
+add_cursor_arguments(pagination_parser)
 # Models for API documentation
 supplier_model = supplier_ns.model('Supplier', {
     "id": fields.Integer(required=True),
@@ -39,137 +44,187 @@ pagination_model = supplier_ns.model('SupplierPagination', {
     'page_size': fields.Integer(required=True),
     'total_pages': fields.Integer(required=True),
     'total_items': fields.Integer(required=True),
-    'all': fields.Boolean(required=True)
+    'all': fields.Boolean(required=True),
+    'next_cursor': fields.String(description='Cursor of the next page (cursor mode only)')
 })
 
-@supplier_ns.route('/excel')
-class SupplierExcelUltra(Resource):
-    @jwt_required()
-    def post(self):
-        """Ultra-optimized supplier import using bulk_insert_mappings"""
-        try:
-            payload = supplier_ns.payload
-            if not payload or 'data' not in payload:
-                supplier_ns.abort(400, "Invalid payload format")
+SUPPLIER_UPLOAD_FIELDS = {'id': ('supplier_id',), 'name': ('supplier',), 'description': ('desc',)}
+
+upload_parser = add_upload_arguments(supplier_ns.parser())
+
+def import_suppliers(payload):
+    """Import payload['data'] suppliers; returns (response body, status)"""
+    try:
+        errors = []
+        success_count = 0
+        
+        # Data validation and deduplication
+        valid_suppliers = []
+        supplier_names = []
+        supplier_ids = []
+        
+        for i, item in enumerate(payload['data']):
+            if not item.get('name') or not item.get('id'):
+                continue
             
-            errors = []
-            success_count = 0
+            supplier_name = str(item['name']).strip()
+            supplier_id = item['id']
+            description = item.get('description', None)
+            if description:
+                description = str(description).strip()
             
-            # Data validation and deduplication
-            valid_suppliers = []
-            supplier_names = []
-            supplier_ids = []
+            valid_suppliers.append({
+                'name': supplier_name,
+                'id': supplier_id,
+                'description': description
+            })
             
-            for i, item in enumerate(payload['data']):
-                if not item.get('name') or not item.get('id'):
-                    continue
-                
-                supplier_name = str(item['name']).strip()
-                supplier_id = item['id']
-                description = item.get('description', None)
-                if description:
-                    description = str(description).strip()
+            supplier_names.append(supplier_name)
+            supplier_ids.append(supplier_id)
+        
+        # Duplicate check
+        existing_suppliers_query = db.session.query(
+            Supplier.name, Supplier.id, Supplier.description
+        ).filter(
+            db.or_(
+                Supplier.name.in_(supplier_names),
+                Supplier.id.in_(supplier_ids)
+            )
+        )
+        
+        existing_names = set()
+        existing_ids = set()
+        existing_combinations = set()
+        
+        for name, supplier_id, description in existing_suppliers_query:
+            existing_names.add(name)
+            existing_ids.add(supplier_id)
+            existing_combinations.add((name, supplier_id, description))
+        
+        # Remove duplicates
+        unique_suppliers = []
+        seen_names = set()
+        seen_ids = set()
+        
+        for supplier in valid_suppliers:
+            if (supplier['name'] not in existing_names and 
+                supplier['id'] not in existing_ids and
+                supplier['name'] not in seen_names and
+                supplier['id'] not in seen_ids):
                 
-                valid_suppliers.append({
-                    'name': supplier_name,
-                    'id': supplier_id,
-                    'description': description
-                })
+                seen_names.add(supplier['name'])
+                seen_ids.add(supplier['id'])
+                unique_suppliers.append(supplier)
+                success_count += 1
+        
+        # SUPER-FAST: Use bulk_insert_mappings
+        if unique_suppliers:
+            try:
+                # Prepare data for bulk insert
+                current_time = datetime.now()
+                supplier_data = []
                 
-                supplier_names.append(supplier_name)
-                supplier_ids.append(supplier_id)
-            
-            # Duplicate check
-            existing_suppliers_query = db.session.query(
-                Supplier.name, Supplier.id, Supplier.description
-            ).filter(
-                db.or_(
-                    Supplier.name.in_(supplier_names),
-                    Supplier.id.in_(supplier_ids)
-                )
-            )
-            
-            existing_names = set()
-            existing_ids = set()
-            existing_combinations = set()
-            
-            for name, supplier_id, description in existing_suppliers_query:
-                existing_names.add(name)
-                existing_ids.add(supplier_id)
-                existing_combinations.add((name, supplier_id, description))
-            
-            # Remove duplicates
-            unique_suppliers = []
-            seen_names = set()
-            seen_ids = set()
-            
-            for supplier in valid_suppliers:
-                if (supplier['name'] not in existing_names and 
-                    supplier['id'] not in existing_ids and
-                    supplier['name'] not in seen_names and
-                    supplier['id'] not in seen_ids):
-                    
-                    seen_names.add(supplier['name'])
-                    seen_ids.add(supplier['id'])
-                    unique_suppliers.append(supplier)
-                    success_count += 1
-            
-            # SUPER-FAST: Use bulk_insert_mappings
-            if unique_suppliers:
-                try:
-                    # Prepare data for bulk insert
-                    current_time = datetime.now()
-                    supplier_data = []
+                for supplier in unique_suppliers:
+                    supplier_record = {
+                        'name': supplier['name'],
+                        'id': supplier['id'],
+                        'description': supplier['description']
+                    }
+                    # Add timestamp if your model has it
+                    if hasattr(Supplier, 'created_at'):
+                        supplier_record['created_at'] = current_time
                     
-                    for supplier in unique_suppliers:
-                        supplier_record = {
-                            'name': supplier['name'],
-                            'id': supplier['id'],
-                            'description': supplier['description']
-                        }
-                        # Add timestamp if your model has it
-                        if hasattr(Supplier, 'created_at'):
-                            supplier_record['created_at'] = current_time
-                        
-                        supplier_data.append(supplier_record)
-                    
-                    # Ultra-fast bulk insert
-                    db.session.bulk_insert_mappings(Supplier, supplier_data)
-                    db.session.commit()
+                    supplier_data.append(supplier_record)
+                
+                # Ultra-fast bulk insert
+                db.session.bulk_insert_mappings(Supplier, supplier_data)
+                tag_session(db.session, "suppliers")
+                db.session.commit()
 
-                    
-                    return {
-                        'status': 'success',
-                        'message': f'Ultra-optimized import: {success_count} suppliers imported',
-                        'total_submitted': len(payload['data']),
-                        'successful_suppliers': success_count
-                    }, 200
-                    
-                except Exception as e:
-                    db.session.rollback()
-                    return {
-                        'status': 'error',
-                        'message': f'Ultra-optimized bulk operation failed: {str(e)}'
-                    }, 500
-            else:
+                
                 return {
-                    'status': 'error',
-                    'message': 'No unique suppliers to import'
-                }, 400
+                    'status': 'success',
+                    'message': f'Ultra-optimized import: {success_count} suppliers imported',
+                    'total_submitted': len(payload['data']),
+                    'successful_suppliers': success_count
+                }, 200
                 
-        except Exception as e:
-            db.session.rollback()
+            except Exception as e:
+                db.session.rollback()
+                return {
+                    'status': 'error',
+                    'message': f'Ultra-optimized bulk operation failed: {str(e)}'
+                }, 500
+        else:
             return {
                 'status': 'error',
-                'message': f'Unexpected error: {str(e)}'
-            }, 500
+                'message': 'No unique suppliers to import'
+            }, 400
+            
+    except Exception as e:
+        db.session.rollback()
+        return {
+            'status': 'error',
+            'message': f'Unexpected error: {str(e)}'
+        }, 500
+
+
+@job_task('supplier_import')
+def supplier_import_job(payload, job):
+    return job_response(*import_suppliers(payload))
+
+
+@supplier_ns.route('/excel')
+class SupplierExcelUltra(Resource):
+    @jwt_required()
+    def post(self):
+        """
+        Ultra-optimized supplier import using bulk_insert_mappings
+        (?async=true runs it as a background job, see /jobs/<job_id>)
+        """
+        payload = supplier_ns.payload
+        if not payload or 'data' not in payload:
+            supplier_ns.abort(400, "Invalid payload format")
+        if wants_async():
+            return job_accepted(enqueue('supplier_import', {'data': payload['data']}, get_jwt_identity()))
+        return import_suppliers(payload)
+
+
+@supplier_ns.route('/upload')
+class SupplierUpload(Resource):
+    @supplier_ns.expect(upload_parser)
+    @jwt_required()
+    def post(self):
+        """
+        Import suppliers from a CSV or XLSX file (multipart ``file``) with columns
+        id, name, description (or names mapped with ``columns``)
+        """
+        args = upload_parser.parse_args()
+        try:
+            reader = UploadReader(args['file'], SUPPLIER_UPLOAD_FIELDS, required=('id', 'name'),
+                                  mapping=args['columns'], sheet=args['sheet'])
+            rows, errors = collect_rows(reader, ('id', 'name'))
+        except UploadError as e:
+            supplier_ns.abort(400, str(e))
+        # CSV cells are text; ids are compared with the integer keys in the table
+        suppliers = []
+        for row in rows:
+            try:
+                suppliers.append({**row, 'id': int(row['id'])})
+            except (ValueError, TypeError):
+                errors.append(f"Row {row[LINE_KEY]}: Invalid id")
+        body, status = import_suppliers({'data': suppliers})
+        if errors:
+            body['errors'] = errors
+        return body, status
 
 @supplier_ns.route('/')
 class SupplierList(Resource):
+    @conditional_get(tags=("suppliers",))
     @supplier_ns.marshal_list_with(pagination_model)
     @supplier_ns.expect(pagination_parser)
     @jwt_required()
-    @cache_result(timeout=300, key_prefix="supplier_list")
+    @cache_result(timeout=300, key_prefix="supplier_list", tags=("suppliers",))
     def get(self):
         """Get all suppliers (cached)"""
         args = pagination_parser.parse_args()
@@ -180,14 +235,21 @@ class SupplierList(Resource):
             supplier_ns.abort(400, "Page and page_size must be positive integers")
         
         query = Supplier.query.with_entities(Supplier.id, Supplier.name, Supplier.description).filter(Supplier.name != 'Default Supplier')
-        if all_results:
+        next_cursor = None
+        if args['cursor'] is not None:
+            suppliers, next_cursor = keyset_page(query, Supplier.id, args['cursor'], page_size)
+            all_results = False
+        elif all_results:
             suppliers = query.all()
+        else:
+            suppliers = query.limit(page_size).offset((page-1)*page_size).all()
+
+        if all_results:
             total_count = len(suppliers)
             total_pages = 1
         else:
-            suppliers = query.limit(page_size).offset((page-1)*page_size).all()
-            total_count = query.count()
-            total_pages = (total_count + page_size - 1) // page_size
+            total_count = count_rows(query, args['count'], Supplier)
+            total_pages = page_count(total_count, page_size)
 
         result = [
             {"id": s.id, "name": s.name, "description": s.description}
@@ -195,11 +257,12 @@ class SupplierList(Resource):
         ]
         return {
             'suppliers': result,
-            'page': page if not all_results else None,
+            'page': page if not all_results and args['cursor'] is None else None,
             'page_size': page_size if not all_results else None,
             'total_pages': total_pages if not all_results else None,
             'total_items': total_count,
-            'all': all_results
+            'all': all_results,
+            'next_cursor': next_cursor
         }, 200
 
     @supplier_ns.marshal_with(supplier_model)
@@ -224,13 +287,15 @@ class SupplierList(Resource):
 
 @supplier_ns.route('/<int:supplier_id>')
 class SupplierDetail(Resource):
+    @conditional_get(tags=("supplier:{supplier_id}", "supplier:*"))
     @supplier_ns.marshal_with(supplier_model)
     @jwt_required()
-    @cache_result(timeout=300, key_prefix="supplier_detail")
+    @cache_result(timeout=300, key_prefix="supplier_detail", tags=("supplier:{supplier_id}", "supplier:*"))
     def get(self, supplier_id):
         """Get a supplier by ID (cached)"""
         supplier = Supplier.query.get_or_404(supplier_id)
-        return supplier
+        # A dict, not the ORM object: cached entries must be serializable
+        return {"id": supplier.id, "name": supplier.name, "description": supplier.description}
 
     @supplier_ns.marshal_with(supplier_model)
     @jwt_required()
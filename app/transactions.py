@@ -0,0 +1,49 @@
+from contextlib import contextmanager
+
+from flask import g, has_app_context
+
+from . import db
+
+SAVEPOINT_KEY = 'operation_savepoint'
+
+
+def current_savepoint():
+    """The savepoint the running operation belongs to, or None for a standalone request"""
+    if not has_app_context():
+        return None
+    return g.get(SAVEPOINT_KEY)
+
+
+@contextmanager
+def operation_savepoint():
+    """
+    Run one stock operation inside a SAVEPOINT of the surrounding transaction.
+
+    While it is active, ``commit_operation`` only flushes and
+    ``rollback_operation`` rolls back to the savepoint, so a batch can keep
+    earlier operations when one fails and commit them all at the end.
+    """
+    savepoint = db.session.begin_nested()
+    previous = g.get(SAVEPOINT_KEY)
+    setattr(g, SAVEPOINT_KEY, savepoint)
+    try:
+        yield savepoint
+    finally:
+        setattr(g, SAVEPOINT_KEY, previous)
+
+
+def commit_operation():
+    """Commit a finished operation (flush only when running inside a batch savepoint)"""
+    if current_savepoint() is None:
+        db.session.commit()
+    else:
+        db.session.flush()
+
+
+def rollback_operation():
+    """Undo a failed operation (only its own savepoint when running inside a batch)"""
+    savepoint = current_savepoint()
+    if savepoint is None:
+        db.session.rollback()
+    elif savepoint.is_active:
+        savepoint.rollback()
@@ -0,0 +1,172 @@
+"""
+Server-side parsing of uploaded CSV and XLSX files for the import endpoints.
+
+Rows are read one at a time: CSV through the csv module, XLSX through
+openpyxl's read-only mode, which streams the sheet instead of building it in
+memory. The first row names the columns; they are matched to import fields
+by name or alias, or through a client-supplied mapping.
+"""
+import codecs
+import csv
+import json
+
+from werkzeug.datastructures import FileStorage
+
+try:
+    from openpyxl import load_workbook
+except ImportError:
+    load_workbook = None
+
+UPLOAD_FORMATS = ('.csv', '.xlsx')
+# Key of the file line number added to every row, used in row error messages
+LINE_KEY = '_line'
+
+
+class UploadError(ValueError):
+    """The upload cannot be read (format, header, mapping); the endpoint answers 400"""
+
+
+def add_upload_arguments(parser):
+    """Add the multipart ``file``, the optional ``columns`` mapping and the XLSX ``sheet``"""
+    parser.add_argument('file',
+                        type=FileStorage,
+                        location='files',
+                        required=True,
+                        help='CSV (UTF-8) or XLSX file whose first row holds the column names')
+    parser.add_argument('columns',
+                        type=str,
+                        location='form',
+                        required=False,
+                        help='JSON object mapping file column names to import fields, '
+                             'e.g. {"Barcode": "item_bar"}')
+    parser.add_argument('sheet',
+                        type=str,
+                        location='form',
+                        required=False,
+                        help='XLSX sheet name (default: the first sheet)')
+    return parser
+
+
+def _normalize(name):
+    return str(name).strip().lower().replace(' ', '_') if name is not None else ''
+
+
+def _is_blank(value):
+    return value is None or (isinstance(value, str) and not value.strip())
+
+
+def _csv_rows(stream):
+    # codecs' reader works on any binary stream (SpooledTemporaryFile included);
+    # utf-8-sig drops the BOM spreadsheet programs write
+    try:
+        yield from csv.reader(codecs.getreader('utf-8-sig')(stream))
+    except UnicodeDecodeError:
+        raise UploadError("CSV files must be UTF-8 encoded")
+
+
+def _xlsx_rows(stream, sheet):
+    if load_workbook is None:
+        raise UploadError("XLSX uploads need openpyxl on the server; upload a CSV file instead")
+    try:
+        workbook = load_workbook(stream, read_only=True, data_only=True)
+    except Exception as e:
+        raise UploadError(f"Not a readable XLSX file: {e}")
+    if sheet and sheet not in workbook.sheetnames:
+        workbook.close()
+        raise UploadError(f"Sheet '{sheet}' not found; sheets: {', '.join(workbook.sheetnames)}")
+
+    def rows():
+        try:
+            yield from (workbook[sheet] if sheet else workbook.worksheets[0]).iter_rows(values_only=True)
+        finally:
+            workbook.close()
+    return rows()
+
+
+class UploadReader:
+    """
+    Iterate the data rows of an uploaded file as dicts keyed by import field.
+
+    ``fields`` maps each import field to its accepted column aliases;
+    ``required`` fields must have a column. Blank rows are skipped, empty
+    cells are left out of the row and every row carries its file line number
+    under LINE_KEY. Format and header problems raise UploadError right away,
+    undecodable CSV lines while iterating.
+    """
+
+    def __init__(self, upload, fields, required=(), mapping=None, sheet=None):
+        filename = (upload.filename or '').lower()
+        if filename.endswith('.csv'):
+            self._rows = _csv_rows(upload.stream)
+        elif filename.endswith('.xlsx'):
+            self._rows = _xlsx_rows(upload.stream, sheet)
+        else:
+            raise UploadError(f"Unsupported file type; upload one of {', '.join(UPLOAD_FORMATS)}")
+
+        headers = next(self._rows, None)
+        if headers is None:
+            raise UploadError("The file is empty")
+        self.columns = self._resolve_columns(headers, fields, self._parse_mapping(mapping, fields))
+        missing = [field for field in required if field not in self.columns.values()]
+        if missing:
+            raise UploadError(f"Missing columns: {', '.join(missing)} (found: {', '.join(map(str, headers))})")
+
+    @staticmethod
+    def _parse_mapping(mapping, fields):
+        if not mapping:
+            return {}
+        if isinstance(mapping, str):
+            try:
+                mapping = json.loads(mapping)
+            except ValueError:
+                raise UploadError("columns must be a JSON object")
+        if not isinstance(mapping, dict):
+            raise UploadError("columns must be a JSON object")
+        unknown = [field for field in mapping.values() if field not in fields]
+        if unknown:
+            raise UploadError(f"Unknown import fields in columns: {', '.join(map(str, unknown))}")
+        return mapping
+
+    @staticmethod
+    def _resolve_columns(headers, fields, mapping):
+        """Column index -> import field; the explicit mapping wins over names and aliases"""
+        mapped = {_normalize(column): field for column, field in mapping.items()}
+        aliases = {}
+        for field, names in fields.items():
+            for name in (field, *names):
+                aliases[_normalize(name)] = field
+
+        columns = {}
+        for lookup in (mapped, aliases):
+            for index, header in enumerate(headers):
+                field = lookup.get(_normalize(header))
+                if field is not None and index not in columns and field not in columns.values():
+                    columns[index] = field
+        return columns
+
+    def __iter__(self):
+        for line, values in enumerate(self._rows, start=2):
+            if values is None or all(_is_blank(value) for value in values):
+                continue
+            row = {
+                field: values[index].strip() if isinstance(values[index], str) else values[index]
+                for index, field in self.columns.items()
+                if index < len(values) and not _is_blank(values[index])
+            }
+            row[LINE_KEY] = line
+            yield row
+
+
+def collect_rows(reader, required):
+    """
+    All rows of a reader for the small reference imports, with one error per
+    row that lacks a required value (those rows are left out)
+    """
+    rows, errors = [], []
+    for row in reader:
+        missing = [field for field in required if field not in row]
+        if missing:
+            errors.append(f"Row {row[LINE_KEY]}: Missing {', '.join(missing)}")
+        else:
+            rows.append(row)
+    return rows, errors
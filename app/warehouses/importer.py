@@ -0,0 +1,381 @@
+"""
+Streaming warehouse import.
+
+Rows are validated in chunks and COPYed into a temporary table. Barcode
+deduplication, new items, location increments, the purchase invoices with
+their lines and the price layers are then written with set-based statements,
+so memory is bounded by the chunk size whatever the number of rows.
+Everything runs in the caller's transaction; the caller commits or rolls
+back. PostgreSQL only (COPY, RETURNING in a CTE, row locks).
+"""
+import csv
+import io
+from datetime import datetime
+from itertools import islice
+
+from sqlalchemy import text
+
+from .. import db
+from ..events.event import queue_events
+from ..models import Supplier
+from ..redis_config import tag_session
+from ..stock_summary import refresh_stock_summary
+from ..stock_changes import log_stock_changes
+from ..uploads import LINE_KEY
+
+# Rows validated and staged per round trip
+IMPORT_CHUNK_SIZE = 5000
+# Lines per generated purchase invoice
+ITEMS_PER_INVOICE = 10
+DEFAULT_LOCATION = 'raf1'
+DEFAULT_SUPPLIER_NAME = "Default Supplier"
+# Row errors and warnings listed in the result; the rest are only counted
+MAX_REPORTED_ERRORS = 200
+# Change events queued for one import; larger imports publish a single resync
+MAX_IMPORT_EVENTS = 1000
+
+STAGING_COLUMNS = ('row_num', 'item_name', 'item_bar', 'location', 'quantity', 'unit_price')
+
+# A new barcode whose row names another item than its first row in the import
+DUPLICATE_NEW_BARCODE = """
+    NOT EXISTS (SELECT 1 FROM warehouse w WHERE w.item_bar = import_rows.item_bar)
+    AND import_rows.item_name <> (
+        SELECT f.item_name FROM import_rows f
+        WHERE f.item_bar = import_rows.item_bar ORDER BY f.row_num LIMIT 1
+    )
+"""
+INVOICE_COMMENT = "'Excel import items ' || MIN(line_no) || '-' || MAX(line_no)"
+
+
+def parse_row(raw_item, row_num):
+    """Staging tuple for one input row, or (None, error message)"""
+    # Uploaded files number rows by their line in the file
+    label = raw_item.get(LINE_KEY, row_num)
+    if not raw_item.get('item_name') or not raw_item.get('item_bar'):
+        return None, f"Row {label}: Missing item_name or item_bar"
+    if 'quantity' not in raw_item:
+        return None, f"Row {label}: Missing quantity"
+    try:
+        quantity = int(raw_item['quantity'])
+    except (ValueError, TypeError):
+        return None, f"Row {label}: Invalid quantity"
+    if quantity < 0:
+        return None, f"Row {label}: Quantity must be positive"
+
+    unit_price = 0
+    price = raw_item.get('price_unit', raw_item.get('unit_price'))
+    if price is not None:
+        try:
+            unit_price = float(price)
+        except (ValueError, TypeError):
+            unit_price = 0
+
+    return (
+        row_num,
+        str(raw_item['item_name']).strip(),
+        str(raw_item['item_bar']).strip(),
+        str(raw_item.get('location', DEFAULT_LOCATION)).strip(),
+        quantity,
+        unit_price,
+    ), None
+
+
+class WarehouseImport:
+    """One import run: ``stage`` the rows, then ``apply`` them"""
+
+    def __init__(self, employee, progress=None):
+        self.employee = employee
+        # progress(percent, message), e.g. JobContext.progress
+        self.progress = progress
+        dialect = db.session.connection().dialect.name
+        if dialect != 'postgresql':
+            # COPY, the RETURNING CTE and the row locks are PostgreSQL only;
+            # refuse before staging anything
+            raise RuntimeError(f"The warehouse import needs PostgreSQL (database is {dialect})")
+        self.submitted = 0
+        self.staged = 0
+        self.errors = []
+        self.error_count = 0
+        self.warning_count = 0
+
+    def _execute(self, sql, params=None):
+        return db.session.execute(text(sql), params or {})
+
+    def _report(self, percent, message):
+        if self.progress:
+            self.progress(percent, message)
+
+    def _error(self, message, warning=False):
+        self.error_count += 1
+        if warning:
+            self.warning_count += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append(message)
+
+    # ---- Staging ----
+
+    def _create_staging(self):
+        for table in ('import_rows', 'import_lines', 'import_invoices'):
+            self._execute(f"DROP TABLE IF EXISTS {table}")
+        self._execute("""
+            CREATE TEMPORARY TABLE import_rows (
+                row_num INTEGER NOT NULL,
+                item_name TEXT NOT NULL,
+                item_bar TEXT NOT NULL,
+                location TEXT NOT NULL,
+                quantity INTEGER NOT NULL,
+                unit_price FLOAT NOT NULL,
+                item_id INTEGER
+            )
+        """)
+
+    def _copy(self, rows):
+        buffer = io.StringIO()
+        # Strings quoted: an unquoted empty CSV field would be NULL
+        csv.writer(buffer, quoting=csv.QUOTE_NONNUMERIC).writerows(rows)
+        buffer.seek(0)
+        cursor = db.session.connection().connection.cursor()
+        try:
+            cursor.copy_expert(
+                f"COPY import_rows ({', '.join(STAGING_COLUMNS)}) FROM STDIN WITH (FORMAT csv)", buffer
+            )
+        finally:
+            cursor.close()
+
+    def stage(self, rows, total=None):
+        """Validate and stage an iterable of row dicts, IMPORT_CHUNK_SIZE rows at a time"""
+        self._create_staging()
+        rows = iter(rows)
+        while True:
+            chunk = list(islice(rows, IMPORT_CHUNK_SIZE))
+            if not chunk:
+                break
+            valid = []
+            for raw_item in chunk:
+                self.submitted += 1
+                parsed, error = parse_row(raw_item, self.submitted)
+                if error:
+                    self._error(error)
+                else:
+                    valid.append(parsed)
+            if valid:
+                self._copy(valid)
+                self.staged += len(valid)
+            if total:
+                self._report(50 * self.submitted / total, f"Staged {self.submitted} of {total} rows")
+
+        self._execute("CREATE INDEX import_rows_bar ON import_rows (item_bar, row_num)")
+        self._execute("ANALYZE import_rows")
+        return self.staged
+
+    # ---- Set-based apply ----
+
+    def _default_supplier_id(self):
+        supplier = Supplier.query.filter_by(name=DEFAULT_SUPPLIER_NAME).first()
+        if not supplier:
+            supplier = Supplier(
+                name=DEFAULT_SUPPLIER_NAME,
+                description="Default supplier for bulk imports and operations without specific supplier"
+            )
+            db.session.add(supplier)
+            db.session.flush()
+        return supplier.id
+
+    def _barcode_checks(self):
+        for (item_bar,) in self._execute("""
+            SELECT DISTINCT r.item_bar FROM import_rows r
+            JOIN warehouse w ON w.item_bar = r.item_bar
+            WHERE w.item_name <> r.item_name
+            ORDER BY r.item_bar LIMIT :limit
+        """, {'limit': MAX_REPORTED_ERRORS}):
+            self._error(f"Warning: Barcode {item_bar} already exists with different item_name", warning=True)
+
+        for (item_bar,) in self._execute(f"""
+            SELECT DISTINCT item_bar FROM import_rows WHERE {DUPLICATE_NEW_BARCODE}
+            ORDER BY item_bar LIMIT :limit
+        """, {'limit': MAX_REPORTED_ERRORS}):
+            self._error(f"Duplicate barcode {item_bar} within import. Only first occurrence will be added.")
+        # Only the rows naming the barcode's first item are imported
+        self._execute(f"DELETE FROM import_rows WHERE {DUPLICATE_NEW_BARCODE}")
+
+    def _lock_stock(self):
+        """
+        Lock the imported items' warehouse rows, then their locations, in key
+        order, the order locking.lock_stock() uses, so concurrent stock
+        operations on the same items queue instead of deadlocking
+        """
+        self._execute("""
+            SELECT id FROM warehouse WHERE id IN (SELECT item_id FROM import_lines)
+            ORDER BY id FOR NO KEY UPDATE
+        """)
+        self._execute("""
+            SELECT item_id FROM item_locations WHERE item_id IN (SELECT item_id FROM import_lines)
+            ORDER BY item_id, location FOR UPDATE
+        """)
+
+    def _queue_events(self, invoice_count):
+        # The raw SQL above bypasses the flush hooks that collect change events
+        locations = self._execute(
+            "SELECT COUNT(*) FROM (SELECT DISTINCT item_id, location FROM import_lines) AS touched"
+        ).scalar()
+        if invoice_count + locations > MAX_IMPORT_EVENTS:
+            queue_events(db.session, [{'type': 'resync'}])
+            return
+        events = [
+            {'type': 'invoice.created', 'id': invoice_id, 'invoice_type': invoice_type, 'status': status}
+            for invoice_id, invoice_type, status in self._execute("""
+                SELECT invoice.id, invoice.type, invoice.status
+                FROM invoice JOIN import_invoices ON import_invoices.invoice_id = invoice.id
+                ORDER BY import_invoices.invoice_no
+            """)
+        ]
+        events += [
+            {'type': 'stock.changed', 'item_id': item_id, 'location': location, 'quantity': quantity}
+            for item_id, location, quantity in self._execute("""
+                SELECT il.item_id, il.location, il.quantity
+                FROM item_locations il
+                JOIN (SELECT DISTINCT item_id, location FROM import_lines) AS touched
+                  ON touched.item_id = il.item_id AND touched.location = il.location
+                ORDER BY il.item_id, il.location
+            """)
+        ]
+        queue_events(db.session, events)
+
+    def apply(self):
+        """Write the staged rows; returns the import summary"""
+        now = datetime.now()
+        supplier_id = self._default_supplier_id()
+
+        self._report(55, "Checking barcodes")
+        self._barcode_checks()
+        existing_rows = self._execute("""
+            SELECT COUNT(*) FROM import_rows r
+            WHERE EXISTS (SELECT 1 FROM warehouse w WHERE w.item_bar = r.item_bar)
+        """).scalar()
+
+        # New items take the name of their barcode's first row
+        new_items = self._execute("""
+            INSERT INTO warehouse (item_name, item_bar, created_at, updated_at)
+            SELECT r.item_name, r.item_bar, :now, :now FROM import_rows r
+            WHERE r.row_num IN (SELECT MIN(row_num) FROM import_rows GROUP BY item_bar)
+              AND NOT EXISTS (SELECT 1 FROM warehouse w WHERE w.item_bar = r.item_bar)
+            ON CONFLICT (item_bar) DO NOTHING
+        """, {'now': now}).rowcount
+        self._execute("""
+            UPDATE import_rows SET item_id = (
+                SELECT w.id FROM warehouse w WHERE w.item_bar = import_rows.item_bar
+            )
+        """)
+
+        # One line per (item, location): summed quantity, price of its first row
+        self._report(65, "Updating locations")
+        self._execute(f"""
+            CREATE TEMPORARY TABLE import_lines AS
+            SELECT g.item_id, g.location, g.quantity, f.unit_price, g.line_no,
+                   (g.line_no - 1) / {ITEMS_PER_INVOICE} AS invoice_no
+            FROM (
+                SELECT item_id, location, SUM(quantity) AS quantity, MIN(row_num) AS first_row,
+                       ROW_NUMBER() OVER (ORDER BY MIN(row_num)) AS line_no
+                FROM import_rows GROUP BY item_id, location
+            ) g
+            JOIN import_rows f ON f.row_num = g.first_row
+        """)
+        self._execute("CREATE INDEX import_lines_key ON import_lines (item_id, location)")
+        self._execute("ANALYZE import_lines")
+        self._lock_stock()
+
+        location_increments = self._execute("""
+            UPDATE item_locations SET quantity = quantity + (
+                SELECT l.quantity FROM import_lines l
+                WHERE l.item_id = item_locations.item_id AND l.location = item_locations.location
+            )
+            WHERE EXISTS (
+                SELECT 1 FROM import_lines l
+                WHERE l.item_id = item_locations.item_id AND l.location = item_locations.location
+            )
+        """).rowcount
+        self._execute("""
+            INSERT INTO item_locations (item_id, location, quantity)
+            SELECT l.item_id, l.location, l.quantity FROM import_lines l
+            WHERE NOT EXISTS (
+                SELECT 1 FROM item_locations il WHERE il.item_id = l.item_id AND il.location = l.location
+            )
+        """)
+
+        # Purchase invoices of ITEMS_PER_INVOICE lines, totals included
+        self._report(80, "Creating invoices")
+        params = {
+            'now': now, 'username': self.employee.username, 'employee_id': self.employee.id,
+            'type': 'اضافه', 'supplier_id': supplier_id,
+        }
+        self._execute("CREATE TEMPORARY TABLE import_invoices (invoice_id INTEGER NOT NULL, invoice_no BIGINT NOT NULL)")
+        # The new ids come back through RETURNING and are matched to their
+        # group by comment among this statement's rows only (the line ranges
+        # make the comments unique within one import)
+        self._execute(f"""
+            WITH groups AS (
+                SELECT invoice_no, SUM(quantity * unit_price) AS total, {INVOICE_COMMENT} AS comment
+                FROM import_lines GROUP BY invoice_no
+            ), created AS (
+                INSERT INTO invoice (
+                    type, client_name, accreditation_manager, total_amount, paid, residual, comment,
+                    status, employee_name, employee_id, created_at
+                )
+                SELECT :type, '', :username, total, 0, total, comment, 'draft', :username, :employee_id, :now
+                FROM groups
+                RETURNING id, comment
+            )
+            INSERT INTO import_invoices (invoice_id, invoice_no)
+            SELECT created.id, groups.invoice_no FROM created JOIN groups ON groups.comment = created.comment
+        """, params)
+
+        self._execute("""
+            INSERT INTO invoice_item (
+                invoice_id, item_id, quantity, location, supplier_id, unit_price, total_price, description
+            )
+            SELECT m.invoice_id, l.item_id, l.quantity, l.location, :supplier_id, l.unit_price,
+                   l.quantity * l.unit_price, ''
+            FROM import_lines l JOIN import_invoices m ON m.invoice_no = l.invoice_no
+        """, params)
+        self._execute("""
+            INSERT INTO prices (invoice_id, item_id, location, supplier_id, quantity, unit_price, created_at)
+            SELECT m.invoice_id, l.item_id, l.location, :supplier_id, l.quantity, l.unit_price, :now
+            FROM import_lines l JOIN import_invoices m ON m.invoice_no = l.invoice_no
+        """, params)
+
+        # Raw SQL bypasses the flush hooks: tag the caches, recompute the stock
+        # summaries and log the changed items for delta sync
+        self._report(90, "Refreshing stock summary")
+        tag_session(db.session, "warehouses", "warehouse:*", "invoices", "prices")
+        item_ids = [item_id for (item_id,) in self._execute("SELECT DISTINCT item_id FROM import_lines")]
+        refresh_stock_summary(item_ids)
+        log_stock_changes(item_ids)
+
+        invoice_ids = [invoice_id for (invoice_id,) in self._execute(
+            "SELECT invoice_id FROM import_invoices ORDER BY invoice_no"
+        )]
+        self._queue_events(len(invoice_ids))
+        lines = self._execute("SELECT COUNT(*) FROM import_lines").scalar()
+        for table in ('import_invoices', 'import_lines', 'import_rows'):
+            self._execute(f"DROP TABLE {table}")
+
+        return {
+            'total_submitted': self.submitted,
+            'successful_items': lines,
+            'new_warehouse_items': new_items,
+            'existing_item_updates': existing_rows,
+            'location_increments': location_increments,
+            'invoices_created': len(invoice_ids),
+            'invoice_ids': invoice_ids,
+        }
+
+
+def import_warehouse_rows(rows, employee, total=None, progress=None):
+    """
+    Import an iterable of row dicts (item_name, item_bar, quantity, location,
+    unit_price or price_unit). Returns (summary, errors, error count, warning
+    count); the summary is None when no row was valid and nothing was written.
+    """
+    run = WarehouseImport(employee, progress)
+    summary = run.apply() if run.stage(rows, total) else None
+    return summary, run.errors, run.error_count, run.warning_count
@@ -1,10 +1,15 @@
 from flask_restx import Namespace, Resource, fields
 from flask_jwt_extended import jwt_required, get_jwt_identity
 from .. import db
-from ..models import Warehouse,ItemLocations, Invoice, Employee, InvoiceItem, Prices
+from ..models import Warehouse,ItemLocations, Employee, InvoiceItem, StockSummary, RentalWarehouseLocations
 from ..utils import parse_bool
-from datetime import datetime
+from ..pagination import add_cursor_arguments, count_rows, keyset_page, page_count
 from ..redis_config import cache_result
+from ..etags import conditional_get
+from ..stock_changes import CHANGES_PAGE_SIZE, changes_since, current_version
+from .importer import import_warehouse_rows
+from ..uploads import UploadError, UploadReader, add_upload_arguments
+from ..jobs.job import JobFailed, enqueue, job_accepted, job_response, job_task, wants_async
 from sqlalchemy import text
 import time
 from collections import defaultdict
@@ -28,6 +33,7 @@ pagination_parser.add_argument('all',
                                required=False, 
                                default=True, 
                                help='Get all items (default: True) \naccepts values [\'true\', \'false\', \'1\', \'0\', \'t\', \'f\', \'y\', \'n\', \'yes\', \'no\']')
+add_cursor_arguments(pagination_parser)
 
 item_location_model = item_location_ns.model('ItemLocation', {
     'location': fields.String(required=True, description='Location of the item in the warehouse'),
@@ -41,378 +47,178 @@ warehouse_model = warehouse_ns.model('Warehouse', {
     'locations': fields.List(fields.Nested(item_location_model), description='List of locations for the item')
 })
 
+changes_parser = warehouse_ns.parser()
+changes_parser.add_argument('since',
+                            type=int,
+                            required=False,
+                            help='Version returned by the previous sync (omit to get the current version)')
+changes_parser.add_argument('limit',
+                            type=int,
+                            required=False,
+                            default=CHANGES_PAGE_SIZE,
+                            help=f'Maximum changed items per response (default: {CHANGES_PAGE_SIZE})')
+
+rental_location_model = warehouse_ns.model('RentalLocation', {
+    'location': fields.String(required=True),
+    'quantity': fields.Integer(required=True),
+    'reserved_quantity': fields.Integer(required=True),
+    'available_quantity': fields.Integer(required=True)
+})
+
+warehouse_change_model = warehouse_ns.model('WarehouseChange', {
+    'id': fields.Integer(required=True),
+    'item_name': fields.String(required=True),
+    'item_bar': fields.String(required=True),
+    'locations': fields.List(fields.Nested(item_location_model)),
+    'rental_locations': fields.List(fields.Nested(rental_location_model))
+})
+
+changes_model = warehouse_ns.model('WarehouseChanges', {
+    'items': fields.List(fields.Nested(warehouse_change_model), description='Current state of every changed item'),
+    'deleted': fields.List(fields.Integer, description='Ids of items deleted since the previous sync'),
+    'since': fields.Integer(description='Version the changes start from'),
+    'version': fields.Integer(required=True, description='Pass as since on the next sync'),
+    'reset': fields.Boolean(required=True, description='Reload everything (GET /warehouse/?all=true), then sync from version'),
+    'has_more': fields.Boolean(required=True, description='More changes are pending: sync again right away')
+})
+
 pagination_model = warehouse_ns.model('WarehousePagination', {
     'warehouses': fields.List(fields.Nested(warehouse_model)),
     'page': fields.Integer(required=True),
     'page_size': fields.Integer(required=True),
     'total_pages': fields.Integer(required=True),
     'total_items': fields.Integer(required=True),
-    'all': fields.Boolean(required=True)
+    'all': fields.Boolean(required=True),
+    'next_cursor': fields.String(description='Cursor of the next page (cursor mode only)')
 })
 
 
-@warehouse_ns.route('/excel')
-class WarehouseExcelUltraFast(Resource):
-    @jwt_required()
-    def post(self):
-        """Ultra-fast import with multi-location and collision-proof logic."""
-        try:
-            payload = warehouse_ns.payload
-            if not payload or 'data' not in payload:
-                warehouse_ns.abort(400, "Invalid payload format")
-
-            print(f"Starting fresh import of {len(payload['data'])} items")
-
-            employee_id = get_jwt_identity()
-            employee = Employee.query.filter_by(id=employee_id).first()
-            if not employee:
-                warehouse_ns.abort(400, "Employee not found")
-
-            # ---- Step 1: Parse and validate input ----
-            parsed_items = []
-            errors = []
-            for i, raw_item in enumerate(payload['data']):
-                row_num = i + 1
-                if not raw_item.get('item_name') or not raw_item.get('item_bar'):
-                    errors.append(f"Row {row_num}: Missing item_name or item_bar")
-                    continue
-                if 'quantity' not in raw_item:
-                    errors.append(f"Row {row_num}: Missing quantity")
-                    continue
-                try:
-                    quantity = int(raw_item['quantity'])
-                    if quantity < 0:
-                        errors.append(f"Row {row_num}: Quantity must be positive")
-                        continue
-                except (ValueError, TypeError):
-                    errors.append(f"Row {row_num}: Invalid quantity")
-                    continue
-                # Parse price
-                unit_price = 0
-                if 'price_unit' in raw_item:
-                    try:
-                        unit_price = float(raw_item['price_unit'])
-                    except (ValueError, TypeError):
-                        unit_price = 0
-                elif 'unit_price' in raw_item:
-                    try:
-                        unit_price = float(raw_item['unit_price'])
-                    except (ValueError, TypeError):
-                        unit_price = 0
-                parsed_items.append({
-                    'row_num': row_num,
-                    'item_name': str(raw_item['item_name']).strip(),
-                    'item_bar': str(raw_item['item_bar']).strip(),
-                    'location': str(raw_item.get('location', 'raf1')).strip(),
-                    'quantity': quantity,
-                    'unit_price': unit_price
-                })
-
-            if not parsed_items:
-                return {
-                    'status': 'error',
-                    'message': f'No valid items to process. Errors: {errors}'
-                }, 400
-
-            print(f"Parsed {len(parsed_items)} valid items")
-
-            # ---- Step 2: Group by (name, barcode) ----
-            item_groups = {}
-            for item in parsed_items:
-                key = (item['item_name'], item['item_bar'])
-                if key not in item_groups:
-                    item_groups[key] = []
-                item_groups[key].append(item)
-
-            print(f"Found {len(item_groups)} unique item types")
-
-            # ---- Step 3: Barcode deduplication ----
-            all_item_bars = [item['item_bar'] for item in parsed_items]
-            existing_items = db.session.query(
-                Warehouse.id, Warehouse.item_name, Warehouse.item_bar
-            ).filter(
-                Warehouse.item_bar.in_(all_item_bars)
-            ).all()
-            existing_by_bar = {item.item_bar: item.id for item in existing_items}
-            existing_by_name_bar = {(item.item_name, item.item_bar): item.id for item in existing_items}
-
-            print(f"Found {len(existing_items)} existing items in database (barcode-based)")
-
-            new_item_groups = []          # New warehouse items
-            existing_item_updates = []    # Updates for existing warehouse items
-
-            for (item_name, item_bar), group in item_groups.items():
-                if item_bar in existing_by_bar:
-                    warehouse_id = existing_by_bar[item_bar]
-                    if (item_name, item_bar) not in existing_by_name_bar:
-                        errors.append(f"Warning: Barcode {item_bar} already exists with different item_name")
-                    for item in group:
-                        item['warehouse_id'] = warehouse_id
-                        item['is_existing'] = True
-                        existing_item_updates.append(item)
-                else:
-                    new_item_groups.append(group)
-
-            print(f"Categorization complete: New={len(new_item_groups)} Existing={len(existing_item_updates)}")
-
-            # ---- Step 4: Prepare new warehouse items, barcode deduplication ----
-            current_time = datetime.now()
-            new_warehouse_items = []
-            new_warehouse_map = {}
-            seen_new_barcodes = set()
-
-            for group in new_item_groups:
-                first_item = group[0]
-                bar = first_item['item_bar']
-                if bar in seen_new_barcodes:
-                    errors.append(f"Duplicate barcode {bar} within import. Only first occurrence will be added.")
-                    continue
-                seen_new_barcodes.add(bar)
-                warehouse_item = Warehouse(
-                    item_name=first_item['item_name'],
-                    item_bar=bar,
-                    created_at=current_time
-                )
-                new_warehouse_items.append(warehouse_item)
-                new_warehouse_map[(first_item['item_name'], bar)] = warehouse_item
-                for item in group:
-                    item['warehouse_item_obj'] = warehouse_item
-                    item['is_existing'] = False
-
-            # Final deduplication against DB (in case barcode added in parallel)
-            all_db_barcodes = set(
-                b for (b,) in db.session.query(Warehouse.item_bar).all()
-            )
-            deduped_new_warehouse_items = []
-            deduped_new_warehouse_map = {}
-            for wi in new_warehouse_items:
-                if wi.item_bar in all_db_barcodes:
-                    errors.append(f"Attempted to create duplicate item_bar: {wi.item_bar}. Skipped.")
-                    continue
-                deduped_new_warehouse_items.append(wi)
-                deduped_new_warehouse_map[(wi.item_name, wi.item_bar)] = wi
-            new_warehouse_items = deduped_new_warehouse_items
-            new_warehouse_map = deduped_new_warehouse_map
-
-            if new_warehouse_items:
-                db.session.bulk_save_objects(new_warehouse_items, return_defaults=True)
-                db.session.flush()
-                print(f"Created {len(new_warehouse_items)} new warehouse items")
-
-            # ---- Step 5: Prepare all items for invoice/locations ----
-            ITEMS_PER_INVOICE = 10
-            all_items_to_process = []
-            for group in new_item_groups:
-                key = (group[0]['item_name'], group[0]['item_bar'])
-                if key in new_warehouse_map:
-                    all_items_to_process.extend(group)
-            all_items_to_process.extend(existing_item_updates)
-
-            print(f"Processing {len(all_items_to_process)} total item entries")
-
-            # ---- Step 6: Process ItemLocations for each location separately ----
-            # Group by (item_id, location) to handle multi-location properly
-            item_location_map = {}
-            for item in all_items_to_process:
-                if item['is_existing']:
-                    item_id = item['warehouse_id']
-                else:
-                    item_id = item['warehouse_item_obj'].id
-                loc_key = (item_id, item['location'])
-                if loc_key not in item_location_map:
-                    item_location_map[loc_key] = {
-                        'quantity': 0,
-                        'unit_price': item['unit_price'],
-                        'item': item
-                    }
-                item_location_map[loc_key]['quantity'] += item['quantity']
-
-            # Now, fetch all (item_id, location) pairs already in DB
-            all_item_ids = set([k[0] for k in item_location_map.keys()])
-            all_locations = set([k[1] for k in item_location_map.keys()])
-            # Get all existing locs for these items (to avoid inserting dup)
-            existing_locs_query = db.session.query(
-                ItemLocations.item_id, ItemLocations.location
-            ).filter(
-                ItemLocations.item_id.in_(all_item_ids),
-                ItemLocations.location.in_(all_locations)
-            )
-            existing_locs_set = set(existing_locs_query.all())
-
-            new_item_locations = []
-            item_locations_to_update = []  # To increment quantity if needed
-
-            for (item_id, location), data in item_location_map.items():
-                if (item_id, location) in existing_locs_set:
-                    # For production, you might want to INCREMENT quantity instead
-                    # We'll update it after bulk insert for speed
-                    item_locations_to_update.append((item_id, location, data['quantity']))
-                    errors.append(f"Existing location (item_id, location)=({item_id}, {location}) found. Quantity will be incremented.")
-                else:
-                    new_item_locations.append(ItemLocations(
-                        item_id=item_id,
-                        location=location,
-                        quantity=data['quantity']
-                    ))
-
-            # ---- Step 7: Create invoices and invoice items ----
-            invoice_totals = {}
-            created_invoices = []
-            success_count = 0
-
-            # Create invoices and invoice items
-            invoice_item_rows = []
-            # FIXED: Track prices per location (invoice_id, item_id, location)
-            price_tracking = {}
-
-            # Get or create default supplier for bulk imports
-            from ..models import Supplier
-            default_supplier = Supplier.query.filter_by(name="Default Supplier").first()
-            if not default_supplier:
-                default_supplier = Supplier(
-                    name="Default Supplier",
-                    description="Default supplier for bulk imports and operations without specific supplier"
-                )
-                db.session.add(default_supplier)
-                db.session.flush()
-            
-            default_supplier_id = default_supplier.id
+WAREHOUSE_UPLOAD_FIELDS = {
+    'item_name': ('name', 'item'),
+    'item_bar': ('barcode', 'bar'),
+    'quantity': ('qty',),
+    'location': (),
+    'unit_price': ('price', 'price_unit'),
+}
 
-            # Convert item_location_map values to a list for chunking
-            location_entries = list(item_location_map.items())
-            
-            for chunk_start in range(0, len(location_entries), ITEMS_PER_INVOICE):
-                chunk_end = min(chunk_start + ITEMS_PER_INVOICE, len(location_entries))
-                chunk_entries = location_entries[chunk_start:chunk_end]
-
-                invoice = Invoice(
-                    type="اضافه",
-                    client_name="",
-                    accreditation_manager=employee.username,
-                    total_amount=0,
-                    paid=0,
-                    residual=0,
-                    comment=f"Excel import items {chunk_start+1}-{chunk_end}",
-                    status="draft",
-                    supplier_id=None,
-                    employee_name=employee.username,
-                    employee_id=employee.id,
-                    machine_id=None,
-                    mechanism_id=None,
-                    created_at=current_time
-                )
-                db.session.add(invoice)
-                db.session.flush()
-                created_invoices.append(invoice)
-                invoice_totals[invoice.id] = 0
-
-                for (item_id, location), loc_data in chunk_entries:
-                    item = loc_data['item']
-                    quantity = loc_data['quantity']
-                    unit_price = item['unit_price']
-                    total_price = quantity * unit_price
-
-                    invoice_totals[invoice.id] += total_price
-
-                    # Create invoice item for this specific location
-                    invoice_item_rows.append(InvoiceItem(
-                        invoice_id=invoice.id,
-                        item_id=item_id,
-                        quantity=quantity,
-                        location=location,
-                        supplier_id=default_supplier_id,  # Use default supplier for bulk imports
-                        unit_price=unit_price,
-                        total_price=total_price,
-                        description=""
-                    ))
-
-                    # FIXED: Track price info per location for location-based pricing
-                    price_key = (invoice.id, item_id, location)
-                    if price_key not in price_tracking:
-                        price_tracking[price_key] = {
-                            'quantity': 0,
-                            'unit_price': unit_price,
-                            'location': location,
-                            'created_at': current_time
-                        }
-                    price_tracking[price_key]['quantity'] += quantity
-
-                    success_count += 1
-
-
-
-            # FIXED: Create location-specific price rows for the new schema
-            price_rows = []
-            for (invoice_id, item_id, location), price_info in price_tracking.items():
-                price_rows.append(Prices(
-                    invoice_id=invoice_id,
-                    item_id=item_id,
-                    location=location,  # FIXED: Include location for new schema
-                    quantity=price_info['quantity'],
-                    unit_price=price_info['unit_price'],
-                    supplier_id=default_supplier_id,  # Use default supplier for bulk imports
-                    created_at=price_info['created_at']
-                ))
-
-            # ---- Step 8: Bulk insert all objects ----
-            if new_item_locations:
-                db.session.bulk_save_objects(new_item_locations)
-            if invoice_item_rows:
-                db.session.bulk_save_objects(invoice_item_rows)
-            if price_rows:
-                db.session.bulk_save_objects(price_rows)
-
-            # Now update all existing ItemLocations (increment quantity)
-            for item_id, location, add_qty in item_locations_to_update:
-                db.session.query(ItemLocations).filter_by(
-                    item_id=item_id,
-                    location=location
-                ).update({ItemLocations.quantity: ItemLocations.quantity + add_qty})
-
-            # Update invoice totals
-            for invoice_id, total_amount in invoice_totals.items():
-                db.session.query(Invoice).filter_by(id=invoice_id).update({
-                    'total_amount': total_amount,
-                    'residual': total_amount
-                })
+upload_parser = add_upload_arguments(warehouse_ns.parser())
 
-            db.session.commit()
 
-            print(f"Successfully processed {success_count} items across {len(created_invoices)} invoices")
+def import_warehouse_items(rows, employee, job=None, total=None):
+    """
+    Import row dicts (a list or a streaming iterator, see importer.py) as new
+    items, locations and purchase invoices. Returns (response body, status);
+    ``job`` gets progress reports when the import runs as a background job.
+    """
+    errors = []
+    if total is None and isinstance(rows, list):
+        total = len(rows)
+    try:
+        print(f"Starting fresh import of {total if total is not None else 'streamed'} items")
 
-            return {
-                'status': 'success',
-                'message': f'Import complete: {success_count} items across {len(created_invoices)} invoices',
-                'total_submitted': len(payload['data']),
-                'successful_items': success_count,
-                'new_warehouse_items': len(new_warehouse_items),
-                'existing_item_updates': len(existing_item_updates),
-                'invoices_created': len(created_invoices),
-                'invoice_ids': [inv.id for inv in created_invoices],
-                'errors': errors if errors else None,
-                'warnings': len([e for e in errors if 'Warning' in e])
-            }, 200
-
-        except Exception as e:
+        summary, errors, error_count, warning_count = import_warehouse_rows(
+            rows, employee, total=total, progress=job.progress if job else None
+        )
+        if summary is None:
             db.session.rollback()
-            print(f"Error in import: {str(e)}")
-            import traceback
-            traceback.print_exc()
             return {
                 'status': 'error',
-                'message': f'Import failed: {str(e)}',
-                'errors': errors if 'errors' in locals() else []
-            }, 500
+                'message': f'No valid items to process. Errors: {errors}'
+            }, 400
+
+        db.session.commit()
+
+        print(f"Successfully processed {summary['successful_items']} items across {summary['invoices_created']} invoices")
+
+        return {
+            'status': 'success',
+            'message': f"Import complete: {summary['successful_items']} items across {summary['invoices_created']} invoices",
+            **summary,
+            'errors': errors if errors else None,
+            'error_count': error_count,
+            'warnings': warning_count
+        }, 200
+
+    except UploadError as e:
+        db.session.rollback()
+        return {'status': 'error', 'message': str(e), 'errors': errors}, 400
+    except Exception as e:
+        db.session.rollback()
+        print(f"Error in import: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return {
+            'status': 'error',
+            'message': f'Import failed: {str(e)}',
+            'errors': errors
+        }, 500
+
+
+@job_task('warehouse_import')
+def warehouse_import_job(payload, job):
+    employee = Employee.query.filter_by(id=payload['employee_id']).first()
+    if not employee:
+        raise JobFailed("Employee not found")
+    return job_response(*import_warehouse_items(payload['data'], employee, job))
+
+
+@warehouse_ns.route('/excel')
+class WarehouseExcelUltraFast(Resource):
+    @jwt_required()
+    def post(self):
+        """
+        Ultra-fast import with multi-location and collision-proof logic.
+        With ?async=true the import runs as a background job: 202 with the job
+        id; progress and result at /jobs/<job_id>.
+        """
+        payload = warehouse_ns.payload
+        if not payload or 'data' not in payload:
+            warehouse_ns.abort(400, "Invalid payload format")
+
+        employee_id = get_jwt_identity()
+        employee = Employee.query.filter_by(id=employee_id).first()
+        if not employee:
+            warehouse_ns.abort(400, "Employee not found")
+
+        if wants_async():
+            job_id = enqueue('warehouse_import', {'employee_id': employee.id, 'data': payload['data']}, employee.id)
+            return job_accepted(job_id)
+        return import_warehouse_items(payload['data'], employee)
+
+
+@warehouse_ns.route('/upload')
+class WarehouseUpload(Resource):
+    @warehouse_ns.expect(upload_parser)
+    @jwt_required()
+    def post(self):
+        """
+        Import a CSV or XLSX file (multipart ``file``) with the same rules as
+        /excel. Columns: item_name, item_bar, quantity, location, unit_price
+        (or their aliases, or any names mapped with ``columns``). The file is
+        parsed row by row and streamed into the database in chunks.
+        """
+        args = upload_parser.parse_args()
+        employee = Employee.query.filter_by(id=get_jwt_identity()).first()
+        if not employee:
+            warehouse_ns.abort(400, "Employee not found")
+        try:
+            reader = UploadReader(args['file'], WAREHOUSE_UPLOAD_FIELDS,
+                                  required=('item_name', 'item_bar', 'quantity'),
+                                  mapping=args['columns'], sheet=args['sheet'])
+        except UploadError as e:
+            warehouse_ns.abort(400, str(e))
+        return import_warehouse_items(reader, employee)
 
 
 
 
 @warehouse_ns.route('/')
 class WarehouseList(Resource):
+    @conditional_get(tags=("warehouses",))
     @warehouse_ns.marshal_list_with(pagination_model)
     @warehouse_ns.expect(pagination_parser)
     @jwt_required()
-    @cache_result(timeout=300, key_prefix="warehouse_list")
+    @cache_result(timeout=300, key_prefix="warehouse_list", tags=("warehouses",), single_flight=True)
     def get(self):
         """Get all warehouse items with their locations (cached)"""
         args = pagination_parser.parse_args()
@@ -424,15 +230,21 @@ class WarehouseList(Resource):
             warehouse_ns.abort(400, "Page and page_size must be positive integers")
             
         query = Warehouse.query.order_by(Warehouse.id.desc())
-        if all_results:
+        next_cursor = None
+        if args['cursor'] is not None:
+            warehouse_items, next_cursor = keyset_page(query, Warehouse.id, args['cursor'], page_size)
+            all_results = False
+        elif all_results:
             warehouse_items = query.all()
+        else:
+            warehouse_items = query.limit(page_size).offset((page - 1) * page_size).all()
+
+        if all_results:
             total_count = len(warehouse_items)
             total_pages = 1
         else:
-            pagination = query.paginate(page=page, per_page=page_size, error_out=False)
-            warehouse_items = pagination.items
-            total_count = pagination.total
-            total_pages = (total_count + page_size - 1) // page_size
+            total_count = count_rows(query, args['count'], Warehouse)
+            total_pages = page_count(total_count, page_size)
 
         item_ids = [item.id for item in warehouse_items]
         all_locations = ItemLocations.query.filter(ItemLocations.item_id.in_(item_ids)).all() if item_ids else []
@@ -458,11 +270,12 @@ class WarehouseList(Resource):
 
         return {
             'warehouses': result,
-            'page': page if not all_results else None,
+            'page': page if not all_results and args['cursor'] is None else None,
             'page_size': page_size if not all_results else None,
             'total_pages': total_pages if not all_results else None,
             'total_items': total_count,
-            'all': all_results
+            'all': all_results,
+            'next_cursor': next_cursor
         }, 200
 
     @warehouse_ns.marshal_with(warehouse_model)
@@ -506,11 +319,73 @@ class WarehouseList(Resource):
         }
         return response, 201
 
+@warehouse_ns.route('/changes')
+class WarehouseChanges(Resource):
+    @warehouse_ns.marshal_with(changes_model)
+    @warehouse_ns.expect(changes_parser)
+    @jwt_required()
+    def get(self):
+        """
+        Items whose stock changed since a version (delta sync).
+
+        Without ``since`` only the current version is returned with reset=true:
+        load the full list afterwards and pass the version on the next sync.
+        Changed items are returned whole (with all their locations); deleted
+        items are listed by id.
+        """
+        args = changes_parser.parse_args()
+        since = args['since']
+        limit = args['limit']
+        if limit is None or limit < 1:
+            warehouse_ns.abort(400, "limit must be a positive integer")
+        if since is None:
+            return {'items': [], 'deleted': [], 'since': None, 'version': current_version(), 'reset': True, 'has_more': False}, 200
+        if since < 0:
+            warehouse_ns.abort(400, "since must be a version returned by this endpoint")
+
+        item_ids, version, reset, has_more = changes_since(since, limit)
+
+        items = Warehouse.query.filter(Warehouse.id.in_(item_ids)).order_by(Warehouse.id).all() if item_ids else []
+        locations = defaultdict(list)
+        rental_locations = defaultdict(list)
+        if items:
+            found_ids = [item.id for item in items]
+            for loc in ItemLocations.query.filter(ItemLocations.item_id.in_(found_ids)).order_by(ItemLocations.location):
+                locations[loc.item_id].append({"location": loc.location, "quantity": loc.quantity})
+            for loc in RentalWarehouseLocations.query.filter(RentalWarehouseLocations.item_id.in_(found_ids)):
+                rental_locations[loc.item_id].append({
+                    "location": loc.location,
+                    "quantity": loc.quantity,
+                    "reserved_quantity": loc.reserved_quantity,
+                    "available_quantity": loc.available_quantity
+                })
+
+        found = {item.id for item in items}
+        return {
+            'items': [
+                {
+                    "id": item.id,
+                    "item_name": item.item_name,
+                    "item_bar": item.item_bar,
+                    "locations": locations[item.id],
+                    "rental_locations": rental_locations[item.id]
+                }
+                for item in items
+            ],
+            'deleted': [item_id for item_id in item_ids if item_id not in found],
+            'since': since,
+            'version': version,
+            'reset': reset,
+            'has_more': has_more
+        }, 200
+
+
 @warehouse_ns.route('/<int:item_id>')
 class WarehouseDetail(Resource):
+    @conditional_get(tags=("warehouse:{item_id}", "warehouse:*"))
     @warehouse_ns.marshal_with(warehouse_model)
     @jwt_required()
-    @cache_result(timeout=300, key_prefix="warehouse_detail")
+    @cache_result(timeout=300, key_prefix="warehouse_detail", tags=("warehouse:{item_id}", "warehouse:*"))
     def get(self, item_id):
         """Get a warehouse item by ID with its locations (cached)"""
         item = Warehouse.query.get_or_404(item_id)
@@ -591,6 +466,7 @@ class WarehouseDetail(Resource):
         if InvoiceItem.query.filter_by(item_id=item.id).first():
             warehouse_ns.abort(400, "Cannot delete warehouse item with associated sales")
         ItemLocations.query.filter_by(item_id=item.id).delete()
+        StockSummary.query.filter_by(item_id=item.id).delete()
         db.session.delete(item)
         db.session.commit()
 
@@ -603,6 +479,11 @@ class ClearWarehouseCache(Resource):
     @jwt_required()
     def post(self):
         """Clear warehouse-related cache"""
+        from ..redis_config import CACHE_NAMESPACES, invalidate_namespace
+
+        for namespace in CACHE_NAMESPACES:
+            if namespace.startswith("warehouse_"):
+                invalidate_namespace(namespace)
         return {"message": "Warehouse cache cleared successfully"}, 200
 
 @warehouse_ns.route('/cache/status')
@@ -610,18 +491,23 @@ class WarehouseCacheStatus(Resource):
     @jwt_required()
     def get(self):
         """Get warehouse cache status"""
-        from ..redis_config import redis_manager
+        from ..redis_config import redis_manager, CACHE_NAMESPACES, count_entries
         
         if redis_manager.redis_client:
             try:
-                warehouse_keys = redis_manager.redis_client.keys("warehouse_app:warehouse_*")
-                inventory_keys = redis_manager.redis_client.keys("warehouse_app:inventory_*")
+                # Entry counts come from the per-namespace indexes, never from KEYS
+                warehouse_entries = sum(
+                    count_entries(namespace) for namespace in CACHE_NAMESPACES if namespace.startswith("warehouse_")
+                )
+                inventory_entries = sum(
+                    count_entries(namespace) for namespace in CACHE_NAMESPACES if namespace.startswith("inventory_")
+                )
                 
                 return {
                     "status": "active",
-                    "warehouse_cache_entries": len(warehouse_keys),
-                    "inventory_cache_entries": len(inventory_keys),
-                    "total_entries": len(warehouse_keys) + len(inventory_keys)
+                    "warehouse_cache_entries": warehouse_entries,
+                    "inventory_cache_entries": inventory_entries,
+                    "total_entries": warehouse_entries + inventory_entries
                 }, 200
             except Exception as e:
                 return {"status": "error", "message": str(e)}, 500
@@ -0,0 +1 @@
+"""Performance scripts run against a staging copy of the database or a generated dataset (not shipped with the API)"""
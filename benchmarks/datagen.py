@@ -0,0 +1,280 @@
+"""
+Fill a local database with a synthetic, reproducible dataset for the
+benchmark suite (benchmarks/suite.py).
+
+Reference rows (employee, machines, mechanisms, suppliers, items) are
+inserted through the models; every invoice is created by the real operation
+functions through ``process_invoice_batch``, so price layers, FIFO details,
+booking deductions, the stock summary and the change log are exactly what
+the API would have written. The same seed and volumes give the same data.
+
+The schema has to be migrated first (``flask db upgrade``); PostgreSQL is
+required (the change log and row locks rely on it). --reset truncates every
+table: use a local or staging database only.
+
+Usage:
+    FLASK_ENV=development python -m benchmarks.datagen --reset [--items 2000] [--seed 42]
+"""
+import argparse
+import json
+import random
+import time
+
+from sqlalchemy import text
+from werkzeug.security import generate_password_hash
+
+from app import create_app, db
+from app.models import Employee, Machine, Mechanism, Supplier, Warehouse, Invoice
+from app.permissions import PERMISSION_FIELDS
+from app.redis_config import clear_all_cache
+
+BENCH_USERNAME = 'benchmark'
+BENCH_EMPLOYEE_NAME = 'Benchmark'
+LOCATION_FORMAT = 'LOC-{:02d}'
+ITEM_NAME_FORMAT = 'Bench item {:06d}'
+ITEM_BAR_FORMAT = 'BENCH-{:06d}'
+# Invoices per process_invoice_batch call (one transaction each)
+GENERATE_BATCH_SIZE = 200
+
+DEFAULTS = {
+    'items': 2000,
+    'locations': 5,
+    'layers': 4,
+    'machines': 20,
+    'mechanisms': 20,
+    'suppliers': 10,
+    'sales': 2000,
+    'voids': 200,
+    'warranties': 200,
+    'bookings': 200,
+    'rentals': 100,
+    'transfers': 200,
+    'lines': 5,
+}
+
+
+def reset_database():
+    """Empty every application table (the schema and alembic_version are kept)"""
+    tables = ', '.join(f'"{table.name}"' for table in db.metadata.sorted_tables)
+    db.session.execute(text(f"TRUNCATE {tables} RESTART IDENTITY CASCADE"))
+    db.session.commit()
+    clear_all_cache()
+
+
+def create_employee():
+    employee = Employee(
+        username=BENCH_USERNAME,
+        password_hash=generate_password_hash(BENCH_USERNAME),
+        job_name='benchmark',
+        **{name: True for name in PERMISSION_FIELDS},
+    )
+    db.session.add(employee)
+    db.session.commit()
+    return employee
+
+
+def benchmark_employee():
+    return Employee.query.filter_by(username=BENCH_USERNAME).first()
+
+
+def create_references(options):
+    db.session.add_all(Machine(name=f'Machine {n:03d}') for n in range(options.machines))
+    db.session.add_all(Mechanism(name=f'Mechanism {n:03d}') for n in range(options.mechanisms))
+    db.session.add_all(Supplier(name=f'Supplier {n:03d}') for n in range(options.suppliers))
+    db.session.add_all(
+        Warehouse(item_name=ITEM_NAME_FORMAT.format(n), item_bar=ITEM_BAR_FORMAT.format(n))
+        for n in range(options.items)
+    )
+    db.session.commit()
+
+
+class Generator:
+    """Builds invoice payloads against an in-memory copy of the stock it created"""
+
+    def __init__(self, options, employee):
+        self.options = options
+        self.employee = employee
+        self.rng = random.Random(options.seed)
+        self.locations = [LOCATION_FORMAT.format(n + 1) for n in range(options.locations)]
+        # (item number, location) -> quantity on hand
+        self.stock = {}
+        self.counts = {}
+
+    def _header(self, invoice_type, with_machine=True):
+        data = {
+            'type': invoice_type,
+            'client_name': f'Client {self.rng.randrange(500):03d}',
+            'employee_name': BENCH_EMPLOYEE_NAME,
+            'status': 'draft',
+        }
+        if with_machine:
+            data['machine_name'] = f'Machine {self.rng.randrange(self.options.machines):03d}'
+            data['mechanism_name'] = f'Mechanism {self.rng.randrange(self.options.mechanisms):03d}'
+        return data
+
+    def _pick_stock(self, count, max_quantity):
+        """Up to ``count`` distinct (item, location) lines with stock; quantities are reserved"""
+        available = [key for key, quantity in self.stock.items() if quantity > 0]
+        lines = []
+        for key in self.rng.sample(available, min(count, len(available))):
+            quantity = self.rng.randint(1, min(max_quantity, self.stock[key]))
+            self.stock[key] -= quantity
+            lines.append((key, quantity))
+        return lines
+
+    def _line(self, key, quantity, **extra):
+        item, location = key
+        return {'item_name': ITEM_NAME_FORMAT.format(item), 'location': location, 'quantity': quantity, **extra}
+
+    def purchases(self):
+        """``layers`` purchase rounds over every item: each round adds one price layer per item"""
+        items = list(range(self.options.items))
+        home = {item: self.rng.choice(self.locations) for item in items}
+        for _ in range(self.options.layers):
+            self.rng.shuffle(items)
+            for start in range(0, len(items), self.options.lines):
+                data = self._header('اضافه', with_machine=False)
+                data['items'] = []
+                lines = []
+                for item in items[start:start + self.options.lines]:
+                    # Most layers land on the item's home location, some elsewhere
+                    location = home[item] if self.rng.random() < 0.8 else self.rng.choice(self.locations)
+                    quantity = self.rng.randint(20, 200)
+                    unit_price = round(self.rng.uniform(1, 500), 2)
+                    data['items'].append(self._line(
+                        (item, location), quantity,
+                        unit_price=unit_price, total_price=round(quantity * unit_price, 2),
+                        supplier_name=f'Supplier {self.rng.randrange(self.options.suppliers):03d}',
+                    ))
+                    lines.append(((item, location), quantity))
+                yield data, lines
+
+    def withdrawals(self, invoice_type, count, max_quantity):
+        for _ in range(count):
+            lines = self._pick_stock(self.rng.randint(1, self.options.lines), max_quantity)
+            if not lines:
+                return
+            data = self._header(invoice_type)
+            data['items'] = [self._line(key, quantity) for key, quantity in lines]
+            yield data, lines
+
+    def transfers(self):
+        for _ in range(self.options.transfers):
+            lines = self._pick_stock(self.rng.randint(1, self.options.lines), 20)
+            if not lines:
+                return
+            data = self._header('تحويل', with_machine=False)
+            data['items'] = []
+            for (item, location), quantity in lines:
+                new_location = self.rng.choice([other for other in self.locations if other != location] or [location])
+                data['items'].append(self._line((item, location), quantity, new_location=new_location))
+            yield data, lines
+
+
+def _item_number(name):
+    return int(name.rsplit(' ', 1)[1])
+
+
+def run_batches(generator, kind, payloads, on_success=None):
+    """Create payloads through process_invoice_batch; failed invoices give their reserved stock back"""
+    from app.routes import process_invoice_batch
+
+    created = failed = 0
+    batch = []
+
+    def flush():
+        nonlocal created, failed
+        result = process_invoice_batch([data for data, _ in batch], generator.employee)
+        for (data, lines), entry in zip(batch, result['invoice'] or []):
+            if entry['status'] == 'success':
+                created += 1
+                if on_success:
+                    on_success(data, lines, entry['invoice_id'])
+            else:
+                failed += 1
+                if data['type'] != 'اضافه':
+                    for key, quantity in lines:
+                        generator.stock[key] += quantity
+        batch.clear()
+
+    for data, lines in payloads:
+        batch.append((data, lines))
+        if len(batch) >= GENERATE_BATCH_SIZE:
+            flush()
+    if batch:
+        flush()
+    generator.counts[kind] = {'created': created, 'failed': failed}
+
+
+def generate(options):
+    employee = benchmark_employee() or create_employee()
+    create_references(options)
+    generator = Generator(options, employee)
+    started = time.perf_counter()
+
+    def stock_in(data, lines, invoice_id):
+        for key, quantity in lines:
+            generator.stock[key] = generator.stock.get(key, 0) + quantity
+
+    def stock_moved(data, lines, invoice_id):
+        for line in data['items']:
+            key = (_item_number(line['item_name']), line['new_location'])
+            generator.stock[key] = generator.stock.get(key, 0) + line['quantity']
+
+    rentals = []
+
+    def rented(data, lines, invoice_id):
+        rentals.extend((invoice_id, _item_number(line['item_name'])) for line in data['items'])
+
+    run_batches(generator, 'purchases', generator.purchases(), on_success=stock_in)
+    run_batches(generator, 'transfers', generator.transfers(), on_success=stock_moved)
+    run_batches(generator, 'bookings', generator.withdrawals('حجز', options.bookings, 5))
+    run_batches(generator, 'rentals', generator.withdrawals('حجز', options.rentals, 5), on_success=rented)
+    run_batches(generator, 'sales', generator.withdrawals('صرف', options.sales, 10))
+    run_batches(generator, 'voids', generator.withdrawals('توالف', options.voids, 3))
+    run_batches(generator, 'warranties', generator.withdrawals('أمانات', options.warranties, 3))
+
+    # Rentals are bookings handed over to the customer
+    from app.operations.rent import update_rental_status
+    item_ids = dict(db.session.query(Warehouse.item_bar, Warehouse.id).all())
+    for invoice_id, item in rentals:
+        update_rental_status(invoice_id, item_ids[ITEM_BAR_FORMAT.format(item)], 'given', employee.id)
+
+    clear_all_cache()
+    return {
+        'seed': options.seed,
+        'volumes': {name: getattr(options, name) for name in DEFAULTS},
+        'invoices': generator.counts,
+        'invoice_rows': Invoice.query.count(),
+        'seconds': round(time.perf_counter() - started, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--seed', type=int, default=42, help='Random seed (same seed and volumes, same data)')
+    parser.add_argument('--reset', action='store_true', help='Truncate every table first')
+    for name, default in DEFAULTS.items():
+        parser.add_argument(f'--{name}', type=int, default=default, help=f'default: {default}')
+    args = parser.parse_args()
+    if args.items < 1 or args.locations < 1 or args.lines < 1:
+        parser.error('--items, --locations and --lines must be positive')
+
+    app = create_app()
+    with app.app_context():
+        if db.engine.dialect.name != 'postgresql':
+            parser.error('The generator needs PostgreSQL')
+        if args.reset:
+            reset_database()
+        elif Warehouse.query.first() is not None:
+            parser.error('The database is not empty; pass --reset to truncate it first')
+
+        # Operations keep per-request state on flask.g
+        with app.test_request_context():
+            summary = generate(args)
+
+    print(json.dumps(summary, ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
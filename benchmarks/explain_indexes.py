@@ -0,0 +1,234 @@
+"""
+Before/after EXPLAIN ANALYZE timings for the hot-path indexes
+(migrations/versions/5c1e9a7d3b20_add_hot_path_indexes.py).
+
+Each case is the query an endpoint runs, with parameters sampled from the
+current data. It is timed with the indexes in place ("after"), then again
+after dropping them inside a transaction that is rolled back ("before"), so
+the schema is left untouched.
+
+DROP INDEX holds an ACCESS EXCLUSIVE lock on the table until the rollback:
+run this against a staging copy, never against production.
+
+Usage:
+    FLASK_ENV=development python -m benchmarks.explain_indexes [--runs 5] [--json]
+"""
+import argparse
+import json
+import statistics
+
+from sqlalchemy import text
+
+from app import create_app, db
+
+
+SAMPLE_QUERIES = {
+    'item_id': """
+        SELECT item_id FROM prices WHERE quantity > 0
+        GROUP BY item_id ORDER BY count(*) DESC LIMIT 1
+    """,
+    'location': """
+        SELECT location FROM prices WHERE item_id = :item_id AND quantity > 0 LIMIT 1
+    """,
+    'detail_invoice_ids': """
+        SELECT DISTINCT invoice_id FROM invoice_price_detail ORDER BY invoice_id DESC LIMIT 10
+    """,
+    'source': """
+        SELECT source_price_invoice_id, source_price_item_id, source_price_location
+        FROM invoice_price_detail ORDER BY id DESC LIMIT 1
+    """,
+    'return_invoice_ids': """
+        SELECT id FROM invoice WHERE type = 'مرتجع' ORDER BY id DESC LIMIT 10
+    """,
+    'rented_item_id': """
+        SELECT item_id FROM rented_items GROUP BY item_id ORDER BY count(*) DESC LIMIT 1
+    """,
+}
+
+# name, endpoint(s) the query comes from, indexes it relies on, SQL
+CASES = [
+    (
+        'fifo_open_layers',
+        'POST /invoice/ (صرف, توالف, أمانات) -> fifo.open_layers',
+        ['ix_prices_open_layers'],
+        """
+        SELECT * FROM prices
+        WHERE item_id = :item_id AND quantity > 0 AND location = :location
+        ORDER BY invoice_id, location, supplier_id LIMIT 20
+        """,
+    ),
+    (
+        'latest_layer',
+        'POST /invoice/ (fill_from_latest) -> fifo.latest_layer',
+        ['ix_prices_item_invoice'],
+        """
+        SELECT * FROM prices WHERE item_id = :item_id ORDER BY invoice_id DESC LIMIT 1
+        """,
+    ),
+    (
+        'invoice_page_price_details',
+        'GET /invoice/, GET /invoice/<type> -> serializers.load_invoice_bundle',
+        ['ix_invoice_price_detail_invoice_item'],
+        """
+        SELECT * FROM invoice_price_detail WHERE invoice_id = ANY(:detail_invoice_ids)
+        """,
+    ),
+    (
+        'price_details_by_source',
+        'PUT /invoice/<id> (اضافه) -> purchase price update',
+        ['ix_invoice_price_detail_source'],
+        """
+        SELECT * FROM invoice_price_detail
+        WHERE source_price_invoice_id = :source_price_invoice_id
+          AND source_price_item_id = :source_price_item_id
+          AND source_price_location = :source_price_location
+        """,
+    ),
+    (
+        'invoice_items_by_item',
+        'GET /reports/filter?type=item, DELETE /warehouse/<id>',
+        ['ix_invoice_item_item_id'],
+        """
+        SELECT * FROM invoice_item WHERE item_id = :item_id
+        """,
+    ),
+    (
+        'invoices_by_status',
+        'GET /invoice/لم-تراجع',
+        ['ix_invoice_type_status_id'],
+        """
+        SELECT * FROM invoice
+        WHERE status = 'draft' AND type IN ('اضافه', 'صرف', 'مرتجع', 'توالف')
+        ORDER BY id DESC LIMIT 10
+        """,
+    ),
+    (
+        'return_sales_lookup',
+        'GET /invoice/مرتجع -> serializers.load_invoice_bundle',
+        ['ix_return_sales_return_invoice_id'],
+        """
+        SELECT * FROM return_sales WHERE return_invoice_id = ANY(:return_invoice_ids)
+        """,
+    ),
+    (
+        'reserved_rentals_by_item',
+        'POST /invoice/ (صرف from bookings), rental borrow',
+        ['idx_rented_items_item_status_created'],
+        """
+        SELECT * FROM rented_items
+        WHERE item_id = :rented_item_id AND status = 'reserved'
+        ORDER BY created_at
+        """,
+    ),
+]
+
+
+def load_samples(connection):
+    """Pick representative parameter values from the current data"""
+    item_id = connection.execute(text(SAMPLE_QUERIES['item_id'])).scalar()
+    location = connection.execute(text(SAMPLE_QUERIES['location']), {'item_id': item_id}).scalar()
+    source = connection.execute(text(SAMPLE_QUERIES['source'])).first()
+    return {
+        'item_id': item_id,
+        'location': location,
+        'detail_invoice_ids': connection.execute(text(SAMPLE_QUERIES['detail_invoice_ids'])).scalars().all(),
+        'source_price_invoice_id': source[0] if source else None,
+        'source_price_item_id': source[1] if source else None,
+        'source_price_location': source[2] if source else None,
+        'return_invoice_ids': connection.execute(text(SAMPLE_QUERIES['return_invoice_ids'])).scalars().all(),
+        'rented_item_id': connection.execute(text(SAMPLE_QUERIES['rented_item_id'])).scalar(),
+    }
+
+
+def explain(connection, sql, params, runs):
+    """Median execution time (ms) over ``runs`` EXPLAIN ANALYZE runs, plus the last plan's top node"""
+    timings = []
+    plan = None
+    for _ in range(runs):
+        result = connection.execute(text(f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {sql}"), params).scalar()
+        if isinstance(result, str):
+            result = json.loads(result)
+        plan = result[0]
+        timings.append(plan['Execution Time'])
+    return statistics.median(timings), plan['Plan']['Node Type']
+
+
+def existing_indexes(connection, names):
+    rows = connection.execute(
+        text("SELECT indexname FROM pg_indexes WHERE indexname = ANY(:names)"), {'names': names}
+    )
+    return {row[0] for row in rows}
+
+
+def run_case(engine, case, samples, runs):
+    name, endpoint, indexes, sql = case
+    params = {key: value for key, value in samples.items() if f':{key}' in sql}
+    if any(value is None for value in params.values()):
+        return {'case': name, 'endpoint': endpoint, 'skipped': 'no sample data'}
+
+    with engine.connect() as connection:
+        transaction = connection.begin()
+        try:
+            missing = set(indexes) - existing_indexes(connection, indexes)
+            if missing:
+                return {'case': name, 'endpoint': endpoint, 'skipped': f"missing indexes: {', '.join(sorted(missing))}"}
+
+            after_ms, after_node = explain(connection, sql, params, runs)
+            for index in indexes:
+                connection.execute(text(f'DROP INDEX "{index}"'))
+            before_ms, before_node = explain(connection, sql, params, runs)
+        finally:
+            transaction.rollback()
+
+    return {
+        'case': name,
+        'endpoint': endpoint,
+        'indexes': indexes,
+        'before_ms': round(before_ms, 3),
+        'before_plan': before_node,
+        'after_ms': round(after_ms, 3),
+        'after_plan': after_node,
+        'speedup': round(before_ms / after_ms, 1) if after_ms else None,
+    }
+
+
+def print_table(results):
+    print(f"{'case':<28} {'before ms':>10} {'after ms':>10} {'speedup':>8}  plan (before -> after)")
+    for result in results:
+        if 'skipped' in result:
+            print(f"{result['case']:<28} skipped: {result['skipped']}")
+            continue
+        print(
+            f"{result['case']:<28} {result['before_ms']:>10} {result['after_ms']:>10} "
+            f"{str(result['speedup']) + 'x':>8}  {result['before_plan']} -> {result['after_plan']}"
+        )
+        print(f"{'':<28} {result['endpoint']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5, help='EXPLAIN ANALYZE runs per case (median is reported)')
+    parser.add_argument('--case', action='append', help='Only run the named case (repeatable)')
+    parser.add_argument('--json', action='store_true', help='Print results as JSON')
+    args = parser.parse_args()
+
+    app = create_app()
+    with app.app_context():
+        engine = db.engine
+        if engine.dialect.name != 'postgresql':
+            parser.error('EXPLAIN ANALYZE timings need PostgreSQL')
+
+        with engine.connect() as connection:
+            samples = load_samples(connection)
+
+        cases = [case for case in CASES if not args.case or case[0] in args.case]
+        results = [run_case(engine, case, samples, args.runs) for case in cases]
+
+    if args.json:
+        print(json.dumps(results, ensure_ascii=False, indent=2))
+    else:
+        print_table(results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,219 @@
+"""
+SQL statement budgets per endpoint.
+
+Generates the benchmark dataset at N and at 10N (benchmarks/datagen.py),
+calls every read route of the invoice, rental, warehouse, reports, machine,
+mechanism, supplier and auth namespaces, plus the sales and transfer
+operations (rolled back), and counts the statements each call sends. A case
+fails when it goes over its budget or needs more statements at 10N than at
+N, which is what a per-row query inside a loop looks like. A GET route of
+those namespaces without a case fails as well, so new routes get a budget.
+
+Each call runs once to warm the reference and permission caches; response
+caches are then cleared and the second call is counted.
+
+Every table is truncated before each dataset is generated: local databases
+only.
+
+Usage:
+    FLASK_ENV=development python -m benchmarks.query_budget [--items 200] [--json]
+"""
+import argparse
+import json
+import sys
+
+from sqlalchemy import func
+
+from app import create_app, db
+from app.models import Invoice, InvoiceItem, Machine, Mechanism, Supplier, Prices, RentedItems
+from app.redis_config import clear_all_cache
+
+from .datagen import DEFAULTS, benchmark_employee, generate, reset_database
+from .suite import Bench, BenchmarkError, QueryCounter, sales_operation, transfer_operation
+
+NAMESPACE_PREFIXES = ('/invoice', '/rental', '/warehouse', '/reports', '/machine', '/mechanism', '/supplier', '/auth')
+# Volumes that grow with the dataset; layers, locations and lines per invoice stay fixed
+SCALED_VOLUMES = ('items', 'sales', 'voids', 'warranties', 'bookings', 'rentals', 'transfers')
+SCALE_FACTOR = 10
+PAGE = {'all': 'false', 'page': 1, 'page_size': 50}
+
+# name, Flask rule, path (filled from the samples), query string, statement budget
+CASES = [
+    ('invoice_list', '/invoice/', '/invoice/', PAGE, 10),
+    ('invoice_list_by_type', '/invoice/<string:type>', '/invoice/صرف', PAGE, 10),
+    ('invoice_detail', '/invoice/<int:invoice_id>', '/invoice/{sales_invoice_id}', {}, 10),
+    ('invoice_last_id', '/invoice/last-id', '/invoice/last-id', {}, 3),
+    ('fifo_prices', '/invoice/fifo-prices/<int:item_id>', '/invoice/fifo-prices/{item_id}', {}, 5),
+    ('warranty_return_status', '/invoice/<int:invoice_id>/WarrantyReturnStatus',
+     '/invoice/{warranty_invoice_id}/WarrantyReturnStatus', {}, 20),
+    ('inventory_value', '/invoice/inventory-value', '/invoice/inventory-value', PAGE, 5),
+    ('sales_invoices', '/invoice/sales-invoices', '/invoice/sales-invoices', {}, 3),
+    ('price_report', '/invoice/price-report/<int:invoice_id>', '/invoice/price-report/{sales_invoice_id}', {}, 12),
+    ('fifo_report', '/invoice/fifo-report', '/invoice/fifo-report', PAGE, 8),
+    ('rental_items', '/rental/items', '/rental/items', {}, 5),
+    ('rental_warehouse', '/rental/warehouse', '/rental/warehouse', {}, 4),
+    ('rental_missing_qty', '/rental/missing-qty/<int:invoice_id>', '/rental/missing-qty/{rental_invoice_id}', {}, 15),
+    ('warehouse_list', '/warehouse/', '/warehouse/', PAGE, 5),
+    ('warehouse_detail', '/warehouse/<int:item_id>', '/warehouse/{item_id}', {}, 4),
+    ('warehouse_changes', '/warehouse/changes', '/warehouse/changes', {'since': 0}, 4),
+    ('warehouse_cache_status', '/warehouse/cache/status', '/warehouse/cache/status', {}, 2),
+    ('reports_tables', '/reports/', '/reports/', PAGE, 25),
+    ('reports_filter_invoices', '/reports/filter', '/reports/filter', {**PAGE, 'type': 'invoice'}, 12),
+    ('reports_filter_items', '/reports/filter', '/reports/filter', {**PAGE, 'type': 'item'}, 12),
+    ('machine_list', '/machine/', '/machine/', PAGE, 4),
+    ('machine_detail', '/machine/<int:machine_id>', '/machine/{machine_id}', {}, 3),
+    ('mechanism_list', '/mechanism/', '/mechanism/', PAGE, 4),
+    ('mechanism_detail', '/mechanism/<int:mechanism_id>', '/mechanism/{mechanism_id}', {}, 3),
+    ('supplier_list', '/supplier/', '/supplier/', PAGE, 4),
+    ('supplier_detail', '/supplier/<int:supplier_id>', '/supplier/{supplier_id}', {}, 3),
+    ('auth_users', '/auth/users', '/auth/users', PAGE, 4),
+    ('auth_current_user', '/auth/user', '/auth/user', {}, 3),
+]
+
+# Operations (rolled back): name, suite setup, statement budget
+OPERATION_CASES = [
+    ('sales_operation', sales_operation, 60),
+    ('transfer_operation', transfer_operation, 60),
+]
+
+# GET routes that are not measured, and why
+EXCLUDED_RULES = {
+    '/invoice/updateprice/<int:invoice_id>': 'writes prices despite being a GET',
+}
+
+
+def scaled_options(items, factor, seed):
+    options = argparse.Namespace(seed=seed, **DEFAULTS)
+    scale = items * factor / DEFAULTS['items']
+    for name in SCALED_VOLUMES:
+        setattr(options, name, max(1, round(DEFAULTS[name] * scale)))
+    return options
+
+
+def load_samples(employee):
+    def busiest_invoice(invoice_type):
+        row = db.session.query(InvoiceItem.invoice_id).join(Invoice).filter(
+            Invoice.type == invoice_type
+        ).group_by(InvoiceItem.invoice_id).order_by(func.count().desc(), InvoiceItem.invoice_id).first()
+        return row[0] if row else None
+
+    item = db.session.query(Prices.item_id).group_by(Prices.item_id).order_by(
+        func.count().desc(), Prices.item_id
+    ).first()
+    rental = db.session.query(RentedItems.rental_invoice_id).order_by(RentedItems.rental_invoice_id).first()
+    return {
+        'sales_invoice_id': busiest_invoice('صرف'),
+        'warranty_invoice_id': busiest_invoice('أمانات'),
+        'rental_invoice_id': rental[0] if rental else None,
+        'item_id': item[0] if item else None,
+        'machine_id': db.session.query(func.min(Machine.id)).scalar(),
+        'mechanism_id': db.session.query(func.min(Mechanism.id)).scalar(),
+        'supplier_id': db.session.query(func.min(Supplier.id)).scalar(),
+        'user_id': employee.id,
+    }
+
+
+def count_statements(run, counter):
+    """Statements of one call made after a warm-up call, with response caches cleared"""
+    run()
+    clear_all_cache()
+    with counter:
+        run()
+    return counter.count
+
+
+def measure_dataset(app, options):
+    """Statement count per case on a freshly generated dataset ({name: count or error string})"""
+    reset_database()
+    with app.test_request_context():
+        generate(options)
+
+    employee = benchmark_employee()
+    samples = load_samples(employee)
+    bench = Bench(app, employee)
+    counter = QueryCounter(db.engine)
+
+    counts = {}
+    for name, rule, path, params, budget in CASES:
+        try:
+            counts[name] = count_statements(bench.get(path.format(**samples), **params), counter)
+        except (BenchmarkError, KeyError) as e:
+            counts[name] = f'error: {e}'
+    for name, setup, budget in OPERATION_CASES:
+        try:
+            run = setup(bench)
+            counts[name] = count_statements(run, counter) if run else 'error: no sample data'
+        except BenchmarkError as e:
+            db.session.rollback()
+            counts[name] = f'error: {e}'
+    return counts
+
+
+def uncovered_rules(app):
+    """GET routes of the checked namespaces with neither a case nor an exclusion"""
+    covered = {rule for _, rule, _, _, _ in CASES} | set(EXCLUDED_RULES)
+    missing = []
+    for rule in app.url_map.iter_rules():
+        path = rule.rule
+        if 'GET' not in rule.methods or path in covered:
+            continue
+        if any(path == prefix or path.startswith(prefix + '/') for prefix in NAMESPACE_PREFIXES):
+            missing.append(path)
+    return sorted(missing)
+
+
+def evaluate(small, large):
+    budgets = {case[0]: case[-1] for case in CASES}
+    budgets.update({name: budget for name, _, budget in OPERATION_CASES})
+    rows = []
+    for name, budget in budgets.items():
+        at_n, at_10n = small.get(name), large.get(name)
+        if isinstance(at_n, str) or isinstance(at_10n, str):
+            status = at_n if isinstance(at_n, str) else at_10n
+        elif at_10n > budget:
+            status = 'over budget'
+        elif at_10n > at_n:
+            status = 'grows with N'
+        else:
+            status = 'ok'
+        rows.append({'case': name, 'n': at_n, '10n': at_10n, 'budget': budget, 'status': status})
+    return rows
+
+
+def print_table(rows, missing):
+    print(f"{'case':<26} {'N':>6} {'10N':>6} {'budget':>7}  status")
+    for row in rows:
+        print(f"{row['case']:<26} {str(row['n']):>6} {str(row['10n']):>6} {row['budget']:>7}  {row['status']}")
+    for path in missing:
+        print(f"{'(no budget)':<26} {'':>6} {'':>6} {'':>7}  GET {path} has no case")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--items', type=int, default=200, help='Items at size N (other volumes scale with it)')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--json', action='store_true', help='Print results as JSON')
+    args = parser.parse_args()
+    if args.items < 1:
+        parser.error('--items must be positive')
+
+    app = create_app()
+    with app.app_context():
+        if db.engine.dialect.name != 'postgresql':
+            parser.error('The dataset generator needs PostgreSQL')
+        small = measure_dataset(app, scaled_options(args.items, 1, args.seed))
+        large = measure_dataset(app, scaled_options(args.items, SCALE_FACTOR, args.seed))
+        missing = uncovered_rules(app)
+
+    rows = evaluate(small, large)
+    if args.json:
+        print(json.dumps({'cases': rows, 'uncovered_routes': missing}, ensure_ascii=False, indent=2))
+    else:
+        print_table(rows, missing)
+
+    if missing or any(row['status'] != 'ok' for row in rows):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
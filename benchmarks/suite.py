@@ -0,0 +1,403 @@
+"""
+Timed scenarios over a dataset made by benchmarks/datagen.py.
+
+Operations (Sales_Operations, Transfer_Operations, put_purchase price
+cascades) run on the busiest items of the dataset inside a savepoint that is
+rolled back, so they can be repeated on unchanged data. Endpoints go through
+the Flask test client with the benchmark employee's token; their caches are
+cleared before every run, so the cold path is measured. The Excel imports
+commit new rows (fresh names and barcodes every run) and go last.
+
+Every scenario reports the median/min/max wall time and the SQL statement
+count per run. Results are written as JSON; --compare prints the change
+against an earlier file and exits with status 1 when a median regressed
+by more than --threshold percent. Compare runs made on the same dataset
+(same seed and volumes, freshly generated).
+
+Usage:
+    FLASK_ENV=development python -m benchmarks.suite [--runs 5] [--output head.json] [--compare base.json]
+    python -m benchmarks.suite --results head.json --compare base.json
+"""
+import argparse
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+from flask_jwt_extended import create_access_token
+from sqlalchemy import event, func
+
+from app import create_app, db
+from app.models import (
+    Machine, Mechanism, Warehouse, ItemLocations, Prices, Invoice, InvoiceItem, InvoicePriceDetail, RentedItems,
+)
+from app.permissions import permission_claims
+from app.redis_config import clear_all_cache
+from app.transactions import operation_savepoint
+
+from .datagen import BENCH_EMPLOYEE_NAME, benchmark_employee
+
+# Lines per benchmarked sales/transfer invoice
+OPERATION_LINES = 5
+IMPORT_ROWS = 500
+LIST_PAGE_SIZE = 50
+REPORT_PAGE_SIZE = 100
+DATASET_MODELS = (Warehouse, ItemLocations, Prices, Invoice, InvoiceItem, InvoicePriceDetail, RentedItems)
+
+
+class BenchmarkError(Exception):
+    pass
+
+
+class QueryCounter:
+    """Counts statements sent to the database while attached"""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.count = 0
+
+    def _count(self, *args):
+        self.count += 1
+
+    def __enter__(self):
+        self.count = 0
+        event.listen(self.engine, 'before_cursor_execute', self._count)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(self.engine, 'before_cursor_execute', self._count)
+
+
+class Bench:
+    """What the scenarios share: the app, a logged-in test client and a run tag for fresh names"""
+
+    def __init__(self, app, employee):
+        self.app = app
+        self.employee = employee
+        self.client = app.test_client()
+        token = create_access_token(identity=str(employee.id), additional_claims=permission_claims(employee))
+        self.headers = {'Authorization': f'Bearer {token}'}
+        self.tag = datetime.now().strftime('%Y%m%d%H%M%S')
+        self.sequence = 0
+
+    def next_tag(self):
+        self.sequence += 1
+        return f'{self.tag}-{self.sequence}'
+
+    def rolled_back(self, operation):
+        """Run an operation in a savepoint and roll the whole transaction back"""
+        def run():
+            with self.app.test_request_context():
+                try:
+                    with operation_savepoint():
+                        result = operation()
+                finally:
+                    db.session.rollback()
+            if isinstance(result, dict) and result.get('status') == 'error':
+                raise BenchmarkError(result['message'])
+        return run
+
+    def get(self, path, **params):
+        def run():
+            response = self.client.get(path, query_string=params, headers=self.headers)
+            if response.status_code >= 400:
+                raise BenchmarkError(f"GET {path}: {response.status_code} {response.get_data(as_text=True)[:200]}")
+        return run
+
+    def post(self, path, payload_factory):
+        def run():
+            response = self.client.post(path, json=payload_factory(), headers=self.headers)
+            if response.status_code >= 400:
+                raise BenchmarkError(f"POST {path}: {response.status_code} {response.get_data(as_text=True)[:200]}")
+        return run
+
+
+# ---- Sample data: the items with the most open price layers ----
+
+def layered_stock(limit):
+    """(item_name, location, on-hand quantity) of the item locations with the most open layers"""
+    layers = db.session.query(
+        Prices.item_id, Prices.location, func.count().label('layers')
+    ).filter(Prices.quantity > 0).group_by(Prices.item_id, Prices.location).subquery()
+    rows = db.session.query(Warehouse.item_name, ItemLocations.location, ItemLocations.quantity).join(
+        ItemLocations, ItemLocations.item_id == Warehouse.id
+    ).join(
+        layers, (layers.c.item_id == ItemLocations.item_id) & (layers.c.location == ItemLocations.location)
+    ).filter(ItemLocations.quantity > 0).order_by(layers.c.layers.desc(), Warehouse.id).limit(limit * 4).all()
+
+    picked, names = [], set()
+    for row in rows:
+        if row.item_name not in names:
+            names.add(row.item_name)
+            picked.append(row)
+    return picked[:limit]
+
+
+def other_location(location):
+    row = db.session.query(ItemLocations.location).filter(
+        ItemLocations.location != location
+    ).distinct().order_by(ItemLocations.location).first()
+    return row[0] if row else f'{location}-B'
+
+
+# ---- Scenarios: setup(bench) -> callable timed per run, or None when the data is missing ----
+
+def sales_operation(bench):
+    from app.routes import create_invoice
+    from app.lookups import find_machine, find_mechanism
+    stock = layered_stock(OPERATION_LINES)
+    machine, mechanism = Machine.query.first(), Mechanism.query.first()
+    if not stock or machine is None or mechanism is None:
+        return None
+    data = {
+        'type': 'صرف',
+        'client_name': 'Benchmark client',
+        'employee_name': BENCH_EMPLOYEE_NAME,
+        'machine_name': machine.name,
+        'mechanism_name': mechanism.name,
+        # All stock of the location: consumes every open layer
+        'items': [{'item_name': row.item_name, 'location': row.location, 'quantity': row.quantity} for row in stock],
+    }
+    return bench.rolled_back(lambda: create_invoice(
+        data, find_machine(data['machine_name']), find_mechanism(data['mechanism_name']), None, bench.employee
+    ))
+
+
+def transfer_operation(bench):
+    from app.routes import create_invoice
+    stock = layered_stock(OPERATION_LINES)
+    if not stock:
+        return None
+    data = {
+        'type': 'تحويل',
+        'employee_name': BENCH_EMPLOYEE_NAME,
+        'items': [
+            {'item_name': row.item_name, 'location': row.location, 'quantity': row.quantity,
+             'new_location': other_location(row.location)}
+            for row in stock
+        ],
+    }
+    return bench.rolled_back(lambda: create_invoice(data, None, None, None, bench.employee))
+
+
+def purchase_price_cascade(bench):
+    """Change every price of the purchase whose layers were consumed most"""
+    from app.purchases.purchase import put_purchase
+    from app.routes import invoice_ns
+    row = db.session.query(
+        InvoicePriceDetail.source_price_invoice_id, func.count()
+    ).join(Invoice, Invoice.id == InvoicePriceDetail.source_price_invoice_id).filter(
+        Invoice.type == 'اضافه'
+    ).group_by(InvoicePriceDetail.source_price_invoice_id).order_by(func.count().desc()).first()
+    if row is None:
+        return None
+    invoice_id = row[0]
+    items = InvoiceItem.query.filter_by(invoice_id=invoice_id).all()
+    data = {
+        'type': 'اضافه',
+        'items': [
+            {'item_name': item.warehouse.item_name, 'location': item.location, 'quantity': item.quantity,
+             'unit_price': round(item.unit_price + 1, 2), 'supplier_name': item.supplier_name or ''}
+            for item in items
+        ],
+    }
+    return bench.rolled_back(lambda: put_purchase(data, Invoice.query.get(invoice_id), None, None, invoice_ns))
+
+
+def invoice_list(bench):
+    return bench.get('/invoice/', all='false', page=1, page_size=LIST_PAGE_SIZE)
+
+
+def invoice_list_by_type(bench):
+    return bench.get('/invoice/صرف', all='false', page=1, page_size=LIST_PAGE_SIZE)
+
+
+def fifo_report(bench):
+    return bench.get('/invoice/fifo-report', all='false', page=1, page_size=REPORT_PAGE_SIZE)
+
+
+def reports_filter_invoices(bench):
+    return bench.get('/reports/filter', type='invoice', all='false', page=1, page_size=REPORT_PAGE_SIZE)
+
+
+def reports_filter_items(bench):
+    return bench.get('/reports/filter', type='item', all='false', page=1, page_size=REPORT_PAGE_SIZE)
+
+
+def warehouse_excel_import(bench):
+    locations = [row[0] for row in db.session.query(ItemLocations.location).distinct().limit(5)] or ['raf1']
+
+    def payload():
+        tag = bench.next_tag()
+        return {'data': [
+            {'item_name': f'Import {tag} {n}', 'item_bar': f'IMPORT-{tag}-{n}',
+             'location': locations[n % len(locations)], 'quantity': 10 + n % 50, 'unit_price': 1 + n % 100}
+            for n in range(IMPORT_ROWS)
+        ]}
+    return bench.post('/warehouse/excel', payload)
+
+
+def machine_excel_import(bench):
+    return bench.post('/machine/excel', lambda: {'data': [
+        {'name': f'Import machine {bench.next_tag()}', 'description': 'benchmark'} for _ in range(IMPORT_ROWS)
+    ]})
+
+
+def mechanism_excel_import(bench):
+    return bench.post('/mechanism/excel', lambda: {'data': [
+        {'name': f'Import mechanism {bench.next_tag()}', 'description': 'benchmark'} for _ in range(IMPORT_ROWS)
+    ]})
+
+
+# name, what is measured, setup; the imports change the data and stay last
+SCENARIOS = [
+    ('sales_operation', f'Sales_Operations, {OPERATION_LINES} lines over many FIFO layers', sales_operation),
+    ('transfer_operation', f'Transfer_Operations, {OPERATION_LINES} lines over many FIFO layers', transfer_operation),
+    ('purchase_price_cascade', 'put_purchase repricing the most consumed purchase', purchase_price_cascade),
+    ('invoice_list', f'GET /invoice/ (page of {LIST_PAGE_SIZE})', invoice_list),
+    ('invoice_list_by_type', f'GET /invoice/صرف (page of {LIST_PAGE_SIZE})', invoice_list_by_type),
+    ('fifo_report', f'GET /invoice/fifo-report (page of {REPORT_PAGE_SIZE})', fifo_report),
+    ('reports_filter_invoices', f'GET /reports/filter?type=invoice (page of {REPORT_PAGE_SIZE})', reports_filter_invoices),
+    ('reports_filter_items', f'GET /reports/filter?type=item (page of {REPORT_PAGE_SIZE})', reports_filter_items),
+    ('warehouse_excel_import', f'POST /warehouse/excel ({IMPORT_ROWS} rows)', warehouse_excel_import),
+    ('machine_excel_import', f'POST /machine/excel ({IMPORT_ROWS} rows)', machine_excel_import),
+    ('mechanism_excel_import', f'POST /mechanism/excel ({IMPORT_ROWS} rows)', mechanism_excel_import),
+]
+
+
+def measure(run, runs, warmup, counter):
+    for _ in range(warmup):
+        clear_all_cache()
+        run()
+    timings, queries = [], []
+    for _ in range(runs):
+        clear_all_cache()
+        with counter:
+            started = time.perf_counter()
+            run()
+            timings.append((time.perf_counter() - started) * 1000)
+        queries.append(counter.count)
+    return {
+        'median_ms': round(statistics.median(timings), 2),
+        'min_ms': round(min(timings), 2),
+        'max_ms': round(max(timings), 2),
+        'queries': int(statistics.median(queries)),
+        'samples_ms': [round(timing, 2) for timing in timings],
+    }
+
+
+def run_scenario(bench, scenario, runs, warmup, counter):
+    name, description, setup = scenario
+    result = {'scenario': name, 'description': description}
+    try:
+        run = setup(bench)
+        if run is None:
+            return {**result, 'skipped': 'no sample data (run benchmarks.datagen first)'}
+        return {**result, 'runs': runs, **measure(run, runs, warmup, counter)}
+    except BenchmarkError as e:
+        db.session.rollback()
+        return {**result, 'error': str(e)}
+
+
+def git_revision():
+    try:
+        revision = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return f'{revision}-dirty' if dirty else revision
+
+
+def dataset_summary():
+    return {model.__tablename__: model.query.count() for model in DATASET_MODELS}
+
+
+def run_suite(args):
+    app = create_app()
+    with app.app_context():
+        employee = benchmark_employee()
+        if employee is None:
+            sys.exit('No benchmark employee: generate a dataset with python -m benchmarks.datagen first')
+        meta = {
+            'revision': git_revision(),
+            'started_at': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'database': db.engine.dialect.name,
+            'runs': args.runs,
+            'warmup': args.warmup,
+            'dataset': dataset_summary(),
+        }
+        bench = Bench(app, employee)
+        counter = QueryCounter(db.engine)
+        scenarios = [scenario for scenario in SCENARIOS if not args.scenario or scenario[0] in args.scenario]
+        results = [run_scenario(bench, scenario, args.runs, args.warmup, counter) for scenario in scenarios]
+    return {'meta': meta, 'results': results}
+
+
+def print_results(report):
+    print(f"{'scenario':<26} {'median ms':>10} {'min ms':>9} {'max ms':>9} {'queries':>8}")
+    for result in report['results']:
+        if 'median_ms' not in result:
+            print(f"{result['scenario']:<26} {result.get('skipped') or 'error: ' + result['error']}")
+            continue
+        print(f"{result['scenario']:<26} {result['median_ms']:>10} {result['min_ms']:>9} {result['max_ms']:>9} {result['queries']:>8}")
+
+
+def compare(baseline, report, threshold):
+    """Print median and query count changes; returns the scenarios that regressed past ``threshold`` %"""
+    if baseline['meta'].get('dataset') != report['meta'].get('dataset'):
+        print("warning: the runs used different datasets, timings are not comparable")
+    before = {result['scenario']: result for result in baseline['results'] if 'median_ms' in result}
+    regressions = []
+    print(f"{'scenario':<26} {'base ms':>9} {'head ms':>9} {'change':>8} {'queries':>12}")
+    for result in report['results']:
+        base = before.get(result['scenario'])
+        if base is None or 'median_ms' not in result:
+            continue
+        change = (result['median_ms'] - base['median_ms']) / base['median_ms'] * 100 if base['median_ms'] else 0
+        flag = ''
+        if change > threshold:
+            regressions.append(result['scenario'])
+            flag = '  REGRESSION'
+        print(
+            f"{result['scenario']:<26} {base['median_ms']:>9} {result['median_ms']:>9} {change:>+7.1f}% "
+            f"{str(base['queries']) + ' -> ' + str(result['queries']):>12}{flag}"
+        )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5, help='Timed runs per scenario (median is reported)')
+    parser.add_argument('--warmup', type=int, default=1, help='Untimed runs before timing')
+    parser.add_argument('--scenario', action='append', help='Only run the named scenario (repeatable)')
+    parser.add_argument('--output', help='Write the results as JSON to this file')
+    parser.add_argument('--results', help='Use results from this file instead of running the suite')
+    parser.add_argument('--compare', help='Results file to compare against')
+    parser.add_argument('--threshold', type=float, default=10.0, help='Regression threshold in percent (default: 10)')
+    args = parser.parse_args()
+    if args.runs < 1 or args.warmup < 0:
+        parser.error('--runs must be positive and --warmup not negative')
+
+    if args.results:
+        with open(args.results, encoding='utf-8') as handle:
+            report = json.load(handle)
+    else:
+        report = run_suite(args)
+        print_results(report)
+        if args.output:
+            with open(args.output, 'w', encoding='utf-8') as handle:
+                json.dump(report, handle, ensure_ascii=False, indent=2)
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as handle:
+            baseline = json.load(handle)
+        if compare(baseline, report, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
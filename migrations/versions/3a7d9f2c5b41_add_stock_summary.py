@@ -0,0 +1,53 @@
+"""add the stock_summary table behind the stock and valuation reads
+
+Revision ID: 3a7d9f2c5b41
+Revises: 8f4b2c6d1e07
+Create Date: 2026-10-18 16:27:09.514382
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3a7d9f2c5b41'
+down_revision = '8f4b2c6d1e07'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'stock_summary',
+        sa.Column('item_id', sa.Integer(), sa.ForeignKey('warehouse.id', ondelete='CASCADE'), primary_key=True),
+        sa.Column('location', sa.String(length=255), primary_key=True),
+        sa.Column('on_hand_quantity', sa.Integer(), nullable=False),
+        sa.Column('fifo_quantity', sa.Integer(), nullable=False),
+        sa.Column('fifo_value', sa.Float(), nullable=False),
+        sa.Column('updated_at', sa.DateTime(), nullable=True),
+    )
+
+    # Same aggregation as stock_summary.rebuild_stock_summary(): on-hand
+    # quantities from item_locations, open FIFO layers from prices
+    op.execute("""
+        INSERT INTO stock_summary (item_id, location, on_hand_quantity, fifo_quantity, fifo_value, updated_at)
+        SELECT keys.item_id, keys.location,
+               COALESCE(on_hand.quantity, 0), COALESCE(fifo.quantity, 0), COALESCE(fifo.value, 0), now()
+        FROM (
+            SELECT item_id, location FROM item_locations
+            UNION
+            SELECT item_id, location FROM prices WHERE quantity > 0
+        ) AS keys
+        LEFT JOIN (
+            SELECT item_id, location, SUM(quantity) AS quantity
+            FROM item_locations GROUP BY item_id, location
+        ) AS on_hand ON on_hand.item_id = keys.item_id AND on_hand.location = keys.location
+        LEFT JOIN (
+            SELECT item_id, location, SUM(quantity) AS quantity, SUM(quantity * unit_price) AS value
+            FROM prices WHERE quantity > 0 GROUP BY item_id, location
+        ) AS fifo ON fifo.item_id = keys.item_id AND fifo.location = keys.location
+    """)
+
+
+def downgrade():
+    op.drop_table('stock_summary')
@@ -0,0 +1,64 @@
+"""add indexes for the FIFO and reporting hot paths
+
+Revision ID: 5c1e9a7d3b20
+Revises:
+Create Date: 2026-10-18 10:12:44.318204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5c1e9a7d3b20'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+# (index name, table, columns, partial index predicate)
+INDEXES = [
+    ('ix_prices_item_invoice', 'prices', ['item_id', 'invoice_id'], None),
+    ('ix_prices_open_layers', 'prices', ['item_id', 'location', 'invoice_id'], 'quantity > 0'),
+    ('ix_invoice_price_detail_invoice_item', 'invoice_price_detail', ['invoice_id', 'item_id'], None),
+    ('ix_invoice_price_detail_source', 'invoice_price_detail',
+     ['source_price_invoice_id', 'source_price_item_id', 'source_price_location'], None),
+    ('ix_invoice_item_item_id', 'invoice_item', ['item_id'], None),
+    ('ix_invoice_type_status_id', 'invoice', ['type', 'status', 'id'], None),
+    ('ix_return_sales_return_invoice_id', 'return_sales', ['return_invoice_id'], None),
+    ('idx_rented_items_item_status_created', 'rented_items', ['item_id', 'status', 'created_at'], None),
+]
+
+
+def _is_postgresql():
+    return op.get_bind().dialect.name == 'postgresql'
+
+
+def upgrade():
+    if not _is_postgresql():
+        for name, table, columns, where in INDEXES:
+            op.create_index(name, table, columns, if_not_exists=True)
+        return
+
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction block. Building
+    # concurrently keeps the tables writable while the indexes build; a build
+    # that fails leaves an INVALID index that has to be dropped before re-running.
+    with op.get_context().autocommit_block():
+        for name, table, columns, where in INDEXES:
+            op.create_index(
+                name, table, columns,
+                postgresql_concurrently=True,
+                postgresql_where=sa.text(where) if where else None,
+                if_not_exists=True,
+            )
+
+
+def downgrade():
+    if not _is_postgresql():
+        for name, table, columns, where in reversed(INDEXES):
+            op.drop_index(name, table_name=table, if_exists=True)
+        return
+
+    with op.get_context().autocommit_block():
+        for name, table, columns, where in reversed(INDEXES):
+            op.drop_index(name, table_name=table, postgresql_concurrently=True, if_exists=True)
@@ -0,0 +1,37 @@
+"""add the stock_changes log for warehouse delta sync
+
+Revision ID: 8f4b2c6d1e07
+Revises: 5c1e9a7d3b20
+Create Date: 2026-10-18 14:03:51.907112
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8f4b2c6d1e07'
+down_revision = '5c1e9a7d3b20'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'stock_changes',
+        sa.Column('id', sa.BigInteger(), primary_key=True),
+        sa.Column('txid', sa.BigInteger(), nullable=False, server_default=sa.text('txid_current()')),
+        sa.Column('item_id', sa.Integer(), nullable=True),
+        sa.Column('changed_at', sa.DateTime(), nullable=False),
+    )
+    op.create_index('ix_stock_changes_txid', 'stock_changes', ['txid'])
+    op.create_index('ix_stock_changes_changed_at', 'stock_changes', ['changed_at'])
+
+    # Clients syncing from before the log existed start with a full reload
+    op.execute("INSERT INTO stock_changes (item_id, changed_at) VALUES (NULL, now())")
+
+
+def downgrade():
+    op.drop_index('ix_stock_changes_changed_at', table_name='stock_changes')
+    op.drop_index('ix_stock_changes_txid', table_name='stock_changes')
+    op.drop_table('stock_changes')